@@ -12,11 +12,16 @@ import tempfile
 from urllib import urlencode
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
-from poster.streaminghttp import get_handlers
+from poster.streaminghttp import StreamingHTTPRedirectHandler
 from nxdrive.logging_config import get_logger
+from nxdrive.client.chunked_upload import ChunkedUpload
+from nxdrive.client.connection_pool import ConnectionPool
+from nxdrive.client.connection_pool import get_handlers as get_pooled_handlers
 from nxdrive.client.common import DEFAULT_IGNORED_PREFIXES
 from nxdrive.client.common import DEFAULT_IGNORED_SUFFIXES
 from nxdrive.client.common import safe_filename
+from nxdrive.client.file_io import read_chunks
+from nxdrive.client.ignore import IgnoreRules
 from nxdrive.utils import force_decode
 from urllib2 import ProxyHandler
 from urlparse import urlparse
@@ -32,8 +37,6 @@ DEVICE_DESCRIPTIONS = {
     'win32': 'Windows Desktop',
 }
 
-DEFAULT_STREAMING_BUFFER_SIZE = 4096
-
 
 def get_proxies_for_handler(proxy_settings):
     """Return a pair containing proxy string and exceptions list"""
@@ -115,6 +118,18 @@ class BaseAutomationClient(object):
     and in a Mac OS X environment proxy information is retrieved from the
     OS X System Configuration Framework.
     To disable autodetected proxy pass an empty dictionary.
+
+    The HTTP connections are kept alive in connection_pool, shared by the
+    clients of a controller, or in a pool of the client if None. The
+    contents of the files are uploaded and downloaded on the connections of
+    transfer_pool so that the transfers cannot hold all the connections
+    needed by the other calls.
+
+    Files bigger than upload_chunk_size bytes are uploaded by chunks sent by
+    upload_workers threads, resuming the interrupted uploads (see
+    chunked_upload.py), unless upload_chunk_size is None or 0. Likewise the
+    files are downloaded by ranges of download_chunk_size bytes requested by
+    download_workers threads (see ranged_download.py).
     """
     # TODO: handle system proxy detection under Linux,
     # see https://jira.nuxeo.com/browse/NXP-12068
@@ -127,14 +142,28 @@ class BaseAutomationClient(object):
 
     permission = 'ReadWrite'
 
+    upload_chunk_size = 10 * 1024 ** 2
+
+    upload_workers = 4
+
+    download_chunk_size = 10 * 1024 ** 2
+
+    download_workers = 4
+
     def __init__(self, server_url, user_id, device_id, client_version,
                  proxies=None, proxy_exceptions=None,
                  password=None, token=None, repository="default",
                  ignored_prefixes=None, ignored_suffixes=None,
-                 timeout=20, blob_timeout=None, cookie_jar=None,
-                 upload_tmp_dir=None):
+                 ignored_patterns=None, timeout=20, blob_timeout=None,
+                 cookie_jar=None, upload_tmp_dir=None, connection_pool=None,
+                 transfer_pool=None, upload_chunk_size=None,
+                 download_chunk_size=None):
         self.timeout = timeout
         self.blob_timeout = blob_timeout
+        if upload_chunk_size is not None:
+            self.upload_chunk_size = upload_chunk_size
+        if download_chunk_size is not None:
+            self.download_chunk_size = download_chunk_size
         if ignored_prefixes is not None:
             self.ignored_prefixes = ignored_prefixes
         else:
@@ -145,6 +174,10 @@ class BaseAutomationClient(object):
         else:
             self.ignored_suffixes = DEFAULT_IGNORED_SUFFIXES
 
+        self.ignore_rules = IgnoreRules(self.ignored_prefixes,
+                                        self.ignored_suffixes,
+                                        ignored_patterns or ())
+
         self.upload_tmp_dir = (upload_tmp_dir if upload_tmp_dir is not None
                                else tempfile.gettempdir())
 
@@ -169,11 +202,20 @@ class BaseAutomationClient(object):
                                           proxy_exceptions=proxy_exceptions,
                                           url=self.server_url)
 
-        # Build URL openers
-        self.opener = urllib2.build_opener(cookie_processor, proxy_handler)
-        self.streaming_opener = urllib2.build_opener(cookie_processor,
-                                                     proxy_handler,
-                                                     *get_handlers())
+        # Build URL openers sharing the kept alive connections, the request
+        # bodies being streamed by the pooled handlers
+        if connection_pool is None:
+            connection_pool = ConnectionPool()
+        if transfer_pool is None:
+            transfer_pool = ConnectionPool()
+        self.connection_pool = connection_pool
+        self.transfer_pool = transfer_pool
+        self.opener = urllib2.build_opener(
+            cookie_processor, proxy_handler,
+            *get_pooled_handlers(connection_pool))
+        self.streaming_opener = urllib2.build_opener(
+            cookie_processor, proxy_handler, StreamingHTTPRedirectHandler,
+            *get_pooled_handlers(transfer_pool))
 
         # Set Proxy flag
         self.is_proxy = False
@@ -372,8 +414,19 @@ class BaseAutomationClient(object):
                                     mime_type=None, **params):
         """Execute an Automation operation using a batch upload as an input
 
-        Upload is streamed.
+        Upload is streamed, by chunks for big files.
         """
+        if (self.upload_chunk_size
+                and os.path.getsize(file_path) > self.upload_chunk_size):
+            upload = ChunkedUpload(self, file_path, filename=filename,
+                                   mime_type=mime_type)
+            batch_id = upload.run()
+            if batch_id is not None:
+                result = self.execute_batch(command, batch_id, '0', **params)
+                upload.clear()
+                return result
+            # Not supported by the server, do not try again
+            self.upload_chunk_size = None
         batch_id = self._generate_unique_id()
         upload_result = self.upload(batch_id, file_path, filename=filename,
                                     mime_type=mime_type)
@@ -390,10 +443,33 @@ class BaseAutomationClient(object):
         Uses poster.httpstreaming to stream the upload
         and not load the whole file in memory.
         """
-        # Request URL
-        url = self.automation_url.encode('ascii') + self.batch_upload_url
+        headers = self._get_upload_headers(batch_id, file_path, filename,
+                                           file_index, mime_type)
 
-        # HTTP headers
+        # Request data, streamed with a buffer size adapted to the file size
+        data = read_chunks(file_path)
+        return self._send_upload(file_path, headers, data)
+
+    def upload_chunk(self, batch_id, file_path, chunk_index, chunk_count,
+                     offset, length, filename=None, file_index=0,
+                     mime_type=None):
+        """Upload the length bytes of a file starting at offset as a chunk
+
+        The response tells which chunks of the file the server has.
+        """
+        headers = self._get_upload_headers(batch_id, file_path, filename,
+                                           file_index, mime_type)
+        headers.update({
+            "X-Upload-Type": "chunked",
+            "X-Upload-Chunk-Index": chunk_index,
+            "X-Upload-Chunk-Count": chunk_count,
+            "Content-Length": length,
+        })
+        data = read_chunks(file_path, offset=offset, length=length)
+        return self._send_upload(file_path, headers, data)
+
+    def _get_upload_headers(self, batch_id, file_path, filename=None,
+                            file_index=0, mime_type=None):
         if filename is None:
             filename = os.path.basename(file_path)
         file_size = os.path.getsize(file_path)
@@ -417,19 +493,10 @@ class BaseAutomationClient(object):
             "Content-Length": file_size,
         }
         headers.update(self._get_common_headers())
+        return headers
 
-        # Request data
-        input_file = open(file_path, 'rb')
-        # Use file system block size if available for streaming buffer
-        if sys.platform != 'win32':
-            fs_block_size = os.fstatvfs(input_file.fileno()).f_bsize
-        else:
-            fs_block_size = DEFAULT_STREAMING_BUFFER_SIZE
-        log.trace("Using file system block size"
-                  " for the streaming upload buffer: %u bytes", fs_block_size)
-        data = self._read_data(input_file, fs_block_size)
-
-        # Execute request
+    def _send_upload(self, file_path, headers, data):
+        url = self.automation_url.encode('ascii') + self.batch_upload_url
         cookies = self._get_cookies()
         log.trace("Calling %s with headers %r and cookies %r for file %s",
             url, headers, cookies, file_path)
@@ -440,7 +507,7 @@ class BaseAutomationClient(object):
             self._log_details(e)
             raise
         finally:
-            input_file.close()
+            data.close()
 
         return self._read_response(resp, url)
 
@@ -602,10 +669,3 @@ class BaseAutomationClient(object):
         """Generate a unique id based on a timestamp and a random integer"""
 
         return str(time.time()) + '_' + str(random.randint(0, 1000000000))
-
-    def _read_data(self, file_object, buffer_size):
-        while True:
-            r = file_object.read(buffer_size)
-            if not r:
-                break
-            yield r
@@ -0,0 +1,197 @@
+"""Chunked and resumable uploads through Automation batches
+
+A big file is split in chunks sent concurrently to the batch upload
+endpoint with the X-Upload-Type: chunked headers, each chunk being retried
+on its own after a network or server error. The chunks acknowledged by the
+server are recorded in a state file of the upload temporary folder so that
+an upload interrupted by an error or by a restart of the process goes on
+with the missing chunks of the same batch.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from nxdrive.client.transfer import is_transient_error
+from nxdrive.client.transfer import run_concurrently
+from nxdrive.client.transfer import save_json
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+class UploadState(object):
+    """Chunks of a file acknowledged by the server for a batch
+
+    A saved state is only valid for the same file size, modification time
+    and chunk size, and for max_age seconds as the server eventually cleans
+    up the batches that are not executed.
+    """
+
+    # In seconds
+    max_age = 24 * 3600
+
+    def __init__(self, path, batch_id, file_size, mtime, chunk_size,
+                 uploaded=None, created=None):
+        self.path = path
+        self.batch_id = batch_id
+        self.file_size = file_size
+        self.mtime = mtime
+        self.chunk_size = chunk_size
+        self.uploaded = set(uploaded or ())
+        self.created = created if created is not None else time.time()
+
+    @property
+    def chunk_count(self):
+        return max(1, (self.file_size + self.chunk_size - 1)
+                   // self.chunk_size)
+
+    def get_missing(self):
+        return [index for index in range(self.chunk_count)
+                if index not in self.uploaded]
+
+    @staticmethod
+    def get_path(folder, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(folder, 'nxdrive-upload-%s.json' % digest)
+
+    @classmethod
+    def load(cls, path, file_size, mtime, chunk_size):
+        """Return the state saved in path if still valid, None otherwise"""
+        try:
+            with open(path, 'rb') as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return None
+        state = cls(path, saved.get('batch_id'), saved.get('file_size'),
+                    saved.get('mtime'), saved.get('chunk_size'),
+                    uploaded=saved.get('uploaded'),
+                    created=saved.get('created'))
+        if (state.batch_id is None or state.file_size != file_size
+                or state.mtime != mtime or state.chunk_size != chunk_size
+                or time.time() - state.created > cls.max_age):
+            log.debug("Discarding outdated upload state %s", path)
+            state.remove()
+            return None
+        return state
+
+    def save(self):
+        save_json(self.path, {
+            'batch_id': self.batch_id,
+            'file_size': self.file_size,
+            'mtime': self.mtime,
+            'chunk_size': self.chunk_size,
+            'uploaded': sorted(self.uploaded),
+            'created': self.created,
+        })
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class ChunkedUpload(object):
+    """Upload of a file by chunks to a new or resumed batch
+
+    run returns the id of the batch holding the uploaded file as index 0, or
+    None if the server does not support chunked uploads. clear must be
+    called once the batch has been executed.
+
+    The first missing chunk, or the last one if none is missing, is sent
+    alone: the response tells whether the server supports chunked uploads
+    and, when resuming, which chunks the server still has. The other ones
+    are then sent by workers threads, a chunk being sent up to
+    max_chunk_attempts times if the errors are transient.
+    """
+
+    max_chunk_attempts = 3
+
+    # In seconds, multiplied by the number of the attempt
+    retry_delay = 1
+
+    def __init__(self, client, file_path, filename=None, mime_type=None,
+                 chunk_size=None, workers=None):
+        self.client = client
+        self.file_path = file_path
+        self.filename = filename
+        self.mime_type = mime_type
+        self.chunk_size = chunk_size or client.upload_chunk_size
+        self.workers = workers or client.upload_workers
+        self._lock = threading.Lock()
+
+        stat = os.stat(file_path)
+        key = u'\n'.join((client.server_url, client.user_id,
+                          os.path.abspath(file_path), filename or u''))
+        path = UploadState.get_path(client.upload_tmp_dir, key)
+        self.state = UploadState.load(path, stat.st_size, stat.st_mtime,
+                                      self.chunk_size)
+        if self.state is None:
+            self.state = UploadState(path, client._generate_unique_id(),
+                                     stat.st_size, stat.st_mtime,
+                                     self.chunk_size)
+
+    def run(self):
+        state = self.state
+        missing = state.get_missing()
+        if state.uploaded:
+            log.debug("Resuming upload of %s to batch %s: %d/%d chunks"
+                      " missing", self.file_path, state.batch_id,
+                      len(missing), state.chunk_count)
+        index = missing[0] if missing else state.chunk_count - 1
+        response = self._send_chunk(index)
+        if (not isinstance(response, dict)
+                or response.get('uploadType') != 'chunked'):
+            log.debug("Chunked upload not supported by %s",
+                      self.client.server_url)
+            self.clear()
+            return None
+        self._acknowledge(index, response, reset=True)
+
+        missing = state.get_missing()
+        if missing:
+            self._send_chunks(missing)
+        return state.batch_id
+
+    def clear(self):
+        self.state.remove()
+
+    def _acknowledge(self, index, response, reset=False):
+        uploaded = set(int(i) for i in response.get('uploadedChunkIds') or ())
+        uploaded.add(index)
+        with self._lock:
+            if reset:
+                self.state.uploaded = uploaded
+            else:
+                self.state.uploaded.update(uploaded)
+            self.state.save()
+
+    def _send_chunks(self, indexes):
+        # The acknowledged chunks are kept for the next attempt on error
+        run_concurrently(
+            lambda index: self._acknowledge(index, self._send_chunk(index)),
+            indexes, self.workers, "ChunkedUpload")
+
+    def _send_chunk(self, index):
+        state = self.state
+        offset = index * state.chunk_size
+        length = min(state.chunk_size, state.file_size - offset)
+        attempt = 1
+        while True:
+            try:
+                return self.client.upload_chunk(
+                    state.batch_id, self.file_path, index, state.chunk_count,
+                    offset, length, filename=self.filename,
+                    mime_type=self.mime_type)
+            except Exception as e:
+                if (attempt >= self.max_chunk_attempts
+                        or not is_transient_error(e)):
+                    raise
+                log.debug("Sending chunk %d/%d of %s again after %r", index,
+                          state.chunk_count, self.file_path, e)
+                time.sleep(self.retry_delay * attempt)
+                attempt += 1
@@ -0,0 +1,365 @@
+"""Persistent HTTP connections shared by the urllib2 openers"""
+
+import errno
+import httplib
+import select
+import socket
+import sys
+import threading
+import time
+import urllib2
+
+from poster.streaminghttp import StreamingHTTPConnection
+
+from nxdrive.logging_config import get_logger
+
+try:
+    from poster.streaminghttp import StreamingHTTPSConnection
+except ImportError:
+    # Python built without SSL support
+    StreamingHTTPSConnection = None
+
+
+log = get_logger(__name__)
+
+
+# Errors of a request sent on a kept alive connection closed by the server
+# in the mean time, before the response status could be read
+STALE_CONNECTION_ERRORS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
+class ConnectionPool(object):
+    """Kept alive HTTP connections by host, shared between threads
+
+    At most max_per_host connections are open for a given host, idle or
+    serving a request: a request waits for a connection to be given back
+    beyond that, for the timeout of the request if any. The connections
+    idle for more than idle_timeout seconds are closed when the pool is
+    used.
+
+    created and reused count the connections opened and the requests sent
+    on a kept alive connection.
+    """
+
+    max_per_host = 8
+
+    idle_timeout = 60
+
+    def __init__(self, max_per_host=None, idle_timeout=None):
+        if max_per_host is not None:
+            self.max_per_host = max_per_host
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        self._condition = threading.Condition()
+        # Idle connections by key, the most recently used last
+        self._idle = dict()
+        # Number of open connections by key, idle or not
+        self._open = dict()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, key, factory, timeout=None):
+        """Return an idle connection for key or a new one built by factory
+
+        Return a tuple of the connection and whether it has already been
+        used. Raise URLError if no connection is given back in time when
+        max_per_host connections are open.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            stale = self._reap()
+            while True:
+                idle = self._idle.get(key)
+                while idle:
+                    connection, _ = idle.pop()
+                    if _is_dropped(connection):
+                        stale.append(connection)
+                        self._open[key] -= 1
+                        continue
+                    self.reused += 1
+                    _close_all(stale)
+                    return connection, True
+                if self._open.get(key, 0) < self.max_per_host:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    break
+                remaining = (deadline - time.time()
+                             if deadline is not None else None)
+                if remaining is not None and remaining <= 0:
+                    _close_all(stale)
+                    raise urllib2.URLError(
+                        "Timed out waiting for one of the %d connections to"
+                        " %s" % (self.max_per_host, key[1]))
+                self._condition.wait(remaining)
+        _close_all(stale)
+        try:
+            connection = factory()
+        except:
+            self._forget(key)
+            raise
+        with self._condition:
+            self.created += 1
+        return connection, False
+
+    def release(self, key, connection, reusable=True):
+        """Give a connection back, closing it if not reusable"""
+        if reusable and connection.sock is not None:
+            with self._condition:
+                self._idle.setdefault(key, []).append(
+                    (connection, time.time()))
+                self._condition.notify()
+            return
+        connection.close()
+        self._forget(key)
+
+    def clear(self):
+        """Close the idle connections"""
+        with self._condition:
+            connections = [connection for idle in self._idle.values()
+                           for connection, _ in idle]
+            for key, idle in self._idle.items():
+                self._open[key] -= len(idle)
+            self._idle.clear()
+            self._condition.notify_all()
+        _close_all(connections)
+
+    def _forget(self, key):
+        with self._condition:
+            self._open[key] -= 1
+            self._condition.notify()
+
+    def _reap(self):
+        # Called with the condition acquired, the connections to close being
+        # returned to be closed once released
+        expired = []
+        limit = time.time() - self.idle_timeout
+        for key, idle in self._idle.items():
+            while idle and idle[0][1] < limit:
+                expired.append(idle.pop(0)[0])
+                self._open[key] -= 1
+        if expired:
+            log.trace("Closing %d idle HTTP connections", len(expired))
+        return expired
+
+
+def _is_dropped(connection):
+    """Check whether the server closed an idle connection
+
+    An idle kept alive connection is not readable unless closed.
+    """
+    if connection.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([connection.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+def _close_all(connections):
+    for connection in connections:
+        connection.close()
+
+
+class PooledResponse(httplib.HTTPResponse):
+    """Response giving its connection back to the pool once read
+
+    The connection is reusable if the whole body has been read and the
+    server keeps it alive, otherwise it is closed.
+    """
+
+    _release = None
+
+    _reading = False
+
+    def read(self, amt=None):
+        self._reading = True
+        try:
+            data = httplib.HTTPResponse.read(self, amt)
+        except:
+            self._reading = False
+            self._give_back(False)
+            raise
+        self._reading = False
+        if self.fp is None:
+            # Closed by read at the end of the body
+            self._give_back(not self.will_close and not self.length)
+        return data
+
+    def close(self):
+        httplib.HTTPResponse.close(self)
+        if not self._reading:
+            # Closed before the end of the body
+            self._give_back(False)
+
+    def _give_back(self, reusable):
+        release, self._release = self._release, None
+        if release is not None:
+            release(reusable)
+
+
+class _PooledHandlerMixin(object):
+    """Open the requests on the connections of a ConnectionPool
+
+    The request bodies can be files or iterables as for the poster
+    streaming handlers. A request failing on a reused connection closed by
+    the server in the mean time is sent again on a new connection if its
+    body can be read again.
+    """
+
+    def _pooled_open(self, connection_class, scheme, req, **kwargs):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (scheme, host, req._tunnel_host)
+        timeout = req.timeout
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers["Connection"] = "keep-alive"
+        headers = dict(
+            (name.title(), val) for name, val in headers.items())
+        tunnel_headers = {}
+        if req._tunnel_host and "Proxy-Authorization" in headers:
+            # Proxy-Authorization should not be sent to the origin server
+            tunnel_headers["Proxy-Authorization"] = headers.pop(
+                "Proxy-Authorization")
+
+        def factory():
+            connection = connection_class(host, timeout=timeout, **kwargs)
+            connection.set_debuglevel(self._debuglevel)
+            connection.response_class = PooledResponse
+            if req._tunnel_host:
+                connection.set_tunnel(req._tunnel_host,
+                                      headers=tunnel_headers)
+            return connection
+
+        while True:
+            connection, reused = self.pool.acquire(key, factory,
+                                                   timeout=timeout)
+            try:
+                response = self._send(connection, req, headers, timeout)
+            except:
+                exc_info = sys.exc_info()
+                self.pool.release(key, connection, reusable=False)
+                if (reused and _is_stale_error(exc_info[1])
+                        and _can_resend(req.data)):
+                    log.trace("Sending %s again on a new connection after"
+                              " %r", req.get_full_url(), exc_info[1])
+                    continue
+                raise exc_info[0], exc_info[1], exc_info[2]
+            break
+
+        response._release = (lambda reusable:
+                             self.pool.release(key, connection, reusable))
+
+        # As urllib2.AbstractHTTPHandler.do_open
+        response.recv = response.read
+        fp = socket._fileobject(response, close=True)
+        resp = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+    def _send(self, connection, req, headers, timeout):
+        connection.timeout = timeout
+        try:
+            if connection.sock is None:
+                connection.connect()
+                # The headers and the body are sent by separate writes: do
+                # not wait for the acknowledgment of the previous response
+                connection.sock.setsockopt(socket.IPPROTO_TCP,
+                                           socket.TCP_NODELAY, 1)
+            else:
+                # The timeout differs between the requests sent on a
+                # connection
+                connection.sock.settimeout(timeout)
+            connection.request(req.get_method(), req.get_selector(),
+                               req.data, headers)
+        except socket.error as e:
+            raise urllib2.URLError(e)
+        try:
+            return connection.getresponse(buffering=True)
+        except TypeError:
+            # buffering keyword not supported
+            return connection.getresponse()
+
+    def _check_body(self, req):
+        # As the poster streaming handlers
+        if req.has_data():
+            data = req.get_data()
+            if hasattr(data, 'read') or hasattr(data, 'next'):
+                if not req.has_header('Content-length'):
+                    raise ValueError(
+                        "No Content-Length specified for iterable body")
+
+
+def _is_stale_error(error):
+    if isinstance(error, urllib2.URLError):
+        error = error.reason
+    if isinstance(error, httplib.BadStatusLine):
+        # No status line: closed by the server without response
+        return True
+    return getattr(error, 'errno', None) in STALE_CONNECTION_ERRORS
+
+
+def _can_resend(data):
+    """Check whether a request body can be sent again from its start"""
+    if data is None or isinstance(data, basestring):
+        return True
+    if hasattr(data, 'read'):
+        return hasattr(data, 'seek')
+    return hasattr(data, 'reset')
+
+
+class PooledHTTPHandler(_PooledHandlerMixin, urllib2.HTTPHandler):
+    """HTTP handler keeping the connections of a ConnectionPool alive"""
+
+    def __init__(self, pool, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self._pooled_open(StreamingHTTPConnection, 'http', req)
+
+    def http_request(self, req):
+        self._check_body(req)
+        return urllib2.HTTPHandler.do_request_(self, req)
+
+
+if StreamingHTTPSConnection is not None:
+
+    class PooledHTTPSHandler(_PooledHandlerMixin, urllib2.HTTPSHandler):
+        """HTTPS handler keeping the connections of a ConnectionPool alive
+
+        The TLS session of a connection is kept along with it.
+        """
+
+        def __init__(self, pool, debuglevel=0):
+            urllib2.HTTPSHandler.__init__(self, debuglevel)
+            self.pool = pool
+
+        def https_open(self, req):
+            kwargs = {}
+            context = getattr(self, '_context', None)
+            if context is not None:
+                kwargs['context'] = context
+            return self._pooled_open(StreamingHTTPSConnection, 'https', req,
+                                     **kwargs)
+
+        def https_request(self, req):
+            self._check_body(req)
+            return urllib2.HTTPSHandler.do_request_(self, req)
+
+else:
+    PooledHTTPSHandler = None
+
+
+def get_handlers(pool):
+    """Handlers opening the HTTP(S) requests on the connections of pool"""
+    handlers = [PooledHTTPHandler(pool)]
+    if PooledHTTPSHandler is not None:
+        handlers.append(PooledHTTPSHandler(pool))
+    return handlers
@@ -0,0 +1,180 @@
+"""Shared file reading layer for hashing and uploads
+
+Files are read sequentially by chunks whose size is adapted to the size of
+the file. The operating system is told about the sequential access and, for
+large files, the pages that have been read are dropped from the page cache
+so that synchronizing huge files does not evict the files the user is
+working with.
+
+Reading through mmap is available but not enabled by default: a file
+truncated by another process while being mapped kills the process with a
+SIGBUS signal, which cannot be handled from Python.
+"""
+
+import io
+import mmap
+import os
+import sys
+
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Bounds of the adaptive buffer size
+MIN_BUFFER_SIZE = 64 * 1024
+MAX_BUFFER_SIZE = 8 * 1024 ** 2
+
+# Files bigger than that are dropped from the page cache once read
+DROP_CACHE_THRESHOLD = 64 * 1024 ** 2
+
+# Default reading mode for files bigger than MIN_BUFFER_SIZE
+USE_MMAP = False
+
+# Constants from <fcntl.h> under Linux
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+
+def _load_fadvise():
+    """Return a posix_fadvise(fd, offset, length, advice) function or None"""
+    if hasattr(os, 'posix_fadvise'):
+        return os.posix_fadvise
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        fadvise = getattr(libc, 'posix_fadvise64', None)
+        if fadvise is None:
+            fadvise = libc.posix_fadvise
+        fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                            ctypes.c_int]
+        fadvise.restype = ctypes.c_int
+        return fadvise
+    except (ImportError, OSError, AttributeError):
+        return None
+
+
+_fadvise = _load_fadvise()
+
+
+def advise(fd, offset, length, advice):
+    """Give an access pattern hint to the OS, ignored if not supported"""
+    if _fadvise is None:
+        return
+    try:
+        _fadvise(fd, offset, length, advice)
+    except OSError:
+        # Advices are only hints
+        pass
+
+
+def get_buffer_size(file_size):
+    """Return a buffer size adapted to the size of the file to read
+
+    Small files are read at once while bigger files are read by chunks of
+    about 1/64th of their size, rounded to a power of 2 and bounded by
+    MIN_BUFFER_SIZE and MAX_BUFFER_SIZE.
+    """
+    if file_size <= MIN_BUFFER_SIZE:
+        return MIN_BUFFER_SIZE
+    buffer_size = MIN_BUFFER_SIZE
+    while buffer_size * 64 < file_size and buffer_size < MAX_BUFFER_SIZE:
+        buffer_size *= 2
+    return buffer_size
+
+
+def read_chunks(filepath, buffer_size=None, reuse_buffer=False,
+                use_mmap=None, drop_cache=None, offset=0, length=None):
+    """Yield the content of a file by chunks
+
+    If reuse_buffer is True, the chunks are read into the same buffer and
+    are memoryview or buffer objects that are only valid until the next
+    chunk is requested: suitable for hashing without copying the data.
+
+    use_mmap and drop_cache default to USE_MMAP and to whether the file is
+    bigger than DROP_CACHE_THRESHOLD.
+
+    If length is given, only the length bytes starting at offset are read,
+    e.g. for a chunk of an upload.
+    """
+    with io.open(filepath, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        file_size = os.fstat(fd).st_size
+        size = file_size - offset
+        if length is not None:
+            size = min(size, length)
+        if buffer_size is None:
+            buffer_size = get_buffer_size(size)
+        if use_mmap is None:
+            use_mmap = USE_MMAP
+        if drop_cache is None:
+            drop_cache = file_size > DROP_CACHE_THRESHOLD
+        advise(fd, offset, 0 if length is None else size,
+               POSIX_FADV_SEQUENTIAL)
+
+        if (use_mmap and size > MIN_BUFFER_SIZE
+                and offset % mmap.ALLOCATIONGRANULARITY == 0):
+            chunks = _read_mmap_chunks(fd, offset, offset + size,
+                                       buffer_size, reuse_buffer)
+        else:
+            if offset:
+                f.seek(offset)
+            chunks = _read_file_chunks(f, None if length is None else size,
+                                       buffer_size, reuse_buffer)
+        position = offset
+        for chunk in chunks:
+            yield chunk
+            position += len(chunk)
+            if drop_cache:
+                # Pages that have been read are not needed any more
+                advise(fd, offset, position - offset, POSIX_FADV_DONTNEED)
+
+
+def _read_file_chunks(f, size, buffer_size, reuse_buffer):
+    # Read up to size bytes, or up to the end of the file if None
+    if not reuse_buffer or (size is not None and size < buffer_size):
+        # Not worth allocating a buffer to read a small file at once
+        while size is None or size > 0:
+            chunk = f.read(buffer_size if size is None
+                           else min(buffer_size, size))
+            if not chunk:
+                return
+            if size is not None:
+                size -= len(chunk)
+            yield chunk
+        return
+    buffer_ = bytearray(buffer_size)
+    view = memoryview(buffer_)
+    while size is None or size > 0:
+        if size is None or size >= buffer_size:
+            length = f.readinto(buffer_)
+        else:
+            length = f.readinto(view[:size])
+        if not length:
+            return
+        if size is not None:
+            size -= length
+        yield view[:length]
+
+
+def _read_mmap_chunks(fd, offset, end, buffer_size, reuse_buffer):
+    # Map the file by windows so that the pages can be released, window
+    # offsets have to be multiples of the allocation granularity
+    granularity = mmap.ALLOCATIONGRANULARITY
+    window_size = max(granularity, buffer_size - buffer_size % granularity)
+    while offset < end:
+        length = min(window_size, end - offset)
+        window = mmap.mmap(fd, length, access=mmap.ACCESS_READ, offset=offset)
+        try:
+            if reuse_buffer:
+                yield buffer(window)
+            else:
+                yield window[:]
+        finally:
+            window.close()
+        offset += length
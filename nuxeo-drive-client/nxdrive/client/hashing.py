@@ -0,0 +1,149 @@
+"""Background computation of the digests of local files"""
+
+import hashlib
+import threading
+from Queue import Queue
+
+from nxdrive.client.file_io import read_chunks
+from nxdrive.logging_config import get_logger
+from nxdrive.utils import safe_long_path
+
+
+log = get_logger(__name__)
+
+
+def compute_digests(filepath, digest_funcs):
+    """Compute several digests of a file reading its content only once"""
+    digesters = []
+    for digest_func in digest_funcs:
+        digester = getattr(hashlib, digest_func, None)
+        if digester is None:
+            raise ValueError('Unknow digest method: ' + digest_func)
+        digesters.append((digest_func, digester()))
+
+    for chunk in read_chunks(safe_long_path(filepath), reuse_buffer=True):
+        for _, h in digesters:
+            h.update(chunk)
+    return dict((digest_func, h.hexdigest()) for digest_func, h in digesters)
+
+
+class _HashingJob(object):
+
+    def __init__(self, version, filepath, digest_funcs):
+        self.version = version
+        self.filepath = filepath
+        self.digest_funcs = digest_funcs
+        self.digests = None
+        self.error = None
+
+    def is_done(self):
+        return self.digests is not None or self.error is not None
+
+
+class HashingService(object):
+    """Pool of threads computing the digests of local files
+
+    hashlib releases the GIL while hashing large buffers hence several files
+    can be hashed concurrently without blocking the synchronization thread.
+
+    Jobs are identified by a key chosen by the caller (typically the bound
+    folder and the path of the file) and a version of the file (typically its
+    size, modification time and inode) so that a result is never used for
+    another version of the file content.
+
+    The digest_funcs algorithms are always computed along with the requested
+    one during the same read of the file.
+    """
+
+    def __init__(self, workers=2, digest_funcs=('md5',)):
+        self.workers = workers
+        self.digest_funcs = tuple(digest_funcs)
+        self._queue = Queue()
+        self._jobs = dict()
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def get_digests(self, key, version, filepath, digest_func, wait=True):
+        """Return the digests of the file by algorithm
+
+        If wait is False and the digests have not been computed yet, schedule
+        their computation and return None: the digest is pending. Raise
+        IOError if the file cannot be read.
+        """
+        digest_funcs = set(self.digest_funcs)
+        digest_funcs.add(digest_func)
+        with self._condition:
+            job = self._jobs.get(key)
+            if job is not None and (job.version != version
+                                    or digest_func not in job.digest_funcs):
+                # Obsolete job: its result will be ignored
+                del self._jobs[key]
+                job = None
+            if job is None:
+                if wait or self.workers < 1:
+                    job = None
+                else:
+                    job = _HashingJob(version, filepath, digest_funcs)
+                    self._jobs[key] = job
+                    self._ensure_started()
+                    self._queue.put((key, job))
+                    return None
+            else:
+                while not job.is_done():
+                    if not wait:
+                        return None
+                    self._condition.wait()
+                del self._jobs[key]
+
+        if job is None:
+            # Compute the digests from the calling thread
+            return compute_digests(filepath, digest_funcs)
+        if job.error is not None:
+            raise job.error
+        return job.digests
+
+    def is_pending(self, key):
+        """Return True if the digests of the file are being computed"""
+        with self._condition:
+            job = self._jobs.get(key)
+            return job is not None and not job.is_done()
+
+    def stop(self):
+        """Stop the worker threads and forget the scheduled jobs"""
+        with self._condition:
+            self._jobs.clear()
+            for _ in self._threads:
+                self._queue.put(None)
+            del self._threads[:]
+
+    def _ensure_started(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(
+                target=self._work,
+                name="HashingService-%d" % len(self._threads))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            key, job = item
+            with self._condition:
+                if self._jobs.get(key) is not job:
+                    # Obsolete job
+                    continue
+            try:
+                digests, error = compute_digests(job.filepath,
+                                                 job.digest_funcs), None
+            except (IOError, OSError) as e:
+                digests, error = None, e
+            except Exception as e:
+                log.error("Unexpected error while hashing %r", job.filepath,
+                          exc_info=True)
+                digests, error = None, e
+            with self._condition:
+                job.digests, job.error = digests, error
+                self._condition.notify_all()
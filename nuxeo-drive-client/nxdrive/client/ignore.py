@@ -0,0 +1,199 @@
+"""Rules telling which local files and folders are not synchronized
+
+Rules are compiled into regular expressions so that checking a name costs a
+single match whatever the number of rules. They come from:
+
+- the default ignored prefixes and suffixes (hidden files, editor buffers,
+  locks, ...),
+- global patterns (from the command line or the IGNORE_FILE_NAME file of the
+  configuration folder),
+- the IGNORE_FILE_NAME file of each synchronized folder, applying to the
+  content of this folder and of its descendants.
+
+Ignore files hold one pattern per line, blank lines and lines starting with
+'#' being skipped:
+
+- a glob pattern without any '/' matches the names at any depth, for
+  instance '*.tmp' or 'node_modules',
+- a glob pattern with a '/' matches the paths relative to the folder of the
+  ignore file, for instance '/build' or 'doc/_build', '**' matching any
+  number of folders,
+- a trailing '/' restricts the pattern to folders, for instance 'build/',
+- a 're:' prefix introduces a regular expression that has to match the whole
+  name, for instance 're:.*\\.(o|pyc)'.
+
+Ignored folders are never listed, hence their content is neither scanned nor
+hashed. Ignoring a file or folder that has already been synchronized does not
+delete it remotely: its pair is marked as unsynchronized and left untouched.
+"""
+
+import re
+
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+IGNORE_FILE_NAME = u'.nxdriveignore'
+
+REGEX_PREFIX = u're:'
+
+
+def glob_to_regex(pattern):
+    """Translate a glob pattern into a regular expression without anchors
+
+    Unlike fnmatch, wildcards do not match the '/' separator except '**'.
+    """
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == u'*':
+            if pattern[i:i + 1] == u'*':
+                i += 1
+                if pattern[i:i + 1] == u'/':
+                    # '**/' matches zero or more folders
+                    i += 1
+                    res.append(u'(?:.*/)?')
+                else:
+                    res.append(u'.*')
+            else:
+                res.append(u'[^/]*')
+        elif c == u'?':
+            res.append(u'[^/]')
+        elif c == u'[':
+            j = i
+            if pattern[j:j + 1] in (u'!', u']'):
+                j += 1
+            while j < n and pattern[j] != u']':
+                j += 1
+            if j >= n:
+                res.append(u'\\[')
+            else:
+                chars = pattern[i:j].replace(u'\\', u'\\\\')
+                if chars.startswith(u'!'):
+                    chars = u'^' + chars[1:]
+                res.append(u'[%s]' % chars)
+                i = j + 1
+        else:
+            res.append(re.escape(c))
+    return u''.join(res)
+
+
+def parse_patterns(lines, base_path=u'/'):
+    """Parse the lines of an ignore file into rules
+
+    Rules are (target, regex, folders_only) tuples where target is 'name' if
+    the regex matches names and 'path' if it matches absolute paths.
+    """
+    if not base_path.endswith(u'/'):
+        base_path += u'/'
+    rules = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith(u'#'):
+            continue
+        if line.startswith(REGEX_PREFIX):
+            regex = line[len(REGEX_PREFIX):]
+            # Fail early on invalid expressions
+            re.compile(regex)
+            rules.append(('name', regex, False))
+            continue
+        folders_only = line.endswith(u'/')
+        line = line.rstrip(u'/')
+        if not line:
+            continue
+        if u'/' in line:
+            regex = re.escape(base_path) + glob_to_regex(line.lstrip(u'/'))
+            rules.append(('path', regex, folders_only))
+        else:
+            rules.append(('name', glob_to_regex(line), folders_only))
+    return rules
+
+
+def read_patterns(os_path):
+    """Return the valid patterns of an ignore file, [] if it cannot be read
+
+    A broken ignore file should not prevent the synchronization: invalid
+    lines are logged and skipped.
+    """
+    try:
+        with open(os_path, 'rb') as f:
+            content = f.read()
+    except (IOError, OSError):
+        return []
+    try:
+        lines = content.decode('utf-8').splitlines()
+    except UnicodeDecodeError:
+        log.warning("Ignore file %r is not encoded in UTF-8", os_path)
+        return []
+    patterns = []
+    for line in lines:
+        try:
+            parse_patterns([line])
+        except re.error as e:
+            log.warning("Invalid pattern %r in %r: %s", line, os_path, e)
+            continue
+        patterns.append(line)
+    return patterns
+
+
+def read_ignore_file(os_path, base_path=u'/'):
+    """Parse the rules of an ignore file applying to the base_path folder"""
+    return parse_patterns(read_patterns(os_path), base_path=base_path)
+
+
+class IgnoreRules(object):
+    """Compiled set of ignore rules
+
+    Instances are immutable: extend returns the rules of a sub-folder that
+    has its own ignore file.
+    """
+
+    def __init__(self, prefixes=(), suffixes=(), patterns=(), rules=None):
+        if rules is None:
+            rules = []
+            for prefix in prefixes:
+                rules.append(('name', re.escape(prefix) + u'.*', False))
+            for suffix in suffixes:
+                rules.append(('name', u'.*' + re.escape(suffix), False))
+            rules.extend(parse_patterns(patterns))
+        self.rules = tuple(rules)
+        self._name_regex = self._compile('name', False)
+        self._path_regex = self._compile('path', False)
+        self._folder_name_regex = self._compile('name', True)
+        self._folder_path_regex = self._compile('path', True)
+
+    def _compile(self, target, folders_only):
+        regexes = [regex for t, regex, f in self.rules
+                   if t == target and f == folders_only]
+        if not regexes:
+            return None
+        return re.compile(u'|'.join(u'(?:%s)\\Z' % r for r in regexes),
+                          re.DOTALL)
+
+    def extend(self, rules):
+        """Return new rules with the additional parsed rules"""
+        if not rules:
+            return self
+        return IgnoreRules(rules=self.rules + tuple(rules))
+
+    def is_ignored(self, name, path=None, folderish=False):
+        """Return True if the file or folder should not be synchronized
+
+        Path rules are only checked if the absolute path is provided.
+        """
+        if self._name_regex is not None and self._name_regex.match(name):
+            return True
+        if (path is not None and self._path_regex is not None
+            and self._path_regex.match(path)):
+            return True
+        if not folderish:
+            return False
+        if (self._folder_name_regex is not None
+            and self._folder_name_regex.match(name)):
+            return True
+        return (path is not None and self._folder_path_regex is not None
+                and self._folder_path_regex.match(path) is not None)
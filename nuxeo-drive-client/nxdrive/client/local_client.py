@@ -2,9 +2,9 @@
 
 import unicodedata
 from datetime import datetime
-import hashlib
 import os
 import shutil
+import stat
 import re
 
 from nxdrive.logging_config import get_logger
@@ -12,16 +12,32 @@ from nxdrive.client.common import safe_filename
 from nxdrive.client.common import NotFound
 from nxdrive.client.common import DEFAULT_IGNORED_PREFIXES
 from nxdrive.client.common import DEFAULT_IGNORED_SUFFIXES
+from nxdrive.client.ignore import IgnoreRules
+from nxdrive.client.ignore import IGNORE_FILE_NAME
+from nxdrive.client.ignore import read_ignore_file
 from nxdrive.utils import normalized_path
 from nxdrive.utils import safe_long_path
-from nxdrive.client.common import BUFFER_SIZE
+from nxdrive.client.hashing import compute_digests
 
 
 log = get_logger(__name__)
 
+try:
+    # Directory listing that also collects the type of the children and, under
+    # Windows, their stat info from a single directory read
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 DEDUPED_BASENAME_PATTERN = ur'^(.*)__(\d{1,3})$'
 
+# Marker of an ignore file whose stat info has not been read yet
+_UNKNOWN = object()
+
 
 # Data transfer objects
 
@@ -29,7 +45,8 @@ class FileInfo(object):
     """Data Transfer Object for file info on the Local FS"""
 
     def __init__(self, root, path, folderish, last_modification_time,
-                 digest_func='md5'):
+                 digest_func='md5', size=None, inode=None, digest_cache=None,
+                 background_digest=False):
         root = unicodedata.normalize('NFKC', root)
         path = unicodedata.normalize('NFKC', path)
         self.root = root  # the sync root folder local path
@@ -39,9 +56,20 @@ class FileInfo(object):
         # Last OS modification date of the file
         self.last_modification_time = last_modification_time
 
+        # Size in bytes and inode of the file, used along with the
+        # modification time to identify a given version of the file content
+        self.size = size
+        self.inode = inode
+
         # Function to use
         self._digest_func = digest_func.lower()
 
+        # Optional persistent cache of the digests of the local files, if
+        # background_digest is True the digest is computed by the hashing
+        # service of the cache and get_digest returns None until it is ready
+        self._digest_cache = digest_cache
+        self._background_digest = background_digest
+
         # Precompute base name once and for all are it's often useful in
         # practice
         self.name = os.path.basename(path)
@@ -49,22 +77,28 @@ class FileInfo(object):
         self.filepath = os.path.join(
             root, path[1:].replace(u'/', os.path.sep))
 
-    def get_digest(self):
-        """Lazy computation of the digest"""
+    @property
+    def digest_func(self):
+        return self._digest_func
+
+    def get_digest(self, digest_func=None):
+        """Lazy computation of the digest, reusing the cached one if any
+
+        Return None for folders and for files whose digest is pending.
+        """
         if self.folderish:
             return None
-        digester = getattr(hashlib, self._digest_func, None)
-        if digester is None:
-            raise ValueError('Unknow digest method: ' + self.digest_func)
+        if self._digest_cache is not None:
+            return self._digest_cache.get_digest(
+                self, digest_func=digest_func,
+                wait=not self._background_digest)
+        return self.compute_digest(digest_func)
 
-        h = digester()
-        with open(safe_long_path(self.filepath), 'rb') as f:
-            while True:
-                buffer_ = f.read(BUFFER_SIZE)
-                if buffer_ == '':
-                    break
-                h.update(buffer_)
-        return h.hexdigest()
+    def compute_digest(self, digest_func=None):
+        """Compute the digest by reading the whole file content"""
+        digest_func = (self._digest_func if digest_func is None
+                       else digest_func.lower())
+        return compute_digests(self.filepath, [digest_func])[digest_func]
 
 
 class LocalClient(object):
@@ -74,7 +108,8 @@ class LocalClient(object):
     # Automation operations fetched at controller init time.
 
     def __init__(self, base_folder, digest_func='md5', ignored_prefixes=None,
-                 ignored_suffixes=None):
+                 ignored_suffixes=None, ignored_patterns=None,
+                 digest_cache=None, background_digests=False):
         if ignored_prefixes is not None:
             self.ignored_prefixes = ignored_prefixes
         else:
@@ -85,67 +120,167 @@ class LocalClient(object):
         else:
             self.ignored_suffixes = DEFAULT_IGNORED_SUFFIXES
 
+        # Global rules, the ones of the folders having an ignore file are
+        # cached by folder path
+        self.ignore_rules = IgnoreRules(self.ignored_prefixes,
+                                        self.ignored_suffixes,
+                                        ignored_patterns or ())
+        self._folder_ignore_rules = dict()
+
         while len(base_folder) > 1 and base_folder.endswith(os.path.sep):
             base_folder = base_folder[:-1]
         self.base_folder = base_folder
         self._digest_func = digest_func
+        self.digest_cache = digest_cache
+        self.background_digests = background_digests
 
     # Getters
     def get_info(self, ref, raise_if_missing=True):
         os_path = self._abspath(ref)
-        if not os.path.exists(os_path):
+        try:
+            # A single stat call tells both the existence and the type
+            stat_info = os.stat(os_path)
+        except OSError:
             if raise_if_missing:
                 raise NotFound("Could not found file '%s' under '%s'" % (
                 ref, self.base_folder))
             else:
                 return None
-        folderish = os.path.isdir(os_path)
-        stat_info = os.stat(os_path)
-        mtime = datetime.fromtimestamp(stat_info.st_mtime)
         path = u'/' + os_path[len(safe_long_path(self.base_folder)) + 1:]
         path = path.replace(os.path.sep, u'/')  # unix style path
+        return self._get_info_from_stat(path, stat_info)
+
+    def _get_info_from_stat(self, path, stat_info):
+        folderish = stat.S_ISDIR(stat_info.st_mode)
+        mtime = datetime.fromtimestamp(stat_info.st_mtime)
         # On unix we could use the inode for file move detection but that won't
         # work on Windows. To reduce complexity of the code and the possibility
-        # to have Windows specific bugs, let's not use the unix inode at all.
-        # uid = str(stat_info.st_ino)
+        # to have Windows specific bugs, the inode is only used to identify
+        # a version of the file content for the digest cache.
         return FileInfo(self.base_folder, path, folderish, mtime,
-                        digest_func=self._digest_func)
+                        digest_func=self._digest_func,
+                        size=stat_info.st_size, inode=str(stat_info.st_ino),
+                        digest_cache=self.digest_cache,
+                        background_digest=self.background_digests)
 
     def get_content(self, ref):
         return open(self._abspath(ref), "rb").read()
 
     def get_children_info(self, ref):
         os_path = self._abspath(ref)
+        if scandir is None:
+            return self._get_children_info_listdir(ref, os_path)
+        entries = list(scandir(os_path))
+        ignore_file_stat = None
+        for entry in entries:
+            if entry.name == IGNORE_FILE_NAME:
+                try:
+                    ignore_file_stat = entry.stat()
+                except OSError:
+                    pass
+                break
+        rules = self._get_ignore_rules(ref, ignore_file_stat)
+
         result = []
+        children = []
+        # Ignored children are filtered out before reading any attribute,
+        # hence the content of the ignored folders is never listed
+        for entry in entries:
+            if ref == u'/':
+                child_ref = ref + entry.name
+            else:
+                child_ref = ref + u'/' + entry.name
+            if not rules.is_ignored(entry.name, child_ref):
+                children.append((entry.name, child_ref, entry))
+        children.sort()
+        for name, child_ref, entry in children:
+            try:
+                # Follow symbolic links as os.stat does
+                stat_info = entry.stat()
+            except OSError:
+                # the child file has been deleted in the mean time or is a
+                # broken link
+                continue
+            if (stat.S_ISDIR(stat_info.st_mode)
+                and rules.is_ignored(name, child_ref, folderish=True)):
+                continue
+            result.append(self._get_info_from_stat(child_ref, stat_info))
+        return result
+
+    def _get_children_info_listdir(self, ref, os_path):
+        result = []
+        rules = self._get_ignore_rules(ref)
         children = os.listdir(os_path)
         children.sort()
         for child_name in children:
-            ignore = False
-
-            for suffix in self.ignored_suffixes:
-                if child_name.endswith(suffix):
-                    ignore = True
-                    break
-
-            for prefix in self.ignored_prefixes:
-                if child_name.startswith(prefix):
-                    ignore = True
-                    break
-
-            if not ignore:
-                if ref == u'/':
-                    child_ref = ref + child_name
-                else:
-                    child_ref = ref + u'/' + child_name
+            if ref == u'/':
+                child_ref = ref + child_name
+            else:
+                child_ref = ref + u'/' + child_name
+            if not rules.is_ignored(child_name, child_ref):
                 try:
-                    result.append(self.get_info(child_ref))
+                    info = self.get_info(child_ref)
                 except (OSError, NotFound):
                     # the child file has been deleted in the mean time or while
                     # reading some of its attributes
-                    pass
+                    continue
+                if not (info.folderish and rules.is_ignored(
+                        child_name, child_ref, folderish=True)):
+                    result.append(info)
 
         return result
 
+    def is_ignored(self, name, ref=None, folderish=False):
+        """Return True if the file or folder name should not be synchronized
+
+        If the path of the file or folder is provided, the rules of the ignore
+        files of its parent folders are also checked.
+        """
+        if ref is None:
+            return self.ignore_rules.is_ignored(name, folderish=folderish)
+        parent_ref = ref.rsplit(u'/', 1)[0] or u'/'
+        return self._get_ignore_rules(parent_ref).is_ignored(
+            name, ref, folderish=folderish)
+
+    def get_ignore_rules(self, ref):
+        """Return the rules applying to the children of a folder"""
+        return self._get_ignore_rules(ref)
+
+    def _get_ignore_rules(self, ref, ignore_file_stat=_UNKNOWN):
+        # The rules of the parent folders are cached when listing them: a
+        # scan always lists a folder before its children
+        if ref == u'/':
+            parent_rules = self.ignore_rules
+        else:
+            parent_ref = ref.rsplit(u'/', 1)[0] or u'/'
+            cached = self._folder_ignore_rules.get(parent_ref)
+            if cached is not None:
+                parent_rules = cached[2]
+            else:
+                parent_rules = self._get_ignore_rules(parent_ref)
+
+        ignore_file = os.path.join(self._abspath(ref), IGNORE_FILE_NAME)
+        if ignore_file_stat is _UNKNOWN:
+            try:
+                ignore_file_stat = os.stat(ignore_file)
+            except OSError:
+                ignore_file_stat = None
+        version = None
+        if ignore_file_stat is not None:
+            version = (ignore_file_stat.st_mtime, ignore_file_stat.st_size,
+                       ignore_file_stat.st_ino)
+
+        cached = self._folder_ignore_rules.get(ref)
+        if (cached is not None and cached[0] == version
+            and cached[1] is parent_rules):
+            return cached[2]
+        rules = parent_rules
+        if version is not None:
+            rules = parent_rules.extend(read_ignore_file(ignore_file,
+                                                         base_path=ref))
+        self._folder_ignore_rules[ref] = (version, parent_rules, rules)
+        return rules
+
     def make_folder(self, parent, name):
         os_path, name = self._abspath_deduped(parent, name)
         os.mkdir(os_path)
@@ -0,0 +1,109 @@
+"""Concurrent listing of local folders for the local scan"""
+
+import threading
+from Queue import LifoQueue
+
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Markers for the folders that have been submitted but not listed yet
+_QUEUED = object()
+_RUNNING = object()
+
+
+class LocalTreeWalker(object):
+    """List local folders ahead of the scan using a pool of threads
+
+    The scan still processes the folders one at a time, in its usual depth
+    first order, from the single thread that writes to the database: the
+    walker only lists in advance the folders that are going to be scanned
+    next (the sub folders of the folder being scanned) so that the latency of
+    the file system is waited for concurrently for sibling folders.
+
+    If a watcher is given, each folder is monitored before being listed.
+    """
+
+    def __init__(self, client, workers=4, watcher=None):
+        self.client = client
+        self.watcher = watcher
+        # Last submitted folders are listed first as they are the ones the
+        # depth first scan is going to need first
+        self._queue = LifoQueue()
+        self._results = dict()
+        self._condition = threading.Condition()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work,
+                                      name="LocalTreeWalker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def prefetch(self, refs):
+        """Submit folders to be listed in the order they will be needed"""
+        with self._condition:
+            refs = [ref for ref in refs if ref not in self._results]
+            for ref in refs:
+                self._results[ref] = _QUEUED
+        for ref in reversed(refs):
+            self._queue.put(ref)
+
+    def get_children_info(self, ref):
+        """Return the info of the children of a folder
+
+        Wait for the listing if it is currently performed by a worker, or
+        list the folder from the calling thread if no worker has started
+        doing it yet. Raise OSError if the folder cannot be listed.
+        """
+        with self._condition:
+            result = self._results.pop(ref, None)
+            while result is _RUNNING:
+                # Put the marker back for the worker to store its result
+                self._results[ref] = _RUNNING
+                self._condition.wait()
+                result = self._results.pop(ref)
+        if result is None or result is _QUEUED:
+            return self._list(ref)
+        children_info, error = result
+        if error is not None:
+            raise error
+        return children_info
+
+    def close(self):
+        """Stop the worker threads and forget any prefetched result"""
+        with self._condition:
+            self._results.clear()
+        for _ in self._threads:
+            self._queue.put(None)
+        del self._threads[:]
+
+    def _list(self, ref):
+        if self.watcher is not None:
+            self.watcher.watch(ref)
+        return self.client.get_children_info(ref)
+
+    def _work(self):
+        while True:
+            ref = self._queue.get()
+            if ref is None:
+                return
+            with self._condition:
+                if self._results.get(ref) is not _QUEUED:
+                    # Already listed by the scan thread or walker closed
+                    continue
+                self._results[ref] = _RUNNING
+            try:
+                result = self._list(ref), None
+            except OSError as e:
+                result = None, e
+            except Exception as e:
+                log.error("Unexpected error while listing %r", ref,
+                          exc_info=True)
+                result = None, e
+            with self._condition:
+                if ref in self._results:
+                    self._results[ref] = result
+                self._condition.notify_all()
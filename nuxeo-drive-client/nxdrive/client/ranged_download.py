@@ -0,0 +1,237 @@
+"""Resumable and parallel downloads by HTTP ranges
+
+The content of a file is downloaded to its temporary file by ranges of
+chunk_size bytes. The first missing range is requested alone: if the server
+answers with a partial content, the other ones are requested concurrently,
+each one being retried on its own after a network or server error, and
+written at their offset. The downloaded ranges are recorded in a state file
+next to the temporary file so that an interrupted download goes on with the
+missing ranges as long as the digest of the remote file is the same. A
+server not supporting ranges sends the whole content in the first response,
+which is streamed to the temporary file.
+"""
+
+import httplib
+import json
+import os
+import re
+import threading
+import time
+import urllib2
+
+from nxdrive.client.common import BUFFER_SIZE
+from nxdrive.client.transfer import is_transient_error
+from nxdrive.client.transfer import run_concurrently
+from nxdrive.client.transfer import save_json
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+DOWNLOAD_STATE_SUFFIX = '.json'
+
+CONTENT_RANGE_PATTERN = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+def get_download_state_path(tmp_path):
+    """State file of the download to the temporary file tmp_path"""
+    return tmp_path + DOWNLOAD_STATE_SUFFIX
+
+
+def parse_content_range(content_range):
+    """Return the first and last positions and the size of a range"""
+    match = CONTENT_RANGE_PATTERN.match((content_range or '').strip())
+    if match is None:
+        raise ValueError("Invalid Content-Range %r" % content_range)
+    return tuple(int(group) for group in match.groups())
+
+
+class DownloadState(object):
+    """Ranges of a remote file downloaded to a temporary file
+
+    A saved state is only valid for the same digest of the remote file and
+    the same chunk size. size is None until the first range is downloaded.
+    validator is the ETag or the Last-Modified header of the first range,
+    sent back in the If-Range header of the next ones.
+    """
+
+    def __init__(self, path, digest, chunk_size, size=None, validator=None,
+                 downloaded=None):
+        self.path = path
+        self.digest = digest
+        self.chunk_size = chunk_size
+        self.size = size
+        self.validator = validator
+        self.downloaded = set(downloaded or ())
+
+    @property
+    def chunk_count(self):
+        return max(1, (self.size + self.chunk_size - 1) // self.chunk_size)
+
+    def get_missing(self):
+        return [index for index in range(self.chunk_count)
+                if index not in self.downloaded]
+
+    @classmethod
+    def load(cls, path, digest, chunk_size):
+        """Return the state saved in path if still valid, None otherwise"""
+        try:
+            with open(path, 'rb') as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return None
+        state = cls(path, saved.get('digest'), saved.get('chunk_size'),
+                    size=saved.get('size'), validator=saved.get('validator'),
+                    downloaded=saved.get('downloaded'))
+        if (digest is None or state.digest != digest or state.size is None
+                or state.chunk_size != chunk_size):
+            log.debug("Discarding outdated download state %s", path)
+            state.remove()
+            return None
+        return state
+
+    def save(self):
+        save_json(self.path, {
+            'digest': self.digest,
+            'chunk_size': self.chunk_size,
+            'size': self.size,
+            'validator': self.validator,
+            'downloaded': sorted(self.downloaded),
+        })
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class RangedDownload(object):
+    """Download of the content at url to file_path by ranges
+
+    digest is the digest of the remote file: an interrupted download is
+    only resumed if it is the same. The ranges after the first one are
+    requested by workers threads, a range being requested up to
+    max_chunk_attempts times if the errors are transient.
+    """
+
+    max_chunk_attempts = 3
+
+    # In seconds, multiplied by the number of the attempt
+    retry_delay = 1
+
+    def __init__(self, client, url, file_path, digest=None, chunk_size=None,
+                 workers=None):
+        self.client = client
+        self.url = url
+        self.file_path = file_path
+        self.chunk_size = chunk_size or client.download_chunk_size
+        self.workers = workers or client.download_workers
+        self._lock = threading.Lock()
+
+        path = get_download_state_path(file_path)
+        self.state = None
+        if os.path.exists(file_path):
+            self.state = DownloadState.load(path, digest, self.chunk_size)
+        if self.state is None:
+            self.state = DownloadState(path, digest, self.chunk_size)
+
+    def run(self):
+        state = self.state
+        if state.size is None:
+            index = 0
+        else:
+            missing = state.get_missing()
+            log.debug("Resuming download of %s: %d/%d ranges missing",
+                      self.file_path, len(missing), state.chunk_count)
+            if not missing:
+                state.remove()
+                return
+            index = missing[0]
+        if self._download_chunk(index, first=True):
+            missing = state.get_missing()
+            if missing:
+                # The downloaded ranges are kept for the next attempt on
+                # error
+                run_concurrently(self._download_chunk, missing, self.workers,
+                                 "RangedDownload")
+        state.remove()
+
+    def _download_chunk(self, index, first=False):
+        attempt = 1
+        while True:
+            try:
+                return self._get_chunk(index, first)
+            except Exception as e:
+                if (attempt >= self.max_chunk_attempts
+                        or not is_transient_error(e)):
+                    raise
+                log.debug("Requesting range %d of %s again after %r", index,
+                          self.url, e)
+                time.sleep(self.retry_delay * attempt)
+                attempt += 1
+
+    def _get_chunk(self, index, first):
+        """Download a range, return False if the whole content was sent"""
+        state = self.state
+        start = index * state.chunk_size
+        headers = {'Range': 'bytes=%d-%d' % (start,
+                                             start + state.chunk_size - 1)}
+        if state.validator is not None:
+            headers['If-Range'] = state.validator
+        try:
+            response = self.client.open_download(self.url, headers=headers)
+        except urllib2.HTTPError as e:
+            # Give the connection back to the pool
+            e.close()
+            if not first or e.code != 416:
+                raise
+            # Empty file
+            response = self.client.open_download(self.url)
+        try:
+            if response.code != 206:
+                if not first:
+                    raise ValueError("Range %d of %s not sent by the server"
+                                     % (index, self.url))
+                # Ranges not supported or remote content changed
+                log.debug("Downloading %s in a single stream", self.url)
+                state.remove()
+                length = response.info().get('Content-Length')
+                self._write(response, 0, int(length) if length else None,
+                            truncate=True)
+                return False
+            info = response.info()
+            offset, end, size = parse_content_range(info.get('Content-Range'))
+            if offset != start:
+                raise ValueError("Unexpected range %d-%d of %s instead of %d"
+                                 % (offset, end, self.url, index))
+            if first and size != state.size:
+                # New download: make room for the ranges
+                state.size = size
+                state.validator = (info.get('ETag')
+                                   or info.get('Last-Modified'))
+                state.downloaded.clear()
+                with open(self.file_path, 'wb') as f:
+                    f.truncate(size)
+            self._write(response, offset, end - offset + 1)
+        finally:
+            response.close()
+        with self._lock:
+            state.downloaded.add(index)
+            state.save()
+        return True
+
+    def _write(self, response, offset, length, truncate=False):
+        written = 0
+        with open(self.file_path, 'wb' if truncate else 'r+b') as f:
+            f.seek(offset)
+            while True:
+                buffer_ = response.read(BUFFER_SIZE)
+                if buffer_ == '':
+                    break
+                f.write(buffer_)
+                written += len(buffer_)
+        if length is not None and written != length:
+            # Connection closed before the end of the content
+            raise httplib.HTTPException("Received %d bytes of %d from %s"
+                                        % (written, length, self.url))
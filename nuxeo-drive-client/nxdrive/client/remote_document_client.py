@@ -63,17 +63,24 @@ class RemoteDocumentClient(BaseAutomationClient):
                  proxies=None, proxy_exceptions=None,
                  password=None, token=None, repository="default",
                  ignored_prefixes=None, ignored_suffixes=None,
-                 base_folder=None, timeout=20, blob_timeout=None,
-                 cookie_jar=None, upload_tmp_dir=None):
+                 ignored_patterns=None, base_folder=None, timeout=20,
+                 blob_timeout=None, cookie_jar=None, upload_tmp_dir=None,
+                 connection_pool=None, transfer_pool=None,
+                 upload_chunk_size=None, download_chunk_size=None):
         super(RemoteDocumentClient, self).__init__(
             server_url, user_id, device_id, client_version,
             proxies=proxies, proxy_exceptions=proxy_exceptions,
             password=password, token=token, repository=repository,
             ignored_prefixes=ignored_prefixes,
             ignored_suffixes=ignored_suffixes,
+            ignored_patterns=ignored_patterns,
             timeout=timeout, blob_timeout=blob_timeout,
             cookie_jar=cookie_jar,
-            upload_tmp_dir=upload_tmp_dir)
+            upload_tmp_dir=upload_tmp_dir,
+            connection_pool=connection_pool,
+            transfer_pool=transfer_pool,
+            upload_chunk_size=upload_chunk_size,
+            download_chunk_size=download_chunk_size)
 
         # fetch the root folder ref
         self.base_folder = base_folder
@@ -277,19 +284,8 @@ class RemoteDocumentClient(BaseAutomationClient):
         for info in [self._doc_to_info(d, fetch_parent_uid=fetch_parent_uid,
                                        parent_uid=parent_uid)
                      for d in entries]:
-            ignore = False
-
-            for suffix in self.ignored_suffixes:
-                if info.name.endswith(suffix):
-                    ignore = True
-                    break
-
-            for prefix in self.ignored_prefixes:
-                if info.name.startswith(prefix):
-                    ignore = True
-                    break
-
-            if not ignore:
+            if not self.ignore_rules.is_ignored(info.name,
+                                                folderish=info.folderish):
                 filtered.append(info)
 
         return filtered
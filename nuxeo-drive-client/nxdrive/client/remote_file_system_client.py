@@ -10,6 +10,7 @@ from nxdrive.client.common import NotFound
 from nxdrive.client.common import BUFFER_SIZE
 from nxdrive.client.base_automation_client import Unauthorized
 from nxdrive.client.base_automation_client import BaseAutomationClient
+from nxdrive.client.ranged_download import RangedDownload
 
 
 log = get_logger(__name__)
@@ -17,6 +18,15 @@ log = get_logger(__name__)
 DOWNLOAD_TMP_FILE_PREFIX = '.'
 DOWNLOAD_TMP_FILE_SUFFIX = '.part'
 
+
+def get_download_tmp_path(file_path):
+    """Temporary file the content of file_path is downloaded to"""
+    file_dir = os.path.dirname(file_path)
+    file_name = os.path.basename(file_path)
+    return os.path.join(file_dir, DOWNLOAD_TMP_FILE_PREFIX + file_name
+                        + DOWNLOAD_TMP_FILE_SUFFIX)
+
+
 # Data transfer objects
 
 BaseRemoteFileInfo = namedtuple('RemoteFileInfo', [
@@ -83,16 +93,17 @@ class RemoteFileSystemClient(BaseAutomationClient):
     def stream_content(self, fs_item_id, file_path):
         """Stream the binary content of a file system item to a tmp file
 
+        An interrupted download to the tmp file is resumed if the digest of
+        the file system item has not changed.
+
         Raises NotFound if file system item with id fs_item_id
         cannot be found
         """
         fs_item_info = self.get_info(fs_item_id)
         download_url = self.server_url + fs_item_info.download_url
-        file_dir = os.path.dirname(file_path)
-        file_name = os.path.basename(file_path)
-        file_out = os.path.join(file_dir, DOWNLOAD_TMP_FILE_PREFIX + file_name
-                                + DOWNLOAD_TMP_FILE_SUFFIX)
-        _, tmp_file = self._do_get(download_url, file_out=file_out)
+        _, tmp_file = self._do_get(download_url,
+                                   file_out=get_download_tmp_path(file_path),
+                                   digest=fs_item_info.digest)
         return tmp_file
 
     def get_children_info(self, fs_item_id):
@@ -194,21 +205,35 @@ class RemoteFileSystemClient(BaseAutomationClient):
             download_url, fs_item['canRename'], fs_item['canDelete'],
             can_update, can_create_child)
 
-    def _do_get(self, url, file_out=None):
+    def open_download(self, url, headers=None):
+        """Send a GET request for url and return the response"""
+        request_headers = self._get_common_headers()
+        if headers is not None:
+            request_headers.update(headers)
+        log.trace("Calling '%s' with headers: %r", url, request_headers)
+        req = urllib2.Request(url, headers=request_headers)
+        return self.streaming_opener.open(req, timeout=self.blob_timeout)
+
+    def _do_get(self, url, file_out=None, digest=None):
+        """Return the content at url, or write it to file_out
+
+        The content is written to file_out by ranges unless
+        download_chunk_size is None or 0.
+        """
         if self._error is not None:
             # Simulate a configurable (e.g. network or server) error for the
             # tests
             raise self._error
 
-        headers = self._get_common_headers()
         base_error_message = (
             "Failed to connect to Nuxeo server %r with user %r"
         ) % (self.server_url, self.user_id)
         try:
-            log.trace("Calling '%s' with headers: %r", url, headers)
-            req = urllib2.Request(url, headers=headers)
-            response = self.opener.open(req, timeout=self.blob_timeout)
+            if file_out is not None and self.download_chunk_size:
+                RangedDownload(self, url, file_out, digest=digest).run()
+                return None, file_out
 
+            response = self.open_download(url)
             if file_out is not None:
                 with open(file_out, "wb") as f:
                     while True:
@@ -0,0 +1,133 @@
+"""Concurrent listing of remote folders for the remote scan"""
+
+import threading
+from Queue import LifoQueue
+
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Markers for the folders that have been submitted but not listed yet
+_QUEUED = object()
+_RUNNING = object()
+
+
+class RemoteTreeWalker(object):
+    """List remote folders ahead of the scan using a pool of threads
+
+    The scan processes the folders one at a time, in its usual depth first
+    order, from the single thread that writes to the database. Unlike the
+    local tree walker, the workers do not wait for the scan to reach a
+    folder to submit its sub folders: each listed folder has its sub folders
+    listed in turn, so that up to workers GetChildren calls are kept in
+    flight across the whole tree and the network latency is paid about once
+    per level of the tree instead of once per folder.
+
+    At most max_prefetched listings are kept waiting for the scan, the
+    workers pausing beyond that. The client is shared by the threads.
+    """
+
+    max_prefetched = 1000
+
+    def __init__(self, client, workers=4, max_prefetched=None):
+        self.client = client
+        if max_prefetched is not None:
+            self.max_prefetched = max_prefetched
+        # Last submitted folders are listed first as they are the ones the
+        # depth first scan is going to need first
+        self._queue = LifoQueue()
+        self._results = dict()
+        # Number of listings running or waiting for the scan
+        self._prefetched = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work,
+                                      name="RemoteTreeWalker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def prefetch(self, refs):
+        """Submit folders to be listed in the order they will be needed"""
+        with self._condition:
+            if self._closed:
+                return
+            refs = [ref for ref in refs if ref not in self._results]
+            for ref in refs:
+                self._results[ref] = _QUEUED
+        for ref in reversed(refs):
+            self._queue.put(ref)
+
+    def get_children_info(self, ref):
+        """Return the info of the children of a folder
+
+        Wait for the listing if it is currently performed by a worker, or
+        list the folder from the calling thread if no worker has started
+        doing it yet. The errors of the listing are raised.
+        """
+        with self._condition:
+            result = self._results.pop(ref, None)
+            while result is _RUNNING:
+                # Put the marker back for the worker to store its result
+                self._results[ref] = _RUNNING
+                self._condition.wait()
+                result = self._results.pop(ref)
+            if result is not None and result is not _QUEUED:
+                self._prefetched -= 1
+                self._condition.notify_all()
+        if result is None or result is _QUEUED:
+            return self._list(ref)
+        children_info, error = result
+        if error is not None:
+            raise error
+        return children_info
+
+    def close(self):
+        """Stop the worker threads and forget any prefetched result"""
+        with self._condition:
+            self._closed = True
+            self._results.clear()
+            self._condition.notify_all()
+        for _ in self._threads:
+            self._queue.put(None)
+        del self._threads[:]
+
+    def _list(self, ref):
+        children_info = self.client.get_children_info(ref)
+        self.prefetch([c.uid for c in children_info if c.folderish])
+        return children_info
+
+    def _work(self):
+        while True:
+            ref = self._queue.get()
+            if ref is None:
+                return
+            with self._condition:
+                if self._closed:
+                    return
+                while (not self._closed
+                       and self._prefetched >= self.max_prefetched
+                       and self._results.get(ref) is _QUEUED):
+                    self._condition.wait()
+                if self._results.get(ref) is not _QUEUED:
+                    # Already listed by the scan thread or walker closed
+                    continue
+                self._results[ref] = _RUNNING
+                self._prefetched += 1
+            try:
+                result = self._list(ref), None
+            except Exception as e:
+                # Raised by the scan thread when it needs the folder
+                log.trace("Error while listing remote folder %r: %r", ref, e)
+                result = None, e
+            with self._condition:
+                if ref in self._results:
+                    self._results[ref] = result
+                else:
+                    # Walker closed
+                    self._prefetched -= 1
+                self._condition.notify_all()
@@ -0,0 +1,248 @@
+"""Concurrent transfers of the content of the synchronized files"""
+
+import httplib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import urllib2
+from Queue import Empty
+from Queue import Queue
+
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+def is_transient_error(error):
+    """Check whether sending a request again may succeed"""
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500
+    return isinstance(error, (urllib2.URLError, socket.error,
+                              httplib.HTTPException))
+
+
+def run_concurrently(function, items, workers, name):
+    """Call function on each item from up to workers threads
+
+    No call is started after an error, the first error being raised once
+    the started calls are over.
+    """
+    queue = Queue()
+    for item in items:
+        queue.put(item)
+    errors = []
+
+    def work():
+        while not errors:
+            try:
+                item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                function(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = []
+    for i in range(min(workers, len(items))):
+        thread = threading.Thread(target=work, name="%s-%d" % (name, i))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def save_json(path, value):
+    """Write value as JSON to path, never leaving a truncated file"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        json.dump(value, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # The target cannot be replaced under Windows
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        os.rename(tmp_path, path)
+
+
+class Transfer(object):
+    """Transfer of the content of a file run by a TransferService
+
+    run is called without argument and returns a tuple of its result and
+    the number of bytes transferred.
+    """
+
+    def __init__(self, key, run):
+        self.key = key
+        self.run = run
+        self.bytes = 0
+        self.duration = None
+        self._result = None
+        self._exc_info = None
+
+    def execute(self):
+        """Run the transfer, keeping its result or its error"""
+        start = time.time()
+        try:
+            self._result, self.bytes = self.run()
+        except Exception:
+            self._exc_info = sys.exc_info()
+        self.duration = time.time() - start
+
+    def get_result(self):
+        """Return the result of the transfer, raising its error if it failed"""
+        if self._exc_info is not None:
+            exc_info, self._exc_info = self._exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return self._result
+
+
+class TransferService(object):
+    """Pool of threads transferring the content of files
+
+    The synchronization thread submits a transfer when a worker is free (see
+    has_free_slot) and collects the finished ones with pop_done to update
+    the pairs: the transfers never use the database.
+
+    At most workers transfers run at once. With auto_tune, workers is tuned
+    between min_workers and max_workers by hill climbing on the throughput
+    measured over periods of tuning_period seconds during which some
+    transfers had to wait for a free worker: workers keeps moving by one in
+    the same direction as long as the throughput does not drop by more than
+    tuning_tolerance, and turns back otherwise.
+    """
+
+    auto_tune = True
+
+    min_workers = 2
+
+    # In seconds
+    tuning_period = 10
+
+    tuning_tolerance = 0.1
+
+    def __init__(self, max_workers=4, auto_tune=None):
+        self.max_workers = max_workers
+        if auto_tune is not None:
+            self.auto_tune = auto_tune
+        self.workers = max_workers
+        self._queue = Queue()
+        self._running = set()
+        self._done = []
+        self._condition = threading.Condition()
+        self._threads = []
+        # Measure of the throughput
+        self._period_start = None
+        self._period_bytes = 0
+        self._period_saturated = False
+        self._throughput = None
+        self._step = -1
+
+    def has_free_slot(self):
+        """Return True if a submitted transfer would start right away"""
+        with self._condition:
+            if len(self._running) < self.workers:
+                return True
+            self._period_saturated = True
+            return False
+
+    def submit(self, key, run):
+        """Schedule a transfer identified by key, see Transfer"""
+        transfer = Transfer(key, run)
+        with self._condition:
+            self._running.add(key)
+            self._ensure_started()
+            if self._period_start is None:
+                self._period_start = time.time()
+        self._queue.put(transfer)
+        return transfer
+
+    def is_running(self, key):
+        with self._condition:
+            return key in self._running
+
+    def pop_done(self, wait=False):
+        """Return the finished transfers not returned yet
+
+        If wait is True and no transfer has finished yet, wait for one if any
+        is running.
+        """
+        with self._condition:
+            while wait and not self._done and self._running:
+                self._condition.wait()
+            done, self._done = self._done, []
+            self._tune(time.time())
+        return done
+
+    def stop(self):
+        """Stop the worker threads, the running transfers being forgotten"""
+        with self._condition:
+            self._running.clear()
+            del self._done[:]
+            for _ in self._threads:
+                self._queue.put(None)
+            del self._threads[:]
+            self._period_start = None
+
+    def _tune(self, now):
+        # Called with the condition acquired
+        if self._period_start is None:
+            return
+        elapsed = now - self._period_start
+        if elapsed < self.tuning_period:
+            return
+        if self.auto_tune and self._period_saturated:
+            throughput = self._period_bytes / elapsed
+            if (self._throughput is not None and throughput
+                    < self._throughput * (1 - self.tuning_tolerance)):
+                # Worse than before the last move
+                self._step = -self._step
+            self._throughput = throughput
+            low = min(self.min_workers, self.max_workers)
+            workers = self.workers + self._step
+            if not low <= workers <= self.max_workers:
+                self._step = -self._step
+                workers = self.workers + self._step
+            workers = max(low, min(self.max_workers, workers))
+            if workers != self.workers:
+                log.debug("Transfer throughput %.0f bytes/s with %d workers,"
+                          " moving to %d workers", throughput, self.workers,
+                          workers)
+                self.workers = workers
+        self._period_start = now if self._running else None
+        self._period_bytes = 0
+        self._period_saturated = False
+
+    def _ensure_started(self):
+        while len(self._threads) < self.max_workers:
+            thread = threading.Thread(
+                target=self._work,
+                name="TransferService-%d" % len(self._threads))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            transfer = self._queue.get()
+            if transfer is None:
+                return
+            transfer.execute()
+            with self._condition:
+                if transfer.key not in self._running:
+                    # Service stopped
+                    continue
+                self._running.discard(transfer.key)
+                self._period_bytes += transfer.bytes
+                self._done.append(transfer)
+                self._condition.notify_all()
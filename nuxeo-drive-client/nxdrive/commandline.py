@@ -17,6 +17,8 @@ from nxdrive.daemon import daemonize
 from nxdrive.controller import default_nuxeo_drive_folder
 from nxdrive.logging_config import configure
 from nxdrive.logging_config import get_logger
+from nxdrive.model import DB_PROFILES
+from nxdrive.model import DEFAULT_DB_PROFILE
 from nxdrive.protocol_handler import parse_protocol_url
 from nxdrive.protocol_handler import register_protocol_handlers
 from nxdrive.startup import register_startup
@@ -28,6 +30,12 @@ DEFAULT_DELAY = 5.0
 DEFAULT_MAX_SYNC_STEP = 10
 DEFAULT_HANDSHAKE_TIMEOUT = 60
 DEFAULT_TIMEOUT = 20
+DEFAULT_LOCAL_SCAN_WORKERS = 4
+DEFAULT_REMOTE_SCAN_WORKERS = 4
+DEFAULT_HASHING_WORKERS = 2
+DEFAULT_TRANSFER_WORKERS = 4
+DEFAULT_UPLOAD_CHUNK_SIZE = 10
+DEFAULT_DOWNLOAD_CHUNK_SIZE = 10
 USAGE = """ndrive [command]
 
 If no command is provided, the graphical application is started along with a
@@ -97,6 +105,53 @@ def make_cli_parser(add_subparsers=True):
     common_parser.add_argument(
         "--timeout", default=DEFAULT_TIMEOUT, type=int,
         help="HTTP request timeout in seconds for the sync Automation calls.")
+    common_parser.add_argument(
+        "--local-scan-workers", default=DEFAULT_LOCAL_SCAN_WORKERS, type=int,
+        help="Number of threads listing local folders concurrently during"
+        " full local scans, 1 to disable concurrent listing.")
+    common_parser.add_argument(
+        "--remote-scan-workers", default=DEFAULT_REMOTE_SCAN_WORKERS,
+        type=int,
+        help="Number of threads listing remote folders concurrently during"
+        " full remote scans, 1 to disable concurrent listing.")
+    common_parser.add_argument(
+        "--hashing-workers", default=DEFAULT_HASHING_WORKERS, type=int,
+        help="Number of threads computing the digests of the local files,"
+        " 0 to compute them from the synchronization thread.")
+    common_parser.add_argument(
+        "--transfer-workers", default=DEFAULT_TRANSFER_WORKERS, type=int,
+        help="Maximum number of file contents uploaded or downloaded"
+        " concurrently while the synchronization goes on, tuned from the"
+        " measured throughput, 0 to transfer them from the synchronization"
+        " thread.")
+    common_parser.add_argument(
+        "--upload-chunk-size", default=DEFAULT_UPLOAD_CHUNK_SIZE, type=int,
+        help="Size in MiB of the chunks of the uploads of bigger files, sent"
+        " concurrently and resumed after an interruption, 0 to upload the"
+        " files in a single request.")
+    common_parser.add_argument(
+        "--download-chunk-size", default=DEFAULT_DOWNLOAD_CHUNK_SIZE,
+        type=int,
+        help="Size in MiB of the ranges of the downloads, requested"
+        " concurrently and resumed after an interruption if the server"
+        " supports ranges, 0 to download the files in a single request.")
+    common_parser.add_argument(
+        "--ignore", action="append", metavar="PATTERN",
+        help="Glob pattern of the local files and folders not to synchronize"
+        " in addition to the ones of NXDRIVE_HOME/.nxdriveignore, can be"
+        " repeated.")
+    common_parser.add_argument(
+        "--skip-unchanged-folders", default=False, action="store_true",
+        help="When file system monitoring is not available, do not list the"
+        " local folders whose modification time did not change since the"
+        " previous scan, except for an hourly deep scan.")
+    common_parser.add_argument(
+        "--db-profile", default=DEFAULT_DB_PROFILE,
+        choices=sorted(DB_PROFILES),
+        help="Trade-off of the local database between durability and speed:"
+        " 'durable' flushes each commit to the disk, 'fast' (default) can"
+        " lose the last commits on power failure, 'compatible' does not use"
+        " a write-ahead log for file systems not supporting it.")
     common_parser.add_argument(
         # XXX: Make it true by default as the fault tolerant mode is not yet
         # implemented
@@ -308,7 +363,20 @@ class CliHandler(object):
         if command != 'test':
             self.controller = Controller(options.nxdrive_home,
                                 handshake_timeout=options.handshake_timeout,
-                                timeout=options.timeout)
+                                timeout=options.timeout,
+                                local_scan_workers=options.local_scan_workers,
+                                remote_scan_workers=(
+                                    options.remote_scan_workers),
+                                hashing_workers=options.hashing_workers,
+                                transfer_workers=options.transfer_workers,
+                                upload_chunk_size=(
+                                    options.upload_chunk_size * 1024 ** 2),
+                                download_chunk_size=(
+                                    options.download_chunk_size * 1024 ** 2),
+                                ignored_patterns=options.ignore,
+                                skip_unchanged_local_folders=(
+                                    options.skip_unchanged_folders),
+                                db_profile=options.db_profile)
 
         # Find the command to execute based on the
         handler = getattr(self, command, None)
@@ -354,7 +422,19 @@ class CliHandler(object):
 
         self.controller = Controller(options.nxdrive_home,
                             handshake_timeout=options.handshake_timeout,
-                            timeout=options.timeout)
+                            timeout=options.timeout,
+                            local_scan_workers=options.local_scan_workers,
+                            remote_scan_workers=options.remote_scan_workers,
+                            hashing_workers=options.hashing_workers,
+                            transfer_workers=options.transfer_workers,
+                            upload_chunk_size=(
+                                options.upload_chunk_size * 1024 ** 2),
+                            download_chunk_size=(
+                                options.download_chunk_size * 1024 ** 2),
+                            ignored_patterns=options.ignore,
+                            skip_unchanged_local_folders=(
+                                options.skip_unchanged_folders),
+                            db_profile=options.db_profile)
         self._configure_logger(options)
         self.log.debug("Synchronization daemon started.")
         self.controller.synchronizer.loop(
@@ -436,6 +516,13 @@ class CliHandler(object):
         # List the test modules explicitly as recursive discovery is broken
         # when the app is frozen.
         argv += [
+            "nxdrive.tests.test_chunked_upload",
+            "nxdrive.tests.test_connection_pool",
+            "nxdrive.tests.test_digest_cache",
+            "nxdrive.tests.test_file_io",
+            "nxdrive.tests.test_folder_status",
+            "nxdrive.tests.test_hashing",
+            "nxdrive.tests.test_ignore",
             "nxdrive.tests.test_integration_concurrent_synchronization",
             "nxdrive.tests.test_integration_copy",
             "nxdrive.tests.test_integration_encoding",
@@ -451,7 +538,15 @@ class CliHandler(object):
             "nxdrive.tests.test_integration_synchronization",
             "nxdrive.tests.test_integration_versioning",
             "nxdrive.tests.test_integration_windows",
+            "nxdrive.tests.test_local_scan",
+            "nxdrive.tests.test_local_tree_walker",
+            "nxdrive.tests.test_local_watcher",
+            "nxdrive.tests.test_pair_index",
+            "nxdrive.tests.test_query_plans",
+            "nxdrive.tests.test_ranged_download",
+            "nxdrive.tests.test_remote_tree_walker",
             "nxdrive.tests.test_synchronizer",
+            "nxdrive.tests.test_transfer",
         ]
         return 0 if nose.run(argv=argv) else 1
 
@@ -6,26 +6,30 @@ from urllib import quote
 from threading import local
 import subprocess
 from datetime import datetime
-from datetime import timedelta
 import calendar
 
 from cookielib import CookieJar
 
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy import asc
-from sqlalchemy import or_
 
 import nxdrive
 from nxdrive.client import Unauthorized
 from nxdrive.client import LocalClient
+from nxdrive.client.hashing import HashingService
+from nxdrive.client.transfer import TransferService
+from nxdrive.client.connection_pool import ConnectionPool
+from nxdrive.client.ignore import IGNORE_FILE_NAME
+from nxdrive.client.ignore import read_patterns
 from nxdrive.client import RemoteFileSystemClient
 from nxdrive.client import RemoteDocumentClient
+from nxdrive.client.base_automation_client import BaseAutomationClient
 from nxdrive.client.base_automation_client import get_proxies_for_handler
 from nxdrive.client import NotFound
 from nxdrive.model import init_db
 from nxdrive.model import DeviceConfig
 from nxdrive.model import ServerBinding
 from nxdrive.model import LastKnownState
+from nxdrive.model import DigestCache
 from nxdrive.synchronizer import Synchronizer
 from nxdrive.synchronizer import POSSIBLE_NETWORK_ERROR_TYPES
 from nxdrive.logging_config import get_logger
@@ -121,7 +125,12 @@ class Controller(object):
     remote_fs_client_factory = RemoteFileSystemClient
 
     def __init__(self, config_folder, echo=None, poolclass=None,
-                 handshake_timeout=60, timeout=20, page_size=None):
+                 handshake_timeout=60, timeout=20, page_size=None,
+                 local_scan_workers=None, hashing_workers=2,
+                 ignored_patterns=None, skip_unchanged_local_folders=None,
+                 db_profile=None, remote_scan_workers=None,
+                 transfer_workers=4, upload_chunk_size=None,
+                 download_chunk_size=None):
         # Log the installation location for debug
         nxdrive_install_folder = os.path.dirname(nxdrive.__file__)
         nxdrive_install_folder = os.path.realpath(nxdrive_install_folder)
@@ -142,14 +151,36 @@ class Controller(object):
         # Handle connection to the local Nuxeo Drive configuration and
         # metadata sqlite database.
         self._engine, self._session_maker = init_db(
-            self.config_folder, echo=echo, poolclass=poolclass)
+            self.config_folder, echo=echo, poolclass=poolclass,
+            profile=db_profile)
 
         # Thread-local storage for the remote client cache
         self._local = local()
         self._client_cache_timestamps = dict()
 
+        # Persistent digest caches by bound local folder, missing digests
+        # being computed by a pool of threads
+        self._digest_caches = dict()
+        self.hashing_service = HashingService(workers=hashing_workers)
+
+        # Pool of threads transferring the contents of the files while the
+        # synchronization goes on
+        self.transfer_service = TransferService(max_workers=transfer_workers)
+
+        # Size of the chunks of the uploads of big files and of the ranges
+        # of the downloads, the defaults of the remote clients if None
+        self.upload_chunk_size = upload_chunk_size
+        self.download_chunk_size = download_chunk_size
+
         self._remote_error = None
 
+        # Global ignore rules: the patterns of the ignore file of the
+        # configuration folder completed by the provided ones
+        self.ignored_patterns = read_patterns(
+            os.path.join(self.config_folder, IGNORE_FILE_NAME))
+        if ignored_patterns is not None:
+            self.ignored_patterns.extend(ignored_patterns)
+
         device_config = self.get_device_config()
         self.device_id = device_config.device_id
         self.version = nxdrive.__version__
@@ -160,12 +191,25 @@ class Controller(object):
         self.proxy_exceptions = None
         self.refresh_proxies(device_config=device_config)
 
-        self.synchronizer = Synchronizer(self, page_size=page_size)
+        self.synchronizer = Synchronizer(
+            self, page_size=page_size, local_scan_workers=local_scan_workers,
+            skip_unchanged_local_folders=skip_unchanged_local_folders,
+            remote_scan_workers=remote_scan_workers)
 
         # Make all the automation client related to this controller
         # share cookies using threadsafe jar
         self.cookie_jar = CookieJar()
 
+        # Kept alive HTTP connections shared by the automation clients, the
+        # contents of the files being transferred on their own connections:
+        # enough for each transfer worker, or the synchronization thread
+        # without transfer workers, to send its chunks concurrently
+        self.connection_pool = ConnectionPool()
+        chunk_workers = max(BaseAutomationClient.upload_workers,
+                            BaseAutomationClient.download_workers)
+        self.transfer_pool = ConnectionPool(
+            max_per_host=max(transfer_workers, 1) * chunk_workers)
+
     def get_session(self):
         """Reuse the thread local session for this controller
 
@@ -326,6 +370,9 @@ class Controller(object):
         than their own instric synchronization step which is of little
         use for the end user.
 
+        The descendants are not read: the folders hold the number of their
+        descendants by status, see LastKnownState.count_descendants.
+
         """
         session = self.get_session()
         # Find the server binding for this absolute path
@@ -335,57 +382,25 @@ class Controller(object):
             return []
 
         try:
-            folder_state = session.query(LastKnownState).filter_by(
+            session.query(LastKnownState).filter_by(
                 local_folder=binding.local_folder,
                 local_path=path,
             ).one()
         except NoResultFound:
             return []
 
-        states = self._pair_states_recursive(session, folder_state)
-
-        return [(os.path.basename(s.local_path), pair_state)
-                for s, pair_state in states
-                if s.local_parent_path == path]
-
-    def _pair_states_recursive(self, session, doc_pair):
-        """Recursive call to collect pair state under a given location."""
-        if not doc_pair.folderish:
-            return [(doc_pair, doc_pair.pair_state)]
-
-        if doc_pair.local_path is not None and doc_pair.remote_ref is not None:
-            f = or_(
-                LastKnownState.local_parent_path == doc_pair.local_path,
-                LastKnownState.remote_parent_ref == doc_pair.remote_ref,
-            )
-        elif doc_pair.local_path is not None:
-            f = LastKnownState.local_parent_path == doc_pair.local_path
-        elif doc_pair.remote_ref is not None:
-            f = LastKnownState.remote_parent_ref == doc_pair.remote_ref
-        else:
-            raise ValueError("Illegal state %r: at least path or remote_ref"
-                             " should be not None." % doc_pair)
-
-        children_states = session.query(LastKnownState).filter_by(
-            local_folder=doc_pair.local_folder).filter(f).order_by(
-                asc(LastKnownState.local_name),
-                asc(LastKnownState.remote_name),
-            ).all()
-
-        results = []
-        for child_state in children_states:
-            sub_results = self._pair_states_recursive(session, child_state)
-            results.extend(sub_results)
-
-        # A folder stays synchronized (or unknown) only if all the descendants
-        # are themselfves synchronized.
-        pair_state = doc_pair.pair_state
-        for _, sub_pair_state in results:
-            if sub_pair_state != 'synchronized':
+        states = []
+        for child, counts in LastKnownState.get_local_children_counts(
+                session, binding.local_folder, path):
+            pair_state = child['pair_state']
+            # A folder stays synchronized (or unknown) only if all the
+            # descendants are themselfves synchronized.
+            if counts is not None and counts['synchronized'] != sum(
+                    counts.values()):
                 pair_state = 'children_modified'
-            break
-        # Pre-pend the folder state to the descendants
-        return [(doc_pair, pair_state)] + results
+            states.append((os.path.basename(child['local_path']),
+                           pair_state))
+        return states
 
     def _binding_path(self, local_path, session=None):
         """Find a server binding and relative path for a given FS path"""
@@ -429,7 +444,8 @@ class Controller(object):
         nxclient = self.remote_doc_client_factory(
             server_url, username, self.device_id, self.version,
             proxies=self.proxies, proxy_exceptions=self.proxy_exceptions,
-            password=password, timeout=self.handshake_timeout)
+            password=password, timeout=self.handshake_timeout,
+            connection_pool=self.connection_pool)
         token = nxclient.request_token()
         if token is not None:
             # The server supports token based identification: do not store the
@@ -506,7 +522,8 @@ class Controller(object):
                         proxies=self.proxies,
                         proxy_exceptions=self.proxy_exceptions,
                         token=binding.remote_token,
-                        timeout=self.timeout)
+                        timeout=self.timeout,
+                        connection_pool=self.connection_pool)
                 log.info("Revoking token for '%s' with account '%s'",
                          binding.server_url, binding.remote_user)
                 nxclient.revoke_token()
@@ -523,7 +540,7 @@ class Controller(object):
         # Delete binding info in local DB
         log.info("Unbinding '%s' from '%s' with account '%s'",
                  local_folder, binding.server_url, binding.remote_user)
-        session.delete(binding)
+        binding.delete(session)
         session.commit()
 
     def unbind_all(self):
@@ -581,34 +598,9 @@ class Controller(object):
         """
         if session is None:
             session = self.get_session()
-
-        # Only consider pair states that are not synchronized
-        # and ignore unsynchronized ones
-        predicates = [LastKnownState.pair_state != 'synchronized',
-                      LastKnownState.pair_state != 'unsynchronized']
-        if local_folder is not None:
-            predicates.append(LastKnownState.local_folder == local_folder)
-
-        if ignore_in_error is not None and ignore_in_error > 0:
-            max_date = datetime.utcnow() - timedelta(seconds=ignore_in_error)
-            predicates.append(or_(
-                LastKnownState.last_sync_error_date == None,
-                LastKnownState.last_sync_error_date < max_date))
-
-        return session.query(LastKnownState).filter(
-            *predicates
-        ).order_by(
-            # Ensure that newly created remote folders will be synchronized
-            # before their children while keeping a fixed named based
-            # deterministic ordering to make the tests readable
-            asc(LastKnownState.remote_parent_path),
-            asc(LastKnownState.remote_name),
-            asc(LastKnownState.remote_ref),
-
-            # Ensure that newly created local folders will be synchronized
-            # before their children
-            asc(LastKnownState.local_path)
-        ).limit(limit).all()
+        return LastKnownState.query_pending(
+            session, local_folder=local_folder,
+            ignore_in_error=ignore_in_error).limit(limit).all()
 
     def next_pending(self, local_folder=None, session=None):
         """Return the next pending file to synchronize or None"""
@@ -621,6 +613,26 @@ class Controller(object):
             self._local.remote_clients = dict()
         return self._local.remote_clients
 
+    def get_digest_cache(self, local_folder):
+        """Return the persistent digest cache of the binding"""
+        digest_cache = self._digest_caches.get(local_folder)
+        if digest_cache is None:
+            digest_cache = DigestCache(self.get_session, local_folder,
+                                       hashing_service=self.hashing_service)
+            self._digest_caches[local_folder] = digest_cache
+        return digest_cache
+
+    def get_local_client(self, local_folder, background_digests=False):
+        """Return a local client sharing the digest cache of the binding
+
+        If background_digests is True, the digests of the files are computed
+        by the hashing service and are None until computed.
+        """
+        return LocalClient(local_folder,
+                           ignored_patterns=self.ignored_patterns,
+                           digest_cache=self.get_digest_cache(local_folder),
+                           background_digests=background_digests)
+
     def get_remote_fs_client(self, server_binding):
         """Return a client for the FileSystem abstraction."""
         cache = self._get_client_cache()
@@ -638,7 +650,11 @@ class Controller(object):
                 self.version,
                 proxies=self.proxies, proxy_exceptions=self.proxy_exceptions,
                 password=sb.remote_password, token=sb.remote_token,
-                timeout=self.timeout, cookie_jar=self.cookie_jar)
+                timeout=self.timeout, cookie_jar=self.cookie_jar,
+                connection_pool=self.connection_pool,
+                transfer_pool=self.transfer_pool,
+                upload_chunk_size=self.upload_chunk_size,
+                download_chunk_size=self.download_chunk_size)
             if client_cache_timestamp is None:
                 client_cache_timestamp = 0
                 self._client_cache_timestamps[cache_key] = 0
@@ -659,7 +675,12 @@ class Controller(object):
             proxies=self.proxies, proxy_exceptions=self.proxy_exceptions,
             password=sb.remote_password, token=sb.remote_token,
             repository=repository, base_folder=base_folder,
-            timeout=self.timeout, cookie_jar=self.cookie_jar)
+            ignored_patterns=self.ignored_patterns,
+            timeout=self.timeout, cookie_jar=self.cookie_jar,
+            connection_pool=self.connection_pool,
+            transfer_pool=self.transfer_pool,
+            upload_chunk_size=self.upload_chunk_size,
+            download_chunk_size=self.download_chunk_size)
 
     def invalidate_client_cache(self, server_url=None):
         for key in self._client_cache_timestamps:
@@ -725,7 +746,13 @@ class Controller(object):
         self._remote_error = error
 
     def dispose(self):
-        """Release all database resources"""
+        """Release all database, file system monitoring, hashing and
+        transfer resources"""
+        self.synchronizer.stop_local_watchers()
+        self.hashing_service.stop()
+        self.transfer_service.stop()
+        self.connection_pool.clear()
+        self.transfer_pool.clear()
         self.get_session().close_all()
         self._engine.pool.dispose()
 
@@ -1,15 +1,27 @@
 import os
+import threading
 import uuid
 import datetime
-import itertools
-from time import time
+import weakref
 from sqlalchemy import Column
+from sqlalchemy import event
 from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
 from sqlalchemy import Integer
 from sqlalchemy import Sequence
 from sqlalchemy import String
 from sqlalchemy import Boolean
+from sqlalchemy import Index
+from sqlalchemy import and_
+from sqlalchemy import case
+from sqlalchemy import literal
+from sqlalchemy import literal_column
+from sqlalchemy import or_
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import object_session
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import backref
 from sqlalchemy.ext.declarative import declarative_base
@@ -23,6 +35,16 @@ from nxdrive.client import LocalClient
 from nxdrive.utils import normalized_path
 from nxdrive.logging_config import get_logger
 from sqlalchemy.types import Binary
+from sqlalchemy.types import SmallInteger
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql import bindparam
+try:
+    from sqlalchemy.ext import baked
+except ImportError:
+    # SQLAlchemy < 1.0: the queries are compiled at each execution
+    baked = None
 
 WindowsError = None
 try:
@@ -39,7 +61,8 @@ log = get_logger(__name__)
 Base = declarative_base()
 
 
-__model_version__ = 1
+# Version of the database schema, see MIGRATIONS
+__model_version__ = 5
 
 # Summary status from last known pair of states
 
@@ -69,6 +92,72 @@ PAIR_STATES = {
     ('created', 'created'): 'conflicted',
 }
 
+# Local, remote and pair states stored by their index in this list, see
+# StateEnum: new states must be appended to keep the existing codes. Read
+# as unicode as the text columns of the previous versions.
+STATES = [
+    u'unknown',
+    u'synchronized',
+    u'created',
+    u'modified',
+    u'deleted',
+    u'locally_created',
+    u'remotely_created',
+    u'locally_modified',
+    u'remotely_modified',
+    u'locally_deleted',
+    u'remotely_deleted',
+    u'conflicted',
+    u'unsynchronized',
+]
+
+STATE_CODES = dict((state, code) for code, state in enumerate(STATES))
+
+_STATES_BY_CODE = dict(enumerate(STATES))
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class StateEnum(TypeDecorator):
+    """State stored as a small integer code, see STATES"""
+    impl = SmallInteger
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return STATE_CODES[value]
+        except KeyError:
+            raise ValueError("Unknown state %r" % value)
+
+    def result_processor(self, dialect, coltype):
+        # Looked up without calling process_result_value for each row
+        return _STATES_BY_CODE.get
+
+
+class Timestamp(TypeDecorator):
+    """Naive datetime stored as an integer count of microseconds from EPOCH
+
+    Exact and about three times smaller than the text of DateTime.
+    """
+    impl = Integer
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        delta = value - EPOCH
+        return ((delta.days * 86400 + delta.seconds) * 1000000
+                + delta.microseconds)
+
+    def result_processor(self, dialect, coltype):
+        timedelta = datetime.timedelta
+
+        def process(value):
+            if value is None:
+                return None
+            return EPOCH + timedelta(0, value // 1000000, value % 1000000)
+        return process
+
 
 class DeviceConfig(Base):
     """Holds Nuxeo Drive configuration parameters
@@ -140,73 +229,41 @@ class ServerBinding(Base):
         """Check whether at least one credential is active"""
         return self.remote_password is None and self.remote_token is None
 
+    def delete(self, session):
+        """Delete the binding and its rows with a statement per table
 
-class LastKnownState(Base):
-    """Aggregate state aggregated from last collected events."""
-    __tablename__ = 'last_known_states'
-
-    id = Column(Integer, Sequence('state_id_seq'), primary_key=True)
-
-    local_folder = Column(String, ForeignKey('server_bindings.local_folder'),
-                          index=True)
-    server_binding = relationship(
-        'ServerBinding',
-        backref=backref("states", cascade="all, delete-orphan"))
-
-    # Timestamps to detect modifications
-    last_local_updated = Column(DateTime)
-    last_remote_updated = Column(DateTime)
-
-    # Save the digest too for better updates / moves detection
-    local_digest = Column(String, index=True)
-    remote_digest = Column(String, index=True)
-
-    # Path from root using unix separator, '/' for the root it-self.
-    local_path = Column(String, index=True)
-
-    # Remote reference (instead of path based lookup)
-    remote_ref = Column(String, index=True)
-
-    # Parent path from root / ref for fast children queries,
-    # can be None for the root it-self.
-    local_parent_path = Column(String, index=True)
-    remote_parent_ref = Column(String, index=True)
-    remote_parent_path = Column(String)  # for ordering only
-
-    # Names for fast alignment queries
-    local_name = Column(String, index=True)
-    remote_name = Column(String, index=True)
+        Deleting the binding from the session would load all its rows to
+        cascade the deletion.
+        """
+        for model in (LastKnownState, FileEvent, LocalDigest, TransferJob):
+            session.query(model).filter(
+                model.local_folder == self.local_folder).delete(
+                synchronize_session='evaluate')
+        _subtree_changed(session, self.local_folder)
+        # The collections to cascade are read again, empty
+        session.expire(self, ['states', 'file_events', 'local_digests',
+                              'transfer_jobs'])
+        session.delete(self)
 
-    folderish = Column(Integer)
 
-    # Last known state based on event log
-    local_state = Column(String)
-    remote_state = Column(String)
-    pair_state = Column(String, index=True)
-
-    # TODO: remove since unused, but might brake
-    # previous Nuxeo Drive client installations
-    # Track move operations to avoid losing history
-    locally_moved_from = Column(String)
-    locally_moved_to = Column(String)
-    remotely_moved_from = Column(String)
-    remotely_moved_to = Column(String)
+def _pending_criterion(pair_state):
+    """Criterion matching the pairs to synchronize given the state column
 
-    # Flags for remote write operations
-    remote_can_rename = Column(Integer)
-    remote_can_delete = Column(Integer)
-    remote_can_update = Column(Integer)
-    remote_can_create_child = Column(Integer)
+    The state codes are literal values as SQLite only uses a partial index
+    when the query repeats its WHERE clause.
+    """
+    return pair_state.notin_([
+        literal_column(str(STATE_CODES['synchronized'])),
+        literal_column(str(STATE_CODES['unsynchronized']))])
 
-    # Last sync date
-    last_sync_date = Column(DateTime)
 
-    # Log date of sync errors to be able to skip documents in error for some
-    # time
-    last_sync_error_date = Column(DateTime)
+class PairStateMixin(object):
+    """Synchronization state of a pair of local and remote documents
 
-    # Avoid not in clauses (temporary marker)
-    in_clause_selected = Column(Integer, default=0)
+    Shared by the mapped LastKnownState and the ScannedPair created by
+    the scans, hence only relying on the attributes of the columns.
+    """
+    __slots__ = ()
 
     def __init__(self, local_folder, local_info=None,
                  remote_info=None, local_state='unknown',
@@ -258,46 +315,6 @@ class LastKnownState(Base):
     def get_local_client(self):
         return LocalClient(self.local_folder)
 
-    @staticmethod
-    def select_remote_refs(session, refs, page_size):
-        """Mark remote refs as selected"""
-        tag = time()
-        page_offset = 0
-        log.trace("Selecting refs %r", refs)
-        while (page_offset < len(refs)):
-            page_refs = itertools.islice(refs, page_offset,
-                            page_offset + page_size, None)
-            session.query(LastKnownState).filter(
-                            LastKnownState.remote_ref.in_(page_refs)).update(
-                            {'in_clause_selected': tag},
-                            synchronize_session=False)
-            page_offset += page_size
-        return tag
-
-    @staticmethod
-    def select_local_paths(session, paths, page_size):
-        """Mark local paths as selected"""
-        tag = time()
-        page_offset = 0
-        log.trace("Selecting paths %r", paths)
-        while (page_offset < len(paths)):
-            page_paths = itertools.islice(paths, page_offset,
-                            page_offset + page_size, None)
-            session.query(LastKnownState).filter(
-                            LastKnownState.local_path.in_(page_paths)).update(
-                            {'in_clause_selected': tag},
-                            synchronize_session=False)
-            page_offset += page_size
-        return tag
-
-    @staticmethod
-    def not_selected(query, tag):
-        return query.filter(LastKnownState.in_clause_selected != tag).all()
-
-    @staticmethod
-    def selected(query, tag):
-        return query.filter(LastKnownState.in_clause_selected == tag).all()
-
     def refresh_local(self, client=None, local_path=None):
         """Update the state from the local filesystem info."""
         client = client if client is not None else self.get_local_client()
@@ -336,12 +353,19 @@ class LastKnownState(Base):
         # Shall we recompute the digest from the current file?
         update_digest = self.local_digest == None
 
+        size_changed = (not local_info.folderish
+                        and self.local_size is not None
+                        and local_info.size != self.local_size)
+        self.local_size = local_info.size
+        self.local_inode = local_info.inode
+
         if self.last_local_updated is None:
             self.last_local_updated = local_info.last_modification_time
             self.folderish = local_info.folderish
             update_digest = True
 
-        elif local_info.last_modification_time != self.last_local_updated:
+        elif (local_info.last_modification_time != self.last_local_updated
+              or size_changed):
             self.last_local_updated = local_info.last_modification_time
             self.folderish = local_info.folderish
             # The time stamp of folderish folder seems to be updated when
@@ -448,6 +472,8 @@ class LastKnownState(Base):
 
     def reset_local(self):
         self.local_digest = None
+        self.local_size = None
+        self.local_inode = None
         self.local_name = None
         self.local_parent_path = None
         self.local_path = None
@@ -466,23 +492,1569 @@ class LastKnownState(Base):
         return os.path.join(self.local_folder, relative_path)
 
 
+class LastKnownState(PairStateMixin, Base):
+    """Aggregate state aggregated from last collected events."""
+    __tablename__ = 'last_known_states'
+
+    id = Column(Integer, Sequence('state_id_seq'), primary_key=True)
+
+    # Indexed along with the columns of the queries, see __table_args__
+    local_folder = Column(String, ForeignKey('server_bindings.local_folder'))
+    server_binding = relationship(
+        'ServerBinding',
+        backref=backref("states", cascade="all, delete-orphan"))
+
+    # Timestamps to detect modifications
+    last_local_updated = Column(Timestamp)
+    last_remote_updated = Column(Timestamp)
+
+    # Save the digest too for better updates / moves detection
+    local_digest = Column(String)
+    remote_digest = Column(String, index=True)
+
+    # Size and inode of the local file, to detect content changes
+    local_size = Column(Integer)
+    local_inode = Column(String)
+
+    # Path from root using unix separator, '/' for the root it-self.
+    local_path = Column(String)
+
+    # Remote reference (instead of path based lookup)
+    remote_ref = Column(String)
+
+    # Parent path from root / ref for fast children queries,
+    # can be None for the root it-self.
+    local_parent_path = Column(String)
+    remote_parent_ref = Column(String)
+    remote_parent_path = Column(String)  # for ordering only
+
+    # Names for fast alignment queries
+    local_name = Column(String, index=True)
+    remote_name = Column(String, index=True)
+
+    folderish = Column(Integer)
+
+    # Last known state based on event log
+    local_state = Column(StateEnum)
+    remote_state = Column(StateEnum)
+    pair_state = Column(StateEnum)
+
+    # Flags for remote write operations
+    remote_can_rename = Column(Integer)
+    remote_can_delete = Column(Integer)
+    remote_can_update = Column(Integer)
+    remote_can_create_child = Column(Integer)
+
+    # Last sync date
+    last_sync_date = Column(Timestamp)
+
+    # Log date of sync errors to be able to skip documents in error for some
+    # time
+    last_sync_error_date = Column(Timestamp)
+
+    # Number of descendants of a folder by status, see DESCENDANT_STATUSES,
+    # maintained by the triggers of the table and None until counted again
+    # by count_descendants when the tree of the folder has changed
+    synchronized_descendants = Column(Integer)
+    pending_descendants = Column(Integer)
+    conflicted_descendants = Column(Integer)
+    error_descendants = Column(Integer)
+
+    # Composite indexes for the queries of a given binding, the rows being
+    # ordered by id for each key
+    __table_args__ = (
+        Index('last_known_states_local_path', 'local_folder', 'local_path'),
+        Index('last_known_states_local_parent', 'local_folder',
+              'local_parent_path'),
+        Index('last_known_states_remote_ref', 'local_folder', 'remote_ref'),
+        Index('last_known_states_remote_parent', 'local_folder',
+              'remote_parent_ref'),
+        Index('last_known_states_pair_state', 'local_folder', 'pair_state'),
+        Index('last_known_states_local_digest', 'local_folder',
+              'local_digest'),
+        # Pairs to synchronize in the order of Controller.list_pending
+        Index('last_known_states_pending', 'local_folder',
+              'remote_parent_path', 'remote_name', 'remote_ref', 'local_path',
+              sqlite_where=_pending_criterion(pair_state)),
+    )
+
+    @staticmethod
+    def pending():
+        """Criterion matching the pairs to synchronize"""
+        return _pending_criterion(LastKnownState.pair_state)
+
+    @staticmethod
+    def query_pending(session, local_folder=None, ignore_in_error=None):
+        """Query the pairs to synchronize in the order of synchronization
+
+        The bound folder is read in order from the partial index of the
+        pending pairs.
+
+        If ignore_in_error is a duration in seconds, the pairs that have
+        triggered a synchronization error more recently are skipped.
+        """
+        predicates = [LastKnownState.pending()]
+        if local_folder is not None:
+            predicates.append(LastKnownState.local_folder == local_folder)
+
+        if ignore_in_error is not None and ignore_in_error > 0:
+            max_date = (datetime.datetime.utcnow()
+                        - datetime.timedelta(seconds=ignore_in_error))
+            predicates.append(or_(
+                LastKnownState.last_sync_error_date == None,
+                LastKnownState.last_sync_error_date < max_date))
+
+        return session.query(LastKnownState).filter(
+            *predicates
+        ).order_by(
+            # Ensure that newly created remote folders will be synchronized
+            # before their children while keeping a fixed named based
+            # deterministic ordering to make the tests readable
+            LastKnownState.remote_parent_path.asc(),
+            LastKnownState.remote_name.asc(),
+            LastKnownState.remote_ref.asc(),
+
+            # Ensure that newly created local folders will be synchronized
+            # before their children
+            LastKnownState.local_path.asc())
+
+    @staticmethod
+    def query_local_children(session, local_folder, local_path,
+                             remote_ref=None):
+        """Query the pairs of the local children of a folder by id
+
+        If the remote ref of the folder is given, the pairs of its remote
+        children not bound to a local file yet are included.
+        """
+        if remote_ref is None:
+            return _query_local_children(
+                session, local_folder=local_folder, local_path=local_path)
+        return _query_local_and_unbound_children(
+            session, local_folder=local_folder, local_path=local_path,
+            remote_ref=remote_ref)
+
+    @staticmethod
+    def query_remote_children(session, local_folder, remote_ref):
+        """Query the pairs of the remote children of a folder by id"""
+        return _query_remote_children(
+            session, local_folder=local_folder, remote_ref=remote_ref)
+
+    @staticmethod
+    def query_unbound_local_children(session, local_folder, local_path):
+        """Query the pairs of the local children not bound remotely by id"""
+        return _query_unbound_local_children(
+            session, local_folder=local_folder, local_path=local_path)
+
+    @staticmethod
+    def get_by_local_path(session, local_folder, local_path):
+        """Return the pair of a local path or None"""
+        return _query_local_path(
+            session, local_folder=local_folder, local_path=local_path).first()
+
+    @staticmethod
+    def count_descendants(session, local_folder):
+        """Count again the descendants of the folders of a bound folder
+
+        Only the folders the tree of which has changed are visited, from the
+        root, as their counters and the ones of their ancestors are NULL.
+        """
+        session.flush()
+        table = LastKnownState.__table__
+        roots = session.execute(select(_counted_columns).where(and_(
+            table.c.local_folder == local_folder,
+            table.c.local_path == u'/'))).fetchall()
+        for root in roots:
+            if _descendant_counts(root) is None:
+                _count_descendants(session, root, True)
+
+    @staticmethod
+    def get_local_children_counts(session, local_folder, local_path):
+        """Return the rows of the local children of a folder with counters
+
+        The counters of the descendants of the folders by status are read
+        from the rows, the ones to be counted again being counted without
+        writing to the database. They are None for the files.
+        """
+        table = LastKnownState.__table__
+        children = session.execute(select([table]).where(and_(
+            table.c.local_folder == local_folder,
+            table.c.local_parent_path == local_path)).order_by(
+            table.c.local_name, table.c.remote_name)).fetchall()
+        results = []
+        for child in children:
+            counts = None
+            if child['folderish']:
+                counts = _descendant_counts(child)
+                if counts is None:
+                    counts = _count_descendants(session, child, False)
+            results.append((child, counts))
+        return results
+
+    @staticmethod
+    def local_subtree(local_path):
+        """Criterion matching the pairs of a local path and its descendants
+
+        A range of paths is used instead of LIKE that is case insensitive
+        under SQLite: '0' is the character following '/'.
+        """
+        if local_path == u'/':
+            return LastKnownState.local_path != None
+        return or_(LastKnownState.local_path == local_path,
+                   and_(LastKnownState.local_path > local_path + u'/',
+                        LastKnownState.local_path < local_path + u'0'))
+
+    @staticmethod
+    def locally_modified():
+        """Criterion matching the pairs modified since their synchronization
+
+        The pairs never synchronized are considered as modified.
+        """
+        return or_(LastKnownState.last_sync_date == None,
+                   and_(LastKnownState.last_local_updated != None,
+                        LastKnownState.last_local_updated
+                        > LastKnownState.last_sync_date))
+
+    @staticmethod
+    def supports_subtree_queries(session):
+        """Check that SQLite supports the recursive queries of query_subtree
+
+        Recursive common table expressions require SQLite 3.8.3.
+        """
+        version = session.get_bind().dialect.server_version_info
+        return version is not None and tuple(version) >= (3, 8, 3)
+
+    @staticmethod
+    def query_subtree(session, pair, local=True, remote=True):
+        """Query the pairs of a folder and of its descendants
+
+        The descendants are the local children of the folder if local is
+        True and its remote children if remote is True, then theirs and so
+        on, walked by a recursive common table expression.
+        """
+        session.flush()
+        # Rendered in the IN clause rather than hoisted before the statement:
+        # the sqlite3 module commits the transaction before the statements
+        # not starting with SELECT, INSERT, UPDATE or DELETE
+        criteria = []
+        # The binding is repeated in each branch of the OR clause so that
+        # SQLite looks up both parent indexes
+        if local:
+            criteria.append("child.local_folder = :local_folder"
+                            " AND child.local_parent_path = subtree.local_path")
+        if remote:
+            criteria.append("child.local_folder = :local_folder"
+                            " AND child.remote_parent_ref = subtree.remote_ref")
+        subtree = text(
+            "WITH RECURSIVE subtree(id, local_path, remote_ref) AS ("
+            " SELECT id, local_path, remote_ref FROM last_known_states"
+            " WHERE id = :pair_id"
+            " UNION SELECT child.id, child.local_path, child.remote_ref"
+            " FROM last_known_states AS child, subtree"
+            " WHERE (%s))"
+            " SELECT id FROM subtree" % ") OR (".join(criteria)
+        ).bindparams(pair_id=pair.id, local_folder=pair.local_folder)
+        return session.query(LastKnownState).filter(
+            LastKnownState.id.in_(subtree.columns(LastKnownState.id)))
+
+    @staticmethod
+    def mark_unknown_unsynchronized(session, pair):
+        """Mark the unsynchronized pairs of a local tree as unknown
+
+        Return the number of updated pairs, queried by state as few pairs
+        are unsynchronized.
+        """
+        query = session.query(LastKnownState).filter(
+            LastKnownState.local_folder == pair.local_folder,
+            LastKnownState.pair_state == 'unsynchronized',
+            LastKnownState.local_subtree(pair.local_path))
+        # Run for each scanned folder: only read if there is nothing to do
+        if query.first() is None:
+            return 0
+        count = query.update({LastKnownState.pair_state: 'unknown'},
+                             synchronize_session='evaluate')
+        _subtree_changed(session, pair.local_folder)
+        return count
+
+    @staticmethod
+    def mark_locally_deleted(session, pair):
+        """Mark a pair and its local descendants as locally deleted
+
+        The pairs not bound to a remote document are deleted. The tree is
+        updated by a statement per operation, as update_local(None) and
+        session.delete would do for each pair.
+        """
+        session.flush()
+        query = session.query(LastKnownState).filter(
+            LastKnownState.local_folder == pair.local_folder,
+            LastKnownState.local_subtree(pair.local_path))
+        _mark_deleted(query.filter(LastKnownState.remote_ref != None),
+                      'local')
+        query.filter(LastKnownState.remote_ref == None).delete(
+            synchronize_session='fetch')
+        LocalDigest.delete_subtree(session, pair.local_folder,
+                                   pair.local_path)
+        _subtree_changed(session, pair.local_folder)
+
+    @staticmethod
+    def mark_remotely_deleted(session, pair):
+        """Mark a pair and its remote descendants as remotely deleted
+
+        The pairs not bound to a local file are deleted, see
+        mark_locally_deleted. Requires supports_subtree_queries.
+        """
+        query = LastKnownState.query_subtree(session, pair, local=False)
+        # The remote descendants are not reachable any more once the pairs
+        # of their parents are deleted
+        _mark_deleted(query.filter(LastKnownState.local_path != None),
+                      'remote')
+        query.filter(LastKnownState.local_path == None).delete(
+            synchronize_session='fetch')
+        _subtree_changed(session, pair.local_folder)
+
+    @staticmethod
+    def delete_subtree(session, pair):
+        """Delete a pair and its local and remote descendants
+
+        The digests of their local files are deleted too. Requires
+        supports_subtree_queries.
+        """
+        subtree = LastKnownState.query_subtree(session, pair)
+        session.query(LocalDigest).filter(
+            LocalDigest.local_folder == pair.local_folder,
+            LocalDigest.local_path.in_(subtree.filter(
+                LastKnownState.local_path != None).with_entities(
+                    LastKnownState.local_path).subquery()),
+        ).delete(synchronize_session='fetch')
+        subtree.delete(synchronize_session='fetch')
+        _subtree_changed(session, pair.local_folder)
+
+    @staticmethod
+    def move_local_descendants(session, local_folder, local_path, new_path):
+        """Update the local paths of the descendants of a moved folder
+
+        The prefix of the paths is replaced by a single statement whatever
+        the size of the tree, the descendants loaded in the session being
+        expired. The length of the prefix is computed by SQLite: Python
+        narrow builds count the characters out of the BMP twice.
+        """
+        session.flush()
+        start = func.length(local_path) + 1
+        session.query(LastKnownState).filter(
+            LastKnownState.local_folder == local_folder,
+            LastKnownState.local_path > local_path + u'/',
+            LastKnownState.local_path < local_path + u'0',
+        ).update({
+            LastKnownState.local_path: new_path + func.substr(
+                LastKnownState.local_path, start),
+            LastKnownState.local_parent_path: new_path + func.substr(
+                LastKnownState.local_parent_path, start),
+        }, synchronize_session='fetch')
+        _subtree_changed(session, local_folder)
+
+    @staticmethod
+    def move_remote_descendants(session, local_folder, remote_ref,
+                                remote_path):
+        """Update the remote parent paths of the descendants of a folder
+
+        remote_path is the new remote path of the folder. The children of
+        each sub folder are updated at once.
+        """
+        session.flush()
+        folders = [(remote_ref, remote_path)]
+        visited = set()
+        while folders:
+            remote_ref, remote_path = folders.pop()
+            visited.add(remote_ref)
+            children = session.query(LastKnownState).filter_by(
+                local_folder=local_folder, remote_parent_ref=remote_ref)
+            children.update({LastKnownState.remote_parent_path: remote_path},
+                            synchronize_session='evaluate')
+            folders.extend(
+                (ref, remote_path + u'/' + ref)
+                for ref, in children.filter_by(folderish=True).values(
+                    LastKnownState.remote_ref)
+                if ref is not None and ref not in visited)
+        _subtree_changed(session, local_folder)
+
+
+# Statuses of the pairs counted in the descendants of the folders: the pairs
+# neither synchronized nor conflicted are in error if their last
+# synchronization failed, pending otherwise
+DESCENDANT_STATUSES = ('synchronized', 'pending', 'conflicted', 'error')
+
+
+def _pair_status(pair_state, last_sync_error_date):
+    if pair_state in ('synchronized', 'conflicted'):
+        return pair_state
+    if last_sync_error_date is not None:
+        return 'error'
+    return 'pending'
+
+
+def _status_sql(row, status):
+    """SQL expression of a row of a trigger being 1 if of the status"""
+    pair_state = "COALESCE(%s.pair_state, -1)" % row
+    if status in ('synchronized', 'conflicted'):
+        return "(%s = %d)" % (pair_state, STATE_CODES[status])
+    return ("(%s NOT IN (%d, %d) AND %s.last_sync_error_date IS %s)"
+            % (pair_state, STATE_CODES['synchronized'],
+               STATE_CODES['conflicted'], row,
+               'NOT NULL' if status == 'error' else 'NULL'))
+
+
+def _count_sql(row, status):
+    """SQL expression of the count of a pair and its descendants by status
+
+    NULL for a folder to be counted again, the counters of its ancestors
+    becoming NULL in turn.
+    """
+    return ("(%s + CASE WHEN %s.folderish THEN %s.%s_descendants ELSE 0 END)"
+            % (_status_sql(row, status), row, row, status))
+
+
+def _update_parent_sql(row, deltas):
+    """SQL statements adding deltas to the counters of the parent of a row
+
+    The parent folder of a local pair is looked up by local path, the one
+    of a pair only known remotely by remote reference.
+    """
+    assignments = ', '.join('%s_descendants = %s_descendants + %s'
+                            % (status, status, deltas[status])
+                            for status in DESCENDANT_STATUSES)
+    return ("UPDATE last_known_states SET %(assignments)s"
+            " WHERE %(row)s.local_path IS NOT NULL"
+            " AND local_folder = %(row)s.local_folder"
+            " AND local_path = %(row)s.local_parent_path;"
+            " UPDATE last_known_states SET %(assignments)s"
+            " WHERE %(row)s.local_path IS NULL"
+            " AND local_folder = %(row)s.local_folder"
+            " AND remote_ref = %(row)s.remote_parent_ref;"
+            % dict(assignments=assignments, row=row))
+
+
+def _trigger_sql(name, event, when, body):
+    return ("CREATE TRIGGER IF NOT EXISTS last_known_states_%s %s"
+            " ON last_known_states%s BEGIN %s END"
+            % (name, event, ' WHEN ' + when if when else '', body))
+
+
+def _deltas(*terms):
+    """SQL expressions of the sums of counts of rows by status"""
+    return dict((status, ' '.join('%s%s' % (sign, _count_sql(row, status))
+                                  for sign, row in terms))
+                for status in DESCENDANT_STATUSES)
+
+
+# Position of a pair in the tree and identity of a folder for its children
+_same_position_sql = ' AND '.join(
+    'OLD.%s IS NEW.%s' % (column, column) for column in (
+        'local_folder', 'local_path', 'local_parent_path',
+        'remote_parent_ref'))
+_renamed_folder_sql = ('NEW.folderish AND NEW.pending_descendants IS NOT NULL'
+                       ' AND (OLD.local_path IS NOT NEW.local_path'
+                       ' OR OLD.remote_ref IS NOT NEW.remote_ref)')
+_changed_counts_sql = ' OR '.join(
+    '%s IS NOT %s' % (_count_sql('OLD', status), _count_sql('NEW', status))
+    for status in DESCENDANT_STATUSES)
+
+# Triggers maintaining the counters of the descendants of the folders for
+# any write, from the ORM, Core statements or another connection: a change
+# of status is added to the counters of the parent folder, the update of
+# which is in turn added to its own parent up to the root (PRAGMA
+# recursive_triggers is enabled on each connection). The counters of a
+# renamed folder, the children of which are moved one by one, are reset to
+# NULL as are those of the new folders, for being counted again by
+# LastKnownState.count_descendants.
+DESCENDANT_COUNTERS_TRIGGERS = [
+    _trigger_sql('count_insert', 'AFTER INSERT', None,
+                 _update_parent_sql('NEW', _deltas(('', 'NEW')))),
+    _trigger_sql('count_delete', 'AFTER DELETE', None,
+                 _update_parent_sql('OLD', _deltas(('-', 'OLD')))),
+    _trigger_sql('count_update', 'AFTER UPDATE',
+                 '%s AND (%s)' % (_same_position_sql, _changed_counts_sql),
+                 _update_parent_sql('NEW', _deltas(('', 'NEW'),
+                                                   ('- ', 'OLD')))),
+    _trigger_sql('count_move', 'AFTER UPDATE',
+                 'NOT (%s)' % _same_position_sql,
+                 _update_parent_sql('OLD', _deltas(('-', 'OLD'))) + ' '
+                 + _update_parent_sql('NEW', _deltas(('', 'NEW')))),
+    _trigger_sql('count_rename', 'AFTER UPDATE', _renamed_folder_sql,
+                 'UPDATE last_known_states SET %s WHERE id = NEW.id;'
+                 % ', '.join('%s_descendants = NULL' % status
+                             for status in DESCENDANT_STATUSES)),
+]
+
+
+def _create_triggers(bind):
+    """Create the triggers counting the descendants of the folders"""
+    for statement in DESCENDANT_COUNTERS_TRIGGERS:
+        bind.execute(statement)
+
+
+event.listen(LastKnownState.__table__, 'after_create',
+             lambda target, connection, **kw: _create_triggers(connection))
+
+
+_counted_columns = [LastKnownState.__table__.c[name] for name in (
+    'id', 'local_folder', 'local_path', 'remote_ref', 'folderish',
+    'pair_state', 'last_sync_error_date')] + [
+    LastKnownState.__table__.c[status + '_descendants']
+    for status in DESCENDANT_STATUSES]
+
+
+def _descendant_counts(row):
+    """Return the counters of a folder row by status, None if to count"""
+    counts = dict((status, row[status + '_descendants'])
+                  for status in DESCENDANT_STATUSES)
+    if None in counts.values():
+        return None
+    return counts
+
+
+def _count_descendants(session, folder, write):
+    """Count the descendants of a folder row by status
+
+    The sub folders are only visited if their counters are NULL. If write
+    is True, the counters are saved, their triggers leaving the ones of the
+    ancestors NULL.
+    """
+    table = LastKnownState.__table__
+    in_binding = table.c.local_folder == folder['local_folder']
+    criteria = []
+    if folder['local_path'] is not None:
+        criteria.append(and_(in_binding,
+                             table.c.local_parent_path == folder['local_path'],
+                             table.c.local_path != None))
+    if folder['remote_ref'] is not None:
+        criteria.append(and_(in_binding,
+                             table.c.remote_parent_ref == folder['remote_ref'],
+                             table.c.local_path == None))
+    counts = dict.fromkeys(DESCENDANT_STATUSES, 0)
+    if criteria:
+        children = session.execute(
+            select(_counted_columns).where(or_(*criteria))).fetchall()
+        for child in children:
+            counts[_pair_status(child['pair_state'],
+                                child['last_sync_error_date'])] += 1
+            if not child['folderish']:
+                continue
+            child_counts = _descendant_counts(child)
+            if child_counts is None:
+                child_counts = _count_descendants(session, child, write)
+            for status in DESCENDANT_STATUSES:
+                counts[status] += child_counts[status]
+    if write:
+        session.execute(table.update().where(
+            table.c.id == folder['id']).values(
+            **dict((status + '_descendants', counts[status])
+                   for status in DESCENDANT_STATUSES)))
+    return counts
+
+
+def _mark_deleted(query, side):
+    """Update the pairs of a query as update_local / update_remote(None)
+
+    side is the side of the deleted documents, 'local' or 'remote'.
+    """
+    other = 'remote' if side == 'local' else 'local'
+    state = getattr(LastKnownState, side + '_state')
+    other_state = getattr(LastKnownState, other + '_state')
+    whens = []
+    for (local_state, remote_state), pair_state in sorted(PAIR_STATES.items()):
+        states = dict(local=local_state, remote=remote_state)
+        if states[side] == 'deleted':
+            whens.append((other_state == states[other],
+                          literal(pair_state, StateEnum)))
+    query.filter(state.in_(('unknown', 'created', 'modified',
+                            'synchronized'))).update({
+        state: 'deleted',
+        LastKnownState.pair_state: case(
+            whens, else_=literal('unknown', StateEnum)),
+    }, synchronize_session='fetch')
+
+
+def _subtree_changed(session, local_folder):
+    # The pairs of the indexes and the queues of the session have been
+    # updated or deleted by bulk statements
+    PairIndex.invalidate(session, local_folder)
+    _touch_pending_queues(session)
+
+
+_bakery = baked.bakery() if baked is not None else None
+
+
+def bake_query(build):
+    """Return a function running the query built by build(session)
+
+    The SQL of the query is compiled once if baked queries are supported.
+    The values of its bindparam criteria are given to the function as
+    keyword arguments after the session.
+    """
+    if _bakery is None:
+        return lambda session, **params: build(session).params(**params)
+    query = _bakery(build)
+    return lambda session, **params: query(session).params(**params)
+
+
+# Lookups of the scans, run for each folder
+_query_local_children = bake_query(
+    lambda session: session.query(LastKnownState).filter(
+        LastKnownState.local_folder == bindparam('local_folder'),
+        LastKnownState.local_parent_path == bindparam('local_path'),
+    ).order_by(LastKnownState.id))
+
+# The binding is repeated in each branch of the OR clause so that SQLite
+# looks up both parent indexes
+_query_local_and_unbound_children = bake_query(
+    lambda session: session.query(LastKnownState).filter(or_(
+        and_(LastKnownState.local_folder == bindparam('local_folder'),
+             LastKnownState.local_parent_path == bindparam('local_path')),
+        and_(LastKnownState.local_folder == bindparam('local_folder'),
+             LastKnownState.local_path == None,
+             LastKnownState.remote_parent_ref == bindparam('remote_ref')),
+    )).order_by(LastKnownState.id))
+
+_query_remote_children = bake_query(
+    lambda session: session.query(LastKnownState).filter(
+        LastKnownState.local_folder == bindparam('local_folder'),
+        LastKnownState.remote_parent_ref == bindparam('remote_ref'),
+    ).order_by(LastKnownState.id))
+
+_query_unbound_local_children = bake_query(
+    lambda session: session.query(LastKnownState).filter(
+        LastKnownState.local_folder == bindparam('local_folder'),
+        LastKnownState.local_parent_path == bindparam('local_path'),
+        LastKnownState.remote_ref == None,
+    ).order_by(LastKnownState.id))
+
+_query_local_path = bake_query(
+    lambda session: session.query(LastKnownState).filter(
+        LastKnownState.local_folder == bindparam('local_folder'),
+        LastKnownState.local_path == bindparam('local_path')))
+
+
+class ScannedPair(PairStateMixin):
+    """Pair created by a scan, inserted in batches by a PairWriter
+
+    Plain objects are much cheaper to build than mapped instances that the
+    session tracks until the end of the scan.
+    """
+    __slots__ = tuple(column.name
+                      for column in LastKnownState.__table__.columns)
+
+    def __init__(self, *args, **kwargs):
+        for column in LastKnownState.__table__.columns:
+            default = column.default
+            setattr(self, column.name,
+                    default.arg if getattr(default, 'is_scalar', False)
+                    else None)
+        super(ScannedPair, self).__init__(*args, **kwargs)
+
+    def get_values(self):
+        """Return the values of the columns to insert"""
+        return dict((name, getattr(self, name)) for name in self.__slots__
+                    if name != 'id')
+
+
+class PairWriter(object):
+    """Insert the pairs created by a scan with executemany statements
+
+    The rows are written by batches in the transaction of the session:
+    they are only visible to the queries once flushed.
+    """
+
+    batch_size = 1000
+
+    def __init__(self, session, batch_size=None):
+        self.session = session
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.count = 0
+        self._rows = []
+
+    def add(self, pair):
+        self._rows.append(pair.get_values())
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        self.session.execute(LastKnownState.__table__.insert(), self._rows)
+        # The indexes and the queues of the session do not know the inserted
+        # rows
+        for local_folder in set(row['local_folder'] for row in self._rows):
+            PairIndex.invalidate(self.session, local_folder)
+        _touch_pending_queues(self.session)
+        self.count += len(self._rows)
+        self._rows = []
+
+
+# Indexes of the pairs loaded in each session by bound local folder, see
+# PairIndex.get
+_pair_indexes = weakref.WeakKeyDictionary()
+
+# Last value of PRAGMA data_version read by each session
+_data_versions = weakref.WeakKeyDictionary()
+
+
+class PairIndex(object):
+    """In-memory index of the pairs of a bound folder
+
+    The pairs are looked up by local path, remote ref, local parent path,
+    remote parent ref, local name and local digest without querying the
+    database.
+
+    The index of a session returned by get follows the changes made to its
+    mapped pairs: the indexed attributes set, the pairs added to the session
+    and the deleted ones, the session writing them behind to the database
+    when flushed. The rows inserted by a PairWriter, a rollback and the
+    changes committed by other connections (see refresh) invalidate it, the
+    pairs being loaded again on next use.
+
+    The pairs of the bindings of more than max_size pairs are not loaded:
+    they are queried by each lookup.
+    """
+
+    keys = ('local_path', 'remote_ref', 'local_parent_path',
+            'remote_parent_ref', 'local_name', 'local_digest')
+
+    max_size = 100000
+
+    def __init__(self, session, local_folder, pairs=None):
+        self.session = session
+        self.local_folder = local_folder
+        self._pairs = dict((key, dict()) for key in self.keys)
+        self._keys = dict()
+        self.loaded = pairs is not None
+        if pairs is None and session.query(func.count(LastKnownState.id)
+            ).filter_by(local_folder=local_folder).scalar() <= self.max_size:
+            pairs = session.query(LastKnownState).filter_by(
+                local_folder=local_folder).order_by(LastKnownState.id)
+            self.loaded = True
+        for pair in pairs or ():
+            self.add(pair)
+
+    @classmethod
+    def get(cls, session, local_folder):
+        """Return the index of the pairs of a bound folder in a session"""
+        indexes = _pair_indexes.setdefault(session, dict())
+        index = indexes.get(local_folder)
+        if index is None:
+            index = indexes[local_folder] = cls(session, local_folder)
+        return index
+
+    @staticmethod
+    def invalidate(session, local_folder=None):
+        """Drop the indexes of a session, all of them if local_folder is None
+        """
+        indexes = _pair_indexes.get(session)
+        if not indexes:
+            return
+        if local_folder is None:
+            indexes.clear()
+        else:
+            indexes.pop(local_folder, None)
+
+    @staticmethod
+    def refresh(session):
+        """Forget the pairs of a session if other connections changed them
+
+        The indexes are dropped and the loaded pairs expired when the
+        database has been modified by another connection since the previous
+        call.
+        """
+        version = session.execute('PRAGMA data_version').scalar()
+        previous = _data_versions.get(session)
+        _data_versions[session] = version
+        if version is None or version != previous:
+            PairIndex.invalidate(session)
+            session.expire_all()
+
+    def add(self, pair):
+        if pair in self._keys:
+            return
+        keys = tuple(getattr(pair, key) for key in self.keys)
+        self._keys[pair] = keys
+        for key, value in zip(self.keys, keys):
+            if value is not None:
+                self._pairs[key].setdefault(value, []).append(pair)
+
+    def discard(self, pair):
+        keys = self._keys.pop(pair, None)
+        if keys is None:
+            return
+        for key, value in zip(self.keys, keys):
+            if value is not None:
+                self._pairs[key][value].remove(pair)
+
+    def reindex(self, pair, key, value):
+        """Index pair under the new value of one of its keys"""
+        keys = self._keys.get(pair)
+        if keys is None:
+            return
+        i = self.keys.index(key)
+        pairs = self._pairs[key]
+        if keys[i] is not None:
+            pairs[keys[i]].remove(pair)
+        if value is not None:
+            pairs.setdefault(value, []).append(pair)
+        self._keys[pair] = keys[:i] + (value,) + keys[i + 1:]
+
+    def _lookup(self, key, value):
+        """Return the indexed pairs of a key value, dropping deleted ones"""
+        pairs = self._pairs[key].get(value)
+        if not pairs:
+            return []
+        deleted = self.session.deleted
+        alive = []
+        for pair in list(pairs):
+            if pair in deleted:
+                continue
+            if pair not in self.session:
+                # Deleted since flushed
+                self.discard(pair)
+                continue
+            alive.append(pair)
+        return alive
+
+    def _find(self, key, value):
+        """Return the pairs of a key value in the order of creation"""
+        if value is None:
+            return []
+        if not self.loaded:
+            return self.session.query(LastKnownState).filter(
+                LastKnownState.local_folder == self.local_folder,
+                getattr(LastKnownState, key) == value,
+            ).order_by(LastKnownState.id).all()
+        return self._lookup(key, value)
+
+    def _get(self, key, value):
+        pairs = self._find(key, value)
+        if pairs or value is None or not self.loaded:
+            return pairs[0] if pairs else None
+        # Not indexed: look it up in the database in case the index missed
+        # it
+        pair = self.session.query(LastKnownState).filter(
+            LastKnownState.local_folder == self.local_folder,
+            getattr(LastKnownState, key) == value,
+        ).order_by(LastKnownState.id).first()
+        if pair is not None:
+            self.add(pair)
+        return pair
+
+    def get_by_local_path(self, local_path):
+        """Return the pair of a local path or None"""
+        return self._get('local_path', local_path)
+
+    def get_by_remote_ref(self, remote_ref):
+        """Return the first pair of a remote ref or None"""
+        return self._get('remote_ref', remote_ref)
+
+    def get_local_children(self, local_path):
+        """Return the pairs of the children of a local folder"""
+        return self._find('local_parent_path', local_path)
+
+    def get_remote_children(self, remote_ref):
+        """Return the pairs of the children of a remote folder"""
+        return self._find('remote_parent_ref', remote_ref)
+
+    def get_by_local_name(self, local_name):
+        """Return the pairs of a local name"""
+        return self._find('local_name', local_name)
+
+    def get_by_local_digest(self, local_digest):
+        """Return the pairs of the local files of a digest"""
+        return self._find('local_digest', local_digest)
+
+
+def _get_pair_index(pair):
+    session = object_session(pair)
+    if session is None:
+        return None
+    return _pair_indexes.get(session, {}).get(pair.local_folder)
+
+
+def _reindex_pair(key):
+    def listener(pair, value, oldvalue, initiator):
+        index = _get_pair_index(pair)
+        if index is not None:
+            index.reindex(pair, key, value)
+    return listener
+
+
+for _key in PairIndex.keys:
+    event.listen(getattr(LastKnownState, _key), 'set', _reindex_pair(_key))
+
+
+def _index_attached_pair(session, instance):
+    if isinstance(instance, LastKnownState):
+        index = _get_pair_index(instance)
+        if index is not None and index.loaded:
+            index.add(instance)
+
+
+event.listen(Session, 'after_attach', _index_attached_pair)
+event.listen(Session, 'after_soft_rollback',
+             lambda session, previous_transaction:
+             PairIndex.invalidate(session))
+
+
+# Pending queues reading the pairs of each session, see PendingQueue
+_pending_queues = weakref.WeakKeyDictionary()
+
+
+class PendingQueue(object):
+    """Queue of the pairs to synchronize
+
+    The queue is persisted by the partial index of the pending pairs: the
+    scans enqueue a pair by updating its state and a synchronized pair
+    leaves it. The pairs are read in the order of synchronization by
+    batches of batch_size pairs, see LastKnownState.query_pending.
+
+    A batch is served until exhausted unless pairs of the session are added
+    or change state or position in the queue, the next batch being read
+    then. The changes of the current pair, being synchronized, only count if
+    it is still pending afterwards. The pairs synchronized or deleted in the
+    mean time are skipped. A batch expired by a commit is read again at once
+    rather than loading its pairs one by one.
+    """
+
+    batch_size = 100
+
+    # Attributes of the pairs defining their state and position in the queue
+    keys = ('pair_state', 'remote_parent_path', 'remote_name', 'remote_ref',
+            'local_path')
+
+    def __init__(self, session, local_folder=None, ignore_in_error=None,
+                 batch_size=None):
+        self.session = session
+        self.local_folder = local_folder
+        self.ignore_in_error = ignore_in_error
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.current = None
+        self.or_more = False
+        self.reads = 0
+        self._pairs = []
+        self._stale = True
+        self._current_changed = False
+        _pending_queues.setdefault(session, weakref.WeakSet()).add(self)
+
+    def invalidate(self):
+        """Read a new batch on next access"""
+        self._stale = True
+
+    def touch(self, pair):
+        """Take into account the change of a pair of the session"""
+        if pair is None or pair is not self.current:
+            self._stale = True
+        else:
+            self._current_changed = True
+
+    def _is_pending(self, pair):
+        return (pair in self.session and pair not in self.session.deleted
+                and pair.pair_state not in ('synchronized', 'unsynchronized'))
+
+    def get_pairs(self):
+        """Return the pairs of the current batch in order"""
+        if (self.current is not None and self._current_changed
+            and self._is_pending(self.current)):
+            self._stale = True
+        self.current = None
+        self._current_changed = False
+        if not self._stale:
+            if any('pair_state' not in pair.__dict__ for pair in self._pairs):
+                self._stale = True
+            else:
+                self._pairs = [pair for pair in self._pairs
+                               if self._is_pending(pair)]
+        if self._stale or (not self._pairs and self.or_more):
+            self._pairs = LastKnownState.query_pending(
+                self.session, local_folder=self.local_folder,
+                ignore_in_error=self.ignore_in_error,
+            ).limit(self.batch_size).all()
+            self.or_more = len(self._pairs) == self.batch_size
+            self.reads += 1
+            self._stale = False
+        return list(self._pairs)
+
+    def remove(self, pair):
+        """Remove a pair from the batch, set as the current one"""
+        self._pairs.remove(pair)
+        self.current = pair
+
+
+def _touch_pending_queues(session, pair=None):
+    if session is None:
+        return
+    for queue in list(_pending_queues.get(session, ())):
+        queue.touch(pair)
+
+
+def _touch_queued_pair(pair, value, oldvalue, initiator):
+    if value != oldvalue:
+        _touch_pending_queues(object_session(pair), pair)
+
+
+for _key in PendingQueue.keys:
+    event.listen(getattr(LastKnownState, _key), 'set', _touch_queued_pair)
+event.listen(Session, 'after_attach',
+             lambda session, instance: isinstance(instance, LastKnownState)
+             and _touch_pending_queues(session))
+event.listen(Session, 'after_soft_rollback',
+             lambda session, previous_transaction:
+             _touch_pending_queues(session))
+
+
 class FileEvent(Base):
+    """Journal of the local changes to process for a bound folder
+
+    Rows with a path are local changes reported by the file system watcher
+    that have not been processed yet, in arrival order. The row with a NULL
+    path is a checkpoint recording that a complete local scan of the bound
+    folder has been performed: without it the journal cannot be trusted and
+    a full scan is required.
+    """
     __tablename__ = 'fileevents'
 
     id = Column(Integer, Sequence('fileevent_id_seq'), primary_key=True)
-    local_folder = Column(String, ForeignKey('server_bindings.local_folder'))
+    local_folder = Column(String, ForeignKey('server_bindings.local_folder'),
+                          index=True)
     utc_time = Column(DateTime)
     path = Column(String)
 
-    server_binding = relationship("ServerBinding")
+    server_binding = relationship(
+        'ServerBinding',
+        backref=backref("file_events", cascade="all, delete-orphan"))
 
     def __init__(self, local_folder, path, utc_time=None):
         self.local_folder = local_folder
+        self.path = path
         if utc_time is None:
-            utc_time = datetime.utcnow()
+            utc_time = datetime.datetime.utcnow()
+        self.utc_time = utc_time
+
+    def __repr__(self):
+        return "FileEvent<local_folder=%r, path=%r, utc_time=%r>" % (
+            os.path.basename(self.local_folder), self.path, self.utc_time)
 
+    @classmethod
+    def record(cls, session, local_folder, paths):
+        """Append the changed paths to the journal
 
-def init_db(nxdrive_home, echo=False, scoped_sessions=True, poolclass=None):
+        Paths that are already waiting in the journal are not recorded twice
+        so that the journal stays compact.
+        """
+        if not paths:
+            return
+        journaled = set(path for path, in session.query(cls.path).filter(
+            cls.local_folder == local_folder, cls.path != None))
+        utc_time = datetime.datetime.utcnow()
+        rows = [dict(local_folder=local_folder, path=path, utc_time=utc_time)
+                for path in sorted(paths) if path not in journaled]
+        if rows:
+            session.execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def get_pending(cls, session, local_folder):
+        """Return the id of the last journaled change and the changed paths"""
+        rows = session.query(cls.id, cls.path).filter(
+            cls.local_folder == local_folder,
+            cls.path != None).order_by(cls.id).all()
+        if not rows:
+            return None, []
+        return rows[-1][0], [path for _, path in rows]
+
+    @classmethod
+    def clear(cls, session, local_folder, last_id=None):
+        """Remove the processed changes up to last_id, all if None"""
+        query = session.query(cls).filter(cls.local_folder == local_folder,
+                                          cls.path != None)
+        if last_id is not None:
+            query = query.filter(cls.id <= last_id)
+        query.delete(synchronize_session=False)
+
+    @classmethod
+    def get_checkpoint(cls, session, local_folder):
+        """UTC time of the last complete local scan, None if unknown"""
+        checkpoint = session.query(cls).filter(
+            cls.local_folder == local_folder, cls.path == None).first()
+        return checkpoint.utc_time if checkpoint is not None else None
+
+    @classmethod
+    def set_checkpoint(cls, session, local_folder):
+        """Record that a complete local scan has just been performed"""
+        cls.clear_checkpoint(session, local_folder)
+        session.add(cls(local_folder, None))
+
+    @classmethod
+    def clear_checkpoint(cls, session, local_folder):
+        """Force a complete local scan at next startup"""
+        session.query(cls).filter(cls.local_folder == local_folder,
+                                  cls.path == None).delete(
+                                      synchronize_session=False)
+
+
+class LocalDigest(Base):
+    """Persistent cache of the digests of the local files
+
+    A digest is valid as long as the size, modification time and inode of
+    the file are unchanged. The digests of a file are deleted along with its
+    pair and moved along with it when renamed or moved by the synchronizer.
+    """
+    __tablename__ = 'local_digests'
+    __table_args__ = (
+        Index('local_digests_path', 'local_folder', 'local_path',
+              'digest_func', unique=True),
+    )
+
+    id = Column(Integer, Sequence('local_digest_id_seq'), primary_key=True)
+    local_folder = Column(String, ForeignKey('server_bindings.local_folder'))
+    local_path = Column(String)
+    digest_func = Column(String)
+    size = Column(Integer)
+    last_modification_time = Column(Timestamp)
+    inode = Column(String)
+    digest = Column(String)
+
+    server_binding = relationship(
+        'ServerBinding',
+        backref=backref("local_digests", cascade="all, delete-orphan"))
+
+    def __init__(self, local_folder, local_path, digest_func):
+        self.local_folder = local_folder
+        self.local_path = local_path
+        self.digest_func = digest_func
+
+    def __repr__(self):
+        return ("LocalDigest<local_folder=%r, local_path=%r, digest_func=%r,"
+                " digest=%r>") % (os.path.basename(self.local_folder),
+                                  self.local_path, self.digest_func,
+                                  self.digest)
+
+    @staticmethod
+    def local_subtree(local_path):
+        """Criterion matching the digests of a local path and its
+        descendants, see LastKnownState.local_subtree"""
+        if local_path == u'/':
+            return LocalDigest.local_path != None
+        return or_(LocalDigest.local_path == local_path,
+                   and_(LocalDigest.local_path > local_path + u'/',
+                        LocalDigest.local_path < local_path + u'0'))
+
+    @staticmethod
+    def delete_subtree(session, local_folder, local_path):
+        """Delete the digests of a local file or folder and its descendants"""
+        if local_path is None:
+            return
+        session.query(LocalDigest).filter(
+            LocalDigest.local_folder == local_folder,
+            LocalDigest.local_subtree(local_path),
+        ).delete(synchronize_session='evaluate')
+
+    @staticmethod
+    def move_subtree(session, local_folder, local_path, new_path):
+        """Move the digests of a local file or folder and its descendants
+
+        The digests of the files unchanged by the move stay valid. The
+        prefix of the paths is replaced by a single statement, as by
+        LastKnownState.move_local_descendants.
+        """
+        if local_path is None or local_path == new_path:
+            return
+        LocalDigest.delete_subtree(session, local_folder, new_path)
+        session.query(LocalDigest).filter(
+            LocalDigest.local_folder == local_folder,
+            LocalDigest.local_subtree(local_path),
+        ).update({
+            LocalDigest.local_path: new_path + func.substr(
+                LocalDigest.local_path, func.length(local_path) + 1),
+        }, synchronize_session='fetch')
+
+
+def _delete_local_digests(session, flush_context, instances):
+    # The digests of the deleted pairs are deleted in the same flush
+    for pair in session.deleted:
+        if isinstance(pair, LastKnownState) and pair.local_path is not None:
+            LocalDigest.delete_subtree(session, pair.local_folder,
+                                       pair.local_path)
+
+
+event.listen(Session, 'before_flush', _delete_local_digests)
+
+
+class TransferJob(Base):
+    """Transfer of the content of a pair run concurrently by the synchronizer
+
+    A row is recorded before the transfer starts and deleted once the pair
+    has been updated from its result: the remaining rows are the transfers
+    interrupted by a stop of the process. file_path is the uploaded file or
+    the temporary file of a download, and attempts the number of times the
+    transfer has been started.
+    """
+    __tablename__ = 'transfer_jobs'
+
+    id = Column(Integer, Sequence('transfer_job_id_seq'), primary_key=True)
+    local_folder = Column(String, ForeignKey('server_bindings.local_folder'),
+                          index=True)
+    pair_id = Column(Integer)
+    direction = Column(String)
+    file_path = Column(String)
+    attempts = Column(Integer)
+
+    server_binding = relationship(
+        'ServerBinding',
+        backref=backref("transfer_jobs", cascade="all, delete-orphan"))
+
+    def __init__(self, local_folder, pair_id):
+        self.local_folder = local_folder
+        self.pair_id = pair_id
+        self.attempts = 0
+
+    def __repr__(self):
+        return ("TransferJob<local_folder=%r, pair_id=%r, direction=%r,"
+                " file_path=%r, attempts=%r>") % (
+                    os.path.basename(self.local_folder), self.pair_id,
+                    self.direction, self.file_path, self.attempts)
+
+    @classmethod
+    def get(cls, session, pair_id):
+        return session.query(cls).filter(cls.pair_id == pair_id).first()
+
+    @classmethod
+    def get_or_create(cls, session, local_folder, pair_id):
+        job = cls.get(session, pair_id)
+        if job is None:
+            job = cls(local_folder, pair_id)
+            session.add(job)
+        return job
+
+
+class DigestCache(object):
+    """Compute the digests of the files of a bound folder at most once
+
+    Cache entries are stored in the session of the calling thread and
+    committed along with the synchronization states.
+
+    If a hashing service is given, missing digests are computed by its
+    threads: when not waiting for them, get_digest returns None while the
+    digest is pending.
+
+    Between start_scan and end_scan, the entries of the files of a folder
+    are loaded by a single query on the first lookup in that folder and
+    kept by the calling thread until release_folder is called.
+    """
+
+    def __init__(self, get_session, local_folder, hashing_service=None):
+        self._get_session = get_session
+        self.local_folder = local_folder
+        self.hashing_service = hashing_service
+        self.hits = 0
+        self.misses = 0
+        self._scans = threading.local()
+
+    def get_digest(self, file_info, digest_func=None, wait=True):
+        session = self._get_session()
+        digest_func = (file_info.digest_func if digest_func is None
+                       else digest_func.lower())
+        entry = self._get_entry(session, file_info, digest_func)
+        if entry is not None and self._is_valid(entry, file_info):
+            self.hits += 1
+            return entry.digest
+
+        if self.hashing_service is None:
+            digests = {digest_func: file_info.compute_digest(digest_func)}
+        else:
+            version = (file_info.size, file_info.last_modification_time,
+                       file_info.inode)
+            digests = self.hashing_service.get_digests(
+                (self.local_folder, file_info.path), version,
+                file_info.filepath, digest_func, wait=wait)
+            if digests is None:
+                return None
+        self.misses += 1
+        for other_func, digest in digests.items():
+            if other_func != digest_func:
+                self._store(session, file_info, other_func, digest,
+                            self._get_entry(session, file_info, other_func))
+        self._store(session, file_info, digest_func, digests[digest_func],
+                    entry)
+        return digests[digest_func]
+
+    def is_pending(self, local_path):
+        """Return True if the digest of the file is being computed"""
+        return (self.hashing_service is not None
+                and self.hashing_service.is_pending(
+                    (self.local_folder, local_path)))
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def start_scan(self):
+        """Load the entries by folder in the session of the calling thread"""
+        self._scans.session = self._get_session()
+        self._scans.folders = dict()
+
+    def release_folder(self, local_path):
+        """Forget the loaded entries of the files of a scanned folder"""
+        folders = getattr(self._scans, 'folders', None)
+        if folders is not None:
+            folders.pop(local_path, None)
+
+    def end_scan(self):
+        self._scans.session = None
+        self._scans.folders = None
+
+    def _get_loaded_folder(self, session, local_path):
+        """Return the loaded entries of the folder of a file, if scanning"""
+        folders = getattr(self._scans, 'folders', None)
+        if folders is None or self._scans.session is not session:
+            return None
+        parent_path = local_path.rsplit(u'/', 1)[0] or u'/'
+        entries = folders.get(parent_path)
+        if entries is None:
+            prefix = parent_path.rstrip(u'/') + u'/'
+            # The direct children have no separator after the prefix
+            query = session.query(LocalDigest).filter(
+                LocalDigest.local_folder == self.local_folder,
+                LocalDigest.local_path > prefix,
+                LocalDigest.local_path < prefix[:-1] + u'0',
+                func.instr(func.substr(LocalDigest.local_path,
+                                       func.length(prefix) + 1), u'/') == 0)
+            entries = dict(((entry.local_path, entry.digest_func), entry)
+                           for entry in query)
+            folders[parent_path] = entries
+        return entries
+
+    def _get_entry(self, session, file_info, digest_func):
+        entries = self._get_loaded_folder(session, file_info.path)
+        if entries is not None:
+            return entries.get((file_info.path, digest_func))
+        return session.query(LocalDigest).filter_by(
+            local_folder=self.local_folder, local_path=file_info.path,
+            digest_func=digest_func).first()
+
+    def _is_valid(self, entry, file_info):
+        return (entry.size == file_info.size
+                and entry.last_modification_time
+                    == file_info.last_modification_time
+                and entry.inode == file_info.inode)
+
+    def _store(self, session, file_info, digest_func, digest, entry):
+        if entry is None:
+            entry = LocalDigest(self.local_folder, file_info.path, digest_func)
+            session.add(entry)
+            entries = self._get_loaded_folder(session, file_info.path)
+            if entries is not None:
+                entries[(file_info.path, digest_func)] = entry
+        entry.size = file_info.size
+        entry.last_modification_time = file_info.last_modification_time
+        entry.inode = file_info.inode
+        entry.digest = digest
+
+
+# SQLite tuning profiles: PRAGMA statements run on each new connection
+#
+# - compatible: rollback journal, for file systems not supporting the shared
+#   memory of the write-ahead log such as network shares
+# - durable: write-ahead log so that readers, e.g. the GUI, do not wait for
+#   the writers and conversely, each commit being flushed to the disk
+# - fast: write-ahead log only flushed to the disk at checkpoints, the last
+#   commits can be lost on power failure but the database stays consistent,
+#   with a larger page cache and memory mapped reads
+DB_PROFILES = {
+    'compatible': [
+        ('journal_mode', 'DELETE'),
+        ('synchronous', 'FULL'),
+    ],
+    'durable': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'FULL'),
+        ('cache_size', -16384),
+        ('temp_store', 'MEMORY'),
+    ],
+    'fast': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -16384),
+        ('mmap_size', 64 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+    ],
+}
+
+DEFAULT_DB_PROFILE = 'fast'
+
+
+def _configure_connection(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    try:
+        # The counters of the descendants of the folders are propagated to
+        # the ancestors by triggers fired by the triggers
+        cursor.execute('PRAGMA recursive_triggers = ON')
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+            if name == 'journal_mode':
+                # The journal mode is not changed if not supported
+                mode = cursor.fetchone()[0]
+                if mode.upper() != value:
+                    log.warning("Could not set SQLite journal mode to %s,"
+                                " using %s", value, mode)
+    finally:
+        cursor.close()
+
+
+def _add_missing_columns(engine):
+    """Add the columns of the model missing in tables of a previous version
+
+    The new columns are nullable hence the existing rows are left unchanged.
+    """
+    for table in Base.metadata.sorted_tables:
+        existing = set(row[1] for row in engine.execute(
+            'PRAGMA table_info("%s")' % table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            log.info("Adding missing column %s.%s", table.name, column.name)
+            engine.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (
+                table.name, column.name,
+                column.type.compile(dialect=engine.dialect)))
+
+
+def _create_missing_indexes(engine, table):
+    """Create the indexes of the model missing in a table"""
+    existing = set(row[1] for row in engine.execute(
+        'PRAGMA index_list("%s")' % table.name))
+    for index in table.indexes:
+        if index.name not in existing:
+            log.info("Creating index %s", index.name)
+            index.create(engine)
+
+
+def _migrate_composite_indexes(engine):
+    """Index the pairs by binding and queried columns"""
+    _create_missing_indexes(engine, LastKnownState.__table__)
+    # Replaced by the composite indexes
+    for column in ('local_folder', 'local_digest', 'local_path',
+                   'local_parent_path', 'remote_ref', 'remote_parent_ref',
+                   'pair_state'):
+        engine.execute('DROP INDEX IF EXISTS ix_last_known_states_%s'
+                       % column)
+
+
+def _compact_value_sql(column):
+    """SQL expression converting a value of a previous version of a column
+
+    The states were stored as text and the timestamps as the text of
+    DateTime, 'YYYY-MM-DD HH:MM:SS.ffffff'. Values already converted are
+    left unchanged.
+    """
+    name = column.name
+    if isinstance(column.type, StateEnum):
+        return 'CASE %s %s ELSE %s END' % (name, ' '.join(
+            "WHEN '%s' THEN %d" % (state, code)
+            for code, state in enumerate(STATES)), name)
+    if isinstance(column.type, Timestamp):
+        return ("CASE WHEN typeof(%(name)s) = 'text'"
+                " THEN CAST(strftime('%%s', %(name)s) AS INTEGER) * 1000000"
+                " + CAST(substr(%(name)s, 21, 6) AS INTEGER)"
+                " ELSE %(name)s END" % dict(name=name))
+    return name
+
+
+def _compact_states(engine):
+    """Store the states as codes and the timestamps as integers
+
+    The unused columns are dropped as well. SQLite neither changing nor
+    dropping columns, the rows are copied to a new table in a single
+    transaction, the driver committing the transaction before the DDL
+    statements otherwise.
+    """
+    table = LastKnownState.__table__
+    existing = set(row[1] for row in engine.execute(
+        'PRAGMA table_info("%s")' % table.name))
+    columns = [column for column in table.columns if column.name in existing]
+    statements = [
+        'ALTER TABLE %s RENAME TO %s_previous' % (table.name, table.name),
+        str(CreateTable(table).compile(dialect=engine.dialect)),
+        'INSERT INTO %s (%s) SELECT %s FROM %s_previous' % (
+            table.name, ', '.join(column.name for column in columns),
+            ', '.join(_compact_value_sql(column) for column in columns),
+            table.name),
+        'DROP TABLE %s_previous' % table.name,
+    ] + [str(CreateIndex(index).compile(dialect=engine.dialect))
+         for index in table.indexes] + DESCENDANT_COUNTERS_TRIGGERS
+    connection = engine.raw_connection()
+    dbapi_connection = connection.connection
+    isolation_level = dbapi_connection.isolation_level
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('BEGIN')
+        try:
+            # Renaming the table would rewrite the triggers
+            for name, in cursor.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+                    " AND tbl_name = ?", (table.name,)).fetchall():
+                cursor.execute('DROP TRIGGER "%s"' % name)
+            for statement in statements:
+                cursor.execute(statement)
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+    finally:
+        cursor.close()
+        dbapi_connection.isolation_level = isolation_level
+        connection.close()
+    # Give the space of the previous table back to the file system
+    engine.execute('VACUUM')
+
+
+def _compact_digest_timestamps(engine):
+    """Store the modification times of the cached digests as integers"""
+    column = LocalDigest.__table__.c.last_modification_time
+    engine.execute('UPDATE %s SET %s = %s' % (
+        LocalDigest.__tablename__, column.name, _compact_value_sql(column)))
+
+
+# Schema migrations by version, each one upgrading the database from the
+# previous version once the missing tables and columns are added. The DDL
+# statements are not transactional with pysqlite hence a migration must
+# support being run again if interrupted.
+MIGRATIONS = {
+    2: _migrate_composite_indexes,
+    3: _create_triggers,
+    4: _compact_states,
+    5: _compact_digest_timestamps,
+}
+
+
+def get_schema_version(engine):
+    """Return the version of the database schema, 1 if never migrated"""
+    return engine.execute('PRAGMA user_version').scalar() or 1
+
+
+def _set_schema_version(engine, version):
+    engine.execute('PRAGMA user_version = %d' % version)
+
+
+def _migrate(engine):
+    """Run the migrations from the version of the database to the model's"""
+    version = get_schema_version(engine)
+    if version > __model_version__:
+        log.warning("Database schema version %d is more recent than the"
+                    " supported version %d", version, __model_version__)
+        return
+    for version in range(version + 1, __model_version__ + 1):
+        log.info("Migrating database schema to version %d", version)
+        MIGRATIONS[version](engine)
+        _set_schema_version(engine, version)
+
+
+def init_db(nxdrive_home, echo=False, scoped_sessions=True, poolclass=None,
+            profile=None):
     """Return an engine and session maker configured for using nxdrive_home
 
     The database is created in nxdrive_home if missing and the tables
@@ -492,7 +2064,15 @@ def init_db(nxdrive_home, echo=False, scoped_sessions=True, poolclass=None):
     If scoped_sessions is True, sessions built with this maker are reusable
     thread local singletons.
 
+    profile is the name of the SQLite tuning profile from DB_PROFILES applied
+    to each connection, DEFAULT_DB_PROFILE if None.
+
     """
+    profile = DEFAULT_DB_PROFILE if profile is None else profile
+    if profile not in DB_PROFILES:
+        raise ValueError("Unknown database profile %r, expected one of %s"
+                         % (profile, ', '.join(sorted(DB_PROFILES))))
+
     # We store the DB as SQLite files in the nxdrive_home folder
     dbfile = os.path.join(normalized_path(nxdrive_home), 'nxdrive.db')
 
@@ -501,9 +2081,20 @@ def init_db(nxdrive_home, echo=False, scoped_sessions=True, poolclass=None):
     poolclass = SingletonThreadPool if poolclass is None else poolclass
     engine = create_engine('sqlite:///' + dbfile, echo=echo,
                            poolclass=poolclass)
-
-    # Ensure that the tables are properly initialized
+    pragmas = DB_PROFILES[profile]
+    event.listen(engine, 'connect',
+                 lambda dbapi_connection, connection_record:
+                 _configure_connection(dbapi_connection, pragmas))
+
+    # Ensure that the tables are properly initialized, the new databases
+    # being created with the latest schema
+    new_db = not engine.has_table(LastKnownState.__tablename__)
     Base.metadata.create_all(engine)
+    if new_db:
+        _set_schema_version(engine, __model_version__)
+    else:
+        _add_missing_columns(engine)
+        _migrate(engine)
     maker = sessionmaker(bind=engine)
     if scoped_sessions:
         maker = scoped_session(maker)
@@ -1,24 +1,42 @@
 """Handle synchronization logic."""
 import re
 import os.path
+import sys
 from time import time
 from time import sleep
 from datetime import datetime
+from datetime import timedelta
 import urllib2
 import socket
 import httplib
 
+from sqlalchemy import and_
 from sqlalchemy import or_
+from sqlalchemy import not_
 import psutil
 
 from nxdrive.client import DEDUPED_BASENAME_PATTERN
 from nxdrive.client import safe_filename
 from nxdrive.client import NotFound
 from nxdrive.client import Unauthorized
+from nxdrive.client.local_tree_walker import LocalTreeWalker
+from nxdrive.client.remote_tree_walker import RemoteTreeWalker
+from nxdrive.client.remote_file_system_client import get_download_tmp_path
+from nxdrive.client.ranged_download import get_download_state_path
+from nxdrive.client.transfer import Transfer
 from nxdrive.model import ServerBinding
 from nxdrive.model import LastKnownState
+from nxdrive.model import LocalDigest
+from nxdrive.model import PairIndex
+from nxdrive.model import PairWriter
+from nxdrive.model import PendingQueue
+from nxdrive.model import ScannedPair
+from nxdrive.model import FileEvent
+from nxdrive.model import TransferJob
 from nxdrive.logging_config import get_logger
 from nxdrive.utils import safe_long_path
+from nxdrive.watcher import get_local_watcher
+from nxdrive.watcher import WatcherOverflow
 
 WindowsError = None
 try:
@@ -146,6 +164,96 @@ def find_first_name_match(name, possible_pairs):
     return None
 
 
+# Pair states whose synchronization may transfer the content of a file
+TRANSFER_PAIR_STATES = (
+    'locally_created',
+    'locally_modified',
+    'remotely_created',
+    'remotely_modified',
+    'conflicted',
+)
+
+
+def _may_transfer(pair):
+    return not pair.folderish and pair.pair_state in TRANSFER_PAIR_STATES
+
+
+def _get_order_keys(pair):
+    """Keys of a pair for the ordering of the synchronization
+
+    Return the paths of the pair on each side, the remote one being made of
+    the refs of its ancestors, and its names in its parent folders.
+    """
+    paths = []
+    if pair.local_path is not None:
+        paths.append(('local', pair.local_path))
+    if pair.remote_ref is not None and pair.remote_parent_path is not None:
+        paths.append(('remote',
+                      pair.remote_parent_path + u'/' + pair.remote_ref))
+    names = set()
+    for name in (pair.local_name, pair.remote_name):
+        if not name:
+            continue
+        if pair.local_parent_path is not None:
+            names.add(('local', pair.local_parent_path, name.lower()))
+        if pair.remote_parent_ref is not None:
+            names.add(('remote', pair.remote_parent_ref, name.lower()))
+    return paths, names
+
+
+def _get_ancestor_keys(key):
+    side, path = key
+    parts = path.split(u'/')
+    return [(side, u'/'.join(parts[:i]) or u'/')
+            for i in range(1, len(parts)) if path != u'/']
+
+
+class _WaitingPairs(object):
+    """Pairs waiting for a transfer to finish, see _get_order_keys
+
+    A pair conflicts with a waiting pair if they are the same document or
+    if one of them is an ancestor of the other, on either side, or if they
+    are siblings of the same name, the case being ignored.
+    """
+
+    def __init__(self):
+        self._paths = set()
+        self._ancestors = set()
+        self._names = set()
+
+    def add(self, keys):
+        paths, names = keys
+        for path in paths:
+            self._paths.add(path)
+            self._ancestors.update(_get_ancestor_keys(path))
+        self._names.update(names)
+
+    def conflicts(self, keys):
+        paths, names = keys
+        for path in paths:
+            if path in self._paths or path in self._ancestors:
+                return True
+            for ancestor in _get_ancestor_keys(path):
+                if ancestor in self._paths:
+                    return True
+        return not self._names.isdisjoint(names)
+
+
+def _upload(file_path, upload):
+    """Transfer uploading a local file, see Synchronizer._transfer"""
+    def run():
+        return upload(), os.path.getsize(safe_long_path(file_path))
+    return run
+
+
+def _download(remote_client, remote_ref, file_path):
+    """Transfer downloading to the temporary file of file_path"""
+    def run():
+        tmp_file = remote_client.stream_content(remote_ref, file_path)
+        return tmp_file, os.path.getsize(safe_long_path(tmp_file))
+    return run
+
+
 class Synchronizer(object):
     """Handle synchronization operations between the client FS and Nuxeo"""
 
@@ -168,14 +276,73 @@ class Synchronizer(object):
     # to a fixed cooldown period
     error_skip_period = 300  # 5 minutes
 
-    # Default page size for deleted items detection query in DB
+    # Default maximum number of values of the IN clauses of the scan queries
     default_page_size = 100
 
-    def __init__(self, controller, page_size=None):
+    # Use file system monitoring when supported by the platform to only
+    # rescan the recently changed local paths instead of the whole bound
+    # folder at each iteration of the synchronization loop
+    local_watcher_enabled = True
+
+    # Delay in seconds between two full local scans when file system
+    # monitoring is active: safety net in case some events were missed
+    full_local_scan_period = 3600  # 1 hour
+
+    # Number of threads listing local folders concurrently during full local
+    # scans, 1 or less to list them from the synchronization thread only
+    default_local_scan_workers = 4
+
+    # Number of threads listing remote folders concurrently during full
+    # remote scans, 1 or less to list them from the synchronization thread
+    # only
+    default_remote_scan_workers = 4
+
+    # When file system monitoring is not available, do not list again the
+    # local folders whose modification time did not change since the previous
+    # scan: adding, removing or renaming a child updates the modification
+    # time of its parent folder. Only the known children of such folders are
+    # checked.
+    skip_unchanged_local_folders = False
+
+    # Delay in seconds between two deep local scans listing all the folders
+    # when skipping the unchanged ones: safety net for the file systems that
+    # do not update the modification time of folders
+    deep_local_scan_period = 3600  # 1 hour
+
+    # Resolution in seconds of the modification time of folders (FAT): a
+    # folder modified in the same time slot as it is listed is listed again
+    # by the next scan
+    folder_mtime_resolution = 2
+
+    # Number of times the transfer of a pair can be interrupted by a stop of
+    # the process before blacklisting the pair for error_skip_period
+    max_transfer_attempts = 3
+
+    def __init__(self, controller, page_size=None, local_scan_workers=None,
+                 skip_unchanged_local_folders=None, remote_scan_workers=None):
         self._controller = controller
         self._frontend = None
         self.page_size = (page_size if page_size is not None
                           else self.default_page_size)
+        self.local_scan_workers = (local_scan_workers
+                                   if local_scan_workers is not None
+                                   else self.default_local_scan_workers)
+        self.remote_scan_workers = (remote_scan_workers
+                                    if remote_scan_workers is not None
+                                    else self.default_remote_scan_workers)
+        if skip_unchanged_local_folders is not None:
+            self.skip_unchanged_local_folders = skip_unchanged_local_folders
+        # File system watchers by bound local folder
+        self._local_watchers = dict()
+        # Time of the last deep local scan, modification times of the
+        # folders when last listed by path and paths of the folders that
+        # have to be listed again, by bound local folder
+        self._last_deep_local_scans = dict()
+        self._listed_local_folders = dict()
+        self._racy_local_folders = dict()
+        # Finish callbacks and order keys of the pairs whose transfer is
+        # running by pair id, None when the transfers are run inline
+        self._in_flight = None
 
     def register_frontend(self, frontend):
         self._frontend = frontend
@@ -183,6 +350,16 @@ class Synchronizer(object):
     def get_session(self):
         return self._controller.get_session()
 
+    def _get_pair_index(self, session, local_folder):
+        """Return the in-memory index of the pairs of a bound folder
+
+        The index lookups need no query, the pairs expired by a commit being
+        loaded again when used. The index is dropped by PairIndex.refresh
+        when the database is modified by another connection, at the
+        beginning of each synchronization pass.
+        """
+        return PairIndex.get(session, local_folder)
+
     def _delete_with_descendant_states(self, session, doc_pair, local_client,
         keep_root=False):
         """Recursive delete the descendants of a deleted doc
@@ -192,6 +369,15 @@ class Synchronizer(object):
         its pair state as 'unsynchronized', else delete it and
         its pair state.
         """
+        if (not keep_root
+                and LastKnownState.supports_subtree_queries(session)):
+            # Delete the whole tree at once if nothing has to be kept
+            subtree = LastKnownState.query_subtree(session, doc_pair)
+            modified = subtree.filter(LastKnownState.locally_modified())
+            if modified.first() is None:
+                self._delete_subtree(session, doc_pair, subtree, local_client)
+                return False
+
         locally_modified = False
         # Handle local and remote descendants first
         if doc_pair.local_path is not None:
@@ -251,6 +437,32 @@ class Synchronizer(object):
 
         return locally_modified
 
+    def _delete_subtree(self, session, doc_pair, subtree, local_client):
+        """Delete a tree not modified since its synchronization
+
+        The descendants are deleted with the folder on the file system, but
+        the ones moved out of it, and in the database by a single statement.
+        """
+        file_or_folder = 'folder' if doc_pair.folderish else 'file'
+        if doc_pair.local_path is not None:
+            moved_out = subtree.filter(
+                LastKnownState.local_path != None,
+                not_(LastKnownState.local_subtree(doc_pair.local_path)))
+        else:
+            moved_out = subtree.filter(LastKnownState.local_path != None)
+        for pair in moved_out:
+            if local_client.exists(pair.local_path):
+                log.debug("Deleting local %s '%s'",
+                          'folder' if pair.folderish else 'file',
+                          pair.get_local_abspath())
+                local_client.delete(pair.local_path)
+        if (doc_pair.local_path is not None
+                and local_client.exists(doc_pair.local_path)):
+            log.debug("Deleting local %s '%s' and its descendants",
+                      file_or_folder, doc_pair.get_local_abspath())
+            local_client.delete(doc_pair.local_path)
+        LastKnownState.delete_subtree(session, doc_pair)
+
     def _mark_descendant_states_remotely_created(self, session, doc_pair,
         keep_root=None):
         """Mark the descendant states as remotely created"""
@@ -269,19 +481,21 @@ class Synchronizer(object):
 
     def _local_rename_with_descendant_states(self, session, client, doc_pair,
         previous_local_path, updated_path):
-        """Update the metadata of the descendants of a renamed doc"""
+        """Update the metadata of the descendants of a renamed doc
+
+        The cached digests of the local files are moved along.
+        """
         # rename local descendants first
         if doc_pair.local_path is None:
             raise ValueError("Cannot apply renaming to %r due to"
                              "missing local path" %
                 doc_pair)
-        local_children = session.query(LastKnownState).filter_by(
-            local_folder=doc_pair.local_folder,
-            local_parent_path=previous_local_path).all()
-        for child in local_children:
-            child_path = updated_path + '/' + child.local_name
-            self._local_rename_with_descendant_states(session, client, child,
-                child.local_path, child_path)
+        if doc_pair.folderish:
+            LastKnownState.move_local_descendants(
+                session, doc_pair.local_folder, previous_local_path,
+                updated_path)
+        LocalDigest.move_subtree(session, doc_pair.local_folder,
+                                 previous_local_path, updated_path)
 
         doc_pair.refresh_local(client=client, local_path=updated_path)
 
@@ -292,20 +506,30 @@ class Synchronizer(object):
         if doc_pair.remote_ref is None:
             raise ValueError("Cannot apply parent path update to %r "
                              "due to missing remote_ref" % doc_pair)
-        local_children = session.query(LastKnownState).filter_by(
-            local_folder=doc_pair.local_folder,
-            remote_parent_ref=doc_pair.remote_ref).all()
-        for child in local_children:
-            child_path = updated_path + '/' + child.remote_ref
-            self._update_remote_parent_path_recursive(session, child,
-                child_path)
+        if doc_pair.folderish:
+            LastKnownState.move_remote_descendants(
+                session, doc_pair.local_folder, doc_pair.remote_ref,
+                updated_path + u'/' + doc_pair.remote_ref)
 
         doc_pair.remote_parent_path = updated_path
 
     def scan_local(self, server_binding_or_local_path, from_state=None,
                    session=None):
-        """Recursively scan the bound local folder looking for updates"""
+        """Recursively scan the bound local folder looking for updates
+
+        When scanning a whole server binding with file system monitoring
+        enabled, only the paths reported as changed since the previous scan
+        are rescanned, except for the first scan and when some events might
+        have been lost. Changes are journaled in the database before being
+        processed so that they can be replayed after a restart without
+        scanning the whole bound folder again.
+
+        Without file system monitoring, the unchanged folders can be skipped
+        between periodic deep scans (see skip_unchanged_local_folders).
+        """
         session = self.get_session() if session is None else session
+        watcher = None
+        whole_binding = False
 
         if isinstance(server_binding_or_local_path, basestring):
             local_path = server_binding_or_local_path
@@ -320,48 +544,303 @@ class Synchronizer(object):
                 local_path='/',
                 local_folder=server_binding.local_folder).filter(
                     LastKnownState.pair_state != 'unsynchronized').one()
+            whole_binding = True
+            client = self._controller.get_local_client(
+                server_binding.local_folder, background_digests=True)
+            watcher = self._get_local_watcher(session, server_binding,
+                                              client)
+        else:
+            client = self._controller.get_local_client(
+                from_state.local_folder, background_digests=True)
 
-        client = from_state.get_local_client()
+        if (watcher is not None and watcher.last_full_scan is not None
+            and time() - watcher.last_full_scan < self.full_local_scan_period):
+            try:
+                changed_paths = watcher.get_changed_paths()
+            except WatcherOverflow:
+                log.debug("Some file system events were lost, falling back"
+                          " to a full scan of %s", server_binding.local_folder)
+            else:
+                self._scan_local_journal(session, client, server_binding,
+                                         changed_paths)
+                self._refresh_pending_digests(session, client,
+                                              server_binding.local_folder)
+                session.commit()
+                return
+
+        if watcher is not None:
+            # Changes detected from now on will be rescanned next time
+            watcher.reset()
+        skip_unchanged = False
+        deep_scan_start = None
+        if (whole_binding and watcher is None
+            and self.skip_unchanged_local_folders):
+            last_deep_scan = self._last_deep_local_scans.get(
+                server_binding.local_folder)
+            if (last_deep_scan is not None
+                and time() - last_deep_scan < self.deep_local_scan_period):
+                skip_unchanged = True
+            else:
+                log.debug("Deep local scan of %s, listing all the folders",
+                          server_binding.local_folder)
+                deep_scan_start = time()
         info = client.get_info('/')
-        # recursive update
-        self._scan_local_recursive(session, client, from_state, info)
+        walker = None
+        if self.local_scan_workers > 1:
+            walker = LocalTreeWalker(client, workers=self.local_scan_workers,
+                                     watcher=watcher)
+        digest_cache = client.digest_cache
+        if digest_cache is not None:
+            digest_cache.start_scan()
+        try:
+            # recursive update
+            self._scan_local_recursive(session, client, from_state, info,
+                                       walker=walker,
+                                       skip_unchanged=skip_unchanged)
+        finally:
+            if digest_cache is not None:
+                digest_cache.end_scan()
+            if walker is not None:
+                walker.close()
+        if deep_scan_start is not None:
+            self._last_deep_local_scans[server_binding.local_folder] = (
+                deep_scan_start)
+        if watcher is not None:
+            # The full scan covers any journaled change
+            FileEvent.clear(session, server_binding.local_folder)
+            FileEvent.set_checkpoint(session, server_binding.local_folder)
+            watcher.last_full_scan = time()
+        self._refresh_pending_digests(session, client, from_state.local_folder)
+        session.commit()
+        if digest_cache is not None:
+            log.debug("Local digest cache for %s: %d hits, %d misses",
+                      digest_cache.local_folder, digest_cache.hits,
+                      digest_cache.misses)
+
+    def _scan_local_journal(self, session, client, server_binding,
+                            changed_paths):
+        """Journal the newly changed paths then rescan all the pending ones"""
+        local_folder = server_binding.local_folder
+        if changed_paths:
+            FileEvent.record(session, local_folder, changed_paths)
+            session.commit()
+        last_id, paths = FileEvent.get_pending(session, local_folder)
+        if last_id is None:
+            return
+        self._scan_local_changed_paths(session, client, server_binding, paths)
+        # Forget the processed changes in the same transaction as the
+        # updated states
+        FileEvent.clear(session, local_folder, last_id)
         session.commit()
 
+    def _refresh_pending_digests(self, session, client, local_folder):
+        """Collect the digests computed in the background since last scan"""
+        # The pairs without local path are skipped afterwards: a range of
+        # local paths would be preferred by SQLite to the digest index
+        pending = session.query(LastKnownState).filter(
+            LastKnownState.local_folder == local_folder,
+            LastKnownState.folderish == False,
+            LastKnownState.local_digest == None,
+            LastKnownState.local_state != 'deleted',
+            LastKnownState.pair_state != 'unsynchronized').all()
+        for doc_pair in pending:
+            if doc_pair.local_path is None:
+                continue
+            doc_pair.refresh_local(client)
+
+    def _is_digest_pending(self, doc_pair):
+        """Return True if the pair waits for the digest of a local file"""
+        return (not doc_pair.folderish and doc_pair.local_path is not None
+                and doc_pair.local_digest is None
+                and doc_pair.local_state in ('created', 'modified')
+                and self._controller.get_digest_cache(
+                    doc_pair.local_folder).is_pending(doc_pair.local_path))
+
+    def _scan_local_changed_paths(self, session, client, server_binding,
+                                  paths):
+        """Rescan the local paths reported as changed by the watcher
+
+        Changed folders get their children list checked again while the
+        descendants of their existing children are not scanned.
+        """
+        if paths:
+            log.trace("Rescanning %d locally changed paths in %s",
+                      len(paths), server_binding.local_folder)
+        scanned = set()
+        # Sorting ensures that parent folders are scanned first
+        for path in sorted(paths):
+            doc_pair = None
+            while path not in scanned:
+                scanned.add(path)
+                doc_pair = LastKnownState.get_by_local_path(
+                    session, server_binding.local_folder, path)
+                local_info = client.get_info(path,
+                                             raise_if_missing=path == u'/')
+                if doc_pair is not None and local_info is not None:
+                    break
+                # Newly created or deleted file or folder: check the
+                # children of the parent folder instead
+                doc_pair = None
+                path = path.rsplit(u'/', 1)[0] or u'/'
+            if doc_pair is not None:
+                self._scan_local_recursive(session, client, doc_pair,
+                                           local_info, recursive=False)
+
+    def _get_local_watcher(self, session, server_binding, client):
+        """Return the file system watcher of a binding, None if unsupported
+
+        When a previous complete local scan has been checkpointed in the
+        journal, a new watcher resumes from the known states instead of
+        requiring a full scan.
+        """
+        if not self.local_watcher_enabled:
+            return None
+        local_folder = server_binding.local_folder
+        if local_folder not in self._local_watchers:
+            watcher = get_local_watcher(client)
+            self._local_watchers[local_folder] = watcher
+            if (watcher is not None and FileEvent.get_checkpoint(
+                session, local_folder) is not None):
+                self._resume_local_watcher(session, client, server_binding,
+                                           watcher)
+        return self._local_watchers[local_folder]
+
+    def _resume_local_watcher(self, session, client, server_binding, watcher):
+        """Monitor the known local folders without listing their content
+
+        The folders whose modification time changed while no watcher was
+        running are journaled to get their children checked again. The files
+        updated in place in the mean time do not change the modification time
+        of their folder: the ones whose modification time or size differs
+        from their pair are journaled too. Resuming still stats every known
+        file and folder, only the listing of the folders and the update of
+        the unchanged pairs are saved compared to a full scan.
+        """
+        local_folder = server_binding.local_folder
+        folders = session.query(
+            LastKnownState.local_path,
+            LastKnownState.last_local_updated).filter(
+                LastKnownState.local_folder == local_folder,
+                LastKnownState.folderish == True,
+                LastKnownState.local_path != None,
+                LastKnownState.pair_state != 'unsynchronized').order_by(
+                    LastKnownState.local_path)
+        changed_paths = set()
+        for path, last_local_updated in folders:
+            # Watch before checking the folder so that no change can be
+            # missed
+            watcher.watch(path)
+            info = client.get_info(path, raise_if_missing=False)
+            if info is None:
+                # Deleted folder: check the parent folder children instead
+                changed_paths.add(path.rsplit(u'/', 1)[0] or u'/')
+            elif (not info.folderish
+                  or info.last_modification_time != last_local_updated):
+                changed_paths.add(path)
+        if watcher.overflowed:
+            # Too many folders to watch: a full scan will be performed
+            return
+        files = session.query(
+            LastKnownState.local_path,
+            LastKnownState.last_local_updated,
+            LastKnownState.local_size).filter(
+                LastKnownState.local_folder == local_folder,
+                LastKnownState.folderish == False,
+                LastKnownState.local_path != None,
+                LastKnownState.pair_state != 'unsynchronized')
+        for path, last_local_updated, local_size in files:
+            info = client.get_info(path, raise_if_missing=False)
+            if info is None:
+                changed_paths.add(path.rsplit(u'/', 1)[0] or u'/')
+            elif (info.folderish
+                  or info.last_modification_time != last_local_updated
+                  or (local_size is not None and info.size != local_size)):
+                changed_paths.add(path)
+        FileEvent.record(session, local_folder, changed_paths)
+        session.commit()
+        watcher.last_full_scan = time()
+        log.debug("Resumed file system monitoring of %s with %d changed"
+                  " paths", local_folder, len(changed_paths))
+
+    def _request_full_local_scan(self, session, local_folder):
+        """Make the next local scan of the binding a full scan"""
+        watcher = self._local_watchers.get(local_folder)
+        if watcher is not None:
+            watcher.last_full_scan = None
+        FileEvent.clear_checkpoint(session, local_folder)
+
+    def stop_local_watchers(self, local_folders=None, session=None):
+        """Release the file system watchers of the given bound folders
+
+        Release all of them if local_folders is None. If a session is given,
+        the changes not processed yet are journaled to be replayed at next
+        startup.
+        """
+        if local_folders is None:
+            local_folders = self._local_watchers.keys()
+        for local_folder in local_folders:
+            watcher = self._local_watchers.pop(local_folder, None)
+            if watcher is None:
+                continue
+            if session is not None and watcher.last_full_scan is not None:
+                try:
+                    FileEvent.record(session, local_folder,
+                                     watcher.get_changed_paths())
+                except WatcherOverflow:
+                    FileEvent.clear_checkpoint(session, local_folder)
+            watcher.stop()
+        if session is not None:
+            session.commit()
+
     def _mark_deleted_local_recursive(self, session, doc_pair):
         """Update the metadata of the descendants of locally deleted doc"""
         log.trace("Marking %r as locally deleted", doc_pair.remote_ref)
-        # delete descendants first
-        children = session.query(LastKnownState).filter_by(
-            local_folder=doc_pair.local_folder,
-            local_parent_path=doc_pair.local_path).all()
-        for child in children:
-            self._mark_deleted_local_recursive(session, child)
-
-        # update the state of the parent it-self
-        if doc_pair.remote_ref is None:
-            # Unbound child metadata can be removed
-            session.delete(doc_pair)
-        else:
-            # mark it for remote deletion
-            doc_pair.update_local(None)
+        # Unbound descendants metadata are removed, the other ones marked
+        # for remote deletion
+        LastKnownState.mark_locally_deleted(session, doc_pair)
 
     def _mark_unknown_local_recursive(self, session, doc_pair):
         """Recursively mark local unsynchronized pair state as 'unknown'"""
         if doc_pair.local_path is not None:
-            # Delete descendants first
-            children = session.query(LastKnownState).filter_by(
-                local_folder=doc_pair.local_folder,
-                local_parent_path=doc_pair.local_path).all()
-            for child in children:
-                self._mark_unknown_local_recursive(session, child)
-
-            # Update the state of the parent it-self
-            if doc_pair.pair_state == 'unsynchronized':
-                log.debug("Unmarking %r as unsynchronized", doc_pair)
-                doc_pair.pair_state = 'unknown'
-
-    def _scan_local_recursive(self, session, client, doc_pair, local_info):
-        """Recursively scan the bound local folder looking for updates"""
+            # Update the unsynchronized descendants at once instead of
+            # walking the whole subtree
+            unsynchronized = LastKnownState.mark_unknown_unsynchronized(
+                session, doc_pair)
+            if unsynchronized:
+                log.debug("Unmarked %d pairs under %r as unsynchronized",
+                          unsynchronized, doc_pair)
+                # Local changes that happened under this folder while it
+                # was unsynchronized have not been monitored
+                self._request_full_local_scan(session,
+                                              doc_pair.local_folder)
+
+    def _scan_local_recursive(self, session, client, doc_pair, local_info,
+                              recursive=True, walker=None,
+                              skip_unchanged=False, writer=None):
+        """Recursively scan the bound local folder looking for updates
+
+        If recursive is False, only the direct children of the folder are
+        refreshed, except for the new or not yet monitored folders that are
+        always scanned recursively.
+
+        If a local tree walker is given, the sub folders are listed ahead of
+        their scan by its threads.
+
+        If skip_unchanged is True, the folders whose modification time did not
+        change since the previous scan are not listed: only their known
+        children are refreshed.
+
+        The new pairs are inserted by the given writer, flushed at the end of
+        the scan if not given.
+        """
+        if writer is None:
+            writer = PairWriter(session)
+            self._scan_local_recursive(session, client, doc_pair, local_info,
+                                       recursive=recursive, walker=walker,
+                                       skip_unchanged=skip_unchanged,
+                                       writer=writer)
+            writer.flush()
+            return
         if doc_pair.pair_state == 'unsynchronized':
             log.trace("Ignoring %s as marked unsynchronized",
                       doc_pair.local_path)
@@ -370,6 +849,10 @@ class Synchronizer(object):
             raise ValueError("Cannot bind %r to missing local info" %
                              doc_pair)
 
+        unchanged = (skip_unchanged and local_info.folderish
+                     and self._is_local_folder_unchanged(doc_pair,
+                                                         local_info))
+
         # Update the pair state from the collected local info
         doc_pair.update_local(local_info)
 
@@ -377,24 +860,36 @@ class Synchronizer(object):
             # No children to align, early stop.
             return
 
-        # detect recently deleted children
-        try:
-            children_info = client.get_children_info(local_info.path)
-        except OSError:
-            # The folder has been deleted in the mean time
+        if unchanged:
+            for child_pair, child_info in self._get_known_local_children(
+                session, client, doc_pair):
+                self._scan_local_recursive(session, client, child_pair,
+                                           child_info, walker=walker,
+                                           skip_unchanged=skip_unchanged,
+                                           writer=writer)
+            return
+
+        watcher = self._local_watchers.get(doc_pair.local_folder)
+        children_info = self._list_local_children(client, doc_pair.local_folder,
+                                                  local_info, walker, watcher)
+        if children_info is None:
             return
 
+        # Load the pairs of the children and the candidates for alignment
+        # at once instead of querying them child by child
         children_path = set(c.path for c in children_info)
+        child_pairs, unbound_pairs, deleted_pairs = (
+            self._get_local_children_pairs(session, doc_pair,
+                                           local_info.path, children_path))
 
-        selection_tag = LastKnownState.select_local_paths(session,
-                                                          children_path,
-                                                          self.page_size)
-        for deleted in LastKnownState.not_selected(
-                            session.query(LastKnownState)
-                                .filter_by(local_folder=doc_pair.local_folder,
-                                           local_parent_path=local_info.path),
-                            selection_tag):
-            self._mark_deleted_local_recursive(session, deleted)
+        if walker is not None and recursive:
+            walker.prefetch(self._get_folders_to_list(
+                child_pairs, children_info, skip_unchanged))
+
+        # detect recently deleted children
+        for deleted in deleted_pairs:
+            if not self._mark_ignored_local(client, deleted):
+                self._mark_deleted_local_recursive(session, deleted)
 
         # recursively update children
         for child_info in children_info:
@@ -402,9 +897,8 @@ class Synchronizer(object):
             # TODO: detect whether this is a __digit suffix name and relax the
             # alignment queries accordingly
             child_name = os.path.basename(child_info.path)
-            child_pair = session.query(LastKnownState).filter_by(
-                local_folder=doc_pair.local_folder,
-                local_path=child_info.path).first()
+            child_pair = child_pairs.get(child_info.path)
+            new_pair = child_pair is None
 
             if child_pair is None and not child_info.folderish:
                 # Try to find an existing remote doc that has not yet been
@@ -412,13 +906,13 @@ class Synchronizer(object):
                 # and digest
                 try:
                     child_digest = child_info.get_digest()
-                    possible_pairs = session.query(LastKnownState).filter_by(
-                        local_folder=doc_pair.local_folder,
-                        local_path=None,
-                        remote_parent_ref=doc_pair.remote_ref,
-                        folderish=child_info.folderish,
-                        remote_digest=child_digest,
-                    ).all()
+                    possible_pairs = []
+                    if child_digest is not None:
+                        possible_pairs = [
+                            pair for pair in unbound_pairs
+                            if pair.local_path is None
+                            and pair.folderish == child_info.folderish
+                            and pair.remote_digest == child_digest]
                     child_pair = find_first_name_match(
                         child_name, possible_pairs)
                     if child_pair is not None:
@@ -435,12 +929,9 @@ class Synchronizer(object):
 
             if child_pair is None:
                 # Previous attempt has failed: relax the digest constraint
-                possible_pairs = session.query(LastKnownState).filter_by(
-                    local_folder=doc_pair.local_folder,
-                    local_path=None,
-                    remote_parent_ref=doc_pair.remote_ref,
-                    folderish=child_info.folderish,
-                ).all()
+                possible_pairs = [pair for pair in unbound_pairs
+                                  if pair.local_path is None
+                                  and pair.folderish == child_info.folderish]
                 child_pair = find_first_name_match(child_name, possible_pairs)
                 if child_pair is not None:
                     log.debug("Matched local %s with remote %s by name only",
@@ -448,18 +939,203 @@ class Synchronizer(object):
 
             if child_pair is None:
                 # Could not find any pair state to align to, create one
-                child_pair = LastKnownState(doc_pair.local_folder,
-                    local_info=child_info)
-                session.add(child_pair)
-                log.debug("Detected a new non-alignable local file at %s",
-                          child_pair.local_path)
+                self._scan_new_local_pair(client, writer, doc_pair.local_folder,
+                                          child_info, walker, watcher)
+                continue
 
-            self._scan_local_recursive(session, client, child_pair,
-                                       child_info)
+            if (recursive or new_pair or (watcher is not None
+                and child_info.folderish
+                and not watcher.is_watching(child_info.path))):
+                # Folders created by the synchronizer or moved locally
+                # are not monitored yet: scan their whole subtree
+                self._scan_local_recursive(session, client, child_pair,
+                                           child_info, walker=walker,
+                                           skip_unchanged=skip_unchanged,
+                                           writer=writer)
+            elif child_pair.pair_state != 'unsynchronized':
+                child_pair.update_local(child_info)
+
+        if client.digest_cache is not None:
+            client.digest_cache.release_folder(local_info.path)
+
+    def _list_local_children(self, client, local_folder, local_info, walker,
+                             watcher):
+        """Return the info of the children of a folder, None if deleted"""
+        try:
+            if walker is not None:
+                # The walker monitors the folder before listing it
+                children_info = walker.get_children_info(local_info.path)
+            else:
+                if watcher is not None:
+                    # Monitor the folder before listing its children so that
+                    # no change can be missed
+                    watcher.watch(local_info.path)
+                children_info = client.get_children_info(local_info.path)
+        except OSError:
+            # The folder has been deleted in the mean time
+            return None
+        if self.skip_unchanged_local_folders:
+            self._listed_local_folders.setdefault(local_folder, dict())[
+                local_info.path] = local_info.last_modification_time
+            self._check_racy_local_folder(local_folder, local_info)
+        return children_info
+
+    def _scan_new_local_pair(self, client, writer, local_folder, local_info,
+                             walker, watcher):
+        """Create the pairs of a new local file or folder and its descendants
+
+        The descendants of a new folder are new too: no query is needed to
+        align them and their pairs are inserted in batches by the writer.
+        """
+        pair = ScannedPair(local_folder, local_info=local_info)
+        writer.add(pair)
+        log.debug("Detected a new non-alignable local file at %s",
+                  pair.local_path)
+        if not local_info.folderish:
+            return
+        children_info = self._list_local_children(client, local_folder,
+                                                  local_info, walker, watcher)
+        if children_info is None:
+            return
+        if walker is not None:
+            walker.prefetch([c.path for c in children_info if c.folderish])
+        for child_info in children_info:
+            self._scan_new_local_pair(client, writer, local_folder, child_info,
+                                      walker, watcher)
+        if client.digest_cache is not None:
+            client.digest_cache.release_folder(local_info.path)
+
+    def _is_local_folder_unchanged(self, doc_pair, local_info):
+        """Return True if the children of the folder do not need listing
+
+        The modification time of the folder is compared to the one it had
+        when last listed, not to the one of its pair: the pair is also
+        refreshed without listing the folder.
+        """
+        listed = self._listed_local_folders.get(doc_pair.local_folder, {})
+        return (doc_pair.local_path == local_info.path
+                and doc_pair.folderish
+                and listed.get(local_info.path) is not None
+                and listed[local_info.path]
+                    == local_info.last_modification_time
+                and local_info.path not in self._racy_local_folders.get(
+                    doc_pair.local_folder, ()))
+
+    def _check_racy_local_folder(self, local_folder, local_info):
+        """Remember the folders modified at the time they were listed
+
+        Their modification time might not change if another child is added
+        in the same time slot.
+        """
+        racy_folders = self._racy_local_folders.setdefault(local_folder,
+                                                           set())
+        age = datetime.now() - local_info.last_modification_time
+        if age < timedelta(seconds=self.folder_mtime_resolution):
+            racy_folders.add(local_info.path)
+        else:
+            racy_folders.discard(local_info.path)
+
+    def _get_known_local_children(self, session, client, doc_pair):
+        """Return the pairs of the known children with their local info
+
+        The modification time of the folder tells that no child has been
+        added, removed or renamed, hence only their content has to be
+        checked, with one stat call per child.
+        """
+        children = []
+        child_pairs = sorted(LastKnownState.query_local_children(
+            session, doc_pair.local_folder, doc_pair.local_path),
+            key=lambda pair: pair.local_path)
+        for child_pair in child_pairs:
+            child_info = client.get_info(child_pair.local_path,
+                                         raise_if_missing=False)
+            if (child_info is not None
+                and not self._mark_ignored_local(client, child_pair)):
+                children.append((child_pair, child_info))
+        return children
+
+    def _mark_ignored_local(self, client, doc_pair):
+        """Mark the pair of an ignored file or folder as unsynchronized
+
+        Return True if the file or folder is ignored: it is not listed any
+        more but still exists, hence must not be deleted remotely.
+        """
+        if (not client.is_ignored(doc_pair.local_name, doc_pair.local_path,
+                                  folderish=doc_pair.folderish)
+            or not client.exists(doc_pair.local_path)):
+            return False
+        if doc_pair.pair_state != 'unsynchronized':
+            log.debug("Marking local %s as unsynchronized as it is ignored",
+                      doc_pair.local_path)
+            doc_pair.pair_state = 'unsynchronized'
+        return True
+
+    def _get_folders_to_list(self, child_pairs, children_info,
+                             skip_unchanged):
+        """Return the paths of the child folders that will be listed"""
+        if not skip_unchanged:
+            return [c.path for c in children_info if c.folderish]
+        return [c.path for c in children_info
+                if c.folderish and (c.path not in child_pairs
+                                    or not self._is_local_folder_unchanged(
+                                        child_pairs[c.path], c))]
+
+    def _get_remote_children_pairs(self, session, doc_pair, remote_refs,
+                                   known_children):
+        """Return the pairs of the given remote refs by remote ref
+
+        Only the refs that are not known as children of the folder yet
+        are queried.
+        """
+        child_pairs = dict()
+        for pair in known_children:
+            if pair.remote_ref in remote_refs:
+                child_pairs.setdefault(pair.remote_ref, pair)
+        remote_refs = [ref for ref in remote_refs if ref not in child_pairs]
+        for i in range(0, len(remote_refs), self.page_size):
+            for pair in session.query(LastKnownState).filter(
+                LastKnownState.local_folder == doc_pair.local_folder,
+                LastKnownState.remote_ref.in_(
+                    remote_refs[i:i + self.page_size]),
+                ).order_by(LastKnownState.id):
+                child_pairs.setdefault(pair.remote_ref, pair)
+        return child_pairs
+
+    def _get_local_children_pairs(self, session, doc_pair, local_path,
+                                  children_path):
+        """Return the pairs of the children of a local folder
+
+        Return a tuple (child_pairs, unbound_pairs, deleted_pairs) where
+        child_pairs maps the listed local paths to their pairs, unbound_pairs
+        are the pairs of the remote children that are not bound to a local
+        file yet, in the order of creation, and deleted_pairs are the pairs
+        of the children that are not listed any more.
+
+        Deleted children are detected by difference with the listed paths
+        without writing to the database.
+        """
+        child_pairs = dict()
+        unbound_pairs = []
+        deleted_pairs = []
+        for pair in LastKnownState.query_local_children(
+            session, doc_pair.local_folder, local_path, doc_pair.remote_ref):
+            if pair.local_path is None:
+                if pair.remote_parent_ref == doc_pair.remote_ref:
+                    unbound_pairs.append(pair)
+            elif pair.local_path in children_path:
+                child_pairs.setdefault(pair.local_path, pair)
+            else:
+                deleted_pairs.append(pair)
+        return child_pairs, unbound_pairs, deleted_pairs
 
     def scan_remote(self, server_binding_or_local_path, from_state=None,
                     session=None):
-        """Recursively scan the bound remote folder looking for updates"""
+        """Recursively scan the bound remote folder looking for updates
+
+        The remote folders are listed ahead of their scan by the threads of
+        a remote tree walker (see remote_scan_workers), the pairs being
+        updated from the calling thread only.
+        """
         if session is None:
             session = self.get_session()
 
@@ -488,12 +1164,24 @@ class Synchronizer(object):
             session.commit()
             return
 
-        # recursive update
-        self._scan_remote_recursive(session, client, from_state, remote_info)
+        walker = None
+        if self.remote_scan_workers > 1:
+            walker = RemoteTreeWalker(client, workers=self.remote_scan_workers)
+        try:
+            # recursive update
+            self._scan_remote_recursive(session, client, from_state,
+                                        remote_info, walker=walker)
+        finally:
+            if walker is not None:
+                walker.close()
         session.commit()
 
     def _mark_deleted_remote_recursive(self, session, doc_pair):
         """Update the metadata of the descendants of remotely deleted doc"""
+        if LastKnownState.supports_subtree_queries(session):
+            LastKnownState.mark_remotely_deleted(session, doc_pair)
+            return
+
         # delete descendants first
         children = session.query(LastKnownState).filter_by(
             local_folder=doc_pair.local_folder,
@@ -510,15 +1198,28 @@ class Synchronizer(object):
             doc_pair.update_remote(None)
 
     def _scan_remote_recursive(self, session, client, doc_pair, remote_info,
-        force_recursion=True):
+        force_recursion=True, writer=None, walker=None):
         """Recursively scan the bound remote folder looking for updates
 
         If force_recursion is True, recursion is done even on
         non newly created children.
+
+        If a remote tree walker is given, the folders are listed ahead of
+        their scan by its threads.
+
+        The new pairs are inserted by the given writer, flushed at the end of
+        the scan if not given.
         """
         if remote_info is None:
             raise ValueError("Cannot bind %r to missing remote info" %
                              doc_pair)
+        if writer is None:
+            writer = PairWriter(session)
+            self._scan_remote_recursive(session, client, doc_pair, remote_info,
+                                        force_recursion=force_recursion,
+                                        writer=writer, walker=walker)
+            writer.flush()
+            return
 
         # Update the pair state from the collected remote info
         doc_pair.update_remote(remote_info)
@@ -534,84 +1235,141 @@ class Synchronizer(object):
         self._mark_unknown_local_recursive(session, doc_pair)
 
         # Detect recently deleted children
-        children_info = client.get_children_info(remote_info.uid)
+        children_info = self._list_remote_children(client, remote_info.uid,
+                                                   walker)
         children_refs = set(c.uid for c in children_info)
 
-        selectionTag = LastKnownState.select_remote_refs(session,
-                                                         children_refs,
-                                                         self.page_size)
-        for deleted in LastKnownState.not_selected(
-                            session.query(LastKnownState)
-                                .filter_by(local_folder=doc_pair.local_folder,
-                                    remote_parent_ref=remote_info.uid,),
-                            selectionTag):
+        known_children = LastKnownState.query_remote_children(
+            session, doc_pair.local_folder, remote_info.uid).all()
+        for deleted in [pair for pair in known_children
+                        if pair.remote_ref not in children_refs]:
             self._mark_deleted_remote_recursive(session, deleted)
 
+        # Load the pairs of the children at once instead of querying them
+        # child by child: they might have been moved from another folder
+        child_pairs = self._get_remote_children_pairs(
+            session, doc_pair, children_refs, known_children)
+        unbound_pairs = None
+
         # Recursively update children
         for child_info in children_info:
 
             # TODO: detect whether this is a __digit suffix name and relax the
             # alignment queries accordingly
-            child_pair = session.query(LastKnownState).filter_by(
-                local_folder=doc_pair.local_folder,
-                remote_ref=child_info.uid).first()
+            child_pair = child_pairs.get(child_info.uid)
 
-            new_pair = False
             if child_pair is None:
-                child_pair, new_pair = self._find_remote_child_match_or_create(
-                    doc_pair, child_info, session=session)
-
-            if new_pair or force_recursion:
+                if unbound_pairs is None:
+                    unbound_pairs = LastKnownState.query_unbound_local_children(
+                        session, doc_pair.local_folder,
+                        doc_pair.local_path).all()
+                child_pair = self._find_remote_child_match(
+                    doc_pair, child_info, session, unbound_pairs)
+                if child_pair is None:
+                    # Could not find any pair state to align to, create one
+                    self._scan_new_remote_pair(session, client, writer,
+                                               doc_pair.local_folder,
+                                               child_info, walker)
+                    continue
+
+            if force_recursion:
+                self._scan_remote_recursive(session, client, child_pair,
+                                            child_info, writer=writer,
+                                            walker=walker)
+
+    def _list_remote_children(self, client, uid, walker):
+        """Return the info of the children of a remote folder"""
+        if walker is not None:
+            return walker.get_children_info(uid)
+        return client.get_children_info(uid)
+
+    def _scan_new_remote_pair(self, session, client, writer, local_folder,
+                              remote_info, walker=None):
+        """Create the pairs of a new remote document and its descendants
+
+        The descendants of a new folder can only be new documents or
+        documents moved from another folder: only the latter are queried and
+        scanned as known pairs, the pairs of the new ones are inserted in
+        batches by the writer.
+        """
+        pair = ScannedPair(local_folder, remote_info=remote_info)
+        writer.add(pair)
+        log.trace("Created new pair %r", pair)
+        if not remote_info.folderish:
+            return
+        children_info = self._list_remote_children(client, remote_info.uid,
+                                                   walker)
+        child_pairs = self._get_remote_children_pairs(
+            session, pair, set(c.uid for c in children_info), [])
+        for child_info in children_info:
+            child_pair = child_pairs.get(child_info.uid)
+            if child_pair is None:
+                self._scan_new_remote_pair(session, client, writer,
+                                           local_folder, child_info, walker)
+            else:
                 self._scan_remote_recursive(session, client, child_pair,
-                                        child_info)
+                                            child_info, writer=writer,
+                                            walker=walker)
 
     def _find_remote_child_match_or_create(self, parent_pair, child_info,
-                                           session=None):
+                                           session=None, unbound_pairs=None):
         """Find a pair_state that can match child_info by name.
 
         Return a tuple (child_pair, created) where created is a boolean marker
         that tells that no match was found and that child_pair is newly created
         from the provided child_info.
 
+        unbound_pairs are the pairs of the local children of the parent that
+        are not bound to a remote document, queried if not provided.
         """
         session = self.get_session() if session is None else session
+        child_pair = self._find_remote_child_match(parent_pair, child_info,
+                                                   session, unbound_pairs)
+        if child_pair is not None:
+            return child_pair, False
+
+        # Could not find any pair state to align to, create one
+        child_pair = LastKnownState(parent_pair.local_folder,
+            remote_info=child_info)
+        log.trace("Created new pair %r", child_pair)
+        session.add(child_pair)
+        return child_pair, True
+
+    def _find_remote_child_match(self, parent_pair, child_info, session,
+                                 unbound_pairs=None):
+        """Return the unbound local child pair matching child_info or None"""
         child_name = child_info.name
-        if not child_info.folderish:
-            # Try to find an existing local doc that has not yet been
-            # bound to any remote file that would align with both name
-            # and digest
-            possible_pairs = session.query(LastKnownState).filter_by(
+        if unbound_pairs is None:
+            unbound_pairs = session.query(LastKnownState).filter_by(
                 local_folder=parent_pair.local_folder,
                 remote_ref=None,
                 local_parent_path=parent_pair.local_path,
                 folderish=child_info.folderish,
-                local_digest=child_info.get_digest(),
-            ).all()
+            ).order_by(LastKnownState.id).all()
+        # Pairs bound since loaded are not candidates any more
+        unbound_pairs = [pair for pair in unbound_pairs
+                         if pair.remote_ref is None
+                         and pair.folderish == child_info.folderish]
+        if not child_info.folderish:
+            # Try to find an existing local doc that has not yet been
+            # bound to any remote file that would align with both name
+            # and digest
+            child_digest = child_info.get_digest()
+            possible_pairs = [pair for pair in unbound_pairs
+                              if pair.local_digest == child_digest]
             child_pair = find_first_name_match(child_name, possible_pairs)
             if child_pair is not None:
                 log.debug("Matched remote %s with local %s with digest",
                           child_info.name, child_pair.local_path)
-                return child_pair, False
+                return child_pair
 
         # Previous attempt has failed: relax the digest constraint
-        possible_pairs = session.query(LastKnownState).filter_by(
-            local_folder=parent_pair.local_folder,
-            remote_ref=None,
-            local_parent_path=parent_pair.local_path,
-            folderish=child_info.folderish,
-        ).all()
+        possible_pairs = unbound_pairs
         child_pair = find_first_name_match(child_name, possible_pairs)
         if child_pair is not None:
             log.debug("Matched remote %s with local %s by name only",
                       child_info.name, child_pair.local_path)
-            return child_pair, False
-
-        # Could not find any pair state to align to, create one
-        child_pair = LastKnownState(parent_pair.local_folder,
-            remote_info=child_info)
-        log.trace("Created new pair %r", child_pair)
-        session.add(child_pair)
-        return child_pair, True
+        return child_pair
 
     def synchronize_one(self, doc_pair, session=None):
         """Refresh state and perform network transfer for a doc pair."""
@@ -620,7 +1378,7 @@ class Synchronizer(object):
         # synchronize
         remote_client = self.get_remote_fs_client(doc_pair.server_binding)
         # local clients are cheap
-        local_client = doc_pair.get_local_client()
+        local_client = self._controller.get_local_client(doc_pair.local_folder)
 
         # Update the status of the collected info of this file to make sure
         # we won't perform inconsistent operations
@@ -669,12 +1427,22 @@ class Synchronizer(object):
         if doc_pair.remote_digest != doc_pair.local_digest:
             log.debug("Updating remote document '%s'.",
                       doc_pair.remote_name)
-            remote_client.stream_update(
-                doc_pair.remote_ref,
-                doc_pair.get_local_abspath(),
-                filename=doc_pair.remote_name,
-            )
-            doc_pair.refresh_remote(remote_client)
+            remote_ref = doc_pair.remote_ref
+            file_path = doc_pair.get_local_abspath()
+            filename = doc_pair.remote_name
+
+            def upload():
+                return remote_client.stream_update(remote_ref, file_path,
+                                                   filename=filename)
+
+            def finish(doc_pair, transfer):
+                transfer.get_result()
+                doc_pair.refresh_remote(remote_client)
+                doc_pair.update_state('synchronized', 'synchronized')
+
+            self._transfer(session, doc_pair, 'upload', file_path,
+                           _upload(file_path, upload), finish)
+            return
         doc_pair.update_state('synchronized', 'synchronized')
 
     def _synchronize_remotely_modified(self, doc_pair, session,
@@ -684,13 +1452,13 @@ class Synchronizer(object):
                 log.debug("Updating content of local file '%s'.",
                           doc_pair.get_local_abspath())
                 os_path = local_client.get_info(doc_pair.local_path).filepath
-                tmp_file = remote_client.stream_content(
-                                            doc_pair.remote_ref, os_path)
-                # Delete original file and rename tmp file
-                local_client.delete(doc_pair.local_path)
-                local_client.rename(local_client.get_path(tmp_file),
-                                    doc_pair.local_name)
-                doc_pair.refresh_local(local_client)
+                self._transfer(
+                    session, doc_pair, 'download',
+                    get_download_tmp_path(os_path),
+                    _download(remote_client, doc_pair.remote_ref, os_path),
+                    lambda doc_pair, transfer: self._update_local_content(
+                        doc_pair, transfer, local_client))
+                return
             else:
                 # digest agree so this might be a renaming and/or a move,
                 # and no need to transfer additional bytes over the network
@@ -733,15 +1501,25 @@ class Synchronizer(object):
                 "content %r due to concurrent file access.",
                 doc_pair)
 
+    def _update_local_content(self, doc_pair, transfer, local_client):
+        try:
+            tmp_file = transfer.get_result()
+            # Delete original file and rename tmp file
+            local_client.delete(doc_pair.local_path)
+            local_client.rename(local_client.get_path(tmp_file),
+                                doc_pair.local_name)
+            doc_pair.refresh_local(local_client)
+            doc_pair.update_state('synchronized', 'synchronized')
+        except (IOError, WindowsError):
+            log.debug("Delaying update for remotely modified "
+                "content %r due to concurrent file access.",
+                doc_pair)
+
     def _is_remote_move(self, doc_pair, session):
-        local_parent_pair = session.query(LastKnownState).filter_by(
-            local_folder=doc_pair.local_folder,
-            local_path=doc_pair.local_parent_path
-        ).first()
-        remote_parent_pair = session.query(LastKnownState).filter_by(
-            local_folder=doc_pair.local_folder,
-            remote_ref=doc_pair.remote_parent_ref
-        ).first()
+        index = self._get_pair_index(session, doc_pair.local_folder)
+        local_parent_pair = index.get_by_local_path(doc_pair.local_parent_path)
+        remote_parent_pair = index.get_by_remote_ref(
+            doc_pair.remote_parent_ref)
         return (local_parent_pair is not None
                 and remote_parent_pair is not None
                 and local_parent_pair.id != remote_parent_pair.id,
@@ -755,10 +1533,9 @@ class Synchronizer(object):
         name = os.path.basename(doc_pair.local_path)
         # Find the parent pair to find the ref of the remote folder to
         # create the document
-        parent_pair = session.query(LastKnownState).filter_by(
-            local_folder=doc_pair.local_folder,
-            local_path=doc_pair.local_parent_path
-        ).first()
+        parent_pair = self._get_pair_index(
+            session, doc_pair.local_folder).get_by_local_path(
+                doc_pair.local_parent_path)
         if parent_pair is None or (parent_pair.remote_can_create_child
                                    and parent_pair.remote_ref is None):
             # Illegal state: report the error and let's wait for the
@@ -776,8 +1553,19 @@ class Synchronizer(object):
             else:
                 log.debug("Creating remote document '%s' in folder '%s'",
                           name, parent_pair.remote_name)
-                remote_ref = remote_client.stream_file(
-                    parent_ref, doc_pair.get_local_abspath(), filename=name)
+                file_path = doc_pair.get_local_abspath()
+
+                def finish(doc_pair, transfer):
+                    doc_pair.update_remote(transfer.get_result())
+                    doc_pair.update_state('synchronized', 'synchronized')
+
+                def upload():
+                    return remote_client.get_info(remote_client.stream_file(
+                        parent_ref, file_path, filename=name))
+
+                self._transfer(session, doc_pair, 'upload', file_path,
+                               _upload(file_path, upload), finish)
+                return
             doc_pair.update_remote(remote_client.get_info(remote_ref))
             doc_pair.update_state('synchronized', 'synchronized')
         else:
@@ -797,10 +1585,9 @@ class Synchronizer(object):
         name = remote_info.name
         # Find the parent pair to find the path of the local folder to
         # create the document into
-        parent_pair = session.query(LastKnownState).filter_by(
-            local_folder=doc_pair.local_folder,
-            remote_ref=remote_info.parent_uid,
-        ).first()
+        parent_pair = self._get_pair_index(
+            session, doc_pair.local_folder).get_by_remote_ref(
+                remote_info.parent_uid)
         if parent_pair is None:
             # Illegal state: report the error and let's wait for the
             # parent folder issue to get resolved first
@@ -826,10 +1613,19 @@ class Synchronizer(object):
                                                             name)
             log.debug("Creating local file '%s' in '%s'", name,
                       parent_pair.get_local_abspath())
-            tmp_file = remote_client.stream_content(
-                                            doc_pair.remote_ref, os_path)
-            # Rename tmp file
-            local_client.rename(local_client.get_path(tmp_file), name)
+
+            def finish(doc_pair, transfer):
+                tmp_file = transfer.get_result()
+                # Rename tmp file
+                local_client.rename(local_client.get_path(tmp_file), name)
+                doc_pair.update_local(local_client.get_info(path))
+                doc_pair.update_state('synchronized', 'synchronized')
+
+            self._transfer(session, doc_pair, 'download',
+                           get_download_tmp_path(os_path),
+                           _download(remote_client, doc_pair.remote_ref,
+                                     os_path), finish)
+            return
         doc_pair.update_local(local_client.get_info(path))
         doc_pair.update_state('synchronized', 'synchronized')
 
@@ -910,23 +1706,19 @@ class Synchronizer(object):
         Otherwise, return (None, None)
 
         """
-        filters = [
-            LastKnownState.local_folder == doc_pair.local_folder,
-            LastKnownState.folderish == doc_pair.folderish,
-        ]
+        index = self._get_pair_index(session, doc_pair.local_folder)
         if doc_pair.folderish:
             # Detect either renaming or move but not both at the same time
             # for folder to reduce the potential cost of re-ranking that
             # needs to fetch the children of all potential candidates.
-            filters.append(or_(
-                LastKnownState.local_name == doc_pair.local_name,
-                LastKnownState.local_parent_path == doc_pair.local_parent_path
-            ))
+            candidates = index.get_by_local_name(doc_pair.local_name)
+            candidates += [
+                pair for pair in index.get_local_children(
+                    doc_pair.local_parent_path) if pair not in candidates]
         else:
             # File match is based on digest hence we can efficiently detect
             # move and rename events or both at the same time.
-            filters.append(
-                LastKnownState.local_digest == doc_pair.local_digest)
+            candidates = index.get_by_local_digest(doc_pair.local_digest)
 
         if doc_pair.pair_state == 'locally_deleted':
             source_doc_pair = doc_pair
@@ -934,20 +1726,26 @@ class Synchronizer(object):
             # The creation detection might not have occurred yet for the
             # other pair state: let consider both pairs in states 'created'
             # and 'unknown'.
-            filters.extend((
-                LastKnownState.remote_ref == None,
-                or_(LastKnownState.local_state == 'created',
-                    LastKnownState.local_state == 'unknown'),
-            ))
+            is_candidate = lambda pair: (
+                pair.remote_ref is None
+                and pair.local_state in ('created', 'unknown'))
         elif doc_pair.pair_state == 'locally_created':
             source_doc_pair = None
             target_doc_pair = doc_pair
-            filters.append(LastKnownState.local_state == 'deleted')
+            is_candidate = lambda pair: pair.local_state == 'deleted'
         else:
             # Nothing to do
             return None, None
 
-        candidates = session.query(LastKnownState).filter(*filters).all()
+        if self._in_flight:
+            # Leave alone the pairs being transferred and their ancestors
+            running = self._get_running_pairs()
+            candidates = [pair for pair in candidates
+                          if not running.conflicts(_get_order_keys(pair))]
+        candidates = sorted(
+            [pair for pair in candidates
+             if pair.folderish == doc_pair.folderish and is_candidate(pair)],
+            key=lambda pair: (pair.id is None, pair.id))
         if len(candidates) == 0:
             # No match found
             return None, None
@@ -1013,10 +1811,9 @@ class Synchronizer(object):
 
             # Find the matching target parent folder, assuming it has already
             # been refreshed and matched in the past
-            parent_doc_pair = session.query(LastKnownState).filter_by(
-                local_folder=doc_pair.local_folder,
-                local_path=target_doc_pair.local_parent_path,
-            ).first()
+            parent_doc_pair = self._get_pair_index(
+                session, doc_pair.local_folder).get_by_local_path(
+                    target_doc_pair.local_parent_path)
 
             if (parent_doc_pair is not None  and
                 parent_doc_pair.remote_ref is not None):
@@ -1077,71 +1874,272 @@ class Synchronizer(object):
         return moved_or_renamed
 
     def synchronize(self, server_binding=None, limit=None):
-        """Synchronize one file at a time from the pending list."""
+        """Synchronize one file at a time from the pending list
+
+        The contents of the files are transferred by the threads of the
+        transfer service of the controller while the next pairs are
+        synchronized, see _transfer and _select_pending_pair. Once the limit
+        is reached, no other pair is selected: the running transfers are
+        waited for. All the transfers have finished when returning.
+        """
         local_folder = (server_binding.local_folder
                         if server_binding is not None else None)
         synchronized = 0
         session = self.get_session()
+        PairIndex.refresh(session)
+        queue = PendingQueue(session, local_folder=local_folder,
+                             ignore_in_error=self.error_skip_period,
+                             batch_size=self.limit_pending)
+        transfers = self._controller.transfer_service
+        resumed = self._resume_transfer_jobs(session, local_folder)
+        if transfers.max_workers > 0:
+            self._in_flight = dict()
 
-        while (limit is None or synchronized < limit):
+        try:
+            while (limit is None or synchronized < limit or self._in_flight):
+                if self._in_flight:
+                    self._finish_transfers(session, transfers.pop_done())
+                if limit is not None and synchronized >= limit:
+                    # Only the running transfers are left to finish
+                    if self._in_flight:
+                        self._wait_for_transfers(session)
+                    continue
+
+                pending = queue.get_pairs()
+                or_more = queue.or_more
+                if self._frontend is not None:
+                    self._frontend.notify_pending(
+                        server_binding, len(pending), or_more=or_more)
 
-            pending = self._controller.list_pending(
-                local_folder=local_folder,
-                limit=self.limit_pending,
-                session=session, ignore_in_error=self.error_skip_period)
+                if len(pending) == 0 and not self._in_flight:
+                    break
 
-            or_more = len(pending) == self.limit_pending
-            if self._frontend is not None:
-                self._frontend.notify_pending(
-                    server_binding, len(pending), or_more=or_more)
-
-            if len(pending) == 0:
-                break
-
-            # Look first for a pending pair state with local_path not None,
-            # fall back on first one. This is needed in the case where a
-            # document is remotely deleted then created with the same name
-            # in the same folder within the same change summary: deletion
-            # (local_path not None) needs to be handled before creation
-            # (local_path None), otherwise the deduplication suffix will
-            # be added. See https://jira.nuxeo.com/browse/NXP-11517
-            pending_iterator = 0
-            while ((pending[pending_iterator].local_path is None
-                    or pending[pending_iterator].remote_ref is None)
-                   and len(pending) > pending_iterator + 1):
-                pending_iterator += 1
-            if ((pending[pending_iterator].local_path is None
-                 or pending[pending_iterator].remote_ref is None)
-                and len(pending) == pending_iterator + 1):
-                pending_iterator = 0
-            pair_state = pending[pending_iterator]
+                # Let the pairs waiting for the digest of a local file
+                # computed in the background go last, the digest being
+                # computed inline when no other pair is left
+                ready = [p for p in pending if not self._is_digest_pending(p)]
+                if ready:
+                    pending = ready
+
+                pair_state = self._select_pending_pair(pending, resumed)
+                if pair_state is None:
+                    if not self._in_flight:
+                        break
+                    # Every pending pair waits for a running transfer
+                    self._wait_for_transfers(session)
+                    continue
+                queue.remove(pair_state)
+                resumed.discard(pair_state.id)
+
+                if self._handle_sync_errors(
+                        session, pair_state,
+                        lambda: self.synchronize_one(pair_state,
+                                                     session=session)):
+                    synchronized += 1
+        except Exception:
+            # Wait for the running transfers, unless interrupted by a stop
+            # of the process: they are resumed from their TransferJob then
+            exc_info = sys.exc_info()
+            self._abort_transfers(session)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            self._in_flight = None
 
-            try:
-                self.synchronize_one(pair_state, session=session)
-                synchronized += 1
-            except POSSIBLE_NETWORK_ERROR_TYPES as e:
-                if getattr(e, 'code', None) in UNEXPECTED_HTTP_STATUS:
-                    # This is an unexpected: blacklist doc_pair for
-                    # a cooldown period
-                    log.error("Failed to sync %r, blacklisting doc pair "
-                              "for %d seconds",
-                        pair_state, self.error_skip_period, exc_info=True)
-                    pair_state.last_sync_error_date = datetime.utcnow()
-                    session.commit()
-                else:
-                    # This is expected and should interrupt the sync process
-                    # for this local_folder and should be dealt with
-                    # in the main loop
-                    raise e
-            except Exception as e:
-                # Unexpected exception: blacklist for a cooldown period
+        return synchronized
+
+    def _select_pending_pair(self, pending, resumed=()):
+        """Return the next pair to synchronize, None if they all wait
+
+        Look first for a pending pair state with local_path not None,
+        fall back on first one. This is needed in the case where a document
+        is remotely deleted then created with the same name in the same
+        folder within the same change summary: deletion (local_path not
+        None) needs to be handled before creation (local_path None),
+        otherwise the deduplication suffix will be added. See
+        https://jira.nuxeo.com/browse/NXP-11517
+
+        The pairs whose transfer is running wait for it to finish, as well
+        as their ancestors and descendants on either side and their siblings
+        of the same name, and in turn the pairs related to a waiting pair:
+        parents are still synchronized before their children and deletions
+        before the creations of the same name. A pair that may transfer the
+        content of a file also waits for a free transfer worker. The pairs
+        whose transfer was interrupted by a stop of the process go first.
+        """
+        candidates = [p for p in pending
+                      if p.local_path is not None and p.remote_ref is not None]
+        candidates += [p for p in pending
+                       if p.local_path is None or p.remote_ref is None]
+        if resumed:
+            candidates.sort(key=lambda pair: pair.id not in resumed)
+        if self._in_flight is None:
+            return candidates[0]
+
+        transfers = self._controller.transfer_service
+        waiting = self._get_running_pairs()
+        for pair in candidates:
+            keys = _get_order_keys(pair)
+            if (pair.id in self._in_flight or waiting.conflicts(keys)
+                or (_may_transfer(pair) and not transfers.has_free_slot())):
+                waiting.add(keys)
+                continue
+            return pair
+        return None
+
+    def _get_running_pairs(self):
+        running = _WaitingPairs()
+        for _, keys in self._in_flight.values():
+            running.add(keys)
+        return running
+
+    def _handle_sync_errors(self, session, doc_pair, sync):
+        """Call sync, blacklisting doc_pair on unexpected errors
+
+        Return True if the synchronization succeeded. The network errors
+        that are expected are raised.
+        """
+        try:
+            sync()
+            return True
+        except POSSIBLE_NETWORK_ERROR_TYPES as e:
+            if getattr(e, 'code', None) in UNEXPECTED_HTTP_STATUS:
+                # This is an unexpected: blacklist doc_pair for
+                # a cooldown period
                 log.error("Failed to sync %r, blacklisting doc pair "
                           "for %d seconds",
-                    pair_state, self.error_skip_period, exc_info=True)
-                pair_state.last_sync_error_date = datetime.utcnow()
+                    doc_pair, self.error_skip_period, exc_info=True)
+                doc_pair.last_sync_error_date = datetime.utcnow()
                 session.commit()
+            else:
+                # This is expected and should interrupt the sync process
+                # for this local_folder and should be dealt with
+                # in the main loop
+                raise
+        except Exception as e:
+            # Unexpected exception: blacklist for a cooldown period
+            log.error("Failed to sync %r, blacklisting doc pair "
+                      "for %d seconds",
+                doc_pair, self.error_skip_period, exc_info=True)
+            doc_pair.last_sync_error_date = datetime.utcnow()
+            session.commit()
+        return False
 
-        return synchronized
+    def _transfer(self, session, doc_pair, direction, file_path, run,
+                  finish):
+        """Transfer the content of a pair then finish its synchronization
+
+        run is called without argument and returns a tuple of its result and
+        the number of bytes transferred: it must not use the session nor the
+        pairs. finish(doc_pair, transfer) then updates the pair from the
+        result, see Transfer.get_result.
+
+        During synchronize, the transfer is recorded as a TransferJob and run
+        by the transfer service, finish being called from the synchronization
+        thread once it is done. Otherwise it is run inline.
+        """
+        if self._in_flight is None:
+            transfer = Transfer(doc_pair.id, run)
+            transfer.execute()
+            finish(doc_pair, transfer)
+            return
+        job = TransferJob.get_or_create(session, doc_pair.local_folder,
+                                        doc_pair.id)
+        job.direction = direction
+        job.file_path = file_path
+        job.attempts += 1
+        session.commit()
+        log.trace("Starting %s of %r", direction, file_path)
+        self._controller.transfer_service.submit(doc_pair.id, run)
+        self._in_flight[doc_pair.id] = finish, _get_order_keys(doc_pair)
+
+    def _finish_transfers(self, session, done):
+        """Finish the synchronization of the pairs transferred"""
+        for transfer in done:
+            if transfer.key not in self._in_flight:
+                # Left running by an interrupted synchronization
+                continue
+            finish, _ = self._in_flight.pop(transfer.key)
+            job = TransferJob.get(session, transfer.key)
+            if job is not None:
+                session.delete(job)
+            doc_pair = session.query(LastKnownState).get(transfer.key)
+            if doc_pair is None:
+                log.debug("Ignoring transfer of deleted pair %r",
+                          transfer.key)
+                session.commit()
+                continue
+
+            def finish_pair():
+                finish(doc_pair, transfer)
+                doc_pair.last_sync_date = datetime.now()
+                session.commit()
+
+            self._handle_sync_errors(session, doc_pair, finish_pair)
+
+    def _wait_for_transfers(self, session):
+        done = self._controller.transfer_service.pop_done(wait=True)
+        if not done:
+            log.warning("Transfer service stopped with %d transfers running",
+                        len(self._in_flight))
+            self._in_flight.clear()
+        self._finish_transfers(session, done)
+
+    def _abort_transfers(self, session):
+        """Wait for the running transfers when synchronize fails"""
+        while self._in_flight:
+            try:
+                self._wait_for_transfers(session)
+            except Exception:
+                log.error("Failed to finish the synchronization of a"
+                          " transferred pair", exc_info=True)
+
+    def _resume_transfer_jobs(self, session, local_folder):
+        """Clean up after the transfers interrupted by a stop of the process
+
+        Return the ids of the pairs to transfer again, the temporary files of
+        their downloads being kept for resuming them. A pair whose transfer
+        has been interrupted max_transfer_attempts times is blacklisted.
+        """
+        query = session.query(TransferJob)
+        if local_folder is not None:
+            query = query.filter(TransferJob.local_folder == local_folder)
+        resumed = set()
+        jobs = query.all()
+        for job in jobs:
+            doc_pair = session.query(LastKnownState).get(job.pair_id)
+            if (doc_pair is None or doc_pair.pair_state
+                in ('synchronized', 'unsynchronized')):
+                session.delete(job)
+            elif job.attempts >= self.max_transfer_attempts:
+                log.error("Transfer of %r interrupted %d times, blacklisting"
+                          " doc pair for %d seconds", doc_pair, job.attempts,
+                          self.error_skip_period)
+                doc_pair.last_sync_error_date = datetime.utcnow()
+                session.delete(job)
+            else:
+                log.debug("Resuming interrupted %s of %r", job.direction,
+                          doc_pair)
+                resumed.add(job.pair_id)
+                if self._controller.transfer_service.max_workers < 1:
+                    # Transferred inline from now on
+                    session.delete(job)
+                continue
+            if job.direction == 'download' and job.file_path is not None:
+                self._remove_download_tmp_files(job.file_path)
+        if jobs:
+            session.commit()
+        return resumed
+
+    def _remove_download_tmp_files(self, tmp_file):
+        for path in (tmp_file, get_download_state_path(tmp_file)):
+            if not os.path.exists(safe_long_path(path)):
+                continue
+            log.debug("Removing temporary file %r of an interrupted"
+                      " download", path)
+            try:
+                os.remove(safe_long_path(path))
+            except OSError as e:
+                log.warning("Could not remove %r: %r", path, e)
 
     def _get_sync_pid_filepath(self, process_name="sync"):
         return os.path.join(self._controller.config_folder,
@@ -1237,6 +2235,12 @@ class Synchronizer(object):
                 if self._frontend is not None:
                     self._frontend.notify_local_folders(bindings)
 
+                # Release the file system watchers of unbound folders
+                bound_folders = set(sb.local_folder for sb in bindings)
+                self.stop_local_watchers([local_folder for local_folder
+                                          in self._local_watchers
+                                          if local_folder not in bound_folders])
+
                 for sb in bindings:
                     if not sb.has_invalid_credentials():
                         n_synchronized += self.update_synchronize_server(
@@ -1265,6 +2269,8 @@ class Synchronizer(object):
         except:
             self.get_session().rollback()
             raise
+        finally:
+            self.stop_local_watchers(session=self.get_session())
 
         # Clean pid file
         pid_filepath = self._get_sync_pid_filepath()
@@ -1402,6 +2408,7 @@ class Synchronizer(object):
                                   full_scan=False, max_sync_step=None):
         """Do one pass of synchronization for given server binding."""
         session = self.get_session() if session is None else session
+        PairIndex.refresh(session)
         max_sync_step = (max_sync_step if max_sync_step is not None
                           else self.max_sync_step)
         local_scan_is_done = False
@@ -1438,8 +2445,8 @@ class Synchronizer(object):
             # from this point next time
             self._checkpoint(server_binding, checkpoint, session=session)
 
-            # Scan local folders to detect changes
-            # XXX: OPTIM: use file system monitoring instead
+            # Scan local folders to detect changes, incrementally when file
+            # system monitoring is available
             try:
                 self.scan_local(server_binding, session=session)
             except NotFound:
@@ -1450,11 +2457,13 @@ class Synchronizer(object):
                          server_binding.local_folder,
                          server_binding.server_url)
                 # LastKnownState table will be deleted on cascade
-                session.delete(server_binding)
+                self.stop_local_watchers([server_binding.local_folder])
+                server_binding.delete(session)
                 session.commit()
                 return 1
 
             local_scan_is_done = True
+            self._count_descendants(server_binding, session)
             local_refresh_duration = time() - tick
 
             tick = time()
@@ -1464,6 +2473,7 @@ class Synchronizer(object):
 
             n_synchronized = self.synchronize(limit=max_sync_step,
                 server_binding=server_binding)
+            self._count_descendants(server_binding, session)
             synchronization_duration = time() - tick
             log.debug("[%s] - [%s]: synchronized: %d, pending: %d, "
                       "local: %0.3fs, remote: %0.3fs sync: %0.3fs",
@@ -1492,6 +2502,15 @@ class Synchronizer(object):
             # pending operations on a per-server basis!
             self._frontend.notify_pending(server_binding, -1)
 
+    def _count_descendants(self, server_binding, session):
+        """Count the descendants of the folders the tree of which changed
+
+        The status of the folders shown by the frontend is read from their
+        counters, see Controller.children_states.
+        """
+        LastKnownState.count_descendants(session, server_binding.local_folder)
+        session.commit()
+
     def _notify_pending(self, server_binding):
         """Update the statistics of the frontend"""
         n_pending = len(self._controller.list_pending(
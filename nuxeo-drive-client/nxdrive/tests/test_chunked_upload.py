@@ -0,0 +1,264 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+from nxdrive.client.base_automation_client import BaseAutomationClient
+from nxdrive.client.chunked_upload import ChunkedUpload
+from nxdrive.client.connection_pool import ConnectionPool
+
+
+CHUNK_SIZE = 16 * 1024
+
+
+class BatchServer(ThreadingMixIn, HTTPServer):
+    """Local stand-in for the batch upload endpoints of a Nuxeo server
+
+    Chunked uploads are supported unless chunked is False, the chunks whose
+    index is in failures are answered with a 503 error that many times and
+    each upload takes latency seconds, plus the time to receive its content
+    at rate bytes per second if given.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0, rate=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), BatchHandler)
+        self.url = 'http://127.0.0.1:%d/nuxeo/' % self.server_address[1]
+        self.latency = latency
+        self.rate = rate
+        self.chunked = True
+        self.failures = dict()
+        self.batches = dict()
+        # Indexes of the received chunks, None for whole files
+        self.uploads = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        pass
+
+    def receive(self, batch_id, index, count, content):
+        with self.lock:
+            self.uploads.append(index)
+            if self.failures.get(index):
+                self.failures[index] -= 1
+                return None
+            batch = self.batches.setdefault(batch_id, dict())
+            if index is None:
+                batch.clear()
+                batch[0] = content
+                return {'uploaded': 'true', 'batchId': batch_id}
+            batch[index] = content
+            return {
+                'uploaded': 'true',
+                'batchId': batch_id,
+                'uploadType': 'chunked',
+                'uploadedChunkIds': [str(i) for i in sorted(batch)],
+                'chunkCount': count,
+            }
+
+    def execute(self, batch_id):
+        # Executed batches are cleaned up as by the server
+        with self.lock:
+            batch = self.batches.pop(batch_id, None)
+        if batch is None or sorted(batch) != range(len(batch)):
+            return None
+        content = b''.join(batch[i] for i in range(len(batch)))
+        return {'digest': hashlib.md5(content).hexdigest()}
+
+
+class BatchHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_json({'operations': []})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path.endswith('/batch/execute'):
+            self.send_json(self.server.execute(
+                json.loads(body)['params']['batchId']))
+            return
+        index = count = None
+        if (self.server.chunked
+                and self.headers.get('X-Upload-Type') == 'chunked'):
+            index = int(self.headers['X-Upload-Chunk-Index'])
+            count = int(self.headers['X-Upload-Chunk-Count'])
+        server = self.server
+        with server.lock:
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        time.sleep(server.latency
+                   + (len(body) / float(server.rate) if server.rate else 0))
+        with server.lock:
+            server.running -= 1
+        self.send_json(server.receive(self.headers['X-Batch-Id'], index,
+                                      count, body))
+
+    def send_json(self, result):
+        if result is None:
+            self.send_response(503)
+            body = b''
+        else:
+            self.send_response(200)
+            body = json.dumps(result)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+server = None
+pool = None
+TEST_FOLDER = None
+retry_delay = None
+
+
+def setup_server():
+    global server, pool, TEST_FOLDER, retry_delay
+    server = BatchServer(latency=0.02)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    pool = ConnectionPool()
+    TEST_FOLDER = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    retry_delay = ChunkedUpload.retry_delay
+    ChunkedUpload.retry_delay = 0
+
+
+def teardown_server():
+    ChunkedUpload.retry_delay = retry_delay
+    pool.clear()
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(TEST_FOLDER)
+
+
+with_server = with_setup(setup_server, teardown_server)
+
+
+def make_client():
+    """A new client, as after a restart of the process"""
+    return BaseAutomationClient(
+        server.url, u'Administrator', u'device', u'1.0', password=u'secret',
+        proxies={}, upload_tmp_dir=TEST_FOLDER, connection_pool=pool,
+        transfer_pool=pool,
+        upload_chunk_size=CHUNK_SIZE)
+
+
+def make_file(name, size):
+    path = os.path.join(TEST_FOLDER, name)
+    content = os.urandom(size)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path, hashlib.md5(content).hexdigest()
+
+
+def upload(client, path):
+    return client.execute_with_blob_streaming('NuxeoDrive.CreateFile', path)
+
+
+def get_states():
+    return [name for name in os.listdir(TEST_FOLDER)
+            if name.startswith('nxdrive-upload-')]
+
+
+@with_server
+def test_chunked_upload():
+    client = make_client()
+    path, digest = make_file(u'Big.bin', 10 * CHUNK_SIZE + 17)
+    assert_equal(upload(client, path), {'digest': digest})
+    assert_equal(sorted(server.uploads), range(11))
+    assert_true(server.max_running > 1)
+    assert_equal(get_states(), [])
+
+    # Small files are uploaded in a single request
+    del server.uploads[:]
+    path, digest = make_file(u'Small.bin', CHUNK_SIZE)
+    assert_equal(upload(client, path), {'digest': digest})
+    assert_equal(server.uploads, [None])
+
+
+@with_server
+def test_chunk_retry():
+    server.failures.update({0: 1, 3: 2, 7: 1})
+    path, digest = make_file(u'Big.bin', 10 * CHUNK_SIZE)
+    assert_equal(upload(make_client(), path), {'digest': digest})
+    assert_equal(sorted(server.uploads),
+                 [0, 0, 1, 2, 3, 3, 3, 4, 5, 6, 7, 7, 8, 9])
+
+
+@with_server
+def test_resumed_upload():
+    # Interrupted by a chunk failing too many times
+    server.failures.update({6: 10})
+    path, digest = make_file(u'Big.bin', 10 * CHUNK_SIZE)
+    with assert_raises(urllib2.HTTPError):
+        upload(make_client(), path)
+    assert_equal(len(get_states()), 1)
+    acknowledged = set(i for i in server.uploads if i != 6)
+    batch_ids = set(server.batches)
+
+    # Only the missing chunks are uploaded by a new client, to the same batch
+    server.failures.clear()
+    del server.uploads[:]
+    assert_equal(upload(make_client(), path), {'digest': digest})
+    assert_equal(sorted(server.uploads + list(acknowledged)), range(10))
+    assert_equal(get_states(), [])
+
+    # The batch is uploaded again if lost by the server
+    server.failures.update({6: 10})
+    with assert_raises(urllib2.HTTPError):
+        upload(make_client(), path)
+    assert_equal(len(server.batches), 1)
+    assert_true(set(server.batches).isdisjoint(batch_ids))
+    server.batches.clear()
+    server.failures.clear()
+    del server.uploads[:]
+    assert_equal(upload(make_client(), path), {'digest': digest})
+    assert_equal(sorted(server.uploads), range(10))
+
+    # A modified file is uploaded to a new batch
+    server.failures.update({6: 10})
+    with assert_raises(urllib2.HTTPError):
+        upload(make_client(), path)
+    batch_ids = set(server.batches)
+    path, digest = make_file(u'Big.bin', 10 * CHUNK_SIZE + 1)
+    server.failures.clear()
+    del server.uploads[:]
+    assert_equal(upload(make_client(), path), {'digest': digest})
+    assert_equal(sorted(server.uploads), range(11))
+    assert_equal(set(server.batches), batch_ids)
+
+
+@with_server
+def test_chunked_upload_not_supported():
+    server.chunked = False
+    client = make_client()
+    path, digest = make_file(u'Big.bin', 10 * CHUNK_SIZE)
+    assert_equal(upload(client, path), {'digest': digest})
+    # The first chunk was taken as the file
+    assert_equal(server.uploads, [None, None])
+    assert_equal(get_states(), [])
+
+    # Not tried again by the client
+    del server.uploads[:]
+    assert_equal(upload(client, path), {'digest': digest})
+    assert_equal(server.uploads, [None])
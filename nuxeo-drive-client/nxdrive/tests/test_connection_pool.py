@@ -0,0 +1,157 @@
+import os
+import shutil
+import tempfile
+import threading
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+
+from nxdrive.client import connection_pool
+from nxdrive.client.connection_pool import ConnectionPool
+from nxdrive.client.connection_pool import get_handlers
+from nxdrive.client.file_io import read_chunks
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """Local HTTP/1.1 server counting the connections"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.connections = 0
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # Connections closed by the client before reading the response
+        pass
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        body = b'x' * (100000 if self.path == '/big' else 10)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == '/close':
+            # Kept alive connection closed by the server
+            self.close_connection = 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+server = None
+pool = None
+opener = None
+TEST_FOLDER = None
+
+
+def setup_server():
+    global server, pool, opener, TEST_FOLDER
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    pool = ConnectionPool()
+    opener = urllib2.build_opener(*get_handlers(pool))
+    TEST_FOLDER = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+
+
+def teardown_server():
+    pool.clear()
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(TEST_FOLDER)
+
+
+with_server = with_setup(setup_server, teardown_server)
+
+
+def get(path, timeout=5):
+    return opener.open(server.url + path[1:], timeout=timeout).read()
+
+
+@with_server
+def test_kept_alive_connection():
+    for _ in range(5):
+        assert_equal(get('/'), b'x' * 10)
+
+    # Streamed request bodies
+    file_path = os.path.join(TEST_FOLDER, 'file.bin')
+    with open(file_path, 'wb') as f:
+        f.write(b'y' * 100000)
+    req = urllib2.Request(server.url, read_chunks(file_path),
+                          {'Content-Length': 100000})
+    assert_equal(opener.open(req, timeout=5).read(), b'y' * 100000)
+    assert_equal(opener.open(urllib2.Request(server.url, b'z'),
+                             timeout=5).read(), b'z')
+    assert_equal(server.connections, 1)
+    assert_equal((pool.created, pool.reused), (1, 6))
+
+
+@with_server
+def test_unread_response_closes_connection():
+    response = opener.open(server.url + 'big', timeout=5)
+    response.read(10)
+    response.close()
+    get('/')
+    assert_equal(server.connections, 2)
+
+
+@with_server
+def test_reconnect_on_stale_connection():
+    get('/close')
+    # Closed connections are detected before being used
+    get('/')
+    assert_equal(server.connections, 2)
+
+    # or by the failure of the request, sent again on a new connection
+    get('/close')
+    is_dropped = connection_pool._is_dropped
+    connection_pool._is_dropped = lambda connection: False
+    try:
+        assert_equal(get('/'), b'x' * 10)
+    finally:
+        connection_pool._is_dropped = is_dropped
+    assert_equal(server.connections, 3)
+
+
+@with_server
+def test_connections_limit():
+    pool.max_per_host = 1
+    response = opener.open(server.url, timeout=5)
+    assert_raises(urllib2.URLError, get, '/', timeout=0.2)
+
+    # Given back once read, for a waiting request
+    threading.Timer(0.2, response.read).start()
+    assert_equal(get('/'), b'x' * 10)
+    assert_equal(server.connections, 1)
+
+
+@with_server
+def test_idle_connections_are_closed():
+    get('/')
+    pool.idle_timeout = 0
+    get('/')
+    assert_equal(server.connections, 2)
+    assert_equal(pool.created, 2)
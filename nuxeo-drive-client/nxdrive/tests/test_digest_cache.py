@@ -0,0 +1,326 @@
+import os
+import hashlib
+import tempfile
+import shutil
+import time
+from datetime import datetime
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+from nose.tools import assert_true
+from sqlalchemy import event
+
+from nxdrive.client import LocalClient
+from nxdrive.client.hashing import HashingService
+from nxdrive.model import init_db
+from nxdrive.model import DigestCache
+from nxdrive.model import DESCENDANT_COUNTERS_TRIGGERS
+from nxdrive.model import LastKnownState
+from nxdrive.model import LocalDigest
+from nxdrive.model import STATE_CODES
+
+
+TEST_FOLDER = None
+LOCAL_TEST_FOLDER = None
+session = None
+digest_cache = None
+lcclient = None
+
+
+def setup_cache():
+    global TEST_FOLDER, LOCAL_TEST_FOLDER, session, digest_cache, lcclient
+    TEST_FOLDER = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    LOCAL_TEST_FOLDER = os.path.join(TEST_FOLDER, u'local')
+    os.makedirs(LOCAL_TEST_FOLDER)
+    _, session_maker = init_db(TEST_FOLDER)
+    session = session_maker()
+    digest_cache = DigestCache(session_maker, LOCAL_TEST_FOLDER)
+    lcclient = LocalClient(LOCAL_TEST_FOLDER, digest_cache=digest_cache)
+
+
+def teardown_cache():
+    session.close()
+    if os.path.exists(TEST_FOLDER):
+        shutil.rmtree(TEST_FOLDER)
+
+
+with_cache = with_setup(setup_cache, teardown_cache)
+
+
+@with_cache
+def test_digest_cache():
+    doc = lcclient.make_file(u'/', u'Document.txt', content=b"Content")
+    assert_equal(lcclient.get_info(doc).get_digest(),
+                 hashlib.md5(b"Content").hexdigest())
+    assert_equal((digest_cache.hits, digest_cache.misses), (0, 1))
+
+    # Same version of the file: no need to read it again
+    assert_equal(lcclient.get_info(doc).get_digest(),
+                 hashlib.md5(b"Content").hexdigest())
+    assert_equal((digest_cache.hits, digest_cache.misses), (1, 1))
+    session.commit()
+    assert_equal(session.query(LocalDigest).count(), 1)
+
+    # Updated content
+    lcclient.update_content(doc, b"Updated content")
+    assert_equal(lcclient.get_info(doc).get_digest(),
+                 hashlib.md5(b"Updated content").hexdigest())
+    assert_equal((digest_cache.hits, digest_cache.misses), (1, 2))
+    session.commit()
+    assert_equal(session.query(LocalDigest).count(), 1)
+
+    # Folders have no digest
+    folder = lcclient.make_folder(u'/', u'Folder')
+    assert_equal(lcclient.get_info(folder).get_digest(), None)
+    assert_equal((digest_cache.hits, digest_cache.misses), (1, 2))
+
+
+@with_cache
+def test_stale_entry():
+    doc = lcclient.make_file(u'/', u'Document.txt', content=b"Content")
+    info = lcclient.get_info(doc)
+    info.get_digest()
+    session.commit()
+
+    # Same size and modification time but another inode
+    entry = session.query(LocalDigest).one()
+    entry.inode = u'0'
+    entry.digest = u'stale'
+    session.commit()
+    assert_equal(lcclient.get_info(doc).get_digest(),
+                 hashlib.md5(b"Content").hexdigest())
+    assert_equal(digest_cache.misses, 2)
+
+
+@with_cache
+def test_background_digest():
+    service = HashingService(workers=1)
+    digest_cache.hashing_service = service
+    client = LocalClient(LOCAL_TEST_FOLDER, digest_cache=digest_cache,
+                         background_digests=True)
+    try:
+        doc = client.make_file(u'/', u'Document.txt', content=b"Content")
+        # The digest is pending until computed by the hashing service
+        assert_equal(client.get_info(doc).get_digest(), None)
+        for _ in range(100):
+            digest = client.get_info(doc).get_digest()
+            if digest is not None:
+                break
+            time.sleep(0.05)
+        assert_equal(digest, hashlib.md5(b"Content").hexdigest())
+        assert_equal((digest_cache.hits, digest_cache.misses), (0, 1))
+        assert_equal(client.get_info(doc).get_digest(), digest)
+        assert_equal((digest_cache.hits, digest_cache.misses), (1, 1))
+    finally:
+        service.stop()
+
+
+def digest_paths():
+    session.expire_all()
+    return sorted(entry.local_path for entry in session.query(LocalDigest))
+
+
+@with_cache
+def test_digests_follow_pairs():
+    lcclient.make_folder(u'/', u'Folder')
+    lcclient.make_folder(u'/Folder', u'Sub')
+    for parent, name in [(u'/', u'Document.txt'), (u'/', u'Folder.txt'),
+                         (u'/Folder', u'Document 1.txt'),
+                         (u'/Folder/Sub', u'Document 2.txt')]:
+        lcclient.get_info(lcclient.make_file(parent, name,
+                                             content=b"Content")).get_digest()
+    session.commit()
+
+    # Moved along with a renamed folder, not a sibling with the same prefix
+    LocalDigest.move_subtree(session, LOCAL_TEST_FOLDER, u'/Folder',
+                             u'/Renamed')
+    session.commit()
+    assert_equal(digest_paths(), [u'/Document.txt', u'/Folder.txt',
+                                  u'/Renamed/Document 1.txt',
+                                  u'/Renamed/Sub/Document 2.txt'])
+
+    # Deleted along with their pair
+    lcclient.rename(u'/Folder', u'Renamed')
+    pair = LastKnownState(LOCAL_TEST_FOLDER,
+                          local_info=lcclient.get_info(u'/Document.txt'))
+    folder = LastKnownState(LOCAL_TEST_FOLDER,
+                            local_info=lcclient.get_info(u'/Renamed'))
+    session.add_all([pair, folder])
+    session.commit()
+    session.delete(pair)
+    session.commit()
+    assert_equal(digest_paths(), [u'/Folder.txt', u'/Renamed/Document 1.txt',
+                                  u'/Renamed/Sub/Document 2.txt'])
+    LastKnownState.mark_locally_deleted(session, folder)
+    session.commit()
+    assert_equal(digest_paths(), [u'/Folder.txt'])
+
+
+@with_cache
+def test_scan_loads_folders():
+    folder = lcclient.make_folder(u'/', u'Folder')
+    docs = [lcclient.make_file(folder, u'Document %d.txt' % i,
+                               content=b"Content %d" % i) for i in range(3)]
+    sub = lcclient.make_folder(folder, u'Sub')
+    nested = lcclient.make_file(sub, u'Nested.txt', content=b"Nested")
+    for doc in docs + [nested]:
+        lcclient.get_info(doc).get_digest()
+    session.commit()
+
+    queries = []
+    engine = session.get_bind()
+    record = lambda conn, cursor, statement, *args: queries.append(statement)
+    event.listen(engine, 'before_cursor_execute', record)
+    digest_cache.start_scan()
+    try:
+        # The entries of the folder are loaded at once, without the ones of
+        # its sub folder
+        for doc in docs:
+            lcclient.get_info(doc).get_digest()
+        assert_equal(len(queries), 1)
+        assert_equal(len(digest_cache._get_loaded_folder(session, docs[0])),
+                     3)
+        assert_equal((digest_cache.hits, digest_cache.misses), (3, 4))
+
+        # New entries are found in the loaded folder
+        doc = lcclient.make_file(folder, u'New.txt', content=b"New")
+        lcclient.get_info(doc).get_digest()
+        lcclient.get_info(doc).get_digest()
+        assert_equal((digest_cache.hits, digest_cache.misses), (4, 5))
+        assert_equal(len(queries), 1)
+        digest_cache.release_folder(folder)
+    finally:
+        digest_cache.end_scan()
+        event.remove(engine, 'before_cursor_execute', record)
+    session.commit()
+    assert_equal(session.query(LocalDigest).count(), 5)
+
+
+def test_add_missing_columns():
+    folder = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    try:
+        engine, _ = init_db(folder)
+        engine.execute('DROP TABLE last_known_states')
+        engine.execute('CREATE TABLE last_known_states ('
+                       'id INTEGER NOT NULL PRIMARY KEY, local_folder VARCHAR)')
+        engine.execute("INSERT INTO last_known_states (local_folder)"
+                       " VALUES ('/folder')")
+        engine.dispose()
+
+        engine, _ = init_db(folder)
+        columns = set(row[1] for row in engine.execute(
+            'PRAGMA table_info(last_known_states)'))
+        assert_true('local_size' in columns)
+        assert_true('pair_state' in columns)
+        assert_equal(engine.execute('SELECT local_folder, local_size'
+                                    ' FROM last_known_states').fetchall(),
+                     [(u'/folder', None)])
+        engine.dispose()
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_compact_states_migration():
+    folder = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    try:
+        engine, _ = init_db(folder)
+        # Layout of the version 3: states and timestamps as text
+        engine.execute('DROP TABLE last_known_states')
+        engine.execute('CREATE TABLE last_known_states ('
+                       'id INTEGER NOT NULL PRIMARY KEY,'
+                       ' local_folder VARCHAR, local_path VARCHAR,'
+                       ' local_state VARCHAR, remote_state VARCHAR,'
+                       ' pair_state VARCHAR, last_local_updated DATETIME,'
+                       ' last_sync_error_date DATETIME,'
+                       ' locally_moved_from VARCHAR,'
+                       ' in_clause_selected INTEGER)')
+        engine.execute("INSERT INTO last_known_states VALUES (1, '/folder',"
+                       " '/doc', 'modified', 'synchronized',"
+                       " 'locally_modified', '2014-01-02 03:04:05.123456',"
+                       " NULL, NULL, 0)")
+        engine.execute("INSERT INTO last_known_states VALUES (2, '/folder',"
+                       " '/other', 'synchronized', 'synchronized',"
+                       " 'synchronized', '2014-01-02 03:04:05.000000',"
+                       " '2014-02-01 00:00:00.000001', NULL, 0)")
+        engine.execute('PRAGMA user_version = 3')
+        engine.dispose()
+
+        engine, session_maker = init_db(folder)
+        columns = set(row[1] for row in engine.execute(
+            'PRAGMA table_info(last_known_states)'))
+        assert_true('locally_moved_from' not in columns)
+        assert_true('in_clause_selected' not in columns)
+        assert_equal(engine.execute(
+            'SELECT pair_state, last_local_updated FROM last_known_states'
+            ' WHERE id = 1').fetchall(),
+            [(STATE_CODES['locally_modified'], 1388631845123456)])
+        triggers = engine.execute("SELECT name FROM sqlite_master"
+                                  " WHERE type = 'trigger'").fetchall()
+        assert_equal(len(triggers), len(DESCENDANT_COUNTERS_TRIGGERS))
+
+        session = session_maker()
+        pairs = session.query(LastKnownState).order_by(
+            LastKnownState.id).all()
+        assert_equal([(pair.local_state, pair.remote_state, pair.pair_state)
+                      for pair in pairs],
+                     [('modified', 'synchronized', 'locally_modified'),
+                      ('synchronized', 'synchronized', 'synchronized')])
+        assert_equal(pairs[0].last_local_updated,
+                     datetime(2014, 1, 2, 3, 4, 5, 123456))
+        assert_equal(pairs[0].last_sync_error_date, None)
+        assert_equal(pairs[1].last_sync_error_date,
+                     datetime(2014, 2, 1, 0, 0, 0, 1))
+        assert_equal(session.query(LastKnownState).filter(
+            LastKnownState.pending()).all(), [pairs[0]])
+        session.close()
+        engine.dispose()
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_compact_digest_timestamps_migration():
+    folder = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    try:
+        engine, _ = init_db(folder)
+        # Modification times of the version 4 as the text of DateTime
+        engine.execute("INSERT INTO local_digests (local_folder, local_path,"
+                       " digest_func, size, last_modification_time, inode,"
+                       " digest) VALUES ('/folder', '/doc', 'md5', 7,"
+                       " '2014-01-02 03:04:05.123456', '1', 'digest')")
+        engine.execute('PRAGMA user_version = 4')
+        engine.dispose()
+
+        engine, session_maker = init_db(folder)
+        assert_equal(engine.execute(
+            'SELECT last_modification_time FROM local_digests').fetchall(),
+            [(1388631845123456,)])
+        session = session_maker()
+        assert_equal(session.query(LocalDigest).one().last_modification_time,
+                     datetime(2014, 1, 2, 3, 4, 5, 123456))
+        session.close()
+        engine.dispose()
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_db_profiles():
+    folder = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    try:
+        engine, _ = init_db(folder)
+        assert_equal(engine.execute('PRAGMA journal_mode').scalar(), u'wal')
+        # NORMAL
+        assert_equal(engine.execute('PRAGMA synchronous').scalar(), 1)
+        assert_equal(engine.execute('PRAGMA temp_store').scalar(), 2)
+        engine.dispose()
+
+        # The journal mode is persistent hence reset by the other profiles
+        engine, _ = init_db(folder, profile='compatible')
+        assert_equal(engine.execute('PRAGMA journal_mode').scalar(),
+                     u'delete')
+        # FULL
+        assert_equal(engine.execute('PRAGMA synchronous').scalar(), 2)
+        engine.dispose()
+
+        assert_raises(ValueError, init_db, folder, profile='unknown')
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,94 @@
+import os
+import tempfile
+import shutil
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_true
+
+from nxdrive.client.file_io import get_buffer_size
+from nxdrive.client.file_io import read_chunks
+from nxdrive.client.file_io import MIN_BUFFER_SIZE
+from nxdrive.client.file_io import MAX_BUFFER_SIZE
+
+
+TEST_FOLDER = None
+
+
+def setup_folder():
+    global TEST_FOLDER
+    TEST_FOLDER = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+
+
+def teardown_folder():
+    if os.path.exists(TEST_FOLDER):
+        shutil.rmtree(TEST_FOLDER)
+
+
+with_folder = with_setup(setup_folder, teardown_folder)
+
+
+def make_file(name, size):
+    path = os.path.join(TEST_FOLDER, name)
+    content = os.urandom(size)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path, content
+
+
+def test_get_buffer_size():
+    assert_equal(get_buffer_size(0), MIN_BUFFER_SIZE)
+    assert_equal(get_buffer_size(1024), MIN_BUFFER_SIZE)
+    assert_equal(get_buffer_size(64 * MIN_BUFFER_SIZE), MIN_BUFFER_SIZE)
+    assert_equal(get_buffer_size(64 * MIN_BUFFER_SIZE + 1),
+                 2 * MIN_BUFFER_SIZE)
+    assert_equal(get_buffer_size(1024 ** 4), MAX_BUFFER_SIZE)
+    sizes = [get_buffer_size(2 ** i) for i in range(40)]
+    assert_equal(sizes, sorted(sizes))
+
+
+@with_folder
+def test_read_chunks():
+    for size in (0, 1, 1000, 3 * MIN_BUFFER_SIZE + 17):
+        path, content = make_file(u'File-%d.bin' % size, size)
+        for use_mmap in (False, True):
+            for reuse_buffer in (False, True):
+                for drop_cache in (False, True):
+                    chunks = read_chunks(
+                        path, buffer_size=MIN_BUFFER_SIZE,
+                        reuse_buffer=reuse_buffer, use_mmap=use_mmap,
+                        drop_cache=drop_cache)
+                    chunks = [bytes(bytearray(chunk)) for chunk in chunks]
+                    assert_equal(b''.join(chunks), content)
+                    assert_true(all(0 < len(chunk) <= MIN_BUFFER_SIZE
+                                    for chunk in chunks))
+
+
+@with_folder
+def test_read_chunks_range():
+    size = 3 * MIN_BUFFER_SIZE + 17
+    path, content = make_file(u'File.bin', size)
+    # Offsets aligned on the mmap windows or not, lengths beyond the end
+    for offset, length in ((0, 10), (MIN_BUFFER_SIZE, MIN_BUFFER_SIZE + 1),
+                           (1000, 2 * MIN_BUFFER_SIZE), (size - 7, 100),
+                           (size, 10)):
+        for use_mmap in (False, True):
+            for reuse_buffer in (False, True):
+                chunks = read_chunks(
+                    path, buffer_size=MIN_BUFFER_SIZE,
+                    reuse_buffer=reuse_buffer, use_mmap=use_mmap,
+                    drop_cache=True, offset=offset, length=length)
+                chunks = [bytes(bytearray(chunk)) for chunk in chunks]
+                assert_equal(b''.join(chunks),
+                             content[offset:offset + length])
+
+
+@with_folder
+def test_read_chunks_close():
+    path, content = make_file(u'File.bin', 3 * MIN_BUFFER_SIZE)
+    chunks = read_chunks(path, buffer_size=MIN_BUFFER_SIZE)
+    assert_equal(next(chunks), content[:MIN_BUFFER_SIZE])
+    # Closing the generator closes the file, for instance when an upload
+    # is interrupted
+    chunks.close()
+    os.remove(path)
+    assert_true(not os.path.exists(path))
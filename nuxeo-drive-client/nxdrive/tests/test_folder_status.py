@@ -0,0 +1,243 @@
+import os
+import random
+import tempfile
+import shutil
+from datetime import datetime
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_true
+
+from nxdrive.client import LocalClient
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
+from nxdrive.controller import Controller
+from nxdrive.model import DESCENDANT_COUNTERS_TRIGGERS
+from nxdrive.model import DESCENDANT_STATUSES
+from nxdrive.model import LastKnownState
+from nxdrive.model import PairWriter
+from nxdrive.model import ScannedPair
+from nxdrive.model import ServerBinding
+from nxdrive.model import init_db
+
+
+TEST_FOLDER = None
+LOCAL_TEST_FOLDER = None
+ctl = None
+session = None
+lcclient = None
+
+
+def setup_tree():
+    global TEST_FOLDER, LOCAL_TEST_FOLDER, ctl, session, lcclient
+    TEST_FOLDER = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    LOCAL_TEST_FOLDER = os.path.join(TEST_FOLDER, u'local')
+    os.makedirs(LOCAL_TEST_FOLDER)
+    ctl = Controller(os.path.join(TEST_FOLDER, u'config'))
+    session = ctl.get_session()
+    lcclient = LocalClient(LOCAL_TEST_FOLDER)
+    for i in range(1, 3):
+        folder = lcclient.make_folder(u'/', u'Folder %d' % i)
+        sub_folder = lcclient.make_folder(folder, u'Sub Folder')
+        for parent in (folder, sub_folder):
+            for j in range(1, 3):
+                lcclient.make_file(parent, u'Document %d.txt' % j,
+                                   content=b"%d" % j)
+    session.add(ServerBinding(LOCAL_TEST_FOLDER,
+                              u'http://localhost:8080/nuxeo/',
+                              u'Administrator'))
+    paths = [u'/']
+    for path in paths:
+        pair = LastKnownState(LOCAL_TEST_FOLDER,
+                              local_info=lcclient.get_info(path))
+        pair.update_state('synchronized', 'synchronized')
+        session.add(pair)
+        if pair.folderish:
+            paths.extend(info.path for info in lcclient.get_children_info(
+                path))
+    session.commit()
+
+
+def teardown_tree():
+    ctl.dispose()
+    if os.path.exists(TEST_FOLDER):
+        shutil.rmtree(TEST_FOLDER)
+
+
+with_tree = with_setup(setup_tree, teardown_tree)
+
+
+def get_pair(local_path):
+    return session.query(LastKnownState).filter_by(
+        local_folder=LOCAL_TEST_FOLDER, local_path=local_path).one()
+
+
+def read_counters():
+    session.expire_all()
+    return dict((pair.id, tuple(getattr(pair, status + '_descendants')
+                                for status in DESCENDANT_STATUSES))
+                for pair in session.query(LastKnownState).filter_by(
+                    folderish=1))
+
+
+def count_all():
+    """Count the descendants of all the folders from the pairs"""
+    session.expire_all()
+    pairs = session.query(LastKnownState).all()
+
+    def get_status(pair):
+        if pair.pair_state in ('synchronized', 'conflicted'):
+            return pair.pair_state
+        if pair.last_sync_error_date is not None:
+            return 'error'
+        return 'pending'
+
+    def count(folder):
+        counts = dict.fromkeys(DESCENDANT_STATUSES, 0)
+        for pair in pairs:
+            if (pair.local_path is not None
+                    and pair.local_parent_path == folder.local_path
+                    or pair.local_path is None
+                    and pair.remote_parent_ref == folder.remote_ref
+                    and folder.remote_ref is not None):
+                counts[get_status(pair)] += 1
+                if pair.folderish:
+                    for status, n in count(pair).items():
+                        counts[status] += n
+        return counts
+
+    return dict((pair.id, tuple(count(pair)[status]
+                                for status in DESCENDANT_STATUSES))
+                for pair in pairs if pair.folderish)
+
+
+@with_tree
+def test_counters_follow_changes():
+    LastKnownState.count_descendants(session, LOCAL_TEST_FOLDER)
+    session.commit()
+    assert_equal(read_counters(), count_all())
+    assert_equal(read_counters()[get_pair(u'/').id], (12, 0, 0, 0))
+
+    # Changes of status are added to the counters of the ancestors
+    get_pair(u'/Folder 1/Sub Folder/Document 1.txt').update_state(
+        'modified', 'synchronized')
+    get_pair(u'/Folder 1/Document 2.txt').update_state(
+        'synchronized', 'deleted')
+    get_pair(u'/Folder 2/Document 1.txt').pair_state = 'conflicted'
+    error_pair = get_pair(u'/Folder 2/Sub Folder/Document 2.txt')
+    error_pair.update_state('modified', 'synchronized')
+    error_pair.last_sync_error_date = datetime.utcnow()
+    session.commit()
+    assert_equal(read_counters(), count_all())
+    assert_equal(read_counters()[get_pair(u'/').id], (8, 2, 1, 1))
+
+    # Renamed folders are counted again
+    for pair in session.query(LastKnownState).filter(
+            LastKnownState.local_subtree(u'/Folder 1')):
+        pair.local_path = u'/Folder 3' + pair.local_path[len(u'/Folder 1'):]
+        if pair.local_parent_path != u'/':
+            pair.local_parent_path = (u'/Folder 3' + pair.local_parent_path[
+                len(u'/Folder 1'):])
+    session.commit()
+    counters = read_counters()
+    assert_equal(counters[get_pair(u'/').id], (None,) * 4)
+    assert_equal(counters[get_pair(u'/Folder 2').id], count_all()[
+        get_pair(u'/Folder 2').id])
+    LastKnownState.count_descendants(session, LOCAL_TEST_FOLDER)
+    session.commit()
+    assert_equal(read_counters(), count_all())
+
+    # Remote pairs inserted by a scan, new and deleted local pairs
+    parent = get_pair(u'/Folder 2')
+    parent.remote_ref = u'folder-2'
+    writer = PairWriter(session)
+    writer.add(ScannedPair(LOCAL_TEST_FOLDER, remote_info=RemoteFileInfo(
+        u'Document 3.txt', u'document-3', u'folder-2', u'/folder-2/document-3',
+        False, datetime(2014, 1, 1), u'digest', 'md5', None, True, True, True,
+        False)))
+    writer.flush()
+    lcclient.make_file(u'/', u'Document 4.txt', content=b"4")
+    session.add(LastKnownState(LOCAL_TEST_FOLDER,
+                               local_info=lcclient.get_info(
+                                   u'/Document 4.txt')))
+    session.delete(get_pair(u'/Folder 3/Sub Folder/Document 2.txt'))
+    session.commit()
+    LastKnownState.count_descendants(session, LOCAL_TEST_FOLDER)
+    session.commit()
+    assert_equal(read_counters(), count_all())
+    assert_equal(read_counters()[get_pair(u'/').id], (7, 4, 1, 1))
+
+
+@with_tree
+def test_counters_of_random_changes():
+    rng = random.Random(42)
+    LastKnownState.count_descendants(session, LOCAL_TEST_FOLDER)
+    session.commit()
+    states = ['synchronized', 'locally_modified', 'remotely_modified',
+              'conflicted', 'unknown']
+    for _ in range(50):
+        pairs = session.query(LastKnownState).filter(
+            LastKnownState.local_path != u'/').all()
+        pair = rng.choice(pairs)
+        action = rng.randint(0, 3)
+        if action == 0:
+            pair.pair_state = rng.choice(states)
+        elif action == 1:
+            pair.last_sync_error_date = rng.choice([None, datetime.utcnow()])
+        elif action == 2 and not pair.folderish:
+            session.delete(pair)
+        elif action == 3 and not pair.folderish:
+            # Move the document to a random folder
+            folder = rng.choice([p for p in pairs if p.folderish])
+            pair.local_parent_path = folder.local_path
+            pair.local_path = folder.local_path + u'/' + pair.local_name
+        session.commit()
+        if rng.randint(0, 1):
+            LastKnownState.count_descendants(session, LOCAL_TEST_FOLDER)
+            session.commit()
+            assert_equal(read_counters(), count_all())
+        else:
+            # The counters are either up to date or to be counted again
+            expected = count_all()
+            for pair_id, counts in read_counters().items():
+                assert_true(counts in (expected[pair_id], (None,) * 4))
+
+
+@with_tree
+def test_children_states():
+    get_pair(u'/Folder 2/Sub Folder/Document 2.txt').update_state(
+        'modified', 'synchronized')
+    session.commit()
+    # Counted on the fly
+    expected = [
+        (u'Folder 1', u'synchronized'),
+        (u'Folder 2', 'children_modified'),
+    ]
+    assert_equal(ctl.children_states(LOCAL_TEST_FOLDER), expected)
+    LastKnownState.count_descendants(session, LOCAL_TEST_FOLDER)
+    session.commit()
+    assert_equal(ctl.children_states(LOCAL_TEST_FOLDER), expected)
+    assert_equal(ctl.children_states(
+        os.path.join(LOCAL_TEST_FOLDER, u'Folder 2')), [
+        (u'Document 1.txt', u'synchronized'),
+        (u'Document 2.txt', u'synchronized'),
+        (u'Sub Folder', 'children_modified'),
+    ])
+
+
+def test_migration():
+    folder = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    try:
+        engine, _ = init_db(folder)
+        # Database of the previous version: no counters
+        engine.execute('PRAGMA user_version = 2')
+        for row in engine.execute("SELECT name FROM sqlite_master"
+                                  " WHERE type = 'trigger'").fetchall():
+            engine.execute('DROP TRIGGER %s' % row[0])
+        engine.dispose()
+
+        engine, _ = init_db(folder)
+        triggers = engine.execute("SELECT name FROM sqlite_master"
+                                  " WHERE type = 'trigger'").fetchall()
+        assert_equal(len(triggers), len(DESCENDANT_COUNTERS_TRIGGERS))
+        engine.dispose()
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,100 @@
+import os
+import hashlib
+import tempfile
+import shutil
+import time
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+from nxdrive.client.hashing import compute_digests
+from nxdrive.client.hashing import HashingService
+
+
+TEST_FOLDER = None
+service = None
+
+CONTENT = b"Some content" * 1000
+
+
+def setup_service():
+    global TEST_FOLDER, service
+    TEST_FOLDER = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    service = HashingService(workers=2, digest_funcs=('md5', 'sha1'))
+
+
+def teardown_service():
+    service.stop()
+    if os.path.exists(TEST_FOLDER):
+        shutil.rmtree(TEST_FOLDER)
+
+
+with_service = with_setup(setup_service, teardown_service)
+
+
+def make_file(name, content=CONTENT):
+    path = os.path.join(TEST_FOLDER, name)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def wait_digests(key, version, path, digest_func='md5'):
+    for _ in range(100):
+        digests = service.get_digests(key, version, path, digest_func,
+                                      wait=False)
+        if digests is not None:
+            return digests
+        time.sleep(0.05)
+    raise AssertionError("Digests of %s not computed in time" % path)
+
+
+def test_compute_digests():
+    folder = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    try:
+        path = os.path.join(folder, u'File.txt')
+        with open(path, 'wb') as f:
+            f.write(CONTENT)
+        assert_equal(compute_digests(path, ['md5', 'sha256']), {
+            'md5': hashlib.md5(CONTENT).hexdigest(),
+            'sha256': hashlib.sha256(CONTENT).hexdigest(),
+        })
+        assert_raises(ValueError, compute_digests, path, ['unknown'])
+    finally:
+        shutil.rmtree(folder)
+
+
+@with_service
+def test_background_digests():
+    path = make_file(u'File.txt')
+    # The digests are pending until computed by the worker threads
+    assert_equal(service.get_digests('key', 1, path, 'md5', wait=False),
+                 None)
+    digests = wait_digests('key', 1, path)
+    assert_equal(digests['md5'], hashlib.md5(CONTENT).hexdigest())
+    # The extra digest algorithms are computed in the same pass
+    assert_equal(digests['sha1'], hashlib.sha1(CONTENT).hexdigest())
+    assert_true(not service.is_pending('key'))
+
+    # Waiting for the digests computes them if not already scheduled
+    digests = service.get_digests('key', 2, path, 'sha256')
+    assert_equal(digests['sha256'], hashlib.sha256(CONTENT).hexdigest())
+
+
+@with_service
+def test_obsolete_job():
+    path = make_file(u'File.txt')
+    service.get_digests('key', 1, path, 'md5', wait=False)
+    make_file(u'File.txt', b"Updated content")
+    # A new version of the file invalidates the pending job
+    digests = service.get_digests('key', 2, path, 'md5')
+    assert_equal(digests['md5'], hashlib.md5(b"Updated content").hexdigest())
+
+
+@with_service
+def test_missing_file():
+    path = os.path.join(TEST_FOLDER, u'Missing.txt')
+    service.get_digests('key', 1, path, 'md5', wait=False)
+    assert_raises(IOError, wait_digests, 'key', 1, path)
+    assert_raises(IOError, service.get_digests, 'key', 1, path, 'md5')
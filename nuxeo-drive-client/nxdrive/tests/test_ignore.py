@@ -0,0 +1,142 @@
+import os
+import re
+import tempfile
+import shutil
+import time
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_false
+from nose.tools import assert_true
+
+from nxdrive.client import LocalClient
+from nxdrive.client.ignore import glob_to_regex
+from nxdrive.client.ignore import IgnoreRules
+from nxdrive.client.ignore import IGNORE_FILE_NAME
+from nxdrive.client.ignore import read_patterns
+
+
+LOCAL_TEST_FOLDER = None
+lcclient = None
+
+
+def setup_client():
+    global LOCAL_TEST_FOLDER, lcclient
+    LOCAL_TEST_FOLDER = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    lcclient = LocalClient(LOCAL_TEST_FOLDER, ignored_patterns=[u'*.tmp'])
+
+
+def teardown_client():
+    if os.path.exists(LOCAL_TEST_FOLDER):
+        shutil.rmtree(LOCAL_TEST_FOLDER)
+
+
+with_client = with_setup(setup_client, teardown_client)
+
+
+def write_ignore_file(ref, content):
+    os_path = os.path.join(lcclient._abspath(ref), IGNORE_FILE_NAME)
+    with open(os_path, 'wb') as f:
+        f.write(content)
+
+
+def children_paths(ref):
+    return [info.path for info in lcclient.get_children_info(ref)]
+
+
+def test_glob_to_regex():
+    def match(pattern, name):
+        return re.match(glob_to_regex(pattern) + r'\Z', name) is not None
+
+    assert_true(match(u'*.tmp', u'file.tmp'))
+    assert_false(match(u'*.tmp', u'file.tmp.txt'))
+    assert_false(match(u'*.tmp', u'folder/file.tmp'))
+    assert_true(match(u'file?.txt', u'file1.txt'))
+    assert_true(match(u'file[0-9].txt', u'file1.txt'))
+    assert_false(match(u'file[!0-9].txt', u'file1.txt'))
+    assert_true(match(u'a/**/b', u'a/b'))
+    assert_true(match(u'a/**/b', u'a/x/y/b'))
+    assert_true(match(u'[abc', u'[abc'))
+    assert_true(match(u'file (1).txt', u'file (1).txt'))
+
+
+def test_ignore_rules():
+    rules = IgnoreRules([u'.'], [u'~'], [u'# Comment', u'', u'*.o',
+                                        u'build/', u'/doc/_build',
+                                        u're:.*\\.py[co]'])
+    assert_true(rules.is_ignored(u'.hidden'))
+    assert_true(rules.is_ignored(u'file.txt~'))
+    assert_true(rules.is_ignored(u'lib.o'))
+    assert_true(rules.is_ignored(u'module.pyc'))
+    assert_false(rules.is_ignored(u'module.py'))
+
+    # Folder only rules
+    assert_false(rules.is_ignored(u'build', u'/src/build'))
+    assert_true(rules.is_ignored(u'build', u'/src/build', folderish=True))
+
+    # Path rules
+    assert_true(rules.is_ignored(u'_build', u'/doc/_build'))
+    assert_false(rules.is_ignored(u'_build', u'/src/doc/_build'))
+    assert_false(rules.is_ignored(u'_build'))
+
+    # Rules of a sub-folder ignore file
+    assert_equal(rules.extend([]), rules)
+    sub_rules = rules.extend(IgnoreRules(patterns=[u'/dist']).rules)
+    assert_true(sub_rules.is_ignored(u'dist', u'/dist'))
+    assert_true(sub_rules.is_ignored(u'lib.o'))
+    assert_false(rules.is_ignored(u'dist', u'/dist'))
+
+
+def test_read_patterns():
+    folder = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    try:
+        path = os.path.join(folder, IGNORE_FILE_NAME)
+        assert_equal(read_patterns(path), [])
+        with open(path, 'wb') as f:
+            f.write(b"*.o\nre:(invalid\n\xc3\xa9t\xc3\xa9/\n")
+        # Invalid lines are skipped
+        assert_equal(read_patterns(path), [u'*.o', u'\xe9t\xe9/'])
+    finally:
+        shutil.rmtree(folder)
+
+
+@with_client
+def test_ignore_files():
+    lcclient.make_file(u'/', u'File.txt')
+    lcclient.make_file(u'/', u'File.tmp')
+    project = lcclient.make_folder(u'/', u'Project')
+    lcclient.make_file(project, u'Main.js')
+    lcclient.make_file(project, u'debug.log')
+    modules = lcclient.make_folder(project, u'node_modules')
+    lcclient.make_file(modules, u'Module.js')
+    build = lcclient.make_folder(project, u'build')
+    sub_folder = lcclient.make_folder(build, u'build')
+    lcclient.make_file(project, u'build.txt')
+    write_ignore_file(project, b"node_modules\n*.log\n/build/build/\n")
+
+    # Global rules apply everywhere
+    assert_equal(children_paths(u'/'), [u'/File.txt', u'/Project'])
+    assert_equal(children_paths(project), [
+        u'/Project/Main.js', u'/Project/build', u'/Project/build.txt'])
+    assert_equal(children_paths(build), [])
+    # The ignored folders are pruned, their content is never listed
+    assert_true(lcclient.is_ignored(u'node_modules', modules,
+                                    folderish=True))
+    assert_true(lcclient.is_ignored(u'build', sub_folder, folderish=True))
+    assert_false(lcclient.is_ignored(u'node_modules'))
+
+    # The directory listing fallback applies the same rules
+    for ref in (u'/', project, build):
+        assert_equal(
+            [info.path for info in lcclient._get_children_info_listdir(
+                ref, lcclient._abspath(ref))],
+            children_paths(ref))
+
+    # Updated rules are taken into account by the next listing
+    time.sleep(1)
+    write_ignore_file(project, b"*.txt\n")
+    assert_equal(children_paths(project), [
+        u'/Project/Main.js', u'/Project/build', u'/Project/debug.log',
+        u'/Project/node_modules'])
+    assert_equal(children_paths(build), [u'/Project/build/build'])
+    os.remove(os.path.join(lcclient._abspath(project), IGNORE_FILE_NAME))
+    assert_equal(len(children_paths(project)), 5)
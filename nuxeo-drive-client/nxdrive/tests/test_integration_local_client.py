@@ -145,6 +145,32 @@ def test_get_children_info():
     assert_equal(workspace_children[2].path, folder_2)
 
 
+@with_temp_folder
+def test_get_children_info_listdir():
+    folder_1 = lcclient.make_folder(TEST_WORKSPACE, u'Folder 1')
+    lcclient.make_file(TEST_WORKSPACE, u'File 1.txt', content=b"foo\n")
+    lcclient.make_file(folder_1, u'File 2.txt', content=b"bar\n")
+    lcclient.make_file(TEST_WORKSPACE, u'.File 2.txt', content=b"baz\n")
+    if hasattr(os, 'symlink'):
+        # broken links are not reported
+        os.symlink(os.path.join(LOCAL_TEST_FOLDER, u'missing'),
+                   os.path.join(LOCAL_TEST_FOLDER, u'Some Workspace',
+                                u'Broken link'))
+
+    # The directory listing fallback returns the same infos as the default
+    # implementation
+    def check(infos, expected):
+        assert_equal([(info.path, info.folderish, info.last_modification_time)
+                      for info in infos],
+                     [(info.path, info.folderish, info.last_modification_time)
+                      for info in expected])
+
+    for ref in (u'/', TEST_WORKSPACE, folder_1):
+        check(lcclient._get_children_info_listdir(ref, lcclient._abspath(ref)),
+              lcclient.get_children_info(ref))
+    assert_equal(len(lcclient.get_children_info(TEST_WORKSPACE)), 2)
+
+
 @with_temp_folder
 def test_deep_folders():
     # Check that local client can workaround the default windows MAX_PATH limit
@@ -0,0 +1,209 @@
+import os
+import tempfile
+import shutil
+from nose import with_setup
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal
+
+from nxdrive.client import LocalClient
+from nxdrive.client.ignore import IGNORE_FILE_NAME
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.watcher import get_local_watcher
+
+
+TEST_FOLDER = None
+LOCAL_TEST_FOLDER = None
+ctl = None
+lcclient = None
+
+
+def setup_scan():
+    global TEST_FOLDER, LOCAL_TEST_FOLDER, ctl, lcclient
+    TEST_FOLDER = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    LOCAL_TEST_FOLDER = os.path.join(TEST_FOLDER, u'local')
+    os.makedirs(LOCAL_TEST_FOLDER)
+    ctl = Controller(os.path.join(TEST_FOLDER, u'config'),
+                     skip_unchanged_local_folders=True)
+    ctl.synchronizer.local_watcher_enabled = False
+    lcclient = LocalClient(LOCAL_TEST_FOLDER)
+
+
+def teardown_scan():
+    ctl.dispose()
+    if os.path.exists(TEST_FOLDER):
+        shutil.rmtree(TEST_FOLDER)
+
+
+with_scan = with_setup(setup_scan, teardown_scan)
+
+
+def bind_folder():
+    session = ctl.get_session()
+    binding = ServerBinding(LOCAL_TEST_FOLDER, u'http://localhost:8080/nuxeo/',
+                            u'Administrator')
+    session.add(binding)
+    session.add(LastKnownState(LOCAL_TEST_FOLDER,
+                               local_info=lcclient.get_info(u'/')))
+    session.commit()
+    return binding
+
+
+def set_old_mtime(ref, old=1400000000):
+    # Not modified in the same time slot as the scan
+    os.utime(lcclient._abspath(ref), (old, old))
+
+
+def get_pair(path):
+    return ctl.get_session().query(LastKnownState).filter_by(
+        local_folder=LOCAL_TEST_FOLDER, local_path=path).first()
+
+
+def get_local_state(path):
+    pair = ctl.get_session().query(LastKnownState).filter_by(
+        local_folder=LOCAL_TEST_FOLDER, local_path=path).first()
+    return pair.local_state if pair is not None else None
+
+
+@with_scan
+def test_skip_unchanged_folders():
+    folder = lcclient.make_folder(u'/', u'Folder')
+    sub_folder = lcclient.make_folder(folder, u'Sub Folder')
+    doc = lcclient.make_file(sub_folder, u'Document 1.txt', content=b"A")
+    for ref in (doc, sub_folder, folder, u'/'):
+        set_old_mtime(ref)
+    binding = bind_folder()
+
+    # The first scan lists all the folders
+    ctl.synchronizer.scan_local(binding)
+    assert_equal(get_local_state(doc), 'unknown')
+
+    # A child added without changing the modification time of the folder
+    # is not seen, but the known files are still checked
+    lcclient.make_file(sub_folder, u'Document 2.txt', content=b"B")
+    set_old_mtime(sub_folder)
+    lcclient.update_content(doc, b"Updated")
+    ctl.synchronizer.scan_local(binding)
+    assert_equal(get_local_state(doc), 'modified')
+    assert_equal(get_local_state(u'/Folder/Sub Folder/Document 2.txt'), None)
+
+    # Changed folders are listed again
+    lcclient.make_file(folder, u'Document 3.txt', content=b"C")
+    ctl.synchronizer.scan_local(binding)
+    assert_equal(get_local_state(u'/Folder/Document 3.txt'), 'unknown')
+    assert_equal(get_local_state(u'/Folder/Sub Folder/Document 2.txt'), None)
+
+    # The periodic deep scan lists all the folders
+    ctl.synchronizer.deep_local_scan_period = 0
+    ctl.synchronizer.scan_local(binding)
+    assert_equal(get_local_state(u'/Folder/Sub Folder/Document 2.txt'),
+                 'unknown')
+
+
+@with_scan
+def test_refreshed_folders_are_listed():
+    folder = lcclient.make_folder(u'/', u'Folder')
+    sub_folder = lcclient.make_folder(folder, u'Sub Folder')
+    for ref in (sub_folder, folder, u'/'):
+        set_old_mtime(ref)
+    binding = bind_folder()
+    ctl.synchronizer.scan_local(binding)
+
+    # The pair of a folder refreshed without listing it, as by the rescan
+    # of the children of its parent, still has to be listed
+    lcclient.make_file(sub_folder, u'Document.txt', content=b"A")
+    set_old_mtime(sub_folder, old=1400000100)
+    ctl.synchronizer._scan_local_changed_paths(
+        ctl.get_session(), ctl.get_local_client(LOCAL_TEST_FOLDER), binding,
+        [folder])
+    assert_equal(get_local_state(u'/Folder/Sub Folder/Document.txt'), None)
+    ctl.synchronizer.scan_local(binding)
+    assert_equal(get_local_state(u'/Folder/Sub Folder/Document.txt'),
+                 'unknown')
+
+
+@with_scan
+def test_new_folders_are_listed():
+    binding = bind_folder()
+    ctl.synchronizer.scan_local(binding)
+
+    # The content of a new folder is scanned even if unchanged folders are
+    # skipped, its pairs being inserted in batches
+    folder = lcclient.make_folder(u'/', u'Folder')
+    sub_folder = lcclient.make_folder(folder, u'Sub Folder')
+    lcclient.make_file(sub_folder, u'Document 1.txt', content=b"A")
+    lcclient.make_file(folder, u'Document 2.txt', content=b"B")
+    for ref in (sub_folder, folder):
+        set_old_mtime(ref)
+    ctl.synchronizer.scan_local(binding)
+    for path in (folder, sub_folder, u'/Folder/Sub Folder/Document 1.txt',
+                 u'/Folder/Document 2.txt'):
+        assert_equal(get_local_state(path), 'unknown')
+    pair = ctl.get_session().query(LastKnownState).filter_by(
+        local_path=u'/Folder/Document 2.txt').one()
+    assert_equal(pair.local_parent_path, folder)
+    assert_equal(pair.local_name, u'Document 2.txt')
+    assert_equal(pair.local_digest, pair.get_local_client().get_info(
+        pair.local_path).get_digest())
+
+
+@with_scan
+def test_ignored_pairs_are_not_deleted():
+    folder = lcclient.make_folder(u'/', u'Folder')
+    doc = lcclient.make_file(folder, u'Document.txt', content=b"A")
+    other = lcclient.make_file(folder, u'Other.txt', content=b"B")
+    log_file = lcclient.make_file(u'/', u'Debug.log', content=b"C")
+    set_old_mtime(u'/')
+    binding = bind_folder()
+    ctl.synchronizer.scan_local(binding)
+    # Synchronized pairs
+    session = ctl.get_session()
+    for i, pair in enumerate(session.query(LastKnownState).filter(
+        LastKnownState.local_path != u'/')):
+        pair.remote_ref = u'doc-%d' % i
+        pair.update_state('synchronized', 'synchronized')
+    session.commit()
+
+    # Folder listed again
+    with open(os.path.join(lcclient._abspath(folder), IGNORE_FILE_NAME),
+              'wb') as f:
+        f.write(b"Document.txt\n")
+    lcclient.delete(other)
+    # Unchanged folder, with a new global rule
+    ctl.ignored_patterns = [u'*.log']
+    ctl.synchronizer.scan_local(binding)
+
+    for path in (doc, log_file):
+        pair = get_pair(path)
+        assert_equal(pair.pair_state, 'unsynchronized')
+        assert_equal(pair.local_state, 'synchronized')
+    assert_equal(get_local_state(other), 'deleted')
+
+
+@with_scan
+def test_resumed_watcher_checks_files():
+    watcher = get_local_watcher(lcclient)
+    if watcher is None:
+        raise SkipTest("File system monitoring is not supported")
+    watcher.stop()
+    ctl.synchronizer.local_watcher_enabled = True
+    folder = lcclient.make_folder(u'/', u'Folder')
+    doc = lcclient.make_file(folder, u'Document.txt', content=b"A")
+    other = lcclient.make_file(folder, u'Other.txt', content=b"B")
+    for ref in (doc, other, folder):
+        set_old_mtime(ref)
+    binding = bind_folder()
+    ctl.synchronizer.scan_local(binding)
+    assert_equal(get_local_state(doc), 'unknown')
+
+    # Files updated in place while stopped, without changing the
+    # modification time of their folder, are rescanned at restart
+    ctl.synchronizer.stop_local_watchers(session=ctl.get_session())
+    lcclient.update_content(doc, b"Updated")
+    lcclient.update_content(other, b"Resized")
+    set_old_mtime(other)
+    set_old_mtime(folder)
+    ctl.synchronizer.scan_local(binding)
+    assert_equal(get_local_state(doc), 'modified')
+    assert_equal(get_local_state(other), 'modified')
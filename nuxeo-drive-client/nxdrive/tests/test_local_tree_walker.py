@@ -0,0 +1,69 @@
+import os
+import tempfile
+import shutil
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+
+from nxdrive.client import LocalClient
+from nxdrive.client.local_tree_walker import LocalTreeWalker
+
+
+LOCAL_TEST_FOLDER = None
+lcclient = None
+
+
+def setup_temp_folder():
+    global lcclient, LOCAL_TEST_FOLDER
+    LOCAL_TEST_FOLDER = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    lcclient = LocalClient(LOCAL_TEST_FOLDER)
+    for i in range(3):
+        folder = lcclient.make_folder(u'/', u'Folder %d' % i)
+        for j in range(3):
+            sub_folder = lcclient.make_folder(folder, u'Folder %d.%d' % (i, j))
+            lcclient.make_file(sub_folder, u'File.txt', content=b"Content")
+        lcclient.make_file(folder, u'File %d.txt' % i, content=b"Content")
+
+
+def teardown_temp_folder():
+    if os.path.exists(LOCAL_TEST_FOLDER):
+        shutil.rmtree(LOCAL_TEST_FOLDER)
+
+
+with_temp_folder = with_setup(setup_temp_folder, teardown_temp_folder)
+
+
+def walk(client, ref, result):
+    """Depth first walk as performed by the local scan"""
+    children = client.get_children_info(ref)
+    result.append((ref, [child.path for child in children]))
+    if isinstance(client, LocalTreeWalker):
+        client.prefetch([child.path for child in children if child.folderish])
+    for child in children:
+        if child.folderish:
+            walk(client, child.path, result)
+    return result
+
+
+@with_temp_folder
+def test_walk_order():
+    expected = walk(lcclient, u'/', [])
+    assert_equal(len(expected), 13)
+    for workers in (1, 4):
+        walker = LocalTreeWalker(lcclient, workers=workers)
+        try:
+            assert_equal(walk(walker, u'/', []), expected)
+        finally:
+            walker.close()
+
+
+@with_temp_folder
+def test_deleted_folder():
+    walker = LocalTreeWalker(lcclient, workers=2)
+    try:
+        walker.prefetch([u'/Folder 0', u'/Missing'])
+        assert_raises(OSError, walker.get_children_info, u'/Missing')
+        assert_equal(len(walker.get_children_info(u'/Folder 0')), 4)
+        assert_raises(OSError, walker.get_children_info, u'/Missing')
+    finally:
+        walker.close()
@@ -0,0 +1,145 @@
+import os
+import tempfile
+import shutil
+from nose import with_setup
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+from nxdrive.client import LocalClient
+from nxdrive.model import init_db
+from nxdrive.model import FileEvent
+from nxdrive.watcher import get_local_watcher
+from nxdrive.watcher import WatcherOverflow
+
+
+LOCAL_TEST_FOLDER = None
+lcclient = None
+watcher = None
+
+
+def setup_watcher():
+    global lcclient, watcher, LOCAL_TEST_FOLDER
+    LOCAL_TEST_FOLDER = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    lcclient = LocalClient(LOCAL_TEST_FOLDER)
+    watcher = get_local_watcher(lcclient)
+
+
+def teardown_watcher():
+    if watcher is not None:
+        watcher.stop()
+    if os.path.exists(LOCAL_TEST_FOLDER):
+        shutil.rmtree(LOCAL_TEST_FOLDER)
+
+
+with_watcher = with_setup(setup_watcher, teardown_watcher)
+
+
+def check_watcher():
+    if watcher is None:
+        raise SkipTest("File system monitoring is not supported")
+
+
+@with_watcher
+def test_changed_paths():
+    check_watcher()
+    watcher.watch(u'/')
+    assert_equal(watcher.get_changed_paths(), set())
+
+    folder = lcclient.make_folder(u'/', u'Folder')
+    assert_equal(watcher.get_changed_paths(), set([u'/']))
+
+    # Changes in sub folders are only reported once they are watched
+    watcher.watch(folder)
+    doc = lcclient.make_file(folder, u'Document 1.txt', content=b"A")
+    assert_true(folder in watcher.get_changed_paths())
+
+    lcclient.update_content(doc, b"B")
+    assert_equal(watcher.get_changed_paths(), set([doc]))
+
+    lcclient.rename(doc, u'Document 2.txt')
+    assert_equal(watcher.get_changed_paths(), set([folder]))
+
+    lcclient.delete(u'/Folder/Document 2.txt')
+    assert_equal(watcher.get_changed_paths(), set([folder]))
+
+
+@with_watcher
+def test_ignored_files():
+    check_watcher()
+    watcher.watch(u'/')
+    lcclient.make_file(u'/', u'.hidden', content=b"A")
+    lcclient.make_file(u'/', u'Document.txt~', content=b"A")
+    assert_equal(watcher.get_changed_paths(), set())
+
+    # Updated ignore rules require a full scan
+    lcclient.make_file(u'/', u'.nxdriveignore', content=b"*.tmp")
+    assert_raises(WatcherOverflow, watcher.get_changed_paths)
+
+
+@with_watcher
+def test_moved_folder():
+    check_watcher()
+    watcher.watch(u'/')
+    folder = lcclient.make_folder(u'/', u'Folder')
+    watcher.watch(folder)
+    watcher.watch(lcclient.make_folder(folder, u'Sub Folder'))
+    watcher.watch(lcclient.make_folder(u'/', u'Destination'))
+    watcher.get_changed_paths()
+
+    lcclient.move(folder, u'/Destination')
+    assert_equal(watcher.get_changed_paths(), set([u'/', u'/Destination']))
+
+    # The watches of the moved folders have been released and are
+    # registered again under the new path
+    lcclient.make_file(u'/Destination/Folder/Sub Folder', u'Document.txt')
+    assert_equal(watcher.get_changed_paths(), set())
+    watcher.watch(u'/Destination/Folder/Sub Folder')
+    lcclient.make_file(u'/Destination/Folder/Sub Folder', u'Document 2.txt')
+    assert_true(u'/Destination/Folder/Sub Folder'
+                in watcher.get_changed_paths())
+
+
+@with_watcher
+def test_overflow():
+    check_watcher()
+    watcher.watch(u'/')
+    lcclient.make_folder(u'/', u'Folder')
+    watcher.overflowed = True
+    assert_raises(WatcherOverflow, watcher.get_changed_paths)
+
+    watcher.reset()
+    assert_true(not watcher.overflowed)
+    assert_equal(watcher.get_changed_paths(), set())
+
+
+@with_watcher
+def test_journal():
+    _, session_maker = init_db(LOCAL_TEST_FOLDER, scoped_sessions=False)
+    session = session_maker()
+    assert_equal(FileEvent.get_pending(session, u'/folder'), (None, []))
+    assert_equal(FileEvent.get_checkpoint(session, u'/folder'), None)
+
+    FileEvent.set_checkpoint(session, u'/folder')
+    FileEvent.record(session, u'/folder', set([u'/b', u'/a']))
+    FileEvent.record(session, u'/folder', set([u'/a', u'/c']))
+    FileEvent.record(session, u'/other', set([u'/a']))
+    session.commit()
+    assert_true(FileEvent.get_checkpoint(session, u'/folder') is not None)
+    last_id, paths = FileEvent.get_pending(session, u'/folder')
+    # Journaled paths are kept in order without duplicates
+    assert_equal(paths, [u'/a', u'/b', u'/c'])
+
+    FileEvent.record(session, u'/folder', set([u'/d']))
+    FileEvent.clear(session, u'/folder', last_id)
+    session.commit()
+    assert_equal(FileEvent.get_pending(session, u'/folder')[1], [u'/d'])
+    assert_equal(FileEvent.get_pending(session, u'/other')[1], [u'/a'])
+    assert_true(FileEvent.get_checkpoint(session, u'/folder') is not None)
+
+    FileEvent.clear_checkpoint(session, u'/folder')
+    session.commit()
+    assert_equal(FileEvent.get_checkpoint(session, u'/folder'), None)
+    assert_equal(FileEvent.get_pending(session, u'/folder')[1], [u'/d'])
+    session.close()
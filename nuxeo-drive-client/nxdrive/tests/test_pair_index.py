@@ -0,0 +1,366 @@
+import os
+import sqlite3
+import tempfile
+import shutil
+from datetime import datetime
+from nose import with_setup
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal
+from nose.tools import assert_true
+from sqlalchemy import event
+
+from nxdrive.client import LocalClient
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
+from nxdrive.model import LastKnownState
+from nxdrive.model import PairIndex
+from nxdrive.model import PairWriter
+from nxdrive.model import PendingQueue
+from nxdrive.model import ScannedPair
+from nxdrive.model import ServerBinding
+from nxdrive.model import init_db
+
+
+TEST_FOLDER = None
+LOCAL_TEST_FOLDER = None
+engine = None
+session = None
+lcclient = None
+statements = None
+
+
+def setup_index():
+    global TEST_FOLDER, LOCAL_TEST_FOLDER, engine, session, lcclient
+    global statements
+    TEST_FOLDER = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    LOCAL_TEST_FOLDER = os.path.join(TEST_FOLDER, u'local')
+    os.makedirs(LOCAL_TEST_FOLDER)
+    engine, session_maker = init_db(TEST_FOLDER, scoped_sessions=False)
+    session = session_maker()
+    lcclient = LocalClient(LOCAL_TEST_FOLDER)
+    folder = lcclient.make_folder(u'/', u'Folder')
+    lcclient.make_file(folder, u'Document 1.txt', content=b"A")
+    lcclient.make_file(u'/', u'Document 2.txt', content=b"A")
+    session.add(ServerBinding(LOCAL_TEST_FOLDER,
+                              u'http://localhost:8080/nuxeo/',
+                              u'Administrator'))
+    for path in (u'/', folder, u'/Folder/Document 1.txt',
+                 u'/Document 2.txt'):
+        session.add(LastKnownState(LOCAL_TEST_FOLDER,
+                                   local_info=lcclient.get_info(path)))
+    session.commit()
+    statements = []
+    event.listen(engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args:
+                 statements.append(statement))
+
+
+def teardown_index():
+    session.close()
+    engine.dispose()
+    if os.path.exists(TEST_FOLDER):
+        shutil.rmtree(TEST_FOLDER)
+
+
+with_index = with_setup(setup_index, teardown_index)
+
+
+def local_paths(pairs):
+    return sorted(pair.local_path for pair in pairs)
+
+
+@with_index
+def test_lookups():
+    index = PairIndex.get(session, LOCAL_TEST_FOLDER)
+    assert_true(PairIndex.get(session, LOCAL_TEST_FOLDER) is index)
+    del statements[:]
+
+    folder = index.get_by_local_path(u'/Folder')
+    assert_equal(folder.local_name, u'Folder')
+    assert_equal(local_paths(index.get_local_children(u'/')),
+                 [u'/Document 2.txt', u'/Folder'])
+    assert_equal(local_paths(index.get_by_local_name(u'Document 1.txt')),
+                 [u'/Folder/Document 1.txt'])
+    digest = folder.get_local_client().get_info(
+        u'/Document 2.txt').get_digest()
+    assert_equal(local_paths(index.get_by_local_digest(digest)),
+                 [u'/Document 2.txt', u'/Folder/Document 1.txt'])
+    assert_equal(index.get_by_remote_ref(None), None)
+    assert_equal(index.get_remote_children(None), [])
+    assert_equal(statements, [])
+
+
+@with_index
+def test_follow_session_changes():
+    index = PairIndex.get(session, LOCAL_TEST_FOLDER)
+    del statements[:]
+
+    # Updated pair
+    folder = index.get_by_local_path(u'/Folder')
+    folder.remote_ref = u'folder-ref'
+    folder.local_name = u'Renamed'
+    assert_true(index.get_by_remote_ref(u'folder-ref') is folder)
+    assert_equal(local_paths(index.get_by_local_name(u'Renamed')),
+                 [u'/Folder'])
+    assert_equal(index.get_by_local_name(u'Folder'), [])
+
+    # Added pair
+    lcclient.make_file(u'/Folder', u'Document 3.txt', content=b"C")
+    new_pair = LastKnownState(LOCAL_TEST_FOLDER,
+                              local_info=lcclient.get_info(
+                                  u'/Folder/Document 3.txt'))
+    session.add(new_pair)
+    assert_equal(local_paths(index.get_local_children(u'/Folder')),
+                 [u'/Folder/Document 1.txt', u'/Folder/Document 3.txt'])
+
+    # Deleted pair, before and after commit
+    session.delete(index.get_by_local_path(u'/Document 2.txt'))
+    assert_equal(local_paths(index.get_local_children(u'/')), [u'/Folder'])
+    assert_equal(statements, [])
+    session.commit()
+    assert_equal(local_paths(index.get_local_children(u'/')), [u'/Folder'])
+    assert_true(index.get_by_local_path(u'/Folder/Document 3.txt')
+                is new_pair)
+
+    # The changes have been written behind
+    session.expunge_all()
+    PairIndex.invalidate(session)
+    index = PairIndex.get(session, LOCAL_TEST_FOLDER)
+    assert_equal(index.get_by_local_path(u'/Folder').remote_ref,
+                 u'folder-ref')
+    assert_equal(index.get_by_local_path(u'/Document 2.txt'), None)
+    assert_equal(local_paths(index.get_local_children(u'/Folder')),
+                 [u'/Folder/Document 1.txt', u'/Folder/Document 3.txt'])
+
+
+@with_index
+def test_invalidation():
+    index = PairIndex.get(session, LOCAL_TEST_FOLDER)
+
+    # Rows inserted by a writer
+    lcclient.make_file(u'/', u'Document 3.txt', content=b"C")
+    writer = PairWriter(session)
+    writer.add(ScannedPair(LOCAL_TEST_FOLDER,
+                           local_info=lcclient.get_info(u'/Document 3.txt')))
+    writer.flush()
+    assert_true(PairIndex.get(session, LOCAL_TEST_FOLDER) is not index)
+    index = PairIndex.get(session, LOCAL_TEST_FOLDER)
+    assert_equal(len(index.get_local_children(u'/')), 3)
+
+    # Rollback
+    index.get_by_local_path(u'/Folder').local_path = u'/Other'
+    session.rollback()
+    index = PairIndex.get(session, LOCAL_TEST_FOLDER)
+    assert_equal(index.get_by_local_path(u'/Other'), None)
+    assert_equal(index.get_by_local_path(u'/Folder').local_path, u'/Folder')
+
+    # Changes committed by another connection, not by the session
+    PairIndex.refresh(session)
+    index = PairIndex.get(session, LOCAL_TEST_FOLDER)
+    index.get_by_local_path(u'/Folder').local_name = u'Renamed'
+    session.commit()
+    PairIndex.refresh(session)
+    assert_true(PairIndex.get(session, LOCAL_TEST_FOLDER) is index)
+    connection = sqlite3.connect(os.path.join(TEST_FOLDER, u'nxdrive.db'))
+    connection.execute("UPDATE last_known_states SET remote_ref = 'ref'"
+                       " WHERE local_path = '/Folder'")
+    connection.commit()
+    connection.close()
+    # The pairs expired by the commit are not stale, only the keys of the
+    # index are
+    assert_equal(index.get_by_local_path(u'/Folder').remote_ref, u'ref')
+    PairIndex.refresh(session)
+    index = PairIndex.get(session, LOCAL_TEST_FOLDER)
+    assert_equal(index.get_by_remote_ref(u'ref').local_path, u'/Folder')
+
+
+@with_index
+def test_large_bindings_are_queried():
+    max_size = PairIndex.max_size
+    PairIndex.max_size = 3
+    try:
+        index = PairIndex.get(session, LOCAL_TEST_FOLDER)
+    finally:
+        PairIndex.max_size = max_size
+    assert_equal(index.loaded, False)
+    del statements[:]
+    assert_equal(local_paths(index.get_local_children(u'/')),
+                 [u'/Document 2.txt', u'/Folder'])
+    assert_equal(index.get_by_local_path(u'/Folder').local_name, u'Folder')
+    assert_equal(len(statements), 2)
+
+
+@with_index
+def test_pending_queue():
+    queue = PendingQueue(session, LOCAL_TEST_FOLDER, batch_size=2)
+
+    def next_pair():
+        pair = queue.get_pairs()[0]
+        queue.remove(pair)
+        return pair
+
+    # The batches are served in order without reading them again
+    pair = next_pair()
+    assert_equal(pair.local_path, u'/')
+    pair.update_state('synchronized', 'synchronized')
+    assert_equal(local_paths(queue.get_pairs()), [u'/Document 2.txt'])
+    assert_equal(queue.reads, 1)
+    next_pair().update_state('synchronized', 'synchronized')
+    assert_equal(local_paths(queue.get_pairs()),
+                 [u'/Folder', u'/Folder/Document 1.txt'])
+    assert_equal(queue.reads, 2)
+    assert_equal(queue.or_more, True)
+
+    # The current pair is served again if still pending after a change
+    pair = next_pair()
+    assert_equal(pair.local_path, u'/Folder')
+    pair.update_state('created', 'unknown')
+    assert_equal(local_paths(queue.get_pairs()),
+                 [u'/Folder', u'/Folder/Document 1.txt'])
+    assert_equal(queue.reads, 3)
+
+    # The changes of the other pairs are read again
+    pair = next_pair()
+    pair.update_state('synchronized', 'synchronized')
+    queue.get_pairs()
+    assert_equal(queue.reads, 3)
+    session.query(LastKnownState).filter_by(
+        local_path=u'/').one().update_state('deleted', 'unknown')
+    assert_equal(local_paths(queue.get_pairs()),
+                 [u'/', u'/Folder/Document 1.txt'])
+    assert_equal(queue.reads, 4)
+
+    # Pairs deleted in the mean time are skipped
+    session.delete(next_pair())
+    assert_equal(local_paths(queue.get_pairs()), [u'/Folder/Document 1.txt'])
+
+
+@with_index
+def test_move_descendants():
+    index = PairIndex.get(session, LOCAL_TEST_FOLDER)
+    document = index.get_by_local_path(u'/Folder/Document 1.txt')
+    folder = index.get_by_local_path(u'/Folder')
+    folder.remote_ref = u'folder-ref'
+    document.remote_ref = u'document-ref'
+    document.remote_parent_ref = u'folder-ref'
+    session.commit()
+    del statements[:]
+
+    # The descendants are updated at once, the loaded pairs being expired
+    LastKnownState.move_local_descendants(session, LOCAL_TEST_FOLDER,
+                                          u'/Folder', u'/Renamed')
+    assert_equal(len([statement for statement in statements
+                      if statement.startswith('UPDATE')]), 1)
+    assert_equal(document.local_path, u'/Renamed/Document 1.txt')
+    assert_equal(document.local_parent_path, u'/Renamed')
+    assert_equal(folder.local_path, u'/Folder')
+    index = PairIndex.get(session, LOCAL_TEST_FOLDER)
+    assert_true(index.get_by_local_path(u'/Renamed/Document 1.txt')
+                is document)
+    assert_equal(index.get_by_local_path(u'/Folder/Document 1.txt'), None)
+
+    # Characters out of the BMP
+    LastKnownState.move_local_descendants(session, LOCAL_TEST_FOLDER,
+                                          u'/Renamed', u'/\U0001f4c1')
+    LastKnownState.move_local_descendants(session, LOCAL_TEST_FOLDER,
+                                          u'/\U0001f4c1', u'/Renamed')
+    assert_equal(document.local_path, u'/Renamed/Document 1.txt')
+
+    LastKnownState.move_remote_descendants(session, LOCAL_TEST_FOLDER,
+                                           u'folder-ref', u'/root/folder-ref')
+    assert_equal(document.remote_parent_path, u'/root/folder-ref')
+
+
+def bind_folder():
+    """Bind /Folder and add an unbound local and a remote only child"""
+    index = PairIndex.get(session, LOCAL_TEST_FOLDER)
+    folder = index.get_by_local_path(u'/Folder')
+    folder.remote_ref = u'folder-ref'
+    folder.update_state('synchronized', 'synchronized')
+    document = index.get_by_local_path(u'/Folder/Document 1.txt')
+    document.remote_ref = u'document-ref'
+    document.remote_parent_ref = u'folder-ref'
+    document.update_state('synchronized', 'modified')
+    lcclient.make_file(u'/Folder', u'Document 3.txt', content=b"C")
+    local_only = LastKnownState(LOCAL_TEST_FOLDER, local_info=lcclient.get_info(
+        u'/Folder/Document 3.txt'))
+    remote_only = LastKnownState(LOCAL_TEST_FOLDER, remote_info=RemoteFileInfo(
+        u'Document 4.txt', u'document-4', u'folder-ref',
+        u'/root/folder-ref/document-4', False, datetime(2014, 1, 1),
+        u'digest', 'md5', None, True, True, True, False))
+    session.add_all([local_only, remote_only])
+    session.commit()
+    del statements[:]
+    return folder, document, local_only, remote_only
+
+
+def bulk_statements():
+    return [statement.split()[0] for statement in statements
+            if statement.startswith(('UPDATE', 'DELETE'))]
+
+
+def remaining_paths():
+    session.expire_all()
+    return sorted((pair.local_path, pair.remote_ref)
+                  for pair in session.query(LastKnownState))
+
+
+@with_index
+def test_mark_locally_deleted():
+    folder, document, local_only, remote_only = bind_folder()
+    remote_only_states = remote_only.local_state, remote_only.remote_state
+    LastKnownState.mark_locally_deleted(session, folder)
+    # The last one deletes the digests of the local files
+    assert_equal(bulk_statements(), ['UPDATE', 'DELETE', 'DELETE'])
+
+    # As update_local(None) for the bound pairs
+    assert_equal((folder.local_state, folder.remote_state, folder.pair_state),
+                 ('deleted', 'synchronized', 'locally_deleted'))
+    assert_equal(document.pair_state, 'remotely_created')
+    assert_true(local_only not in session)
+    # Not a local descendant
+    assert_equal((remote_only.local_state, remote_only.remote_state),
+                 remote_only_states)
+    assert_equal(local_paths(PairIndex.get(
+        session, LOCAL_TEST_FOLDER).get_local_children(u'/Folder')),
+        [u'/Folder/Document 1.txt'])
+
+
+@with_index
+def test_mark_remotely_deleted():
+    if not LastKnownState.supports_subtree_queries(session):
+        raise SkipTest("Recursive queries are not supported")
+    folder, document, local_only, remote_only = bind_folder()
+    local_only_states = local_only.local_state, local_only.remote_state
+    LastKnownState.mark_remotely_deleted(session, folder)
+    assert_equal(bulk_statements(), ['UPDATE', 'DELETE'])
+
+    # As update_remote(None) for the pairs with a local path
+    assert_equal((folder.local_state, folder.remote_state, folder.pair_state),
+                 ('synchronized', 'deleted', 'remotely_deleted'))
+    assert_equal(document.pair_state, 'remotely_deleted')
+    assert_true(remote_only not in session)
+    # Not a remote descendant
+    assert_equal((local_only.local_state, local_only.remote_state),
+                 local_only_states)
+
+
+@with_index
+def test_delete_subtree():
+    if not LastKnownState.supports_subtree_queries(session):
+        raise SkipTest("Recursive queries are not supported")
+    folder = bind_folder()[0]
+    LastKnownState.delete_subtree(session, folder)
+    # The digests of the local files, then the pairs
+    assert_equal(bulk_statements(), ['DELETE', 'DELETE'])
+    session.commit()
+    assert_equal(remaining_paths(), [(u'/', None), (u'/Document 2.txt', None)])
+
+
+@with_index
+def test_delete_binding():
+    bind_folder()
+    binding = session.query(ServerBinding).one()
+    binding.delete(session)
+    session.commit()
+    assert_equal(remaining_paths(), [])
+    assert_equal(session.query(ServerBinding).count(), 0)
@@ -0,0 +1,191 @@
+import hashlib
+import os
+import re
+import tempfile
+import shutil
+from datetime import datetime
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_true
+from sqlalchemy import event
+
+from nxdrive.client import LocalClient
+from nxdrive.client import NotFound
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.model import __model_version__
+from nxdrive.model import get_schema_version
+from nxdrive.model import _migrate_composite_indexes
+from nxdrive.model import init_db
+
+
+TEST_FOLDER = None
+LOCAL_TEST_FOLDER = None
+ctl = None
+lcclient = None
+statements = None
+
+# Plan details of a full scan of the pairs table or of a binding, except for
+# the partial index of the pending pairs
+FULL_SCAN = re.compile(r'SCAN (TABLE )?last_known_states\b'
+                       r'(?! USING INDEX last_known_states_pending)'
+                       r'|USING INDEX (?!last_known_states_pending)\w+'
+                       r' \(local_folder=\?\)$')
+
+
+class MirrorRemoteClient(object):
+    """Remote client exposing a local folder, the ids being the paths"""
+
+    def __init__(self, base_folder):
+        self.base_folder = base_folder
+
+    def get_info(self, uid, raise_if_missing=True):
+        os_path = os.path.join(self.base_folder, uid[1:])
+        if not os.path.exists(os_path):
+            if raise_if_missing:
+                raise NotFound(uid)
+            return None
+        folderish = os.path.isdir(os_path)
+        digest = None
+        if not folderish:
+            with open(os_path, 'rb') as f:
+                digest = hashlib.md5(f.read()).hexdigest()
+        parent_uid = None
+        if uid != u'/':
+            parent_uid = uid.rsplit(u'/', 1)[0] or u'/'
+        name = os.path.basename(uid) or u'Nuxeo Drive'
+        return RemoteFileInfo(name, uid, parent_uid, uid, folderish,
+                              datetime(2014, 1, 1), digest, 'md5', None,
+                              True, True, True, folderish)
+
+    def get_children_info(self, uid):
+        os_path = os.path.join(self.base_folder, uid[1:])
+        prefix = uid if uid.endswith(u'/') else uid + u'/'
+        return [self.get_info(prefix + name)
+                for name in sorted(os.listdir(os_path))]
+
+
+def setup_controller():
+    global TEST_FOLDER, LOCAL_TEST_FOLDER, ctl, lcclient, statements
+    TEST_FOLDER = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    LOCAL_TEST_FOLDER = os.path.join(TEST_FOLDER, u'local')
+    os.makedirs(LOCAL_TEST_FOLDER)
+    ctl = Controller(os.path.join(TEST_FOLDER, u'config'))
+    ctl.synchronizer.local_watcher_enabled = False
+    lcclient = LocalClient(LOCAL_TEST_FOLDER)
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if (statement.startswith('SELECT')
+                and 'FROM last_known_states' in statement):
+            statements.append((statement, parameters))
+
+    event.listen(ctl._engine, 'before_cursor_execute', record)
+
+
+def teardown_controller():
+    ctl.dispose()
+    if os.path.exists(TEST_FOLDER):
+        shutil.rmtree(TEST_FOLDER)
+
+
+with_controller = with_setup(setup_controller, teardown_controller)
+
+
+def get_plan(statement, parameters):
+    return [row[-1] for row in ctl._engine.execute(
+        'EXPLAIN QUERY PLAN ' + statement, parameters)]
+
+
+@with_controller
+def test_hot_queries_use_indexes():
+    folder = lcclient.make_folder(u'/', u'Folder')
+    sub_folder = lcclient.make_folder(folder, u'Sub Folder')
+    lcclient.make_file(folder, u'Document 1.txt', content=b"A")
+    deleted = lcclient.make_file(sub_folder, u'Document 2.txt', content=b"B")
+
+    remote_client = MirrorRemoteClient(LOCAL_TEST_FOLDER)
+    sync = ctl.synchronizer
+    sync.get_remote_fs_client = lambda server_binding: remote_client
+    session = ctl.get_session()
+    binding = ServerBinding(LOCAL_TEST_FOLDER, u'http://localhost:8080/nuxeo/',
+                            u'Administrator')
+    session.add(binding)
+    session.add(LastKnownState(LOCAL_TEST_FOLDER,
+                               local_info=lcclient.get_info(u'/'),
+                               remote_info=remote_client.get_info(u'/')))
+    session.commit()
+
+    # Initial scans, rescans and deletions
+    sync.scan_local(binding)
+    sync.scan_remote(binding)
+    lcclient.delete(deleted)
+    sync.scan_local(binding)
+    sync.scan_remote(binding)
+    # Queries of the synchronization loop and of the GUI
+    ctl.list_pending(local_folder=LOCAL_TEST_FOLDER, ignore_in_error=300)
+    ctl.list_pending()
+    ctl.children_states(LOCAL_TEST_FOLDER)
+    ctl.get_state_for_local_path(os.path.join(LOCAL_TEST_FOLDER, u'Folder'))
+
+    assert_true(len(statements) > 0)
+    plans = dict()
+    for statement, parameters in statements:
+        plan = get_plan(statement, parameters)
+        plans[statement] = plan
+        for detail in plan:
+            assert_true(FULL_SCAN.search(detail) is None,
+                        "%s\n%s" % (statement, "\n".join(plan)))
+
+    # The pending pairs are read in order from their partial index
+    pending = [plan for statement, plan in plans.items()
+               if 'ORDER BY last_known_states.remote_parent_path' in statement
+               and 'last_known_states.local_folder = ?' in statement]
+    assert_true(len(pending) > 0)
+    for plan in pending:
+        assert_equal(plan, [u'SEARCH last_known_states USING INDEX'
+                            u' last_known_states_pending (local_folder=?)'])
+
+
+def test_migrations():
+    folder = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    try:
+        engine, _ = init_db(folder)
+        assert_equal(get_schema_version(engine), __model_version__)
+        # Database of the first version: single column indexes only
+        engine.execute('PRAGMA user_version = 0')
+        for index in LastKnownState.__table__.indexes:
+            engine.execute('DROP INDEX %s' % index.name)
+        replaced = ('local_folder', 'local_digest', 'local_path',
+                    'local_parent_path', 'remote_ref', 'remote_parent_ref',
+                    'pair_state')
+        for column in replaced:
+            engine.execute('CREATE INDEX ix_last_known_states_%s'
+                           ' ON last_known_states (%s)' % (column, column))
+        engine.dispose()
+
+        engine, _ = init_db(folder)
+        assert_equal(get_schema_version(engine), __model_version__)
+        indexes = set(row[1] for row in engine.execute(
+            'PRAGMA index_list(last_known_states)'))
+        for index in LastKnownState.__table__.indexes:
+            assert_true(index.name in indexes)
+        for column in replaced:
+            assert_true('ix_last_known_states_%s' % column not in indexes)
+        engine.dispose()
+
+        # Interrupted before the states were compacted
+        engine.execute('PRAGMA user_version = 1')
+        for column in replaced:
+            engine.execute('CREATE INDEX ix_last_known_states_%s'
+                           ' ON last_known_states (%s)' % (column, column))
+        _migrate_composite_indexes(engine)
+        indexes = set(row[1] for row in engine.execute(
+            'PRAGMA index_list(last_known_states)'))
+        for column in replaced:
+            assert_true('ix_last_known_states_%s' % column not in indexes)
+        engine.dispose()
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,334 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_false
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+from nxdrive.client.connection_pool import ConnectionPool
+from nxdrive.client.ranged_download import RangedDownload
+from nxdrive.client.ranged_download import get_download_state_path
+from nxdrive.client.remote_file_system_client import RemoteFileSystemClient
+from nxdrive.controller import Controller
+
+
+CHUNK_SIZE = 16 * 1024
+
+OPERATIONS = [{
+    'id': 'NuxeoDrive.GetFileSystemItem',
+    'params': [{'name': 'id', 'required': True}],
+}]
+
+
+class RangeServer(ThreadingMixIn, HTTPServer):
+    """Local stand-in for the downloads of a Nuxeo server
+
+    The contents of files are served by name with the file system items
+    describing them. Byte ranges are supported unless ranges is False. The
+    requests for the ranges starting at an offset in failures are answered
+    with a 503 error that many times, the ones in cuts are cut in the middle
+    that many times. Each response takes latency seconds, plus the time to
+    send its content at rate bytes per second if given.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0, rate=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), RangeHandler)
+        self.url = 'http://127.0.0.1:%d/nuxeo/' % self.server_address[1]
+        self.latency = latency
+        self.rate = rate
+        self.ranges = True
+        self.files = dict()
+        self.failures = dict()
+        self.cuts = dict()
+        # Offsets of the requested ranges, None for whole contents
+        self.requests = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+        self._digests = dict()
+
+    def handle_error(self, request, client_address):
+        pass
+
+    def get_digest(self, name):
+        content = self.files[name]
+        cached = self._digests.get(name)
+        if cached is None or cached[0] is not content:
+            cached = content, hashlib.md5(content).hexdigest()
+            self._digests[name] = cached
+        return cached[1]
+
+    def get_fs_item(self, name):
+        return {
+            'id': name,
+            'parentId': 'root',
+            'path': '/root/' + name,
+            'name': name,
+            'folder': False,
+            'lastModificationDate': 0,
+            'digest': self.get_digest(name),
+            'digestAlgorithm': 'md5',
+            'downloadURL': 'nxbigfile/' + name,
+            'canRename': True,
+            'canDelete': True,
+            'canUpdate': True,
+        }
+
+    def record(self, offset):
+        """Return whether to fail, cut or send the response"""
+        with self.lock:
+            self.requests.append(offset)
+            for faults in (self.failures, self.cuts):
+                if faults.get(offset):
+                    faults[offset] -= 1
+                    return faults
+            return None
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        if self.path.endswith('/site/automation/'):
+            self.send_body(200, json.dumps({'operations': OPERATIONS}),
+                           {'Content-Type': 'application/json'})
+            return
+        name = self.path.rsplit('/', 1)[1]
+        content = server.files[name]
+        etag = '"%s"' % server.get_digest(name)
+        headers = {'ETag': etag}
+        match = re.match(r'^bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+        if (server.ranges and match is not None
+                and self.headers.get('If-Range', etag) == etag):
+            headers['Accept-Ranges'] = 'bytes'
+            start, end = int(match.group(1)), int(match.group(2))
+            if start >= len(content):
+                server.record(start)
+                self.send_body(416, b'', {})
+                return
+            end = min(end, len(content) - 1)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end,
+                                                           len(content))
+            status, offset, body = 206, start, content[start:end + 1]
+        else:
+            status, offset, body = 200, None, content
+        faults = server.record(offset)
+        if faults is server.failures:
+            self.send_body(503, b'', {})
+            return
+        with server.lock:
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        time.sleep(server.latency
+                   + (len(body) / float(server.rate) if server.rate else 0))
+        with server.lock:
+            server.running -= 1
+        if faults is server.cuts:
+            # Connection closed before the end of the content
+            headers['Content-Length'] = str(len(body))
+            self.close_connection = 1
+            body = body[:len(body) // 2]
+        self.send_body(status, body, headers)
+
+    def do_POST(self):
+        params = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])))['params']
+        self.send_body(200, json.dumps(self.server.get_fs_item(params['id'])),
+                       {'Content-Type': 'application/json'})
+
+    def send_body(self, status, body, headers):
+        self.send_response(status)
+        headers.setdefault('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+server = None
+pool = None
+TEST_FOLDER = None
+retry_delay = None
+
+
+def setup_server():
+    global server, pool, TEST_FOLDER, retry_delay
+    server = RangeServer(latency=0.02)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    pool = ConnectionPool()
+    TEST_FOLDER = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    retry_delay = RangedDownload.retry_delay
+    RangedDownload.retry_delay = 0
+
+
+def teardown_server():
+    RangedDownload.retry_delay = retry_delay
+    pool.clear()
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(TEST_FOLDER)
+
+
+with_server = with_setup(setup_server, teardown_server)
+
+
+def make_client(download_chunk_size=CHUNK_SIZE):
+    """A new client, as after a restart of the process"""
+    return RemoteFileSystemClient(
+        server.url, u'Administrator', u'device', u'1.0', password=u'secret',
+        proxies={}, connection_pool=pool, transfer_pool=pool,
+        download_chunk_size=download_chunk_size)
+
+
+def make_file(name, size):
+    server.files[name] = content = os.urandom(size)
+    return content
+
+
+def download(client, name):
+    tmp_file = client.stream_content(name, os.path.join(TEST_FOLDER, name))
+    with open(tmp_file, 'rb') as f:
+        return f.read()
+
+
+def get_ranges(*indexes):
+    return [index * CHUNK_SIZE for index in indexes]
+
+
+@with_server
+def test_ranged_download():
+    content = make_file('Big.bin', 10 * CHUNK_SIZE + 17)
+    assert_equal(download(make_client(), 'Big.bin'), content)
+    assert_equal(sorted(server.requests), get_ranges(*range(11)))
+    assert_true(server.max_running > 1)
+    assert_equal(os.listdir(TEST_FOLDER), ['.Big.bin.part'])
+
+    # Small files are downloaded in a single request
+    del server.requests[:]
+    content = make_file('Small.bin', CHUNK_SIZE)
+    assert_equal(download(make_client(), 'Small.bin'), content)
+    assert_equal(server.requests, [0])
+
+
+@with_server
+def test_transfers_use_their_own_connections():
+    # The ranges do not wait for the connections of the other calls
+    control_pool = ConnectionPool(max_per_host=1)
+    client = RemoteFileSystemClient(
+        server.url, u'Administrator', u'device', u'1.0', password=u'secret',
+        proxies={}, connection_pool=control_pool, transfer_pool=pool,
+        download_chunk_size=CHUNK_SIZE)
+    content = make_file('Big.bin', 10 * CHUNK_SIZE)
+    try:
+        assert_equal(download(client, 'Big.bin'), content)
+        assert_true(server.max_running > 1)
+        assert_equal(control_pool.created, 1)
+    finally:
+        control_pool.clear()
+
+
+@with_server
+def test_transfers_without_transfer_workers():
+    # Transferred by the synchronization thread
+    ctl = Controller(os.path.join(TEST_FOLDER, u'config'), transfer_workers=0)
+    client = RemoteFileSystemClient(
+        server.url, u'Administrator', u'device', u'1.0', password=u'secret',
+        proxies={}, connection_pool=pool, transfer_pool=ctl.transfer_pool,
+        download_chunk_size=CHUNK_SIZE)
+    content = make_file('Big.bin', 4 * CHUNK_SIZE)
+    downloaded = []
+    thread = threading.Thread(
+        target=lambda: downloaded.append(download(client, 'Big.bin')))
+    thread.daemon = True
+    try:
+        thread.start()
+        thread.join(10)
+        assert_false(thread.is_alive())
+        assert_equal(downloaded, [content])
+    finally:
+        ctl.dispose()
+
+
+@with_server
+def test_range_retry():
+    content = make_file('Big.bin', 10 * CHUNK_SIZE)
+    server.failures.update(dict.fromkeys(get_ranges(0, 4), 1))
+    server.cuts.update(dict.fromkeys(get_ranges(2, 7), 2))
+    assert_equal(download(make_client(), 'Big.bin'), content)
+    assert_equal(sorted(server.requests),
+                 get_ranges(0, 0, 1, 2, 2, 2, 3, 4, 4, 5, 6, 7, 7, 7, 8, 9))
+
+
+@with_server
+def test_resumed_download():
+    # Interrupted by a range failing too many times
+    content = make_file('Big.bin', 10 * CHUNK_SIZE)
+    server.failures[6 * CHUNK_SIZE] = 10
+    with assert_raises(urllib2.HTTPError):
+        download(make_client(), 'Big.bin')
+    tmp_file = os.path.join(TEST_FOLDER, '.Big.bin.part')
+    assert_true(os.path.exists(get_download_state_path(tmp_file)))
+    downloaded = set(offset for offset in server.requests
+                     if offset != 6 * CHUNK_SIZE)
+
+    # Only the missing ranges are downloaded by a new client
+    server.failures.clear()
+    del server.requests[:]
+    assert_equal(download(make_client(), 'Big.bin'), content)
+    assert_equal(sorted(server.requests + list(downloaded)),
+                 get_ranges(*range(10)))
+    assert_false(os.path.exists(get_download_state_path(tmp_file)))
+
+    # A modified file is downloaded again
+    server.failures[6 * CHUNK_SIZE] = 10
+    with assert_raises(urllib2.HTTPError):
+        download(make_client(), 'Big.bin')
+    content = make_file('Big.bin', 10 * CHUNK_SIZE - 1)
+    server.failures.clear()
+    del server.requests[:]
+    assert_equal(download(make_client(), 'Big.bin'), content)
+    assert_equal(sorted(server.requests), get_ranges(*range(10)))
+
+
+@with_server
+def test_ranges_not_supported():
+    server.ranges = False
+    content = make_file('Big.bin', 10 * CHUNK_SIZE)
+    # A leftover temporary file is overwritten
+    with open(os.path.join(TEST_FOLDER, '.Big.bin.part'), 'wb') as f:
+        f.write(b'x' * 20 * CHUNK_SIZE)
+    assert_equal(download(make_client(), 'Big.bin'), content)
+    assert_equal(server.requests, [None])
+
+    # Empty files cannot be requested by ranges
+    server.ranges = True
+    content = make_file('Empty.bin', 0)
+    del server.requests[:]
+    assert_equal(download(make_client(), 'Empty.bin'), content)
+    assert_equal(server.requests, [0, None])
+
+    # Ranges disabled by the client
+    del server.requests[:]
+    assert_equal(download(make_client(download_chunk_size=0), 'Big.bin'),
+                 server.files['Big.bin'])
+    assert_equal(server.requests, [None])
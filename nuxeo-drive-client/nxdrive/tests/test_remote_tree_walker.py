@@ -0,0 +1,109 @@
+import threading
+import time
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+from nxdrive.client import NotFound
+from nxdrive.client.remote_tree_walker import RemoteTreeWalker
+
+
+class FolderInfo(object):
+
+    def __init__(self, uid, folderish):
+        self.uid = uid
+        self.folderish = folderish
+
+
+class TreeRemoteClient(object):
+    """Remote client serving a tree of 3 folders of 3 sub folders"""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.listed = []
+        self._lock = threading.Lock()
+
+    def get_children_info(self, uid):
+        time.sleep(self.latency)
+        with self._lock:
+            self.listed.append(uid)
+        if uid == u'/' or uid.count(u'/') < 3:
+            prefix = u'' if uid == u'/' else uid
+            return ([FolderInfo(u'%s/Folder %d' % (prefix, i), True)
+                     for i in range(3)]
+                    + [FolderInfo(prefix + u'/File.txt', False)])
+        if uid.endswith(u'Missing'):
+            raise NotFound(uid)
+        return [FolderInfo(uid + u'/File.txt', False)]
+
+
+def close(walker):
+    """Close the walker and wait for its threads to stop"""
+    threads = list(walker._threads)
+    walker.close()
+    for thread in threads:
+        thread.join()
+
+
+def walk(client, uid, result):
+    """Depth first walk as performed by the remote scan"""
+    children = client.get_children_info(uid)
+    result.append((uid, [child.uid for child in children]))
+    for child in children:
+        if child.folderish:
+            walk(client, child.uid, result)
+    return result
+
+
+def test_walk_order():
+    expected = walk(TreeRemoteClient(), u'/', [])
+    assert_equal(len(expected), 40)
+    for workers in (1, 4):
+        client = TreeRemoteClient()
+        walker = RemoteTreeWalker(client, workers=workers)
+        try:
+            assert_equal(walk(walker, u'/', []), expected)
+        finally:
+            close(walker)
+        # Each folder is listed once
+        assert_equal(sorted(client.listed), sorted(uid for uid, _ in expected))
+
+
+def test_listed_ahead():
+    client = TreeRemoteClient(latency=0.05)
+    walker = RemoteTreeWalker(client, workers=8)
+    try:
+        start = time.time()
+        walk(walker, u'/', [])
+        duration = time.time() - start
+    finally:
+        close(walker)
+    # 4 levels of 1, 3, 9 and 27 folders, 5 rounds of 8 calls at best
+    assert_true(duration < 40 * 0.05 / 2, duration)
+
+
+def test_prefetched_limit():
+    client = TreeRemoteClient()
+    walker = RemoteTreeWalker(client, workers=4, max_prefetched=2)
+    try:
+        walker.get_children_info(u'/')
+        time.sleep(0.2)
+        # The workers wait for the scan
+        assert_equal(len(client.listed), 3)
+        assert_equal(len(walk(walker, u'/Folder 0', [])), 13)
+    finally:
+        close(walker)
+
+
+def test_listing_error():
+    client = TreeRemoteClient()
+    walker = RemoteTreeWalker(client, workers=2)
+    try:
+        walker.prefetch([u'/Folder 0/Folder 0/Missing', u'/Folder 1'])
+        assert_raises(NotFound, walker.get_children_info,
+                      u'/Folder 0/Folder 0/Missing')
+        assert_equal(len(walker.get_children_info(u'/Folder 1')), 4)
+        assert_raises(NotFound, walker.get_children_info,
+                      u'/Folder 0/Folder 0/Missing')
+    finally:
+        close(walker)
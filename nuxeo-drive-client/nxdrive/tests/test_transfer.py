@@ -0,0 +1,343 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from datetime import datetime
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_false
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+from nxdrive.client import LocalClient
+from nxdrive.client import NotFound
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
+from nxdrive.client.remote_file_system_client import get_download_tmp_path
+from nxdrive.client.transfer import TransferService
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.model import TransferJob
+from nxdrive.synchronizer import Synchronizer
+from nxdrive.synchronizer import _get_order_keys
+
+
+TEST_FOLDER = None
+LOCAL_TEST_FOLDER = None
+REMOTE_TEST_FOLDER = None
+ctl = None
+lcclient = None
+rclient = None
+
+
+class MirrorRemoteClient(object):
+    """Remote client exposing a local folder, the ids being the paths
+
+    The download of a file waits for the event registered for its name, if
+    any, and the downloads are recorded in the order they finish.
+    """
+
+    def __init__(self, base_folder):
+        self.base_folder = base_folder
+        self.events = dict()
+        self.downloaded = []
+        self._lock = threading.Lock()
+
+    def get_info(self, uid, raise_if_missing=True):
+        os_path = os.path.join(self.base_folder, uid[1:])
+        if not os.path.exists(os_path):
+            if raise_if_missing:
+                raise NotFound(uid)
+            return None
+        folderish = os.path.isdir(os_path)
+        digest = None
+        if not folderish:
+            with open(os_path, 'rb') as f:
+                digest = hashlib.md5(f.read()).hexdigest()
+        parent_uid = None
+        if uid != u'/':
+            parent_uid = uid.rsplit(u'/', 1)[0] or u'/'
+        name = os.path.basename(uid) or u'Nuxeo Drive'
+        return RemoteFileInfo(name, uid, parent_uid, self._get_path(uid),
+                              folderish, datetime(2014, 1, 1), digest, 'md5',
+                              None, True, True, True, folderish)
+
+    def _get_path(self, uid):
+        # Made of the ids of the ancestors as by the server
+        if uid == u'/':
+            return u'/' + uid
+        return self._get_path(uid.rsplit(u'/', 1)[0] or u'/') + u'/' + uid
+
+    def get_children_info(self, uid):
+        os_path = os.path.join(self.base_folder, uid[1:])
+        prefix = uid if uid.endswith(u'/') else uid + u'/'
+        return [self.get_info(prefix + name)
+                for name in sorted(os.listdir(os_path))]
+
+    def stream_content(self, uid, file_path):
+        event = self.events.get(os.path.basename(uid))
+        if event is not None:
+            event.wait(5)
+        tmp_file = get_download_tmp_path(file_path)
+        shutil.copy(os.path.join(self.base_folder, uid[1:]), tmp_file)
+        with self._lock:
+            self.downloaded.append(uid)
+        return tmp_file
+
+
+def setup_controller():
+    global TEST_FOLDER, LOCAL_TEST_FOLDER, REMOTE_TEST_FOLDER
+    global ctl, lcclient, rclient
+    TEST_FOLDER = tempfile.mkdtemp(u'-nuxeo-drive-tests')
+    LOCAL_TEST_FOLDER = os.path.join(TEST_FOLDER, u'local')
+    REMOTE_TEST_FOLDER = os.path.join(TEST_FOLDER, u'remote')
+    os.makedirs(LOCAL_TEST_FOLDER)
+    os.makedirs(REMOTE_TEST_FOLDER)
+    ctl = Controller(os.path.join(TEST_FOLDER, u'config'),
+                     transfer_workers=2)
+    ctl.synchronizer.local_watcher_enabled = False
+    lcclient = LocalClient(LOCAL_TEST_FOLDER)
+    rclient = MirrorRemoteClient(REMOTE_TEST_FOLDER)
+    ctl.synchronizer.get_remote_fs_client = lambda server_binding: rclient
+
+
+def teardown_controller():
+    ctl.dispose()
+    if os.path.exists(TEST_FOLDER):
+        shutil.rmtree(TEST_FOLDER)
+
+
+with_controller = with_setup(setup_controller, teardown_controller)
+
+
+def make_remote_file(path, content=b'content'):
+    os_path = os.path.join(REMOTE_TEST_FOLDER, path[1:])
+    if not os.path.isdir(os.path.dirname(os_path)):
+        os.makedirs(os.path.dirname(os_path))
+    with open(os_path, 'wb') as f:
+        f.write(content)
+
+
+def bind_and_scan():
+    session = ctl.get_session()
+    binding = ServerBinding(LOCAL_TEST_FOLDER, u'http://localhost:8080/nuxeo/',
+                            u'Administrator')
+    session.add(binding)
+    session.add(LastKnownState(LOCAL_TEST_FOLDER,
+                               local_info=lcclient.get_info(u'/'),
+                               remote_info=rclient.get_info(u'/')))
+    session.commit()
+    ctl.synchronizer.scan_remote(binding, session=session)
+    return binding
+
+
+def get_pair(remote_ref):
+    return ctl.get_session().query(LastKnownState).filter_by(
+        local_folder=LOCAL_TEST_FOLDER, remote_ref=remote_ref).one()
+
+
+def test_transfer_service():
+    service = TransferService(max_workers=2, auto_tune=False)
+    event = threading.Event()
+
+    def run(result):
+        event.wait(5)
+        if isinstance(result, Exception):
+            raise result
+        return result, 10
+
+    try:
+        assert_true(service.has_free_slot())
+        service.submit(1, lambda: run(u'one'))
+        service.submit(2, lambda: run(ValueError('two')))
+        assert_false(service.has_free_slot())
+        assert_true(service.is_running(1))
+        assert_equal(service.pop_done(), [])
+        event.set()
+        done = []
+        while len(done) < 2:
+            done += service.pop_done(wait=True)
+        assert_true(service.has_free_slot())
+        assert_false(service.is_running(1))
+        assert_equal(service.pop_done(wait=True), [])
+        done.sort(key=lambda transfer: transfer.key)
+        assert_equal(done[0].get_result(), u'one')
+        assert_equal(done[0].bytes, 10)
+        assert_raises(ValueError, done[1].get_result)
+    finally:
+        service.stop()
+
+
+def test_auto_tuning():
+    service = TransferService(max_workers=4)
+    # Throughput by number of workers, the best with 3
+    throughputs = {2: 18.0, 3: 25.0, 4: 20.0}
+    workers = []
+    for period in range(6):
+        service._period_start = period * 10.0
+        service._period_bytes = throughputs[service.workers] * 10
+        service._period_saturated = True
+        service._tune(period * 10.0 + 10)
+        workers.append(service.workers)
+    assert_equal(workers, [3, 2, 3, 4, 3, 2])
+
+    # Periods without transfers waiting for a worker are not measured
+    service._period_start = 100.0
+    service._period_bytes = 0
+    service._tune(110.0)
+    assert_equal(service.workers, 2)
+
+
+class StubController(object):
+
+    def __init__(self):
+        self.transfer_service = TransferService(max_workers=2,
+                                                auto_tune=False)
+
+
+def make_pair(pair_id, local_path, remote_ref, state, folderish=False):
+    """Pending pair with only the attributes used to order them"""
+    info = RemoteFileInfo(u'File', u'/File', u'/', u'/File', False,
+                          datetime(2014, 1, 1), None, 'md5', None, True,
+                          True, True, False)
+    pair = LastKnownState(u'/tmp/Nuxeo Drive', remote_info=info)
+    pair.id = pair_id
+    pair.folderish = folderish
+    pair.local_path = local_path
+    pair.local_parent_path = (os.path.dirname(local_path)
+                              if local_path is not None else None)
+    pair.local_name = (os.path.basename(local_path)
+                       if local_path is not None else None)
+    pair.remote_ref = remote_ref
+    pair.remote_parent_ref = (os.path.dirname(remote_ref)
+                              if remote_ref is not None else None)
+    pair.remote_parent_path = (u'/root' + os.path.dirname(remote_ref)
+                               if remote_ref is not None else None)
+    pair.remote_name = (os.path.basename(remote_ref)
+                        if remote_ref is not None else None)
+    pair.pair_state = state
+    return pair
+
+
+def test_select_pending_pair():
+    controller = StubController()
+    synchronizer = Synchronizer(controller)
+    running = make_pair(1, u'/A/file.txt', u'/A/file.txt', 'locally_modified')
+    synchronizer._in_flight = {1: (None, _get_order_keys(running))}
+    pending = [
+        # Same name, different case: the deletion goes first
+        make_pair(2, u'/A/File.TXT', u'/A/File.TXT', 'remotely_deleted'),
+        make_pair(3, None, u'/A/File.TXT', 'remotely_created'),
+        # Ancestor, then its descendant waiting for it
+        make_pair(4, u'/A', u'/A', 'remotely_modified', folderish=True),
+        make_pair(5, u'/A/Sub', None, 'locally_created', folderish=True),
+        # Independent pairs
+        make_pair(6, u'/B/other.txt', u'/B/other.txt', 'remotely_deleted'),
+        make_pair(7, u'/B/new.txt', None, 'locally_created'),
+        make_pair(8, u'/B/new2.txt', None, 'locally_created'),
+    ]
+    assert_equal(synchronizer._select_pending_pair(pending).id, 6)
+    pending.pop(4)
+    assert_equal(synchronizer._select_pending_pair(pending).id, 7)
+    # A second transfer is running: no worker is free any more
+    controller.transfer_service._running.update([1, 7])
+    pending.pop(4)
+    assert_equal(synchronizer._select_pending_pair(pending), None)
+
+    # Once the transfers are done, the original order is kept
+    synchronizer._in_flight.clear()
+    controller.transfer_service._running.clear()
+    order = []
+    while pending:
+        pair = synchronizer._select_pending_pair(pending)
+        order.append(pair.id)
+        pending.remove(pair)
+    assert_equal(order, [2, 4, 3, 5, 8])
+
+
+@with_controller
+def test_transfers_run_concurrently():
+    make_remote_file(u'/Big.txt', b'x' * 1000)
+    make_remote_file(u'/Folder/a.txt')
+    make_remote_file(u'/Folder/b.txt')
+    # The big file is downloaded once the small ones are
+    rclient.events[u'Big.txt'] = big = threading.Event()
+    rclient.events[u'b.txt'] = threading.Event()
+    rclient.events[u'b.txt'].set()
+    original = rclient.stream_content
+
+    def stream_content(uid, file_path):
+        tmp_file = original(uid, file_path)
+        if uid == u'/Folder/b.txt':
+            big.set()
+        return tmp_file
+
+    rclient.stream_content = stream_content
+    binding = bind_and_scan()
+    synchronized = ctl.synchronizer.synchronize(binding)
+
+    assert_equal(synchronized, 4)
+    assert_equal(rclient.downloaded[-1], u'/Big.txt')
+    assert_equal(sorted(rclient.downloaded),
+                 [u'/Big.txt', u'/Folder/a.txt', u'/Folder/b.txt'])
+    assert_equal(lcclient.get_content(u'/Big.txt'), b'x' * 1000)
+    assert_equal(lcclient.get_content(u'/Folder/a.txt'), b'content')
+    assert_equal(ctl.list_pending(), [])
+    assert_equal(ctl.get_session().query(TransferJob).count(), 0)
+    # No leftover temporary file
+    assert_equal(sorted(os.listdir(LOCAL_TEST_FOLDER)),
+                 [u'Big.txt', u'Folder'])
+
+
+@with_controller
+def test_limit_waits_for_transfers():
+    make_remote_file(u'/Big.txt', b'x' * 1000)
+    make_remote_file(u'/a.txt')
+    make_remote_file(u'/b.txt')
+    rclient.events[u'Big.txt'] = big = threading.Event()
+    timer = threading.Timer(0.2, big.set)
+    timer.start()
+    binding = bind_and_scan()
+
+    # No other pair is synchronized while the transfer is running
+    assert_equal(ctl.synchronizer.synchronize(binding, limit=1), 1)
+    timer.join()
+    assert_equal(rclient.downloaded, [u'/Big.txt'])
+    assert_equal(lcclient.get_content(u'/Big.txt'), b'x' * 1000)
+    assert_equal(len(ctl.list_pending()), 2)
+    assert_equal(ctl.get_session().query(TransferJob).count(), 0)
+
+
+@with_controller
+def test_interrupted_transfers():
+    make_remote_file(u'/File 1.txt')
+    make_remote_file(u'/File 2.txt')
+    binding = bind_and_scan()
+    session = ctl.get_session()
+    # Downloads interrupted by a stop of the process
+    tmp_files = []
+    for name, attempts in ((u'File 1.txt', 1), (u'File 2.txt', 3)):
+        tmp_file = get_download_tmp_path(
+            os.path.join(LOCAL_TEST_FOLDER, name))
+        with open(tmp_file, 'wb') as f:
+            f.write(b'cont')
+        tmp_files.append(tmp_file)
+        job = TransferJob.get_or_create(session, LOCAL_TEST_FOLDER,
+                                        get_pair(u'/' + name).id)
+        job.direction = 'download'
+        job.file_path = tmp_file
+        job.attempts = attempts
+    session.commit()
+
+    ctl.synchronizer.synchronize(binding)
+
+    # The first download is done again, the second one blacklisted
+    assert_equal(rclient.downloaded, [u'/File 1.txt'])
+    assert_equal(lcclient.get_content(u'/File 1.txt'), b'content')
+    assert_equal(get_pair(u'/File 1.txt').pair_state, 'synchronized')
+    pair = get_pair(u'/File 2.txt')
+    assert_equal(pair.local_path, None)
+    assert_true(pair.last_sync_error_date is not None)
+    assert_false(any(os.path.exists(tmp_file) for tmp_file in tmp_files))
+    assert_equal(session.query(TransferJob).count(), 0)
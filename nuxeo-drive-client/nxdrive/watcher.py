@@ -0,0 +1,308 @@
+"""Local file system monitoring to avoid full scans of the bound folders
+
+The watcher does not replace the local scan: it only records the paths that
+have been reported as changed by the operating system so that the
+synchronizer can rescan the matching subtrees instead of walking the whole
+bound folder at each iteration of the synchronization loop.
+
+"""
+import os
+import sys
+import errno
+import struct
+import threading
+import unicodedata
+
+from nxdrive.client.ignore import IGNORE_FILE_NAME
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# Events that change the list of children of the watched folder
+LISTING_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+# Events that change the content or metadata of a child of the watched folder
+CONTENT_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE
+
+# Events that affect the watched folder it-self
+SELF_EVENTS = IN_DELETE_SELF | IN_MOVE_SELF
+
+WATCH_MASK = LISTING_EVENTS | CONTENT_EVENTS | SELF_EVENTS | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct('iIII')
+
+READ_BUFFER_SIZE = 64 * 1024
+
+
+def _load_libc():
+    """Return the libc exposing the inotify API or None if not available"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        # Check that the inotify API is available
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+        return libc
+    except (ImportError, OSError, AttributeError):
+        return None
+
+
+class WatcherOverflow(Exception):
+    """Some file system events might have been lost: full scan required"""
+    pass
+
+
+class InotifyWatcher(object):
+    """Record the paths changed under a bound local folder using inotify
+
+    inotify is not recursive: the synchronizer is expected to call watch()
+    on each folder before listing its children during the local scan so that
+    no change can be missed between the listing and the watch registration.
+
+    The changed paths are local client references (unix style path relative
+    to the bound folder). A changed folder path means that its children list
+    has to be checked again while a changed file path means that the file
+    it-self has to be refreshed.
+
+    """
+
+    def __init__(self, local_client, libc):
+        self.client = local_client
+        self.base_folder = local_client.base_folder
+        self._libc = libc
+        self._fd = None
+        self._path_by_wd = dict()
+        self._wd_by_path = dict()
+        self._changed = set()
+        # Folders can be watched from the threads of the local tree walker
+        self._lock = threading.Lock()
+
+        # Set to True when events have been lost (kernel queue overflow or
+        # too many folders to watch): the caller should fall back to a full
+        # scan and call reset()
+        self.overflowed = False
+
+        # Time stamp of the last full scan of the watched folder, None if
+        # the first full scan is still to be performed
+        self.last_full_scan = None
+
+    def start(self):
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = self._get_errno()
+            raise OSError(err, os.strerror(err))
+        self._fd = fd
+        log.debug("Started inotify watcher on %s", self.base_folder)
+
+    def stop(self):
+        with self._lock:
+            self._stop()
+
+    def _stop(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            log.debug("Stopped inotify watcher on %s", self.base_folder)
+        self._path_by_wd.clear()
+        self._wd_by_path.clear()
+        self._changed.clear()
+
+    def reset(self):
+        """Forget any recorded change before performing a full scan"""
+        self.read_events()
+        self._changed.clear()
+        self.overflowed = False
+
+    def watch(self, path):
+        """Monitor the direct children of the folder at the given path"""
+        with self._lock:
+            self._watch(path)
+
+    def _watch(self, path):
+        if self._fd is None or self.overflowed:
+            return
+        if path in self._wd_by_path:
+            return
+        os_path = self._os_path(path)
+        wd = self._libc.inotify_add_watch(self._fd, os_path, WATCH_MASK)
+        if wd < 0:
+            err = self._get_errno()
+            if err == errno.ENOSPC:
+                log.warning("Maximum number of inotify watches reached while"
+                            " watching %s: falling back to full scans. Try to"
+                            " increase fs.inotify.max_user_watches.",
+                            self.base_folder)
+                self.overflowed = True
+            elif err not in (errno.ENOENT, errno.ENOTDIR):
+                log.debug("Could not watch %r: %s", os_path,
+                          os.strerror(err))
+            # ENOENT / ENOTDIR: the folder has been deleted or replaced in
+            # the mean time, the parent folder events will report it.
+            return
+        previous_path = self._path_by_wd.get(wd)
+        if previous_path is not None:
+            # Same inode already watched under a previous name
+            self._wd_by_path.pop(previous_path, None)
+        self._path_by_wd[wd] = path
+        self._wd_by_path[path] = wd
+
+    def is_watching(self, path):
+        """Return True if the children of the folder are monitored"""
+        return path in self._wd_by_path
+
+    def get_changed_paths(self):
+        """Return and forget the paths changed since the previous call
+
+        Raise WatcherOverflow if some events might have been lost.
+        """
+        self.read_events()
+        if self.overflowed:
+            raise WatcherOverflow("Lost file system events for %s"
+                                  % self.base_folder)
+        changed = self._changed
+        self._changed = set()
+        return changed
+
+    def read_events(self):
+        """Consume the pending kernel events without blocking"""
+        with self._lock:
+            self._read_events()
+
+    def _read_events(self):
+        if self._fd is None:
+            return
+        while True:
+            try:
+                data = os.read(self._fd, READ_BUFFER_SIZE)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            if not data:
+                return
+            self._parse_events(data)
+
+    def _parse_events(self, data):
+        offset = 0
+        header_size = EVENT_HEADER.size
+        while offset + header_size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += header_size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            self._handle_event(wd, mask, name)
+
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            log.debug("inotify event queue overflow for %s",
+                      self.base_folder)
+            self.overflowed = True
+            return
+
+        path = self._path_by_wd.get(wd)
+        if mask & IN_IGNORED:
+            # The watch has been removed by the kernel (deleted folder)
+            if path is not None:
+                del self._path_by_wd[wd]
+                if self._wd_by_path.get(path) == wd:
+                    del self._wd_by_path[path]
+            return
+        if path is None:
+            # Event on a recently removed watch
+            return
+
+        if mask & SELF_EVENTS:
+            # The parent folder events will report the change, except for
+            # the bound folder it-self
+            if path == u'/':
+                self._changed.add(path)
+            return
+
+        if not name:
+            self._changed.add(path)
+            return
+        name = unicodedata.normalize('NFKC', name.decode('utf-8'))
+        if name == IGNORE_FILE_NAME:
+            # The rules may apply to any descendant of the folder: let the
+            # next scan walk the whole bound folder again
+            log.debug("Ignore rules changed in %s", path)
+            self.overflowed = True
+            return
+        if self.client.is_ignored(name):
+            # Only the global rules are checked: events on children ignored
+            # by the rules of a folder only trigger a useless listing
+            return
+        child_path = path + name if path == u'/' else path + u'/' + name
+
+        if mask & LISTING_EVENTS:
+            self._changed.add(path)
+            if mask & IN_MOVED_FROM and mask & IN_ISDIR:
+                # The watches of the moved folder and its descendants are
+                # now registered under obsolete paths: forget them, they will
+                # be registered again when scanning the new location.
+                self._unwatch_tree(child_path)
+        elif mask & CONTENT_EVENTS:
+            self._changed.add(child_path)
+
+    def _unwatch_tree(self, path):
+        prefix = path + u'/'
+        for watched_path, wd in self._wd_by_path.items():
+            if watched_path == path or watched_path.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._wd_by_path[watched_path]
+                self._path_by_wd.pop(wd, None)
+
+    def _os_path(self, path):
+        os_path = os.path.join(self.base_folder,
+                               path[1:].replace(u'/', os.path.sep))
+        return os_path.encode(sys.getfilesystemencoding() or 'utf-8')
+
+    def _get_errno(self):
+        import ctypes
+        return ctypes.get_errno()
+
+
+_libc = None
+
+
+def get_local_watcher(local_client):
+    """Return a started watcher for the client folder or None if unsupported"""
+    global _libc
+    if _libc is None:
+        _libc = _load_libc() or False
+    if not _libc:
+        return None
+    watcher = InotifyWatcher(local_client, _libc)
+    try:
+        watcher.start()
+    except OSError as e:
+        log.warning("Could not start file system monitoring on %s: %s",
+                    local_client.base_folder, e)
+        return None
+    return watcher
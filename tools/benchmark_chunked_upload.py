@@ -0,0 +1,107 @@
+"""Benchmark the chunked uploads against a local stand-in batch endpoint
+
+Usage:
+
+    python benchmark_chunked_upload.py [--size 64] [--rate 20] [--latency 20]
+                                       [--chunk-sizes 0 4 10]
+                                       [--workers 1 4 8]
+
+A file of SIZE MiB is uploaded to a local server receiving each request at
+RATE MiB/s after LATENCY milliseconds (see tests/test_chunked_upload.py),
+in a single request and by chunks of each size sent by each number of
+workers. The upload is then interrupted by the failure of the last chunk
+and resumed by a new client: the amount of content sent again is reported.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib2
+
+from nxdrive.client.base_automation_client import BaseAutomationClient
+from nxdrive.client.chunked_upload import ChunkedUpload
+from nxdrive.client.connection_pool import ConnectionPool
+from nxdrive.tests.test_chunked_upload import BatchServer
+
+
+MIB = 1024 ** 2
+
+
+def make_client(server, tmp, pool, chunk_size, workers):
+    client = BaseAutomationClient(
+        server.url, u'Administrator', u'device', u'1.0', password=u'secret',
+        proxies={}, upload_tmp_dir=tmp, connection_pool=pool,
+        transfer_pool=pool,
+        upload_chunk_size=chunk_size)
+    client.upload_workers = workers
+    return client
+
+
+def upload(client, path):
+    start = time.time()
+    client.execute_with_blob_streaming('NuxeoDrive.CreateFile', path)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=64, help="MiB")
+    parser.add_argument('--rate', type=float, default=20, help="MiB/s")
+    parser.add_argument('--latency', type=float, default=20,
+                        help="milliseconds")
+    parser.add_argument('--chunk-sizes', type=int, nargs='+',
+                        default=[0, 4, 10], help="MiB, 0 for no chunks")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    options = parser.parse_args()
+
+    server = BatchServer(latency=options.latency / 1000.0,
+                         rate=options.rate * MIB)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    pool = ConnectionPool()
+    ChunkedUpload.retry_delay = 0
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        path = os.path.join(tmp, u'Big.bin')
+        with open(path, 'wb') as f:
+            for _ in range(options.size):
+                f.write(os.urandom(MIB))
+
+        print "%d MiB file, %.1f MiB/s by connection, latency %.1f ms" % (
+            options.size, options.rate, options.latency)
+        print "%-8s %8s %10s %10s %14s" % ("chunks", "workers", "upload (s)",
+                                           "MiB/s", "resent (MiB)")
+        for chunk_size in options.chunk_sizes:
+            for workers in (options.workers if chunk_size else [1]):
+                client = make_client(server, tmp, pool, chunk_size * MIB,
+                                     workers)
+                duration = upload(client, path)
+                resent = '-'
+                if chunk_size:
+                    # Interrupted by the last chunk, then resumed
+                    last = (options.size + chunk_size - 1) // chunk_size - 1
+                    server.failures[last] = ChunkedUpload.max_chunk_attempts
+                    try:
+                        upload(client, path)
+                    except urllib2.HTTPError:
+                        pass
+                    del server.uploads[:]
+                    upload(make_client(server, tmp, pool, chunk_size * MIB,
+                                       workers), path)
+                    resent = '%d' % min(options.size,
+                                        len(server.uploads) * chunk_size)
+                print "%-8s %8d %10.2f %10.1f %14s" % (
+                    '%d MiB' % chunk_size if chunk_size else 'none', workers,
+                    duration, options.size / duration, resent)
+    finally:
+        pool.clear()
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""Report the size and load time of the pairs before and after compaction
+
+Usage:
+
+    python benchmark_compact_states.py [--folders 1000] [--children 1000]
+
+A database of FOLDERS x CHILDREN synchronized pairs (1M rows by default) is
+generated in the layout of the schema version 3: states as text, DateTime
+timestamps and the unused columns. It is then migrated by init_db to the
+compact layout: states as small integer codes and timestamps as integers.
+
+The size of the database file and the time to load all the rows with
+their column types, as tuples and as mapped objects, are reported for both
+layouts along with the duration of the migration.
+"""
+import argparse
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Index
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import create_engine
+from sqlalchemy import select
+from sqlalchemy.orm import mapper
+from sqlalchemy.orm import sessionmaker
+
+from nxdrive.model import LastKnownState
+from nxdrive.model import StateEnum
+from nxdrive.model import Timestamp
+from nxdrive.model import init_db
+
+
+LOCAL_FOLDER = u'/home/user/Nuxeo Drive'
+
+LEGACY_COLUMNS = [
+    Column('locally_moved_from', String),
+    Column('locally_moved_to', String),
+    Column('remotely_moved_from', String),
+    Column('remotely_moved_to', String),
+    Column('in_clause_selected', Integer, default=0),
+]
+
+
+def legacy_table(metadata):
+    """Table of the pairs in the layout of the version 3"""
+    columns = []
+    for column in LastKnownState.__table__.columns:
+        column_type = column.type
+        if isinstance(column_type, StateEnum):
+            column_type = String()
+        elif isinstance(column_type, Timestamp):
+            column_type = DateTime()
+        columns.append(Column(column.name, column_type,
+                              primary_key=column.primary_key))
+    table = Table(LastKnownState.__tablename__, metadata,
+                  *(columns + [column.copy() for column in LEGACY_COLUMNS]))
+    for index in LastKnownState.__table__.indexes:
+        kwargs = {}
+        if index.name == 'last_known_states_pending':
+            kwargs['sqlite_where'] = table.c.pair_state.notin_(
+                ['synchronized', 'unsynchronized'])
+        Index(index.name, *[table.c[column.name]
+                            for column in index.columns], **kwargs)
+    return table
+
+
+def populate(engine, table, n_folders, n_children):
+    now = datetime.datetime.utcnow()
+    connection = engine.connect()
+
+    def row(local_path, local_parent_path, name, remote_ref,
+            remote_parent_ref, folderish):
+        return dict(local_folder=LOCAL_FOLDER, local_path=local_path,
+                    local_parent_path=local_parent_path, local_name=name,
+                    remote_ref=remote_ref, remote_parent_ref=remote_parent_ref,
+                    remote_parent_path=u'/root/' + remote_parent_ref,
+                    remote_name=name, folderish=folderish,
+                    local_digest=None if folderish else u'%032d' % len(name),
+                    remote_digest=None if folderish else u'%032d' % len(name),
+                    local_size=None if folderish else 1024,
+                    local_state='synchronized', remote_state='synchronized',
+                    pair_state='synchronized', last_local_updated=now,
+                    last_remote_updated=now, last_sync_date=now,
+                    remote_can_rename=True, remote_can_delete=True,
+                    remote_can_update=True, remote_can_create_child=folderish,
+                    in_clause_selected=0)
+
+    try:
+        for i in range(n_folders):
+            folder_path = u'/Folder %04d' % i
+            rows = [row(folder_path, u'/', folder_path[1:],
+                        u'folder-%d' % i, u'root', True)]
+            for j in range(n_children):
+                name = u'File %04d.txt' % j
+                rows.append(row(folder_path + u'/' + name, folder_path, name,
+                                u'file-%d-%d' % (i, j), u'folder-%d' % i,
+                                False))
+            with connection.begin():
+                connection.execute(table.insert(), rows)
+    finally:
+        connection.close()
+    engine.execute('PRAGMA user_version = 3')
+    engine.execute('VACUUM')
+
+
+def load(engine, table):
+    start = time.time()
+    rows = engine.execute(select([table])).fetchall()
+    # Values are processed when accessed
+    for row in rows:
+        tuple(row)
+    return time.time() - start
+
+
+def load_objects(engine, table):
+    # Plain class for both layouts, the pairs being loaded as by the ORM
+    pair_class = type('Pair', (object,), {})
+    mapper(pair_class, table)
+    session = sessionmaker(bind=engine)()
+    start = time.time()
+    session.query(pair_class).all()
+    duration = time.time() - start
+    session.close()
+    return duration
+
+
+def report(name, dbfile, engine, table):
+    print "%-10s %10.1f %12.3f %12.3f" % (
+        name, file_size(dbfile), load(engine, table),
+        load_objects(engine, table))
+
+
+def file_size(path):
+    return os.path.getsize(path) / (1024.0 * 1024.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--folders', type=int, default=1000)
+    parser.add_argument('--children', type=int, default=1000)
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        dbfile = os.path.join(tmp, 'nxdrive.db')
+        engine = create_engine('sqlite:///' + dbfile)
+        table = legacy_table(MetaData())
+        table.create(engine)
+        populate(engine, table, options.folders, options.children)
+        print "%d rows" % (options.folders * (options.children + 1))
+        print "%-10s %10s %12s %12s" % ("layout", "size (MB)", "rows (s)",
+                                        "objects (s)")
+        report("text", dbfile, engine, table)
+        engine.dispose()
+
+        start = time.time()
+        engine, _ = init_db(tmp)
+        migration = time.time() - start
+        engine.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        report("compact", dbfile, engine, LastKnownState.__table__)
+        print "migration: %.1fs" % migration
+        engine.dispose()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
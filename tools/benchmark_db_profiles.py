@@ -0,0 +1,150 @@
+"""Benchmark the scans and the synchronization under each database profile
+
+Usage:
+
+    python benchmark_db_profiles.py [--size N]
+                                    [--profiles compatible durable fast]
+
+A tree of N^3 folders and files is generated in a temporary folder (see
+create_folders.py) and served by an in-memory remote client mirroring it (see
+benchmark_scan_queries.py). For each SQLite tuning profile, a new database is
+filled by:
+
+- the initial local and remote scans,
+- the synchronization of each pair, emulated by updating its state in its own
+  transaction as the synchronizer does after each operation, no document
+  being transferred.
+
+Meanwhile a reader thread lists the pending pairs in a loop as the GUI does,
+the duration of its longest read shows how long it waited for the writer.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchmark_scan_queries import TreeRemoteClient
+from create_folders import make_folder_tree
+
+from nxdrive.client import LocalClient
+from nxdrive.controller import Controller
+from nxdrive.model import DB_PROFILES
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+
+
+class PendingReader(threading.Thread):
+    """List the pending pairs in a loop, recording the read durations"""
+
+    def __init__(self, ctl, local_folder):
+        super(PendingReader, self).__init__()
+        self.daemon = True
+        self.ctl = ctl
+        self.local_folder = local_folder
+        self.durations = []
+        self._stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                start = time.time()
+                self.ctl.list_pending(local_folder=self.local_folder)
+                self.durations.append(time.time() - start)
+                time.sleep(0.01)
+        finally:
+            # SQLite connections can only be closed by their own thread
+            self.ctl._session_maker.remove()
+            self.ctl._engine.raw_connection().invalidate()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def synchronize_all(ctl, local_folder):
+    session = ctl.get_session()
+    pair_ids = [pair_id for pair_id, in session.query(LastKnownState.id)
+                .filter_by(local_folder=local_folder)]
+    for pair_id in pair_ids:
+        pair = session.query(LastKnownState).get(pair_id)
+        pair.pair_state = 'synchronized'
+        pair.last_sync_date = datetime.utcnow()
+        session.commit()
+    return len(pair_ids)
+
+
+def run_profile(profile, local_folder, config_folder):
+    ctl = Controller(config_folder, local_scan_workers=1, db_profile=profile)
+    try:
+        sync = ctl.synchronizer
+        sync.local_watcher_enabled = False
+        remote_client = TreeRemoteClient(local_folder)
+        sync.get_remote_fs_client = lambda server_binding: remote_client
+        sync._notify_refreshing = lambda server_binding: None
+
+        session = ctl.get_session()
+        binding = ServerBinding(local_folder,
+                                u'http://localhost:8080/nuxeo/',
+                                u'Administrator')
+        session.add(binding)
+        session.add(LastKnownState(
+            local_folder,
+            local_info=LocalClient(local_folder).get_info(u'/'),
+            remote_info=remote_client.get_info(u'/')))
+        session.commit()
+
+        reader = PendingReader(ctl, local_folder)
+        reader.start()
+        try:
+            results = []
+            for scan in (sync.scan_local, sync.scan_remote):
+                start = time.time()
+                scan(binding)
+                results.append(time.time() - start)
+            start = time.time()
+            n_pairs = synchronize_all(ctl, local_folder)
+            results.append(n_pairs / (time.time() - start))
+        finally:
+            reader.stop()
+        results.append(len(reader.durations))
+        results.append(max(reader.durations) * 1000)
+        return results
+    finally:
+        ctl.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=6,
+                        help="Size of the generated tree")
+    parser.add_argument('--profiles', nargs='+', choices=sorted(DB_PROFILES),
+                        default=sorted(DB_PROFILES))
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        local_folder = os.path.join(tmp, u'local')
+        os.makedirs(local_folder)
+        make_folder_tree(options.size, local_folder)
+        n_items = sum(len(dirs) + len(files)
+                      for _, dirs, files in os.walk(local_folder))
+        print "%d documents" % n_items
+        print "%-12s %12s %12s %12s %10s %14s" % (
+            "profile", "local (s)", "remote (s)", "sync (op/s)", "reads",
+            "max read (ms)")
+        for profile in options.profiles:
+            config_folder = os.path.join(tmp, u'config-' + profile)
+            results = run_profile(profile, local_folder, config_folder)
+            print "%-12s %12.3f %12.3f %12.1f %10d %14.1f" % (
+                (profile,) + tuple(results))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
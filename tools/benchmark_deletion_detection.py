@@ -0,0 +1,163 @@
+"""Benchmark the detection of deleted children on a large database
+
+Usage:
+
+    python benchmark_deletion_detection.py [--folders 1000] [--children 1000]
+                                           [--samples 100]
+
+A database of FOLDERS x CHILDREN pair states (1M rows by default) is
+generated, then the deleted children of SAMPLES folders are detected with:
+
+- tagging: the former scheme stamping the in_clause_selected column, added
+  to the table for the benchmark, on the listed children with paged UPDATE
+  statements before querying the children that are not stamped,
+- difference: the children of the folder are compared with the listed paths
+  in memory, as done by the local scan.
+
+The pairs of the children are loaded by both methods as the scan needs them
+to refresh the listed children anyway.
+
+One child of each sampled folder is considered as deleted. The number of
+rows written to the database is reported along with the duration.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from sqlalchemy import literal_column
+
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+
+
+LOCAL_FOLDER = u'/home/user/Nuxeo Drive'
+
+
+def populate(ctl, n_folders, n_children):
+    table = LastKnownState.__table__
+    connection = ctl._engine.connect()
+    try:
+        # Dropped from the model since not used any more
+        connection.execute('ALTER TABLE last_known_states'
+                           ' ADD COLUMN in_clause_selected INTEGER DEFAULT 0')
+        for i in range(n_folders):
+            folder_path = u'/Folder %04d' % i
+            rows = [dict(local_folder=LOCAL_FOLDER, local_path=folder_path,
+                         local_parent_path=u'/', local_name=folder_path[1:],
+                         remote_ref=u'folder-%d' % i,
+                         remote_parent_ref=u'root', folderish=True,
+                         local_state='synchronized',
+                         remote_state='synchronized',
+                         pair_state='synchronized')]
+            for j in range(n_children):
+                name = u'File %04d.txt' % j
+                rows.append(dict(
+                    local_folder=LOCAL_FOLDER,
+                    local_path=folder_path + u'/' + name,
+                    local_parent_path=folder_path, local_name=name,
+                    remote_ref=u'file-%d-%d' % (i, j),
+                    remote_parent_ref=u'folder-%d' % i, folderish=False,
+                    local_state='synchronized', remote_state='synchronized',
+                    pair_state='synchronized'))
+            with connection.begin():
+                connection.execute(table.insert(), rows)
+    finally:
+        connection.close()
+
+
+def get_folder_pair(session, folder_path):
+    return session.query(LastKnownState).filter_by(
+        local_folder=LOCAL_FOLDER, local_path=folder_path).one()
+
+
+def detect_by_tagging(ctl, session, folder_path, children_path, page_size):
+    ctl.synchronizer._get_local_children_pairs(
+        session, get_folder_pair(session, folder_path), folder_path,
+        children_path)
+    # Former implementation of LastKnownState.select_local_paths and
+    # not_selected
+    tag = time.time()
+    children_path = list(children_path)
+    for i in range(0, len(children_path), page_size):
+        page = children_path[i:i + page_size]
+        session.execute(
+            'UPDATE last_known_states SET in_clause_selected = :tag'
+            ' WHERE local_path IN (%s)' % ', '.join(
+                ':path%d' % j for j in range(len(page))),
+            dict(tag=tag, **dict(('path%d' % j, path)
+                                 for j, path in enumerate(page))))
+    return session.query(LastKnownState).filter_by(
+        local_folder=LOCAL_FOLDER, local_parent_path=folder_path).filter(
+            literal_column('in_clause_selected') != tag).all()
+
+
+def detect_by_difference(ctl, session, folder_path, children_path):
+    _, _, deleted = ctl.synchronizer._get_local_children_pairs(
+        session, get_folder_pair(session, folder_path), folder_path,
+        children_path)
+    return deleted
+
+
+def total_changes(session):
+    # Rows modified on the underlying sqlite3 connection since it was opened
+    return session.connection().connection.connection.total_changes
+
+
+def measure(ctl, name, detect, n_folders, n_children, samples):
+    session = ctl.get_session()
+    changes = total_changes(session)
+    start = time.time()
+    step = max(1, n_folders // samples)
+    for i in range(0, step * samples, step):
+        folder_path = u'/Folder %04d' % i
+        children_path = set(u'%s/File %04d.txt' % (folder_path, j)
+                            for j in range(1, n_children))
+        deleted = detect(session, folder_path, children_path)
+        assert [pair.local_path for pair in deleted] == [
+            folder_path + u'/File 0000.txt']
+        session.commit()
+        # Measure the reads from the database, not from the session
+        session.expunge_all()
+    elapsed = time.time() - start
+    print "%-12s %14.2f %14d" % (name, elapsed * 1000 / samples,
+                                 total_changes(session) - changes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--folders', type=int, default=1000)
+    parser.add_argument('--children', type=int, default=1000)
+    parser.add_argument('--samples', type=int, default=100)
+    options = parser.parse_args()
+    samples = min(options.samples, options.folders)
+
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        ctl = Controller(os.path.join(tmp, u'config'))
+        try:
+            start = time.time()
+            populate(ctl, options.folders, options.children)
+            print "%d rows generated in %.1fs" % (
+                options.folders * (options.children + 1),
+                time.time() - start)
+            print "%-12s %14s %14s" % ("method", "ms per folder",
+                                       "rows written")
+            page_size = ctl.synchronizer.page_size
+            measure(ctl, "tagging",
+                    lambda session, path, children: detect_by_tagging(
+                        ctl, session, path, children, page_size),
+                    options.folders, options.children, samples)
+            measure(ctl, "difference",
+                    lambda session, path, children: detect_by_difference(
+                        ctl, session, path, children),
+                    options.folders, options.children, samples)
+        finally:
+            ctl.dispose()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Benchmark the reading of local files for hashing
+
+Usage:
+
+    python benchmark_file_io.py [--folder FOLDER] [--max-size SIZE]
+                                [--digest md5]
+
+Files of 1KB, 4KB, 16KB, ... up to --max-size (in MB, 4096 for 4GB) are
+generated in FOLDER (a temporary folder by default) and hashed with:
+
+- the former loop reading chunks of BUFFER_SIZE bytes with file.read,
+- read_chunks reading into a reused buffer of adaptive size,
+- read_chunks mapping the file in memory by windows.
+
+Each file is hashed once before measuring so that all the modes read from a
+warm page cache, except when the file is bigger than the drop cache threshold
+in which case the modes read from the disk.
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from nxdrive.client.common import BUFFER_SIZE
+from nxdrive.client.file_io import read_chunks
+
+
+def read_loop(path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(BUFFER_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+MODES = [
+    ('read', read_loop),
+    ('readinto', lambda path: read_chunks(path, reuse_buffer=True,
+                                          use_mmap=False)),
+    ('mmap', lambda path: read_chunks(path, reuse_buffer=True,
+                                      use_mmap=True)),
+]
+
+
+def make_file(path, size):
+    block = os.urandom(min(size, 1024 ** 2))
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            f.write(block[:size - written])
+            written += len(block)
+
+
+def timed_digest(reader, path, digest_func):
+    start = time.time()
+    h = getattr(hashlib, digest_func)()
+    for chunk in reader(path):
+        h.update(chunk)
+    return time.time() - start, h.hexdigest()
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return '%d%s' % (size, unit)
+        size /= 1024
+    return '%dTB' % size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--folder', help="Folder of the generated files")
+    parser.add_argument('--max-size', type=int, default=256,
+                        help="Size of the biggest file in MB")
+    parser.add_argument('--digest', default='md5')
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark', dir=options.folder)
+    try:
+        print "%-8s" % "size" + "".join("%18s" % ("%s (MB/s)" % name)
+                                         for name, _ in MODES)
+        size = 1024
+        while size <= options.max_size * 1024 ** 2:
+            path = os.path.join(tmp, u'file-%d.bin' % size)
+            make_file(path, size)
+            _, expected = timed_digest(read_loop, path, options.digest)
+            # Repeat the small files to get a measurable duration
+            repeat = max(1, 16 * 1024 ** 2 // size)
+            line = "%-8s" % format_size(size)
+            for _, reader in MODES:
+                elapsed = 0
+                for _ in range(repeat):
+                    duration, digest = timed_digest(reader, path,
+                                                    options.digest)
+                    assert digest == expected
+                    elapsed += duration
+                line += "%18.1f" % (size * repeat / 1024.0 ** 2
+                                    / max(elapsed, 1e-9))
+            print line
+            os.remove(path)
+            size *= 4
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Benchmark updating the pairs of a renamed folder
+
+Usage:
+
+    python benchmark_folder_rename.py [--files 5000]
+
+A folder of FILES documents spread in sub folders of 100 documents is
+generated in a temporary folder along with its synchronized pairs. The
+folder is then renamed and its pairs updated:
+
+- recursive: the former scheme refreshing the local state of each
+  descendant from the file system,
+- set-based: the paths of the descendants are rewritten by
+  LastKnownState.move_local_descendants.
+
+The number of statements and the duration are reported for both.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchmark_scan_queries import StatementCounter
+
+from nxdrive.client import LocalClient
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+
+
+def populate(ctl, local_folder, n_files):
+    client = LocalClient(local_folder)
+    session = ctl.get_session()
+    session.add(ServerBinding(local_folder, u'http://localhost:8080/nuxeo/',
+                              u'Administrator'))
+    folder = client.make_folder(u'/', u'Project')
+    paths = [u'/', folder]
+    for i in range(n_files):
+        if i % 100 == 0:
+            sub_folder = client.make_folder(folder, u'Folder %d' % (i / 100))
+            paths.append(sub_folder)
+        paths.append(client.make_file(sub_folder, u'File %d.txt' % i,
+                                      content=b"%d" % i))
+    for path in paths:
+        pair = LastKnownState(local_folder, local_info=client.get_info(path))
+        pair.update_state('synchronized', 'synchronized')
+        session.add(pair)
+    session.commit()
+    return client, session
+
+
+def rename_recursive(session, client, doc_pair, previous_local_path,
+                     updated_path):
+    # Former Synchronizer._local_rename_with_descendant_states
+    for child in session.query(LastKnownState).filter_by(
+            local_folder=doc_pair.local_folder,
+            local_parent_path=previous_local_path).all():
+        rename_recursive(session, client, child, child.local_path,
+                         updated_path + '/' + child.local_name)
+    doc_pair.refresh_local(client=client, local_path=updated_path)
+
+
+def rename_set_based(session, client, doc_pair, previous_local_path,
+                     updated_path):
+    LastKnownState.move_local_descendants(
+        session, doc_pair.local_folder, previous_local_path, updated_path)
+    doc_pair.refresh_local(client=client, local_path=updated_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=5000)
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        print "%d files" % options.files
+        print "%-10s %12s %10s" % ("method", "statements", "time (s)")
+        for name, rename in (("recursive", rename_recursive),
+                             ("set-based", rename_set_based)):
+            local_folder = os.path.join(tmp, name, u'local')
+            os.makedirs(local_folder)
+            ctl = Controller(os.path.join(tmp, name, u'config'))
+            try:
+                client, session = populate(ctl, local_folder, options.files)
+                doc_pair = session.query(LastKnownState).filter_by(
+                    local_path=u'/Project').one()
+                client.rename(u'/Project', u'Renamed')
+                counter = StatementCounter(ctl._engine)
+                start = time.time()
+                rename(session, client, doc_pair, u'/Project', u'/Renamed')
+                session.commit()
+                print "%-10s %12d %10.3f" % (name, counter.count,
+                                             time.time() - start)
+            finally:
+                ctl.dispose()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Benchmark the status of the folders read from their descendant counters
+
+Usage:
+
+    python benchmark_folder_status.py [--size N]
+
+A tree of N^3 folders and files is generated in a temporary folder (see
+create_folders.py) and scanned. The statements and duration are reported
+for:
+
+- counting the descendants of all the folders after the scans,
+- the status of the children of the bound folder, with the descendants
+  counted on the fly then read from the counters,
+- the changes of state of all the pairs, the triggers adding them to the
+  counters of the ancestors, compared to the same updates without triggers.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchmark_scan_queries import StatementCounter
+from benchmark_scan_queries import TreeRemoteClient
+from create_folders import make_folder_tree
+
+from nxdrive.client import LocalClient
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+
+
+def report(name, counter, start):
+    print "%-22s %12d %10.3f" % (name, counter.count, time.time() - start)
+    counter.count = 0
+
+
+def update_states(session, local_folder, pair_state):
+    for pair in session.query(LastKnownState).filter_by(
+            local_folder=local_folder):
+        pair.pair_state = pair_state
+        session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=10,
+                        help="Size of the generated tree")
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        local_folder = os.path.join(tmp, u'local')
+        os.makedirs(local_folder)
+        make_folder_tree(options.size, local_folder)
+
+        ctl = Controller(os.path.join(tmp, u'config'), local_scan_workers=1)
+        try:
+            sync = ctl.synchronizer
+            sync.local_watcher_enabled = False
+            remote_client = TreeRemoteClient(local_folder)
+            sync.get_remote_fs_client = lambda server_binding: remote_client
+            sync._notify_refreshing = lambda server_binding: None
+
+            session = ctl.get_session()
+            binding = ServerBinding(local_folder,
+                                    u'http://localhost:8080/nuxeo/',
+                                    u'Administrator')
+            session.add(binding)
+            session.add(LastKnownState(
+                local_folder,
+                local_info=LocalClient(local_folder).get_info(u'/'),
+                remote_info=remote_client.get_info(u'/')))
+            session.commit()
+            sync.scan_local(binding)
+            sync.scan_remote(binding)
+            print "%d pairs" % session.query(LastKnownState).count()
+
+            # As the synchronizer session, see Synchronizer._get_pair_index
+            session.expire_on_commit = False
+            counter = StatementCounter(ctl._engine)
+            print "%-22s %12s %10s" % ("operation", "statements", "time (s)")
+            start = time.time()
+            ctl.children_states(local_folder)
+            report("status on the fly", counter, start)
+            start = time.time()
+            LastKnownState.count_descendants(session, local_folder)
+            session.commit()
+            report("count descendants", counter, start)
+            start = time.time()
+            ctl.children_states(local_folder)
+            report("status from counters", counter, start)
+
+            start = time.time()
+            update_states(session, local_folder, 'locally_modified')
+            report("updates", counter, start)
+            for row in ctl._engine.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+                    ).fetchall():
+                ctl._engine.execute('DROP TRIGGER %s' % row[0])
+            counter.count = 0
+            start = time.time()
+            update_states(session, local_folder, 'synchronized')
+            report("updates w/o triggers", counter, start)
+        finally:
+            ctl.dispose()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
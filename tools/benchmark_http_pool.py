@@ -0,0 +1,140 @@
+"""Benchmark the automation calls with and without kept alive connections
+
+Usage:
+
+    python benchmark_http_pool.py [--calls 2000] [--handshake-delay 0]
+
+A local stand-in Automation server counting the TCP connections answers
+CALLS operations executed by a BaseAutomationClient, then CALLS uploads of
+a small file through its streaming opener:
+
+- per-call: the former openers, a connection being opened for each call,
+- pooled: the openers share the kept alive connections of a
+  ConnectionPool.
+
+The server sleeps HANDSHAKE_DELAY milliseconds on each new connection to
+emulate the cost of the TCP and TLS handshakes with a remote load
+balancer. The number of connections and the mean latency per call are
+reported.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+
+from poster.streaminghttp import get_handlers
+
+from nxdrive.client.base_automation_client import BaseAutomationClient
+
+
+OPERATIONS = json.dumps({'operations': [
+    {'id': 'Document.Fetch', 'params': [
+        {'name': 'value', 'required': True}]},
+]})
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, handshake_delay):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.handshake_delay = handshake_delay
+        self.connections = 0
+        self.url = 'http://127.0.0.1:%d/nuxeo/' % self.server_address[1]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # Responses written at once, flushed after each request, as by a servlet
+    # container
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+        time.sleep(self.server.handshake_delay)
+
+    def do_GET(self):
+        self.reply(OPERATIONS)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.reply(json.dumps({'entity-type': 'document', 'uid': 'doc'}))
+
+    def reply(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def measure(server, client, calls, file_path):
+    results = []
+    for call in (lambda: client.execute('Document.Fetch', value='/doc'),
+                 lambda: client.upload('batch', file_path)):
+        connections = server.connections
+        start = time.time()
+        for _ in range(calls):
+            call()
+        results.append((server.connections - connections,
+                        (time.time() - start) * 1000.0 / calls))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--handshake-delay', type=float, default=0,
+                        help="milliseconds")
+    options = parser.parse_args()
+
+    server = StandInServer(options.handshake_delay / 1000.0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        file_path = os.path.join(tmp, 'file.txt')
+        with open(file_path, 'wb') as f:
+            f.write(b'x' * 1024)
+        print "%d calls, handshake delay %.1f ms" % (
+            options.calls, options.handshake_delay)
+        print "%-10s %-8s %12s %14s" % ("method", "call", "connections",
+                                        "ms per call")
+        for name in ("per-call", "pooled"):
+            client = BaseAutomationClient(server.url, u'Administrator',
+                                          u'device', u'1.0',
+                                          password=u'Administrator')
+            if name == "per-call":
+                # Former openers
+                client.opener = urllib2.build_opener()
+                client.streaming_opener = urllib2.build_opener(
+                    *get_handlers())
+            results = measure(server, client, options.calls, file_path)
+            for call, (connections, latency) in zip(("execute", "upload"),
+                                                    results):
+                print "%-10s %-8s %12d %14.3f" % (name, call, connections,
+                                                  latency)
+            client.connection_pool.clear()
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Benchmark the full local scan with and without concurrent folder listing
+
+Usage:
+
+    python benchmark_local_scan.py [--folder FOLDER] [--size N]
+                                   [--workers 1 2 4 8] [--latency MS]
+
+Without --folder, a tree of N^3 folders and files is generated in a temporary
+folder (see create_folders.py). --latency adds an artificial delay to each
+folder listing to emulate a network home directory or a spinning disk.
+
+For each worker count, the tree is scanned into a new database (initial scan)
+then scanned again without any change (rescan).
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from create_folders import make_folder_tree
+
+from nxdrive.client import LocalClient
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+
+
+def make_controller(config_folder, local_folder, workers):
+    ctl = Controller(config_folder, local_scan_workers=workers)
+    # Measure the scan of the whole tree at each run
+    ctl.synchronizer.local_watcher_enabled = False
+    session = ctl.get_session()
+    binding = ServerBinding(local_folder, u'http://localhost:8080/nuxeo/',
+                            u'Administrator')
+    session.add(binding)
+    session.add(LastKnownState(local_folder,
+                               local_info=LocalClient(local_folder).get_info(
+                                   u'/')))
+    session.commit()
+    return ctl, binding
+
+
+def timed_scan(ctl, binding):
+    start = time.time()
+    ctl.synchronizer.scan_local(binding)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--folder', help="Existing folder to scan")
+    parser.add_argument('--size', type=int, default=10,
+                        help="Size of the generated tree")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Delay in ms added to each folder listing")
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        if options.folder is not None:
+            local_folder = os.path.abspath(options.folder).decode('utf-8')
+        else:
+            local_folder = os.path.join(tmp, u'tree')
+            os.makedirs(local_folder)
+            make_folder_tree(options.size, local_folder)
+
+        if options.latency:
+            get_children_info = LocalClient.get_children_info
+
+            def slow_get_children_info(self, ref):
+                time.sleep(options.latency / 1000.0)
+                return get_children_info(self, ref)
+            LocalClient.get_children_info = slow_get_children_info
+
+        print "%-8s %12s %12s" % ("workers", "initial (s)", "rescan (s)")
+        for workers in options.workers:
+            config_folder = os.path.join(tmp, u'config-%d' % workers)
+            ctl, binding = make_controller(config_folder, local_folder,
+                                           workers)
+            try:
+                initial = timed_scan(ctl, binding)
+                rescan = timed_scan(ctl, binding)
+            finally:
+                ctl.dispose()
+            print "%-8d %12.3f %12.3f" % (workers, initial, rescan)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Benchmark the lookups of the synchronization handlers with the pair index
+
+Usage:
+
+    python benchmark_pair_index.py [--size N]
+
+A tree of N^3 folders and files is generated in a temporary folder (see
+create_folders.py) and scanned. For each pair, the lookups made by the
+handlers before synchronizing it are run by queries then through the
+in-memory PairIndex:
+
+- the pair of the local parent folder (local creation, local move),
+- the pair of the remote parent folder (remote creation, remote move),
+- the move candidates of the same digest for files.
+
+The status of the children of the bound folder is then computed as the GUI
+does.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchmark_scan_queries import StatementCounter
+from benchmark_scan_queries import TreeRemoteClient
+from create_folders import make_folder_tree
+
+from nxdrive.client import LocalClient
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import PairIndex
+from nxdrive.model import ServerBinding
+
+
+def query_lookups(session, pair):
+    query = session.query(LastKnownState).filter_by(
+        local_folder=pair.local_folder)
+    query.filter_by(local_path=pair.local_parent_path).first()
+    query.filter_by(remote_ref=pair.remote_parent_ref).first()
+    if not pair.folderish:
+        query.filter_by(local_digest=pair.local_digest).all()
+
+
+def index_lookups(index, pair):
+    index.get_by_local_path(pair.local_parent_path)
+    index.get_by_remote_ref(pair.remote_parent_ref)
+    if not pair.folderish:
+        index.get_by_local_digest(pair.local_digest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=10,
+                        help="Size of the generated tree")
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        local_folder = os.path.join(tmp, u'local')
+        os.makedirs(local_folder)
+        make_folder_tree(options.size, local_folder)
+
+        ctl = Controller(os.path.join(tmp, u'config'), local_scan_workers=1)
+        try:
+            sync = ctl.synchronizer
+            sync.local_watcher_enabled = False
+            remote_client = TreeRemoteClient(local_folder)
+            sync.get_remote_fs_client = lambda server_binding: remote_client
+            sync._notify_refreshing = lambda server_binding: None
+
+            session = ctl.get_session()
+            binding = ServerBinding(local_folder,
+                                    u'http://localhost:8080/nuxeo/',
+                                    u'Administrator')
+            session.add(binding)
+            session.add(LastKnownState(
+                local_folder,
+                local_info=LocalClient(local_folder).get_info(u'/'),
+                remote_info=remote_client.get_info(u'/')))
+            session.commit()
+            sync.scan_local(binding)
+            sync.scan_remote(binding)
+            pairs = session.query(LastKnownState).filter_by(
+                local_folder=local_folder).all()
+            print "%d pairs" % len(pairs)
+
+            counter = StatementCounter(ctl._engine)
+            print "%-22s %12s %10s" % ("lookups", "statements", "time (s)")
+            start = time.time()
+            for pair in pairs:
+                query_lookups(session, pair)
+            print "%-22s %12d %10.3f" % ("queries", counter.count,
+                                         time.time() - start)
+
+            counter.count = 0
+            start = time.time()
+            index = PairIndex.get(session, local_folder)
+            print "%-22s %12d %10.3f" % ("index loading", counter.count,
+                                         time.time() - start)
+            counter.count = 0
+            start = time.time()
+            for pair in pairs:
+                index_lookups(index, pair)
+            print "%-22s %12d %10.3f" % ("index", counter.count,
+                                         time.time() - start)
+
+            counter.count = 0
+            start = time.time()
+            ctl.children_states(local_folder)
+            print "%-22s %12d %10.3f" % ("children states", counter.count,
+                                         time.time() - start)
+        finally:
+            ctl.dispose()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
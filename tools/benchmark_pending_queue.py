@@ -0,0 +1,134 @@
+"""Benchmark draining the pending pairs with and without the pending queue
+
+Usage:
+
+    python benchmark_pending_queue.py [--folders 100] [--children 100]
+
+A database of FOLDERS x CHILDREN remotely created documents waiting to be
+synchronized is generated, one out of ten being a remote modification of a
+bound document instead. The pairs are then synchronized one at a time,
+emulated by updating their state in their own transaction, in the order of
+the synchronizer:
+
+- list: the former scheme querying the first 100 pending pairs before each
+  pair,
+- queue: the pairs are served by a PendingQueue reading them by batches.
+
+The number of statements and the duration are reported for both. The
+bound pairs being synchronized first among the pairs read, a batch of 100
+pairs or the sliding window of the next 100 ones, the orders differ.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchmark_scan_queries import StatementCounter
+
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import PendingQueue
+
+
+LOCAL_FOLDER = u'/home/user/Nuxeo Drive'
+
+BATCH_SIZE = 100
+
+
+def populate(ctl, n_folders, n_children):
+    table = LastKnownState.__table__
+    connection = ctl._engine.connect()
+    try:
+        for i in range(n_folders):
+            folder_path = u'/root/folder-%d' % i
+            rows = []
+            for j in range(n_children):
+                name = u'File %04d.txt' % j
+                row = dict(local_folder=LOCAL_FOLDER, local_path=None,
+                           local_parent_path=None, local_name=None,
+                           remote_ref=u'file-%d-%d' % (i, j),
+                           remote_parent_ref=u'folder-%d' % i,
+                           remote_parent_path=folder_path, remote_name=name,
+                           folderish=False, local_state='unknown',
+                           remote_state='created',
+                           pair_state='remotely_created')
+                if j % 10 == 0:
+                    row.update(local_path=u'/Folder %d/%s' % (i, name),
+                               local_parent_path=u'/Folder %d' % i,
+                               local_name=name, local_state='synchronized',
+                               remote_state='modified',
+                               pair_state='remotely_modified')
+                rows.append(row)
+            with connection.begin():
+                connection.execute(table.insert(), rows)
+    finally:
+        connection.close()
+
+
+def choose(pending):
+    # Bound pairs first, see Synchronizer.synchronize
+    for pair in pending:
+        if pair.local_path is not None and pair.remote_ref is not None:
+            return pair
+    return pending[0]
+
+
+def synchronize(session, pair):
+    pair.update_state('synchronized', 'synchronized')
+    session.commit()
+
+
+def drain_list(ctl, session):
+    while True:
+        pending = ctl.list_pending(local_folder=LOCAL_FOLDER,
+                                   limit=BATCH_SIZE, session=session)
+        if not pending:
+            return
+        synchronize(session, choose(pending))
+
+
+def drain_queue(ctl, session):
+    queue = PendingQueue(session, local_folder=LOCAL_FOLDER,
+                         batch_size=BATCH_SIZE)
+    while True:
+        pending = queue.get_pairs()
+        if not pending:
+            return
+        pair = choose(pending)
+        queue.remove(pair)
+        synchronize(session, pair)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--folders', type=int, default=100)
+    parser.add_argument('--children', type=int, default=100)
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        print "%d pending pairs" % (options.folders * options.children)
+        print "%-8s %12s %10s" % ("method", "statements", "time (s)")
+        for name, drain in (("list", drain_list), ("queue", drain_queue)):
+            ctl = Controller(os.path.join(tmp, name))
+            try:
+                populate(ctl, options.folders, options.children)
+                session = ctl.get_session()
+                # As the synchronizer session, see Synchronizer._get_pair_index
+                session.expire_on_commit = False
+                counter = StatementCounter(ctl._engine)
+                start = time.time()
+                drain(ctl, session)
+                print "%-8s %12d %10.3f" % (name, counter.count,
+                                            time.time() - start)
+            finally:
+                ctl.dispose()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Benchmark the ranged downloads against a local range capable server
+
+Usage:
+
+    python benchmark_ranged_download.py [--size 64] [--rate 20]
+                                        [--latency 20] [--chunk-sizes 0 4 10]
+                                        [--workers 1 4 8]
+
+A file of SIZE MiB is downloaded from a local server sending each response
+at RATE MiB/s after LATENCY milliseconds (see tests/test_ranged_download.py),
+in a single request and by ranges of each size requested by each number of
+workers. The download is then interrupted by the failure of the last range
+and resumed by a new client: the amount of content downloaded again is
+reported.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib2
+
+from nxdrive.client.connection_pool import ConnectionPool
+from nxdrive.client.ranged_download import RangedDownload
+from nxdrive.client.remote_file_system_client import RemoteFileSystemClient
+from nxdrive.tests.test_ranged_download import RangeServer
+
+
+MIB = 1024 ** 2
+
+
+def make_client(server, pool, chunk_size, workers):
+    client = RemoteFileSystemClient(
+        server.url, u'Administrator', u'device', u'1.0', password=u'secret',
+        proxies={}, connection_pool=pool, transfer_pool=pool,
+        download_chunk_size=chunk_size)
+    client.download_workers = workers
+    return client
+
+
+def download(client, tmp):
+    start = time.time()
+    client.stream_content('Big.bin', os.path.join(tmp, u'Big.bin'))
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=64, help="MiB")
+    parser.add_argument('--rate', type=float, default=20, help="MiB/s")
+    parser.add_argument('--latency', type=float, default=20,
+                        help="milliseconds")
+    parser.add_argument('--chunk-sizes', type=int, nargs='+',
+                        default=[0, 4, 10], help="MiB, 0 for no ranges")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    options = parser.parse_args()
+
+    server = RangeServer(latency=options.latency / 1000.0,
+                         rate=options.rate * MIB)
+    server.files['Big.bin'] = os.urandom(options.size * MIB)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    pool = ConnectionPool()
+    RangedDownload.retry_delay = 0
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        print "%d MiB file, %.1f MiB/s by connection, latency %.1f ms" % (
+            options.size, options.rate, options.latency)
+        print "%-8s %8s %12s %10s %17s" % (
+            "ranges", "workers", "download (s)", "MiB/s", "downloaded again")
+        for chunk_size in options.chunk_sizes:
+            for workers in (options.workers if chunk_size else [1]):
+                client = make_client(server, pool, chunk_size * MIB, workers)
+                duration = download(client, tmp)
+                again = '-'
+                if chunk_size:
+                    # Interrupted by the last range, then resumed
+                    last = ((options.size + chunk_size - 1) // chunk_size
+                            - 1) * chunk_size * MIB
+                    server.failures[last] = RangedDownload.max_chunk_attempts
+                    os.remove(os.path.join(tmp, u'.Big.bin.part'))
+                    try:
+                        download(client, tmp)
+                    except urllib2.HTTPError:
+                        pass
+                    del server.requests[:]
+                    download(make_client(server, pool, chunk_size * MIB,
+                                         workers), tmp)
+                    again = '%d MiB' % min(options.size,
+                                           len(server.requests) * chunk_size)
+                print "%-8s %8d %12.2f %10.1f %17s" % (
+                    '%d MiB' % chunk_size if chunk_size else 'none', workers,
+                    duration, options.size / duration, again)
+    finally:
+        pool.clear()
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
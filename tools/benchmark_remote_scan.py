@@ -0,0 +1,103 @@
+"""Benchmark the remote scan with concurrent listing of the folders
+
+Usage:
+
+    python benchmark_remote_scan.py [--size 10] [--latency 20]
+                                    [--workers 1 4 8]
+
+A tree of SIZE^3 folders and files is generated in a temporary folder (see
+create_folders.py) and served by an in-memory remote client mirroring it,
+each GetChildren call waiting LATENCY milliseconds as a round trip to the
+server. The initial remote scan, creating the pairs, then a rescan are run
+with each number of remote scan workers, 1 listing the folders from the
+synchronization thread only, in a new database each time.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchmark_scan_queries import TreeRemoteClient
+from create_folders import make_folder_tree
+
+from nxdrive.client import LocalClient
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+
+
+class SlowRemoteClient(TreeRemoteClient):
+
+    def __init__(self, base_folder, latency):
+        TreeRemoteClient.__init__(self, base_folder)
+        self.latency = latency
+        self.calls = 0
+
+    def get_children_info(self, uid):
+        time.sleep(self.latency)
+        self.calls += 1
+        return TreeRemoteClient.get_children_info(self, uid)
+
+
+def scan(config_folder, local_folder, latency, workers):
+    ctl = Controller(config_folder, remote_scan_workers=workers)
+    try:
+        sync = ctl.synchronizer
+        remote_client = SlowRemoteClient(local_folder, latency)
+        sync.get_remote_fs_client = lambda server_binding: remote_client
+        sync._notify_refreshing = lambda server_binding: None
+
+        session = ctl.get_session()
+        binding = ServerBinding(local_folder, u'http://localhost:8080/nuxeo/',
+                                u'Administrator')
+        session.add(binding)
+        session.add(LastKnownState(
+            local_folder, local_info=LocalClient(local_folder).get_info(u'/'),
+            remote_info=remote_client.get_info(u'/')))
+        session.commit()
+
+        durations = []
+        for _ in range(2):
+            start = time.time()
+            sync.scan_remote(binding)
+            durations.append(time.time() - start)
+        return (remote_client.calls / 2, session.query(LastKnownState).count(),
+                durations)
+    finally:
+        ctl.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=10,
+                        help="Size of the generated tree")
+    parser.add_argument('--latency', type=float, default=20,
+                        help="milliseconds")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        local_folder = os.path.join(tmp, u'local')
+        os.makedirs(local_folder)
+        make_folder_tree(options.size, local_folder)
+
+        print "latency %.1f ms" % options.latency
+        print "%-8s %8s %8s %12s %12s" % ("workers", "folders", "pairs",
+                                          "initial (s)", "rescan (s)")
+        for workers in options.workers:
+            config_folder = os.path.join(tmp, u'config-%d' % workers)
+            folders, pairs, durations = scan(config_folder, local_folder,
+                                             options.latency / 1000.0,
+                                             workers)
+            print "%-8d %8d %8d %12.2f %12.2f" % ((workers, folders, pairs)
+                                                  + tuple(durations))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Count the SQL statements issued by the local and remote scans
+
+Usage:
+
+    python benchmark_scan_queries.py [--size N] [--remote-first]
+
+A tree of N^3 folders and files is generated in a temporary folder (see
+create_folders.py) and served by an in-memory remote client mirroring it, so
+that no Nuxeo server is needed. The following scans are measured:
+
+- initial local scan: creation of the local pairs,
+- initial remote scan: alignment of the remote documents with the local
+  pairs by name and digest,
+- local and remote rescans without any change.
+
+With --remote-first, the remote scan creates the pairs and the local scan
+aligns the local files with them. The peak resident memory of the process is
+reported after each scan.
+"""
+import argparse
+import hashlib
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from create_folders import make_folder_tree
+
+from nxdrive.client import LocalClient
+from nxdrive.client import NotFound
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+
+
+class TreeRemoteClient(object):
+    """Read only remote client exposing a local folder as remote documents
+
+    The remote id of a document is its path relative to the folder.
+    """
+
+    def __init__(self, base_folder):
+        self.base_folder = base_folder
+        self._mtime = datetime(2014, 1, 1)
+
+    def get_info(self, uid, raise_if_missing=True):
+        os_path = os.path.join(self.base_folder, uid[1:])
+        if not os.path.exists(os_path):
+            if raise_if_missing:
+                raise NotFound(uid)
+            return None
+        folderish = os.path.isdir(os_path)
+        digest = None
+        if not folderish:
+            with open(os_path, 'rb') as f:
+                digest = hashlib.md5(f.read()).hexdigest()
+        parent_uid = None
+        if uid != u'/':
+            parent_uid = uid.rsplit(u'/', 1)[0] or u'/'
+        name = os.path.basename(uid) or u'Nuxeo Drive'
+        return RemoteFileInfo(name, uid, parent_uid, uid, folderish,
+                              self._mtime, digest, 'md5', None,
+                              True, True, True, folderish)
+
+    def get_children_info(self, uid):
+        os_path = os.path.join(self.base_folder, uid[1:])
+        prefix = uid if uid.endswith(u'/') else uid + u'/'
+        return [self.get_info(prefix + name)
+                for name in sorted(os.listdir(os_path))]
+
+
+class StatementCounter(object):
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=6,
+                        help="Size of the generated tree")
+    parser.add_argument('--remote-first', action='store_true',
+                        help="Run the initial remote scan first")
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        local_folder = os.path.join(tmp, u'local')
+        os.makedirs(local_folder)
+        make_folder_tree(options.size, local_folder)
+        n_items = sum(len(dirs) + len(files)
+                      for _, dirs, files in os.walk(local_folder))
+
+        ctl = Controller(os.path.join(tmp, u'config'), local_scan_workers=1)
+        try:
+            sync = ctl.synchronizer
+            sync.local_watcher_enabled = False
+            remote_client = TreeRemoteClient(local_folder)
+            sync.get_remote_fs_client = lambda server_binding: remote_client
+            sync._notify_refreshing = lambda server_binding: None
+
+            session = ctl.get_session()
+            binding = ServerBinding(local_folder,
+                                    u'http://localhost:8080/nuxeo/',
+                                    u'Administrator')
+            session.add(binding)
+            session.add(LastKnownState(
+                local_folder,
+                local_info=LocalClient(local_folder).get_info(u'/'),
+                remote_info=remote_client.get_info(u'/')))
+            session.commit()
+
+            counter = StatementCounter(ctl._engine)
+            print "%d documents" % n_items
+            print "%-22s %12s %12s %10s %10s" % (
+                "scan", "statements", "per item", "time (s)", "peak (MB)")
+            initial_scans = [("initial local scan", sync.scan_local),
+                             ("initial remote scan", sync.scan_remote)]
+            if options.remote_first:
+                initial_scans.reverse()
+            for name, scan in initial_scans + [
+                ("local rescan", sync.scan_local),
+                ("remote rescan", sync.scan_remote),
+            ]:
+                counter.count = 0
+                start = time.time()
+                scan(binding)
+                elapsed = time.time() - start
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                print "%-22s %12d %12.2f %10.3f %10.1f" % (
+                    name, counter.count, float(counter.count) / n_items,
+                    elapsed, peak / 1024.0)
+            # Each remote document is aligned with its local file
+            print "%d pairs" % session.query(LastKnownState).count()
+        finally:
+            ctl.dispose()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
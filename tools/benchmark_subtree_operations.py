@@ -0,0 +1,138 @@
+"""Benchmark the operations on the pairs of a whole subtree
+
+Usage:
+
+    python benchmark_subtree_operations.py [--files 100000]
+
+A binding of FILES synchronized documents spread in sub folders of 100
+documents is generated, the remote documents being bound to local files
+one out of two times. Each operation is run in its own database:
+
+- mark: the folder is locally deleted, see
+  Synchronizer._mark_deleted_local_recursive,
+- unbind: the server binding is deleted with its pairs, see
+  Controller.unbind_server,
+
+by the former scheme loading the pairs in the session (recursive) and by
+set-based statements. The number of statements and the duration are
+reported.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchmark_scan_queries import StatementCounter
+
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+
+
+LOCAL_FOLDER = u'/home/user/Nuxeo Drive'
+
+
+def populate(ctl, n_files):
+    session = ctl.get_session()
+    session.add(ServerBinding(LOCAL_FOLDER, u'http://localhost:8080/nuxeo/',
+                              u'Administrator'))
+    session.commit()
+    table = LastKnownState.__table__
+    connection = ctl._engine.connect()
+
+    def row(local_path, local_parent_path, name, remote_ref,
+            remote_parent_ref, folderish):
+        return dict(local_folder=LOCAL_FOLDER, local_path=local_path,
+                    local_parent_path=local_parent_path, local_name=name,
+                    remote_ref=remote_ref, remote_parent_ref=remote_parent_ref,
+                    remote_name=name, folderish=folderish,
+                    local_state='synchronized', remote_state='synchronized',
+                    pair_state='synchronized')
+
+    try:
+        with connection.begin():
+            connection.execute(table.insert(), [
+                row(u'/', None, u'Nuxeo Drive', u'root', None, True),
+                row(u'/Project', u'/', u'Project', u'project', u'root', True),
+            ])
+        for i in range(0, n_files, 100):
+            folder_path = u'/Project/Folder %d' % (i / 100)
+            folder_ref = u'folder-%d' % (i / 100)
+            rows = [row(folder_path, u'/Project', u'Folder %d' % (i / 100),
+                        folder_ref, u'project', True)]
+            for j in range(i, min(i + 100, n_files)):
+                name = u'File %d.txt' % j
+                rows.append(row(folder_path + u'/' + name, folder_path, name,
+                                u'file-%d' % j if j % 2 else None,
+                                folder_ref if j % 2 else None, False))
+            with connection.begin():
+                connection.execute(table.insert(), rows)
+    finally:
+        connection.close()
+    return session
+
+
+def mark_recursive(session, doc_pair):
+    # Former Synchronizer._mark_deleted_local_recursive
+    for child in session.query(LastKnownState).filter_by(
+            local_folder=doc_pair.local_folder,
+            local_parent_path=doc_pair.local_path).all():
+        mark_recursive(session, child)
+    if doc_pair.remote_ref is None:
+        session.delete(doc_pair)
+    else:
+        doc_pair.update_local(None)
+
+
+def mark_set_based(session, doc_pair):
+    LastKnownState.mark_locally_deleted(session, doc_pair)
+
+
+def unbind_recursive(session, binding):
+    # Former Controller.unbind_server, the pairs are deleted on cascade
+    session.delete(binding)
+
+
+def unbind_set_based(session, binding):
+    binding.delete(session)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100000)
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        print "%d files" % options.files
+        print "%-7s %-10s %12s %10s" % (
+            "op", "method", "statements", "time (s)")
+        for op, run in (("mark", mark_recursive), ("mark", mark_set_based),
+                        ("unbind", unbind_recursive),
+                        ("unbind", unbind_set_based)):
+            method = run.__name__.split('_', 1)[1].replace('_', '-')
+            ctl = Controller(os.path.join(tmp, op + '-' + method))
+            try:
+                session = populate(ctl, options.files)
+                if op == "mark":
+                    target = session.query(LastKnownState).filter_by(
+                        local_path=u'/Project').one()
+                else:
+                    target = session.query(ServerBinding).one()
+                counter = StatementCounter(ctl._engine)
+                start = time.time()
+                run(session, target)
+                session.commit()
+                print "%-7s %-10s %12d %10.3f" % (
+                    op, method, counter.count, time.time() - start)
+            finally:
+                ctl.dispose()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Benchmark the synchronization of downloads with concurrent transfers
+
+Usage:
+
+    python benchmark_transfers.py [--files 200] [--latency 20] [--big 5]
+                                  [--workers 0 1 4 8]
+
+A remote tree of FILES small files in 10 folders, plus a big file sorted
+first, is served by an in-memory remote client (see
+benchmark_scan_queries.py). Each download waits LATENCY milliseconds as a
+round trip to the server, the big one BIG seconds. The initial
+synchronization of the tree is run with each number of transfer workers, 0
+transferring the files from the synchronization thread, in a new database
+each time. The duration of the synchronization and the time at which the
+last small file was downloaded are reported.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchmark_scan_queries import TreeRemoteClient
+
+from nxdrive.client import LocalClient
+from nxdrive.client.remote_file_system_client import get_download_tmp_path
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+
+
+class SlowRemoteClient(TreeRemoteClient):
+
+    def __init__(self, base_folder, latency, big_latency):
+        TreeRemoteClient.__init__(self, base_folder)
+        self.latency = latency
+        self.big_latency = big_latency
+        self.last_small_download = None
+
+    def get_info(self, uid, raise_if_missing=True):
+        info = TreeRemoteClient.get_info(self, uid, raise_if_missing)
+        if info is None:
+            return None
+        # Path made of the ids of the ancestors as the server does: the
+        # pairs are synchronized in the order of their parent paths
+        return info._replace(path=self._get_path(uid))
+
+    def _get_path(self, uid):
+        if uid == u'/':
+            return u'/' + uid
+        return self._get_path(uid.rsplit(u'/', 1)[0] or u'/') + u'/' + uid
+
+    def stream_content(self, uid, file_path):
+        big = uid == u'/Big.bin'
+        time.sleep(self.big_latency if big else self.latency)
+        tmp_file = get_download_tmp_path(file_path)
+        shutil.copy(os.path.join(self.base_folder, uid[1:]), tmp_file)
+        if not big:
+            self.last_small_download = time.time()
+        return tmp_file
+
+
+def make_remote_tree(base_folder, files):
+    with open(os.path.join(base_folder, u'Big.bin'), 'wb') as f:
+        f.write(b'x' * 1024 * 1024)
+    for i in range(files):
+        folder = os.path.join(base_folder, u'Folder %02d' % (i % 10))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, u'File %04d.txt' % i), 'wb') as f:
+            f.write(b'content %d' % i)
+
+
+def synchronize(tmp, remote_folder, options, workers):
+    local_folder = os.path.join(tmp, u'local-%d' % workers)
+    os.makedirs(local_folder)
+    ctl = Controller(os.path.join(tmp, u'config-%d' % workers),
+                     transfer_workers=workers)
+    try:
+        sync = ctl.synchronizer
+        remote_client = SlowRemoteClient(remote_folder,
+                                         options.latency / 1000.0, options.big)
+        sync.get_remote_fs_client = lambda server_binding: remote_client
+        sync._notify_refreshing = lambda server_binding: None
+
+        session = ctl.get_session()
+        binding = ServerBinding(local_folder, u'http://localhost:8080/nuxeo/',
+                                u'Administrator')
+        session.add(binding)
+        session.add(LastKnownState(
+            local_folder, local_info=LocalClient(local_folder).get_info(u'/'),
+            remote_info=remote_client.get_info(u'/')))
+        session.commit()
+        sync.scan_remote(binding)
+
+        start = time.time()
+        synchronized = sync.synchronize(binding)
+        duration = time.time() - start
+        return (synchronized, duration,
+                remote_client.last_small_download - start,
+                ctl.transfer_service.workers)
+    finally:
+        ctl.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=20,
+                        help="milliseconds")
+    parser.add_argument('--big', type=float, default=5, help="seconds")
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[0, 1, 4, 8])
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(u'-nxdrive-benchmark')
+    try:
+        remote_folder = os.path.join(tmp, u'remote')
+        os.makedirs(remote_folder)
+        make_remote_tree(remote_folder, options.files)
+
+        print "%d files, latency %.1f ms, big file %.1f s" % (
+            options.files, options.latency, options.big)
+        print "%-8s %8s %10s %16s %14s" % ("workers", "pairs", "sync (s)",
+                                           "small files (s)", "tuned to")
+        for workers in options.workers:
+            print "%-8d %8d %10.2f %16.2f %14d" % (
+                (workers,) + synchronize(tmp, remote_folder, options, workers))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()